@@ -73,6 +73,22 @@ class AuthorizeNetRequestHelpers(object):
 
         return _merchantAuth
 
+    def _controller(self, controller_class, request):
+        """ Create an Authorize.net API controller for a request, pointed
+        at the processor's environment (see AUTHORIZENET_SIMULATOR_URL).
+
+        :param controller_class: An authorizenet.apicontrollers class.
+        :param request: The apicontractsv1 request.
+        :returns controller_class instance:
+        """
+
+        controller = controller_class(request)
+
+        if self.environment:
+            controller.setenvironment(self.environment)
+
+        return controller
+
     def _create_credit_card(self, customer):
         """ Create a Credit Card element that can be applied to an
         Authorize.net Transaction Request.
@@ -159,7 +175,7 @@ class AuthorizeNetRequests(AuthorizeNetRequestHelpers):
             customer.email
         )
 
-        controller = createCustomerProfileController(createCustomerProfile)
+        controller = self._controller(createCustomerProfileController, createCustomerProfile)
 
         try:
             controller.execute()
@@ -221,7 +237,7 @@ class AuthorizeNetRequests(AuthorizeNetRequestHelpers):
         createCustomerPaymentProfile.paymentProfile         = profile
         createCustomerPaymentProfile.customerProfileId      = str(customer_profile_id)
 
-        controller = createCustomerPaymentProfileController(createCustomerPaymentProfile)
+        controller = self._controller(createCustomerPaymentProfileController, createCustomerPaymentProfile)
 
         try:
             controller.execute()
@@ -292,21 +308,21 @@ class AuthorizeNetRequests(AuthorizeNetRequestHelpers):
                 fail_code = self._get_silver_fail_code(resp)
                 fail_reason, status_ok = self._get_authorizenet_transaction_status(resp)
                 transaction.fail(fail_code=fail_code, fail_reason=fail_reason)
-                transaction.save()
+                transaction.save_state()
                 return False
 
         elif status == self.void_statuses:
             target_state = transaction.States.Canceled
             if transaction.state != target_state:
                 transaction.cancel()
-                transaction.save()
+                transaction.save_state()
                 return False
 
         elif status in self.settled_statuses:
             target_state = transaction.States.Settled
             if transaction.state != target_state:
                 transaction.settle()
-                transaction.save()
+                transaction.save_state()
                 return True
         else:
             return True
@@ -416,7 +432,7 @@ class AuthorizeNetRequests(AuthorizeNetRequestHelpers):
             'authorizenet_id': str(auth_id),
         })
         try:
-            transaction.save()
+            transaction.save_state()
         except Exception as e:
             logger.warning("Could not save transaction data %s", transaction.data)
             raise e
@@ -681,7 +697,7 @@ class AuthorizeNetRequests(AuthorizeNetRequestHelpers):
         if payment_method.canceled:
             try:
                 transaction.fail(fail_reason='Payment method was canceled.')
-                transaction.save()
+                transaction.save_state()
             finally:
                 return False
 
@@ -711,10 +727,7 @@ class AuthorizeNetRequests(AuthorizeNetRequestHelpers):
             t_reqs = self._create_transaction_request(transaction)
 
         # Create the transaction controller
-        transaction_controller = createTransactionController(t_reqs)
-
-        # Set the environment
-        transaction_controller.setenvironment(self.environment)
+        transaction_controller = self._controller(createTransactionController, t_reqs)
 
         # Execute the transaction request
         try:
@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand
+
+from silver_authorizenet.simulator import AuthorizeNetSimulator
+
+
+def code_list(codes):
+    return [code.strip() for code in codes.split(',') if code.strip()]
+
+
+class Command(BaseCommand):
+    help = ('Runs a local Authorize.net API simulator. Point the processors at it through '
+            'the AUTHORIZENET_SIMULATOR_URL setting.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', action='store', dest='host', default='127.0.0.1')
+        parser.add_argument('--port', action='store', dest='port', type=int, default=8765)
+        parser.add_argument('--latency', action='store', dest='latency', type=float, default=0,
+                            help='The seconds every request takes, at least.')
+        parser.add_argument('--latency-jitter', action='store', dest='latency_jitter',
+                            type=float, default=0,
+                            help='The seconds randomly added to the latency, at most.')
+        parser.add_argument('--error-rate', action='store', dest='error_rate', type=float,
+                            default=0,
+                            help='The fraction of requests answered with an API error.')
+        parser.add_argument('--decline-rate', action='store', dest='decline_rate', type=float,
+                            default=0, help='The fraction of charges declined.')
+        parser.add_argument('--decline-codes', action='store', dest='decline_codes',
+                            type=code_list, default=['2'],
+                            help='The comma separated response reason codes of the declined '
+                                 'charges.')
+        parser.add_argument('--settle-after', action='store', dest='settle_after', type=float,
+                            default=None,
+                            help='The seconds after which the captured transactions are '
+                                 'settled. By default, they are never settled.')
+        parser.add_argument('--seed', action='store', dest='seed', type=int, default=None)
+
+    def handle(self, *args, **options):
+        simulator = AuthorizeNetSimulator(host=options['host'],
+                                          port=options['port'],
+                                          latency=options['latency'],
+                                          latency_jitter=options['latency_jitter'],
+                                          error_rate=options['error_rate'],
+                                          decline_rate=options['decline_rate'],
+                                          decline_codes=options['decline_codes'],
+                                          settle_after=options['settle_after'],
+                                          seed=options['seed']).start()
+
+        self.stdout.write('Serving the Authorize.net simulator on %s' % simulator.url)
+        self.stdout.write('Set AUTHORIZENET_SIMULATOR_URL = %r' % simulator.url)
+
+        try:
+            simulator.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -25,6 +25,7 @@ from authorizenet.apicontrollers import (createTransactionController,
                                          createCustomerPaymentProfileController)
 
 from .authorize_net_requests import *
+from .reconciliation import AuthorizeNetReconciler
 
 logger = logging.getLogger(__name__)
 
@@ -50,6 +51,11 @@ class AuthorizeNetTriggeredBase(AuthorizeNetRequests,
         #     return
 
         self.environment = kwargs.pop('environment', None)
+
+        # Point the processor at a local gateway simulator (see silver_authorizenet.simulator)
+        simulator_url = getattr(settings, 'AUTHORIZENET_SIMULATOR_URL', None)
+        if simulator_url:
+            self.environment = simulator_url
         AuthorizeNetTriggeredBase._has_been_setup = True
 
     @property
@@ -101,7 +107,7 @@ class AuthorizeNetTriggeredBase(AuthorizeNetRequests,
         getCustomerPaymentProfile.customerProfileId        = customer_profile_id
         getCustomerPaymentProfile.customerPaymentProfileId = customer_payment_profile_id
 
-        controller = getCustomerPaymentProfileController(getCustomerPaymentProfile)
+        controller = self._controller(getCustomerPaymentProfileController, getCustomerPaymentProfile)
         controller.execute()
 
         response = controller.getresponse()
@@ -152,7 +158,7 @@ class AuthorizeNetTriggeredBase(AuthorizeNetRequests,
         create_req.refId                  = self.merchantId
         create_req.transactionRequest     = tr_req
 
-        controller = createTransactionController(create_req)
+        controller = self._controller(createTransactionController, create_req)
 
         try:
             controller.execute()
@@ -215,7 +221,7 @@ class AuthorizeNetTriggeredBase(AuthorizeNetRequests,
 
         t_req.transactionRequest = req
 
-        controller = createTransactionController(t_req)
+        controller = self._controller(createTransactionController, t_req)
 
         try:
             controller.execute()
@@ -309,7 +315,7 @@ class AuthorizeNetTriggeredBase(AuthorizeNetRequests,
 
         status = transaction.data.get('status')
 
-        transaction_controller = getTransactionDetailsController(req)
+        transaction_controller = self._controller(getTransactionDetailsController, req)
 
         try:
             transaction_controller.execute()
@@ -338,10 +344,30 @@ class AuthorizeNetTriggeredBase(AuthorizeNetRequests,
         transaction.data.update({
             'status': status,
         })
-        transaction.save()
+        transaction.save_state()
 
         return self._transition_silver_transaction_state(transaction, response, status)
 
+    bulk_fetch_transactions_status = True
+
+    def fetch_transactions_status(self, transactions):
+        """
+        Reconcile many pending transactions at once, against the
+        Authorize.net unsettled and settled transaction lists, instead of
+        fetching the details of every transaction. Only the details of the
+        transactions missing from the lists are fetched.
+
+        :param transactions: Silver transactions with a AuthorizeNet payment method, in Pending state.
+        :return: The number of transactions whose state changed.
+        """
+
+        transactions = [transaction for transaction in transactions
+                        if transaction.payment_processor == self.name]
+
+        result = AuthorizeNetReconciler(self).reconcile(transactions)
+
+        return result['settled'] + result['failed'] + result['canceled']
+
 class AuthorizeNetTriggered(AuthorizeNetTriggeredBase):
     def is_payment_method_recurring(self, payment_method):
         return False
@@ -0,0 +1,311 @@
+import logging
+from datetime import datetime, timedelta
+
+from django_fsm import TransitionNotAllowed
+
+from django.conf import settings
+from django.db import transaction as db_transaction
+
+from silver.models import Transaction
+
+from authorizenet import apicontractsv1
+from authorizenet.apicontrollers import (getSettledBatchListController,
+                                         getTransactionListController,
+                                         getUnsettledTransactionListController)
+
+logger = logging.getLogger(__name__)
+
+
+# How far back the settled batches are listed. Authorize.net allows up to 31 days per request.
+AUTHORIZENET_RECONCILIATION_DAYS = getattr(settings, 'AUTHORIZENET_RECONCILIATION_DAYS', 31)
+# The number of silver transactions transitioned per database transaction
+AUTHORIZENET_RECONCILIATION_BATCH_SIZE = getattr(settings,
+                                                 'AUTHORIZENET_RECONCILIATION_BATCH_SIZE', 100)
+
+# The maximum page size of the transaction list requests
+PAGE_LIMIT = 1000
+
+# NOTES: for more information on the transaction statuses:
+#   https://developer.authorize.net/api/reference/index.html#transaction-reporting
+SETTLED_STATUSES = [
+    'settledSuccessfully',
+]
+
+FAILED_STATUSES = [
+    'declined',
+    'expired',
+    'failedReview',
+    'generalError',
+    'settlementError',
+    'communicationError',
+    'returnedItem',
+]
+
+VOIDED_STATUSES = [
+    'voided',
+]
+
+
+class AuthorizeNetReconciler(object):
+    """ Reconciles the pending silver transactions of an Authorize.net
+    payment processor with the transaction lists of the gateway.
+
+    Instead of a `getTransactionDetails` request per pending transaction,
+    the unsettled transactions and the transactions of the recently
+    settled batches are listed, page by page, and matched to the silver
+    transactions by their `external_reference`. The gateway requests
+    made depend on the number of batches and pages, not on the number of
+    pending transactions. The transactions missing from the lists still
+    get their details fetched, one by one.
+
+    The controllers are class attributes, so they can be replaced by ones
+    talking to a stub of the gateway API.
+    """
+
+    settled_batch_list_controller = getSettledBatchListController
+    transaction_list_controller   = getTransactionListController
+    unsettled_list_controller     = getUnsettledTransactionListController
+
+    def __init__(self, payment_processor, days=None, batch_size=None):
+        self.payment_processor = payment_processor
+        self.days              = days or AUTHORIZENET_RECONCILIATION_DAYS
+        self.batch_size        = batch_size or AUTHORIZENET_RECONCILIATION_BATCH_SIZE
+        self.api_calls         = 0
+
+    def _execute(self, controller_class, request):
+        controller = self.payment_processor._controller(controller_class, request)
+
+        self.api_calls += 1
+        controller.execute()
+
+        response = controller.getresponse()
+
+        if response is None or response.messages.resultCode != apicontractsv1.messageTypeEnum.Ok:
+            message = None
+            if response is not None:
+                message = response.messages.message[0]['text'].text
+
+            raise Exception('Authorize.net request failed: %s' % message)
+
+        return response
+
+    def _paging(self, page):
+        paging        = apicontractsv1.Paging()
+        paging.limit  = PAGE_LIMIT
+        paging.offset = page
+
+        return paging
+
+    def _sorting(self):
+        sorting                 = apicontractsv1.TransactionListSorting()
+        sorting.orderBy         = apicontractsv1.TransactionListOrderFieldEnum.id
+        sorting.orderDescending = False
+
+        return sorting
+
+    def _list_pages(self, controller_class, build_request):
+        """ Yields the transaction summaries of a paged transaction list. """
+
+        page = 1
+        while True:
+            request          = build_request()
+            request.merchantAuthentication = self.payment_processor.merchantAuth
+            request.sorting  = self._sorting()
+            request.paging   = self._paging(page)
+
+            response = self._execute(controller_class, request)
+
+            transactions = getattr(response, 'transactions', None)
+            summaries = list(getattr(transactions, 'transaction', []))
+
+            for summary in summaries:
+                yield summary
+
+            total = getattr(response, 'totalNumInResultSet', None)
+            if len(summaries) < PAGE_LIMIT or (total is not None and
+                                               page * PAGE_LIMIT >= int(total)):
+                return
+
+            page += 1
+
+    def unsettled_transactions(self):
+        return self._list_pages(self.unsettled_list_controller,
+                                apicontractsv1.getUnsettledTransactionListRequest)
+
+    def settled_batch_ids(self, now=None):
+        now = now or datetime.utcnow()
+
+        request = apicontractsv1.getSettledBatchListRequest()
+        request.merchantAuthentication = self.payment_processor.merchantAuth
+        request.includeStatistics      = False
+        request.firstSettlementDate    = now - timedelta(days=self.days)
+        request.lastSettlementDate     = now
+
+        response = self._execute(self.settled_batch_list_controller, request)
+
+        batch_list = getattr(response, 'batchList', None)
+
+        return [str(batch.batchId) for batch in getattr(batch_list, 'batch', [])]
+
+    def settled_transactions(self, batch_id):
+        def build_request():
+            request         = apicontractsv1.getTransactionListRequest()
+            request.batchId = batch_id
+
+            return request
+
+        return self._list_pages(self.transaction_list_controller, build_request)
+
+    def build_status_index(self, external_references):
+        """ :param external_references: The Authorize.net transaction ids
+                                        to look for.
+            :return: A dict of the found transaction ids and their
+                     Authorize.net transaction status.
+        """
+
+        index = {}
+        external_references = set(external_references)
+
+        def add(summaries):
+            for summary in summaries:
+                trans_id = str(summary.transId)
+                if trans_id in external_references:
+                    index[trans_id] = str(summary.transactionStatus)
+
+        add(self.unsettled_transactions())
+        if len(index) == len(external_references):
+            return index
+
+        # The most recent batches are the likeliest to hold the pending transactions
+        for batch_id in reversed(self.settled_batch_ids()):
+            if len(index) == len(external_references):
+                break
+
+            add(self.settled_transactions(batch_id))
+
+        return index
+
+    def _transition(self, transaction, status):
+        """ :return: The name of the applied transition, or None. """
+
+        if status in SETTLED_STATUSES:
+            transaction.settle()
+            return 'settled'
+
+        if status in FAILED_STATUSES:
+            transaction.fail(fail_code='transaction_declined'
+                             if status == 'declined' else 'default',
+                             fail_reason='Authorize.net status: %s' % status)
+            return 'failed'
+
+        if status in VOIDED_STATUSES:
+            transaction.cancel(cancel_reason='Authorize.net status: %s' % status)
+            return 'canceled'
+
+        return None
+
+    def _apply(self, transactions, index, result):
+        outcomes = []
+
+        with db_transaction.atomic():
+            for transaction in transactions:
+                status = index[transaction.external_reference]
+
+                try:
+                    outcome = self._transition(transaction, status)
+                except TransitionNotAllowed:
+                    logger.warning('Couldn\'t reconcile transaction %s', {
+                        'transaction_id': transaction.pk,
+                        'status': status,
+                    })
+                    continue
+
+                transaction.data = transaction.data or {}
+                if not outcome and transaction.data.get('authorizenet_status') == status:
+                    continue
+
+                transaction.data.update({
+                    'authorizenet_status': status,
+                })
+                transaction.save_state()
+
+                if outcome:
+                    outcomes.append(outcome)
+
+        # Only once the transitions are committed
+        for outcome in outcomes:
+            result[outcome] += 1
+
+    def _fetch(self, transactions, result):
+        """ Fetches the details of the transactions missing from the
+        listed transactions, one by one, like the payment processor does
+        without reconciliation: they might be older than the listed
+        batches, or their reference might be unknown.
+        """
+
+        outcomes = {
+            Transaction.States.Settled:  'settled',
+            Transaction.States.Failed:   'failed',
+            Transaction.States.Canceled: 'canceled',
+        }
+
+        for transaction in transactions:
+            result['fetched'] += 1
+
+            try:
+                self.payment_processor.fetch_transaction_status(transaction)
+            except Exception:
+                logger.exception('Couldn\'t fetch the status of transaction %s', {
+                    'transaction_id': transaction.pk,
+                })
+                continue
+
+            outcome = outcomes.get(transaction.state)
+            if outcome:
+                result[outcome] += 1
+
+    def reconcile(self, transactions):
+        """ :param transactions: The pending silver transactions of the
+                                 payment processor.
+            :return: A dict of reconciliation counts.
+        """
+
+        transactions = [
+            transaction for transaction in transactions
+            if transaction.state == Transaction.States.Pending
+        ]
+
+        result = {
+            'transactions': len(transactions),
+            'matched':      0,
+            'settled':      0,
+            'failed':       0,
+            'canceled':     0,
+            'fetched':      0,
+            'api_calls':    0,
+        }
+
+        referenced = [transaction for transaction in transactions
+                      if transaction.external_reference]
+
+        index = {}
+        if referenced:
+            index = self.build_status_index(
+                transaction.external_reference for transaction in referenced
+            )
+
+        matched = [transaction for transaction in referenced
+                   if transaction.external_reference in index]
+        result['matched'] = len(matched)
+
+        for start in range(0, len(matched), self.batch_size):
+            self._apply(matched[start:start + self.batch_size], index, result)
+
+        self._fetch([transaction for transaction in transactions
+                     if transaction.external_reference not in index], result)
+
+        result['api_calls'] = self.api_calls + result['fetched']
+
+        logger.info('Reconciled Authorize.net transactions %s', result)
+
+        return result
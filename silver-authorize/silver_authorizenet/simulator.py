@@ -0,0 +1,618 @@
+""" A local stand-in for the Authorize.net API, for load and latency
+testing the payment path without the sandbox.
+
+It speaks the subset of the XML (and JSON) API used by silver_authorizenet:
+creating, refunding and voiding transactions, the transaction details and
+lists, the settled batches list and the customer (payment) profiles. The
+latency, the rate of API errors and the rate and codes of the declined
+transactions can be configured.
+
+Start it with the `run_authorizenet_simulator` command, or in process:
+
+    simulator = AuthorizeNetSimulator(latency=0.2, decline_rate=0.1).start()
+    ...
+    simulator.stop()
+
+and point the processors at it through the AUTHORIZENET_SIMULATOR_URL
+setting (`simulator.url`).
+"""
+
+import json
+import logging
+import random
+import string
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from decimal import Decimal
+from xml.etree import ElementTree
+
+import six
+from six.moves import BaseHTTPServer, socketserver
+
+logger = logging.getLogger(__name__)
+
+
+XML_NAMESPACE = 'AnetApi/xml/v1/schema/AnetApiSchema.xsd'
+
+# The SDK strips the first 3 characters (a BOM) of every response
+BOM = b'\xef\xbb\xbf'
+
+# https://developer.authorize.net/api/reference/responseCodes.html
+DECLINE_REASONS = {
+    '2':  'This transaction has been declined.',
+    '3':  'This transaction has been declined.',
+    '4':  'This transaction has been declined.',
+    '27': 'The transaction has been declined because of an AVS mismatch.',
+    '44': 'This transaction has been declined.',
+    '65': 'This transaction has been declined.',
+}
+
+UNSETTLED_STATUSES = [
+    'authorizedPendingCapture',
+    'capturedPendingSettlement',
+    'refundPendingSettlement',
+]
+
+# Which children are repeated, per parent, in the JSON responses
+JSON_ARRAYS = {
+    'messages':     'message',
+    'errors':       'error',
+    'transactions': 'transaction',
+    'batchList':    'batch',
+}
+
+
+def _local_name(tag):
+    return tag.split('}', 1)[-1]
+
+
+def _element_to_dict(element):
+    children = list(element)
+    if not children:
+        return element.text
+
+    return dict((_local_name(child.tag), _element_to_dict(child)) for child in children)
+
+
+def _fill_element(element, value):
+    if isinstance(value, list):
+        for tag, child_value in value:
+            _fill_element(ElementTree.SubElement(element, tag), child_value)
+    elif value is not None:
+        element.text = six.text_type(value)
+
+
+def render_xml(response_type, fields):
+    root = ElementTree.Element(response_type, {
+        'xmlns:xsi': 'http://www.w3.org/2001/XMLSchema-instance',
+        'xmlns:xsd': 'http://www.w3.org/2001/XMLSchema',
+        'xmlns':     XML_NAMESPACE,
+    })
+    _fill_element(root, fields)
+
+    return b'<?xml version="1.0" encoding="utf-8"?>' + ElementTree.tostring(root)
+
+
+def _to_json_value(tag, value):
+    if not isinstance(value, list):
+        return value
+
+    result = OrderedDict()
+    for child_tag, child_value in value:
+        child_value = _to_json_value(child_tag, child_value)
+
+        if JSON_ARRAYS.get(tag) == child_tag:
+            result.setdefault(child_tag, []).append(child_value)
+        else:
+            result[child_tag] = child_value
+
+    return result
+
+
+def render_json(response_type, fields):
+    return json.dumps(_to_json_value(response_type, fields)).encode('utf-8')
+
+
+def _format_datetime(value):
+    return value.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class GatewayError(Exception):
+    def __init__(self, code, text):
+        super(GatewayError, self).__init__(code, text)
+        self.code = code
+        self.text = text
+
+
+class AuthorizeNetSimulator(object):
+    """ The simulated gateway and its HTTP server.
+
+    :param latency: The seconds every request takes, at least.
+    :param latency_jitter: The seconds randomly added to the latency, at most.
+    :param error_rate: The fraction of requests answered with an API error.
+    :param decline_rate: The fraction of charges declined.
+    :param decline_codes: The response reason codes of the declined charges.
+    :param settle_after: The seconds after which the captured transactions
+                         are settled in a batch, as the transactions are
+                         requested. By default, they are settled only by
+                         calling `settle`.
+    :param seed: The seed of the random outcomes.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, latency_jitter=0,
+                 error_rate=0, decline_rate=0, decline_codes=None, settle_after=None,
+                 seed=None):
+        self.host           = host
+        self.port           = port
+        self.latency        = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate     = error_rate
+        self.decline_rate   = decline_rate
+        self.decline_codes  = list(decline_codes or ['2'])
+        self.settle_after   = settle_after
+
+        self.random = random.Random(seed)
+        self.lock   = threading.Lock()
+        self.server = None
+        self.thread = None
+
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.transactions        = OrderedDict()
+            self.batches             = OrderedDict()
+            self.profiles            = {}
+            self.requests            = 0
+            self._next_trans_id      = 60000000000
+            self._next_batch_id      = 1000000
+            self._next_profile_id    = 1500000000
+
+    # HTTP server
+
+    @property
+    def url(self):
+        return 'http://%s:%s/xml/v1/request.api' % (self.host, self.port)
+
+    def start(self):
+        simulator = self
+
+        class Handler(_RequestHandler):
+            pass
+
+        Handler.simulator = simulator
+
+        self.server = _ThreadingHTTPServer((self.host, self.port), Handler)
+        self.port   = self.server.server_address[1]
+
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        logger.info('Authorize.net simulator listening on %s', self.url)
+
+        return self
+
+    def serve_forever(self):
+        if not self.server:
+            self.start()
+
+        try:
+            while self.thread.is_alive():
+                self.thread.join(1)
+        finally:
+            self.stop()
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    # Requests
+
+    def handle(self, body):
+        """ :param body: The raw request body, XML or JSON.
+            :returns (content type, raw response body):
+        """
+
+        body = body.lstrip(BOM).strip()
+        is_json = body[:1] == b'{'
+
+        if is_json:
+            request_type, request = list(json.loads(body.decode('utf-8')).items())[0]
+        else:
+            root = ElementTree.fromstring(body)
+            request_type, request = _local_name(root.tag), _element_to_dict(root) or {}
+
+        response_type = request_type.replace('Request', 'Response')
+        fields = self.respond(request_type, request)
+
+        if is_json:
+            return 'application/json; charset=utf-8', BOM + render_json(response_type, fields)
+
+        return 'application/xml; charset=utf-8', BOM + render_xml(response_type, fields)
+
+    def _sleep(self):
+        delay = self.latency
+        if self.latency_jitter:
+            with self.lock:
+                delay += self.random.uniform(0, self.latency_jitter)
+
+        if delay:
+            time.sleep(delay)
+
+    def _roll(self, rate):
+        with self.lock:
+            return rate and self.random.random() < rate
+
+    def respond(self, request_type, request):
+        """ :returns: The response fields, as (tag, value) pairs. """
+
+        self._sleep()
+
+        with self.lock:
+            self.requests += 1
+
+        handler = None
+        if request_type.endswith('Request'):
+            handler = getattr(self, '_' + request_type, None)
+
+        try:
+            if handler is None:
+                raise GatewayError('E00003', 'The request type %s is not supported.' %
+                                   request_type)
+
+            if self._roll(self.error_rate):
+                raise GatewayError('E00001', 'An error occurred during processing. '
+                                             'Please try again.')
+
+            result_code, message, fields = handler(request)
+        except GatewayError as error:
+            result_code, message, fields = 'Error', (error.code, error.text), []
+
+        ref_id = [('refId', request['refId'])] if request.get('refId') else []
+
+        return ref_id + [
+            ('messages', [
+                ('resultCode', result_code),
+                ('message', [('code', message[0]), ('text', message[1])]),
+            ]),
+        ] + fields
+
+    def _ok(self, fields):
+        return 'Ok', ('I00001', 'Successful.'), fields
+
+    def _new_transaction(self, transaction_type, amount, status, response_code,
+                         reason_code, ref_trans_id=None):
+        trans_id = str(self._next_trans_id)
+        self._next_trans_id += 1
+
+        now = datetime.utcnow()
+        transaction = {
+            'transId':          trans_id,
+            'refTransId':       ref_trans_id,
+            'transactionType':  transaction_type,
+            'transactionStatus': status,
+            'responseCode':     response_code,
+            'reasonCode':       reason_code,
+            'amount':           '%.2f' % Decimal(amount),
+            'submitTime':       now,
+            'batchId':          None,
+            'authCode':         ''.join(self.random.choice(string.ascii_uppercase + string.digits)
+                                        for _ in range(6)) if response_code == '1' else '',
+        }
+        self.transactions[trans_id] = transaction
+
+        return transaction
+
+    def settle(self, now=None):
+        """ Settle the captured transactions older than `settle_after`
+        (all of them, if not set) in a new batch.
+
+        :returns: The id of the new batch, or None.
+        """
+
+        now = now or datetime.utcnow()
+        cutoff = now - timedelta(seconds=self.settle_after or 0)
+
+        with self.lock:
+            settled = [
+                transaction for transaction in self.transactions.values()
+                if (transaction['transactionStatus'] in ('capturedPendingSettlement',
+                                                         'refundPendingSettlement') and
+                    transaction['submitTime'] <= cutoff)
+            ]
+            if not settled:
+                return None
+
+            batch_id = str(self._next_batch_id)
+            self._next_batch_id += 1
+
+            for transaction in settled:
+                transaction['batchId'] = batch_id
+                transaction['transactionStatus'] = (
+                    'refundSettledSuccessfully'
+                    if transaction['transactionType'] == 'refundTransaction'
+                    else 'settledSuccessfully'
+                )
+
+            self.batches[batch_id] = {'batchId': batch_id, 'settlementTime': now}
+
+            return batch_id
+
+    def _transaction_response(self, transaction, errors=None):
+        response = [
+            ('responseCode', transaction['responseCode'] if transaction else '3'),
+            ('authCode', transaction['authCode'] if transaction else ''),
+            ('avsResultCode', 'Y' if transaction else 'P'),
+            ('cvvResultCode', 'P'),
+            ('cavvResultCode', '2'),
+            ('transId', transaction['transId'] if transaction else '0'),
+            ('refTransID', (transaction and transaction['refTransId']) or ''),
+            ('transHash', ''),
+            ('testRequest', '0'),
+            ('accountNumber', 'XXXX1111'),
+            ('accountType', 'Visa'),
+        ]
+
+        if errors:
+            response.append(('errors', [
+                ('error', [('errorCode', code), ('errorText', text)])
+                for code, text in errors
+            ]))
+        else:
+            response.append(('messages', [
+                ('message', [('code', '1'),
+                             ('description', 'This transaction has been approved.')]),
+            ]))
+
+        return [('transactionResponse', response)]
+
+    def _transaction_error(self, transaction, code, text):
+        return ('Error', ('E00027', 'The transaction was unsuccessful.'),
+                self._transaction_response(transaction, errors=[(code, text)]))
+
+    def _createTransactionRequest(self, request):
+        transaction_request = request.get('transactionRequest') or {}
+        transaction_type    = transaction_request.get('transactionType')
+        amount              = Decimal(transaction_request.get('amount') or 0)
+        ref_trans_id        = transaction_request.get('refTransId')
+
+        if transaction_type in ('authCaptureTransaction', 'authOnlyTransaction'):
+            declined = self._roll(self.decline_rate)
+
+            with self.lock:
+                if declined:
+                    code = self.random.choice(self.decline_codes)
+                    transaction = self._new_transaction(transaction_type, amount, 'declined',
+                                                        '2', code)
+                else:
+                    transaction = self._new_transaction(
+                        transaction_type, amount,
+                        'capturedPendingSettlement'
+                        if transaction_type == 'authCaptureTransaction'
+                        else 'authorizedPendingCapture',
+                        '1', '1'
+                    )
+
+            if declined:
+                return self._transaction_error(transaction, code,
+                                               DECLINE_REASONS.get(code, DECLINE_REASONS['2']))
+
+            return self._ok(self._transaction_response(transaction))
+
+        if transaction_type == 'refundTransaction':
+            with self.lock:
+                original = self.transactions.get(str(ref_trans_id))
+                if not original or original['transactionStatus'] != 'settledSuccessfully':
+                    return self._transaction_error(
+                        None, '54', 'The referenced transaction does not meet the criteria '
+                                    'for issuing a credit.'
+                    )
+
+                transaction = self._new_transaction(transaction_type, amount or original['amount'],
+                                                    'refundPendingSettlement', '1', '1',
+                                                    ref_trans_id=original['transId'])
+
+            return self._ok(self._transaction_response(transaction))
+
+        if transaction_type == 'voidTransaction':
+            with self.lock:
+                transaction = self.transactions.get(str(ref_trans_id))
+                if not transaction:
+                    return self._transaction_error(None, '16', 'The transaction cannot be found.')
+                if transaction['transactionStatus'] == 'voided':
+                    return self._transaction_error(transaction, '310',
+                                                   'This transaction has already been voided.')
+                if transaction['transactionStatus'] not in UNSETTLED_STATUSES:
+                    return self._transaction_error(transaction, '311',
+                                                   'This transaction has already been captured.')
+
+                transaction['transactionStatus'] = 'voided'
+
+            return self._ok(self._transaction_response(transaction))
+
+        raise GatewayError('E00003', 'The transaction type %s is not supported.' %
+                           transaction_type)
+
+    def _transaction_summary(self, transaction):
+        return [
+            ('transId', transaction['transId']),
+            ('submitTimeUTC', _format_datetime(transaction['submitTime'])),
+            ('submitTimeLocal', _format_datetime(transaction['submitTime'])),
+            ('transactionStatus', transaction['transactionStatus']),
+            ('accountType', 'Visa'),
+            ('accountNumber', 'XXXX1111'),
+            ('settleAmount', transaction['amount']),
+        ]
+
+    def _settle_due(self):
+        if self.settle_after is not None:
+            self.settle()
+
+    def _getTransactionDetailsRequest(self, request):
+        self._settle_due()
+
+        with self.lock:
+            transaction = self.transactions.get(str(request.get('transId')))
+            if not transaction:
+                raise GatewayError('E00040', 'The record cannot be found.')
+
+            details = [
+                ('transId', transaction['transId']),
+                ('refTransId', transaction['refTransId']),
+                ('submitTimeUTC', _format_datetime(transaction['submitTime'])),
+                ('submitTimeLocal', _format_datetime(transaction['submitTime'])),
+                ('transactionType', transaction['transactionType']),
+                ('transactionStatus', transaction['transactionStatus']),
+                ('responseCode', transaction['responseCode']),
+                ('responseReasonCode', transaction['reasonCode']),
+                ('responseReasonDescription',
+                 'Approval' if transaction['responseCode'] == '1'
+                 else DECLINE_REASONS.get(transaction['reasonCode'], DECLINE_REASONS['2'])),
+                ('authCode', transaction['authCode']),
+            ]
+            if transaction['batchId']:
+                details.append(('batch', [('batchId', transaction['batchId'])]))
+            details.extend([
+                ('authAmount', transaction['amount']),
+                ('settleAmount', transaction['amount']),
+            ])
+
+        return self._ok([('transaction', details)])
+
+    def _paged(self, request, transactions):
+        paging = request.get('paging') or {}
+        limit  = int(paging.get('limit') or 1000)
+        offset = int(paging.get('offset') or 1)
+
+        page = transactions[(offset - 1) * limit:offset * limit]
+
+        # Like the API, the empty lists are left out
+        fields = []
+        if page:
+            fields.append(('transactions', [
+                ('transaction', self._transaction_summary(transaction)) for transaction in page
+            ]))
+        fields.append(('totalNumInResultSet', len(transactions)))
+
+        return self._ok(fields)
+
+    def _getUnsettledTransactionListRequest(self, request):
+        self._settle_due()
+
+        with self.lock:
+            transactions = [transaction for transaction in self.transactions.values()
+                            if transaction['transactionStatus'] in UNSETTLED_STATUSES]
+
+            return self._paged(request, transactions)
+
+    def _getSettledBatchListRequest(self, request):
+        self._settle_due()
+
+        with self.lock:
+            batches = list(self.batches.values())
+
+        if not batches:
+            return self._ok([])
+
+        return self._ok([
+            ('batchList', [
+                ('batch', [
+                    ('batchId', batch['batchId']),
+                    ('settlementTimeUTC', _format_datetime(batch['settlementTime'])),
+                    ('settlementTimeLocal', _format_datetime(batch['settlementTime'])),
+                    ('settlementState', 'settledSuccessfully'),
+                ])
+                for batch in batches
+            ]),
+        ])
+
+    def _getTransactionListRequest(self, request):
+        batch_id = str(request.get('batchId'))
+
+        with self.lock:
+            if batch_id not in self.batches:
+                raise GatewayError('E00040', 'The record cannot be found.')
+
+            transactions = [transaction for transaction in self.transactions.values()
+                            if transaction['batchId'] == batch_id]
+
+            return self._paged(request, transactions)
+
+    def _createCustomerProfileRequest(self, request):
+        with self.lock:
+            profile_id = str(self._next_profile_id)
+            self._next_profile_id += 1
+
+            self.profiles[profile_id] = {'profile': request.get('profile'),
+                                         'payment_profiles': {}}
+
+        return self._ok([
+            ('customerProfileId', profile_id),
+        ])
+
+    def _createCustomerPaymentProfileRequest(self, request):
+        with self.lock:
+            profile = self.profiles.get(str(request.get('customerProfileId')))
+            if profile is None:
+                raise GatewayError('E00040', 'The record cannot be found.')
+
+            payment_profile_id = str(self._next_profile_id)
+            self._next_profile_id += 1
+
+            profile['payment_profiles'][payment_profile_id] = request.get('paymentProfile')
+
+        return self._ok([
+            ('customerProfileId', request.get('customerProfileId')),
+            ('customerPaymentProfileId', payment_profile_id),
+        ])
+
+    def _getCustomerPaymentProfileRequest(self, request):
+        profile_id         = str(request.get('customerProfileId'))
+        payment_profile_id = str(request.get('customerPaymentProfileId'))
+
+        with self.lock:
+            profile = self.profiles.get(profile_id)
+            if profile is None or payment_profile_id not in profile['payment_profiles']:
+                raise GatewayError('E00040', 'The record cannot be found.')
+
+        return self._ok([
+            ('paymentProfile', [
+                ('customerProfileId', profile_id),
+                ('customerPaymentProfileId', payment_profile_id),
+                ('payment', [
+                    ('creditCard', [('cardNumber', 'XXXX1111'), ('expirationDate', 'XXXX')]),
+                ]),
+            ]),
+        ])
+
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    simulator = None
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+
+        try:
+            content_type, payload = self.simulator.handle(self.rfile.read(length))
+        except Exception:
+            logger.exception('Couldn\'t handle the simulated Authorize.net request')
+            self.send_error(400)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
@@ -0,0 +1,234 @@
+import pytest
+
+from mock import patch
+
+from authorizenet import apicontractsv1
+
+from silver.models import Transaction
+from silver.payment_processors import get_instance
+
+from silver_authorizenet.reconciliation import AuthorizeNetReconciler
+from silver_authorizenet.tests.factories import (AuthorizeNetPaymentMethodFactory,
+                                                 AuthorizeNetTransactionFactory)
+
+
+class Obj(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def ok_response(**kwargs):
+    return Obj(messages=Obj(resultCode=apicontractsv1.messageTypeEnum.Ok), **kwargs)
+
+
+class StubGateway(object):
+    """ A local stub of the Authorize.net transaction reporting API. """
+
+    def __init__(self, unsettled=(), batches=None):
+        self.unsettled = list(unsettled)
+        self.batches   = batches or {}
+        self.requests  = []
+
+    def _page(self, request, summaries):
+        limit = int(request.paging.limit)
+        start = (int(request.paging.offset) - 1) * limit
+        page = [Obj(transId=trans_id, transactionStatus=status)
+                for trans_id, status in summaries[start:start + limit]]
+
+        return ok_response(transactions=Obj(transaction=page),
+                           totalNumInResultSet=len(summaries))
+
+    def controller(self, respond):
+        gateway = self
+
+        class StubController(object):
+            def __init__(self, request):
+                self.request = request
+
+            def setenvironment(self, environment):
+                pass
+
+            def execute(self):
+                gateway.requests.append(self.request)
+
+            def getresponse(self):
+                return respond(self.request)
+
+        return StubController
+
+    def reconciler(self, payment_processor, **kwargs):
+        reconciler = AuthorizeNetReconciler(payment_processor, **kwargs)
+
+        reconciler.unsettled_list_controller = self.controller(
+            lambda request: self._page(request, self.unsettled)
+        )
+        reconciler.settled_batch_list_controller = self.controller(
+            lambda request: ok_response(batchList=Obj(batch=[
+                Obj(batchId=batch_id) for batch_id in sorted(self.batches)
+            ]))
+        )
+        reconciler.transaction_list_controller = self.controller(
+            lambda request: self._page(request, self.batches[str(request.batchId)])
+        )
+
+        return reconciler
+
+
+def create_pending_transaction(external_reference, payment_method):
+    return AuthorizeNetTransactionFactory.create(state=Transaction.States.Pending,
+                                                 external_reference=external_reference,
+                                                 payment_method=payment_method)
+
+
+@pytest.mark.django_db
+def test_reconcile_applies_the_gateway_statuses():
+    payment_method = AuthorizeNetPaymentMethodFactory.create()
+    payment_processor = get_instance(payment_method.payment_processor)
+
+    settled = create_pending_transaction('1001', payment_method)
+    declined = create_pending_transaction('1002', payment_method)
+    voided = create_pending_transaction('1003', payment_method)
+    captured = create_pending_transaction('1004', payment_method)
+    unknown = create_pending_transaction('1005', payment_method)
+
+    gateway = StubGateway(
+        unsettled=[('1002', 'declined'), ('1004', 'capturedPendingSettlement'),
+                   ('2001', 'capturedPendingSettlement')],
+        batches={
+            '11': [('1001', 'settledSuccessfully'), ('2002', 'settledSuccessfully')],
+            '12': [('1003', 'voided')],
+        }
+    )
+    reconciler = gateway.reconciler(payment_processor, batch_size=2)
+
+    with patch.object(type(payment_processor), 'fetch_transaction_status') as fetch_mock:
+        result = reconciler.reconcile([settled, declined, voided, captured, unknown])
+
+    # The transaction missing from the lists gets its details fetched
+    fetch_mock.assert_called_once_with(unknown)
+
+    assert result == {
+        'transactions': 5,
+        'matched': 4,
+        'settled': 1,
+        'failed': 1,
+        'canceled': 1,
+        'fetched': 1,
+        'api_calls': 5,
+    }
+
+    states = dict(Transaction.objects.values_list('external_reference', 'state'))
+    assert states == {
+        '1001': Transaction.States.Settled,
+        '1002': Transaction.States.Failed,
+        '1003': Transaction.States.Canceled,
+        '1004': Transaction.States.Pending,
+        '1005': Transaction.States.Pending,
+    }
+
+
+@pytest.mark.django_db
+def test_reconcile_gateway_calls_do_not_depend_on_the_pending_transactions():
+    payment_method = AuthorizeNetPaymentMethodFactory.create()
+    payment_processor = get_instance(payment_method.payment_processor)
+
+    transactions = [create_pending_transaction(str(1000 + index), payment_method)
+                    for index in range(20)]
+
+    gateway = StubGateway(
+        unsettled=[(str(1000 + index), 'capturedPendingSettlement') for index in range(10)],
+        batches={'11': [],
+                 '12': [(str(1010 + index), 'settledSuccessfully') for index in range(10)]}
+    )
+
+    result = gateway.reconciler(payment_processor).reconcile(transactions)
+
+    # The unsettled list, the batch list and the most recent batch, which holds the rest
+    assert result['api_calls'] == len(gateway.requests) == 3
+    assert result['matched'] == 20
+    assert result['settled'] == 10
+
+
+@pytest.mark.django_db
+def test_reconcile_pages_through_the_transaction_lists(monkeypatch):
+    monkeypatch.setattr('silver_authorizenet.reconciliation.PAGE_LIMIT', 2)
+
+    payment_method = AuthorizeNetPaymentMethodFactory.create()
+    payment_processor = get_instance(payment_method.payment_processor)
+
+    transaction = create_pending_transaction('1005', payment_method)
+
+    gateway = StubGateway(
+        unsettled=[(str(1000 + index), 'capturedPendingSettlement') for index in range(5)],
+        batches={'11': [('1005', 'settledSuccessfully')]}
+    )
+
+    result = gateway.reconciler(payment_processor).reconcile([transaction])
+
+    # The 3 pages of the unsettled list, the batch list and the batch
+    assert result['api_calls'] == 5
+    assert [int(request.paging.offset) for request in gateway.requests[:3]] == [1, 2, 3]
+    assert result['matched'] == 1
+    assert result['settled'] == 1
+
+
+@pytest.mark.django_db
+def test_reconcile_fetches_the_details_of_the_unlisted_transactions():
+    payment_method = AuthorizeNetPaymentMethodFactory.create()
+    payment_processor = get_instance(payment_method.payment_processor)
+
+    # Settled before the listed batches, and never referenced
+    old = create_pending_transaction('1001', payment_method)
+    unreferenced = create_pending_transaction(None, payment_method)
+
+    def fetch_transaction_status(transaction):
+        if transaction.external_reference:
+            transaction.settle()
+            transaction.save_state()
+
+        return True
+
+    gateway = StubGateway(batches={'11': [('2001', 'settledSuccessfully')]})
+    with patch.object(type(payment_processor), 'fetch_transaction_status',
+                      side_effect=fetch_transaction_status) as fetch_mock:
+        result = gateway.reconciler(payment_processor).reconcile([old, unreferenced])
+
+    assert [call_args[0][0] for call_args in fetch_mock.call_args_list] == [old, unreferenced]
+    assert result['matched'] == 0
+    assert result['fetched'] == 2
+    assert result['settled'] == 1
+    # The unsettled list, the batch list, the batch and the 2 details requests
+    assert result['api_calls'] == 5
+
+    states = dict(Transaction.objects.values_list('pk', 'state'))
+    assert states == {old.pk: Transaction.States.Settled,
+                      unreferenced.pk: Transaction.States.Pending}
+
+
+@pytest.mark.django_db
+def test_reconcile_counts_the_transitions_once_committed():
+    payment_method = AuthorizeNetPaymentMethodFactory.create()
+    payment_processor = get_instance(payment_method.payment_processor)
+
+    transactions = [create_pending_transaction(str(1000 + index), payment_method)
+                    for index in range(2)]
+    index = {transaction.external_reference: 'settledSuccessfully'
+             for transaction in transactions}
+    result = {'settled': 0, 'failed': 0, 'canceled': 0}
+
+    save_state = Transaction.save_state
+
+    def failing_save_state(transaction, *fields):
+        if transaction == transactions[1]:
+            raise Exception('Database is down.')
+
+        return save_state(transaction, *fields)
+
+    with patch.object(Transaction, 'save_state', failing_save_state), \
+            pytest.raises(Exception):
+        AuthorizeNetReconciler(payment_processor)._apply(transactions, index, result)
+
+    assert result == {'settled': 0, 'failed': 0, 'canceled': 0}
+    assert set(Transaction.objects.values_list('state', flat=True)) == {
+        Transaction.States.Pending
+    }
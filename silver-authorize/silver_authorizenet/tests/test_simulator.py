@@ -0,0 +1,188 @@
+import json
+
+import pytest
+import requests
+
+from django.test import override_settings
+
+from silver.models import Transaction
+from silver.payment_processors import get_instance
+from silver.tests.factories import CustomerFactory
+
+from silver_authorizenet.simulator import AuthorizeNetSimulator
+from silver_authorizenet.tests.factories import (AuthorizeNetPaymentMethodFactory,
+                                                 AuthorizeNetTransactionFactory,
+                                                 EntryFactory, InvoiceFactory)
+
+
+@pytest.fixture
+def simulator():
+    simulator = AuthorizeNetSimulator(seed=0).start()
+    yield simulator
+    simulator.stop()
+
+
+def post(simulator, request_type, fields):
+    response = requests.post(simulator.url, data=json.dumps({request_type: fields}),
+                             headers={'Content-Type': 'application/json'})
+    assert response.status_code == 200
+
+    return json.loads(response.content[3:].decode('utf-8'))
+
+
+def charge(simulator, amount='10.00'):
+    return post(simulator, 'createTransactionRequest', {
+        'transactionRequest': {'transactionType': 'authCaptureTransaction', 'amount': amount},
+    })
+
+
+def test_simulator_charges_voids_and_refunds(simulator):
+    charged = charge(simulator)
+    assert charged['messages']['resultCode'] == 'Ok'
+    assert charged['transactionResponse']['responseCode'] == '1'
+
+    trans_id = charged['transactionResponse']['transId']
+
+    voided = post(simulator, 'createTransactionRequest', {
+        'transactionRequest': {'transactionType': 'voidTransaction', 'refTransId': trans_id},
+    })
+    assert voided['messages']['resultCode'] == 'Ok'
+
+    details = post(simulator, 'getTransactionDetailsRequest', {'transId': trans_id})
+    assert details['transaction']['transactionStatus'] == 'voided'
+
+    # Only settled transactions can be refunded
+    refunded = post(simulator, 'createTransactionRequest', {
+        'transactionRequest': {'transactionType': 'refundTransaction', 'refTransId': trans_id},
+    })
+    assert refunded['messages']['resultCode'] == 'Error'
+    assert refunded['transactionResponse']['errors']['error'][0]['errorCode'] == '54'
+
+    trans_id = charge(simulator)['transactionResponse']['transId']
+    simulator.settle()
+
+    refunded = post(simulator, 'createTransactionRequest', {
+        'transactionRequest': {'transactionType': 'refundTransaction', 'refTransId': trans_id},
+    })
+    assert refunded['messages']['resultCode'] == 'Ok'
+    assert refunded['transactionResponse']['refTransID'] == trans_id
+
+
+def test_simulator_declines_and_errors():
+    simulator = AuthorizeNetSimulator(decline_rate=1, decline_codes=['65']).start()
+    try:
+        declined = charge(simulator)
+    finally:
+        simulator.stop()
+
+    assert declined['messages']['resultCode'] == 'Error'
+    assert declined['transactionResponse']['responseCode'] == '2'
+    assert declined['transactionResponse']['errors']['error'][0]['errorCode'] == '65'
+
+    simulator = AuthorizeNetSimulator(error_rate=1).start()
+    try:
+        failed = charge(simulator)
+    finally:
+        simulator.stop()
+
+    assert failed['messages']['message'][0]['code'] == 'E00001'
+    assert not simulator.transactions
+
+
+def test_simulator_lists_transactions_by_settlement(simulator):
+    settled_id = charge(simulator)['transactionResponse']['transId']
+    batch_id = simulator.settle()
+    unsettled_id = charge(simulator)['transactionResponse']['transId']
+
+    unsettled = post(simulator, 'getUnsettledTransactionListRequest', {})
+    assert [transaction['transId'] for transaction in
+            unsettled['transactions']['transaction']] == [unsettled_id]
+
+    batches = post(simulator, 'getSettledBatchListRequest', {})
+    assert [batch['batchId'] for batch in batches['batchList']['batch']] == [batch_id]
+
+    settled = post(simulator, 'getTransactionListRequest', {'batchId': batch_id})
+    assert [transaction['transId'] for transaction in
+            settled['transactions']['transaction']] == [settled_id]
+
+
+def test_simulator_settles_the_transactions_after_a_delay():
+    simulator = AuthorizeNetSimulator(settle_after=0).start()
+    try:
+        trans_id = charge(simulator)['transactionResponse']['transId']
+
+        unsettled = post(simulator, 'getUnsettledTransactionListRequest', {})
+        details = post(simulator, 'getTransactionDetailsRequest', {'transId': trans_id})
+    finally:
+        simulator.stop()
+
+    assert 'transactions' not in unsettled
+    assert details['transaction']['transactionStatus'] == 'settledSuccessfully'
+
+
+def test_simulator_speaks_xml(simulator):
+    response = requests.post(
+        simulator.url,
+        data=b'<?xml version="1.0" encoding="utf-8"?>'
+             b'<createCustomerProfileRequest '
+             b'xmlns="AnetApi/xml/v1/schema/AnetApiSchema.xsd">'
+             b'<profile><email>customer@example.com</email></profile>'
+             b'</createCustomerProfileRequest>',
+        headers={'Content-Type': 'application/xml'}
+    )
+
+    assert response.content.startswith(b'\xef\xbb\xbf<?xml')
+    assert b'<resultCode>Ok</resultCode>' in response.content
+    assert b'<customerProfileId>' in response.content
+
+
+@pytest.mark.django_db
+def test_processor_executes_transactions_against_the_simulator(simulator):
+    customer = CustomerFactory.create()
+    customer.meta = {
+        "cardNumber": "4111111111111111",
+        "expirationDate": "2020-12",
+        "cardCode": "123",
+    }
+    customer.save()
+
+    invoice = InvoiceFactory.create(customer=customer, state='issued',
+                                    invoice_entries=[EntryFactory.create(unit_price=25.00)])
+    payment_method = AuthorizeNetPaymentMethodFactory.create(customer=customer)
+    transaction = AuthorizeNetTransactionFactory.create(
+        invoice=invoice, payment_method=payment_method, state=Transaction.States.Initial,
+        data={'status': None, 'authorizenet_id': None},
+    )
+
+    with override_settings(AUTHORIZENET_SIMULATOR_URL=simulator.url):
+        payment_processor = get_instance(payment_method.payment_processor)
+
+        assert payment_processor.process_transaction(transaction)
+
+    assert transaction.state in [Transaction.States.Pending, Transaction.States.Settled]
+    assert str(transaction.external_reference) in simulator.transactions
+
+
+@pytest.mark.django_db
+def test_processor_reconciles_transactions_against_the_simulator(simulator):
+    payment_method = AuthorizeNetPaymentMethodFactory.create()
+
+    settled = AuthorizeNetTransactionFactory.create(
+        payment_method=payment_method, state=Transaction.States.Pending,
+        external_reference=charge(simulator)['transactionResponse']['transId']
+    )
+    simulator.settle()
+    unsettled = AuthorizeNetTransactionFactory.create(
+        payment_method=payment_method, state=Transaction.States.Pending,
+        external_reference=charge(simulator)['transactionResponse']['transId']
+    )
+
+    with override_settings(AUTHORIZENET_SIMULATOR_URL=simulator.url):
+        payment_processor = get_instance(payment_method.payment_processor)
+
+        assert payment_processor.fetch_transactions_status([settled, unsettled]) == 1
+
+    settled.refresh_from_db()
+    unsettled.refresh_from_db()
+    assert settled.state == Transaction.States.Settled
+    assert unsettled.state == Transaction.States.Pending
@@ -664,10 +664,10 @@ class BillingDocumentAdmin(ModelAdmin):
 
     def retry_failed_transactions(self, request, queryset):
         if request.POST.get('post'):
-            billing_date = timezone.now().date()
+            billing_date = timezone.now()
             TransactionRetryAttempter().check(billing_date=billing_date,
-                                        documents=queryset,
-                                        force_generate=True)
+                                              documents=queryset,
+                                              force=True)
 
             msg = 'Successfully checked all documents.'
             if queryset.count() > 1:
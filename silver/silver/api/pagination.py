@@ -14,17 +14,78 @@
 
 from __future__ import absolute_import
 
-from rest_framework.pagination import PageNumberPagination
+from six import string_types
+
+from rest_framework.pagination import CursorPagination, PageNumberPagination
 from rest_framework.response import Response
 from rest_framework.settings import api_settings
 from rest_framework.utils.urls import replace_query_param, remove_query_param
 
 
+def link_header(links):
+    """
+    :param links: (url, rel) pairs. The links having no url are skipped.
+    """
+
+    return ', '.join('<{}>; rel="{}"'.format(url, rel) for url, rel in links if url is not None)
+
+
+class LinkHeaderCursorPagination(CursorPagination):
+    """
+    Keyset pagination, keyed on the view's `cursor_ordering` (which must be unique and
+    indexed, e.g. '-id'). The pages are fetched by seeking past the last row of the previous
+    page instead of counting and skipping rows, so there's no `last` link.
+    """
+
+    page_size = api_settings.PAGE_SIZE or 30
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = '-id'
+
+    def get_ordering(self, request, queryset, view):
+        ordering = getattr(view, 'cursor_ordering', self.ordering)
+
+        return (ordering, ) if isinstance(ordering, string_types) else tuple(ordering)
+
+    def get_first_link(self):
+        # CursorPagination keeps the request's absolute url, not the request itself
+        return replace_query_param(self.base_url, self.cursor_query_param, '')
+
+    def get_paginated_response(self, data):
+        link = link_header([(self.get_next_link(), 'next'),
+                            (self.get_previous_link(), 'prev'),
+                            (self.get_first_link(), 'first')])
+
+        return Response(data, headers={'Link': link})
+
+
 class LinkHeaderPagination(PageNumberPagination):
+    """
+    Page number pagination. The views having a `cursor_ordering` also support keyset
+    pagination (see `LinkHeaderCursorPagination`), which is used when the `cursor` query
+    parameter is present; an empty `cursor` gets the first page.
+    """
+
     page_size = api_settings.PAGE_SIZE or 30
     page_size_query_param = 'page_size'
     max_page_size = 100
 
+    cursor_pagination_class = LinkHeaderCursorPagination
+    cursor_paginator = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        cursor_pagination = self.cursor_pagination_class
+        if (getattr(view, 'cursor_ordering', None) and
+                cursor_pagination.cursor_query_param in request.query_params):
+            self.cursor_paginator = cursor_pagination()
+
+            return self.cursor_paginator.paginate_queryset(queryset, request, view=view)
+
+        self.cursor_paginator = None
+
+        return super(LinkHeaderPagination, self).paginate_queryset(queryset, request,
+                                                                   view=view)
+
     def get_last_link(self):
         url = self.request.build_absolute_uri()
         page_number = self.page.paginator.num_pages
@@ -39,6 +100,9 @@ class LinkHeaderPagination(PageNumberPagination):
             return remove_query_param(url, self.page_query_param)
 
     def get_paginated_response(self, data):
+        if self.cursor_paginator:
+            return self.cursor_paginator.get_paginated_response(data)
+
         next_url = self.get_next_link()
         previous_url = self.get_previous_link()
         first_url = self.get_first_link()
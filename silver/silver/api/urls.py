@@ -17,8 +17,9 @@ from __future__ import absolute_import
 from django.conf.urls import url
 
 from silver import views as silver_views
-from silver.api.views import billing_entities_views, documents_views, payment_method_views, \
-    plan_views, product_code_views, subscription_views, transaction_views, transaction_one_off_views
+from silver.api.views import billing_entities_views, documents_views, export_views, \
+    payment_method_views, plan_views, product_code_views, subscription_views, transaction_views, \
+    transaction_one_off_views
 
 
 urlpatterns = [
@@ -68,6 +69,10 @@ urlpatterns = [
     url(r'plans/(?P<pk>[0-9]+)/metered-features/$',
         plan_views.PlanMeteredFeatures.as_view(), name='plans-metered-features'),
 
+    url(r'^metered-features/usage/$',
+        subscription_views.MeteredFeatureUsageBatch.as_view(), name='mf-usage-batch'),
+    url(r'^metered-features/usage-events/$',
+        subscription_views.MeteredUsageEventsBatch.as_view(), name='mf-usage-events'),
     url(r'^metered-features/$',
         subscription_views.MeteredFeatureList.as_view(), name='metered-feature-list'),
 
@@ -76,6 +81,9 @@ urlpatterns = [
     url(r'^providers/(?P<pk>[0-9]+)/$',
         billing_entities_views.ProviderRetrieveUpdateDestroy.as_view(), name='provider-detail'),
 
+    url(r'^exports/(?P<resource>[a-z\-]+)\.(?P<export_format>ndjson|csv)$',
+        export_views.ExportDetail.as_view(), name='export-detail'),
+
     url(r'^product-codes/$',
         product_code_views.ProductCodeListCreate.as_view(), name='productcode-list'),
     url(r'^product-codes/(?P<pk>[0-9]+)/$',
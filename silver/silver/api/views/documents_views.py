@@ -37,10 +37,11 @@ class InvoiceListCreate(generics.ListCreateAPIView):
     permission_classes = (permissions.IsAuthenticated,)
     serializer_class = InvoiceSerializer
     queryset = Invoice.objects.all()\
-        .select_related('related_document')\
+        .select_related('related_document', 'customer', 'provider', 'pdf')\
         .prefetch_related('invoice_transactions')
     filter_backends = (DjangoFilterBackend,)
     filter_class = InvoiceFilter
+    cursor_ordering = '-id'
 
 
 class InvoiceRetrieveUpdate(generics.RetrieveUpdateAPIView):
@@ -228,10 +229,11 @@ class ProformaListCreate(generics.ListCreateAPIView):
     permission_classes = (permissions.IsAuthenticated,)
     serializer_class = ProformaSerializer
     queryset = Proforma.objects.all()\
-        .select_related('related_document')\
+        .select_related('related_document', 'customer', 'provider', 'pdf')\
         .prefetch_related('proforma_transactions')
     filter_backends = (DjangoFilterBackend,)
     filter_class = ProformaFilter
+    cursor_ordering = '-id'
 
 
 class ProformaRetrieveUpdate(generics.RetrieveUpdateAPIView):
@@ -0,0 +1,54 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import datetime
+
+from rest_framework import permissions, status
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from silver.exports import EXPORTS, export_response
+
+
+class ExportDetail(APIView):
+    """
+    Streams the invoices, proformas, document entries or transactions as NDJSON or CSV rows,
+    optionally only the ones between the `start_date` and `end_date` query parameters (the
+    documents' issue dates and the transactions' creation dates).
+    """
+
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get(self, request, *args, **kwargs):
+        resource = kwargs.get('resource')
+        if resource not in EXPORTS:
+            return Response({"detail": "Export Not found."},
+                            status=status.HTTP_404_NOT_FOUND)
+
+        dates = {}
+        for param in ('start_date', 'end_date'):
+            value = request.query_params.get(param)
+            if not value:
+                continue
+
+            try:
+                dates[param] = datetime.datetime.strptime(value, '%Y-%m-%d').date()
+            except ValueError:
+                return Response({'detail': 'Invalid date format. Please '
+                                 'use the ISO 8601 date format.'},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+        return export_response(resource, kwargs.get('export_format'), **dates)
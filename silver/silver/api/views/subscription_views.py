@@ -35,6 +35,8 @@ from silver.api.filters import MeteredFeaturesFilter, SubscriptionFilter
 from silver.api.serializers.common import MeteredFeatureSerializer
 from silver.api.serializers.subscriptions_serializers import SubscriptionSerializer, \
     SubscriptionDetailSerializer, MFUnitsLogSerializer
+from silver.metered_usage import (METERED_USAGE_BUFFERED, MeteredUsageBuffer,
+                                  ingest_usage_events, ingest_usage_records)
 from silver.models import MeteredFeature, Subscription, MeteredFeatureUnitsLog
 
 
@@ -64,6 +66,7 @@ class SubscriptionList(generics.ListCreateAPIView):
     serializer_class = SubscriptionSerializer
     filter_backends = (DjangoFilterBackend,)
     filter_class = SubscriptionFilter
+    cursor_ordering = '-id'
 
     def get_queryset(self):
         customer_pk = self.kwargs.get('customer_pk', None)
@@ -330,6 +333,17 @@ class MeteredFeatureUnitsLogDetail(APIView):
             subscription=subscription_pk
         ).first()
 
+        if METERED_USAGE_BUFFERED:
+            key = (subscription.pk, metered_feature.pk, bsd, bed)
+            if update_type == 'relative':
+                buffered_units = MeteredUsageBuffer().increment([(key, consumed_units)])[key]
+                consumed_units = log.consumed_units if log is not None else Decimal(0)
+
+                return Response({"count": consumed_units + buffered_units},
+                                status=status.HTTP_200_OK)
+
+            MeteredUsageBuffer().discard([key])
+
         if log is not None:
             if update_type == 'absolute':
                 log.consumed_units = consumed_units
@@ -346,3 +360,56 @@ class MeteredFeatureUnitsLogDetail(APIView):
             )
         return Response({"count": log.consumed_units},
                         status=status.HTTP_200_OK)
+
+
+class MeteredFeatureUsageBatch(APIView):
+    """
+    Logs the usage of metered features for many subscriptions at once.
+
+    Expects a list of `{subscription, product_code, date, count, update_type}` records and
+    responds with a result for each of them, in order: `{"count": ...}` holding the consumed
+    units of the record's bucket, or `{"detail": ...}` describing why it couldn't be applied.
+    """
+
+    permission_classes = (permissions.IsAuthenticated,)
+    paginate_by = None
+
+    def post(self, request, *args, **kwargs):
+        records = request.data
+        if not isinstance(records, list):
+            return Response({"detail": "A list of usage records is expected."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        results = ingest_usage_records(records)
+
+        logger.debug('Logged metered features usage: %s', {
+            'records': len(records),
+            'failed': len([result for result in results if 'detail' in result]),
+        })
+
+        return Response(results, status=status.HTTP_200_OK)
+
+
+class MeteredUsageEventsBatch(APIView):
+    """
+    Appends raw metered features usage events, which are later rolled up into the metered
+    features units logs.
+
+    Expects a list of `{subscription, product_code, date, count, reference}` records
+    (`reference` being optional) and responds with the number of accepted events and the
+    `{index, detail}` errors of the rejected ones.
+    """
+
+    permission_classes = (permissions.IsAuthenticated,)
+    paginate_by = None
+
+    def post(self, request, *args, **kwargs):
+        records = request.data
+        if not isinstance(records, list):
+            return Response({"detail": "A list of usage events is expected."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        accepted, errors = ingest_usage_events(records)
+
+        return Response({"accepted": accepted, "errors": errors},
+                        status=status.HTTP_200_OK)
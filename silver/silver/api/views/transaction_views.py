@@ -68,6 +68,7 @@ class TransactionList(ListCreateAPIView):
     serializer_class = TransactionSerializer
     filter_backends = (DjangoFilterBackend,)
     filter_class = TransactionFilter
+    cursor_ordering = '-id'
 
     def get_queryset(self):
         customer_pk = self.kwargs.get('customer_pk', None)
@@ -0,0 +1,521 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A billing benchmark over synthetic tenants, used by the `benchmark_billing` command.
+"""
+
+from __future__ import absolute_import, division
+
+import logging
+import multiprocessing
+import platform
+import random
+import uuid
+
+from collections import OrderedDict
+from datetime import timedelta
+from decimal import Decimal
+
+import django
+
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction as db_transaction
+from django.db.models import Max
+from django.urls import resolve, reverse
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from silver.documents_generator import DocumentsGenerator
+from silver.instrumentation import instrument
+from silver.metered_usage import rollup_usage_events
+from silver.models import (BillingDocumentBase, Customer, MeteredFeature,
+                           MeteredUsageEvent, PaymentMethod, Plan, ProductCode, Provider,
+                           Subscription, Transaction)
+from silver.overpayment_checker import OverpaymentChecker
+from silver.pdf_rendering import PDFRenderingEngine
+from silver.transaction_retries import TransactionRetryAttempter
+
+
+logger = logging.getLogger(__name__)
+
+
+BULK_CREATE_BATCH_SIZE = 1000
+
+PLAN_INTERVALS = (Plan.INTERVALS.DAY, Plan.INTERVALS.WEEK, Plan.INTERVALS.MONTH,
+                  Plan.INTERVALS.MONTHISH, Plan.INTERVALS.YEAR)
+TRIAL_PERIODS_DAYS = (None, 14)
+
+# (name, URL name, whether the URL is scoped to a customer, query parameters)
+ENDPOINTS = (
+    ('customer-list', 'customer-list', False, {}),
+    ('invoice-list', 'invoice-list', False, {}),
+    ('invoice-list-cursor', 'invoice-list', False, {'cursor': ''}),
+    ('proforma-list', 'proforma-list', False, {}),
+    ('proforma-list-cursor', 'proforma-list', False, {'cursor': ''}),
+    ('subscription-list', 'subscription-list', True, {}),
+    ('transaction-list', 'transaction-list', True, {}),
+)
+
+
+def _bulk_create(model, objects):
+    """
+    Creates the objects in bulk, setting their primary keys even on the databases which don't
+    return them (assuming nobody else inserts rows meanwhile).
+    """
+
+    if not objects:
+        return objects
+
+    last_pk = model._base_manager.aggregate(last_pk=Max('pk'))['last_pk'] or 0
+    model._base_manager.bulk_create(objects, batch_size=BULK_CREATE_BATCH_SIZE)
+
+    if objects[0].pk is None:
+        pks = model._base_manager.filter(pk__gt=last_pk).order_by('pk')\
+                                 .values_list('pk', flat=True)
+        for obj, pk in zip(objects, pks):
+            obj.pk = pk
+
+    return objects
+
+
+class SyntheticTenants(object):
+    """
+    Generates synthetic billing data in bulk.
+
+    Every provider gets plans for all the intervals, with and without trials, sharing the
+    provider's metered features, the last of which is linked to the first one. Every customer
+    gets `subscriptions` active subscriptions to random plans, the later ones being linked to
+    the first one, some usage events for their metered features and a recurring payment method.
+
+    The data is random, but the same for the same `seed`.
+    """
+
+    def __init__(self, providers=2, customers=100, subscriptions=2, metered_features=3,
+                 usage_events=2, billing_date=None, max_age_days=45, payment_processor=None,
+                 failed_payments=0.2, overpayments=0.05, seed=0):
+        self.providers = providers
+        self.customers = customers
+        self.subscriptions = subscriptions
+        self.metered_features = metered_features
+        self.usage_events = usage_events
+        self.billing_date = billing_date or timezone.now().date()
+        self.max_age_days = max_age_days
+        self.payment_processor = payment_processor
+        self.failed_payments = failed_payments
+        self.overpayments = overpayments
+        self.seed = seed
+
+        self.random = random.Random(seed)
+        # Keeps the generated values unique across runs that keep their data
+        self.prefix = 'benchmark-{}'.format(uuid.uuid4().hex[:8])
+
+    @property
+    def parameters(self):
+        return OrderedDict([
+            ('providers', self.providers),
+            ('customers', self.customers),
+            ('subscriptions', self.subscriptions),
+            ('metered_features', self.metered_features),
+            ('usage_events', self.usage_events),
+            ('billing_date', self.billing_date.isoformat()),
+            ('max_age_days', self.max_age_days),
+            ('payment_processor', self.payment_processor),
+            ('failed_payments', self.failed_payments),
+            ('overpayments', self.overpayments),
+            ('seed', self.seed),
+        ])
+
+    def get_customers(self):
+        return Customer.objects.filter(customer_reference__startswith=self.prefix)
+
+    def _product_codes(self, kind, count):
+        return _bulk_create(ProductCode, [
+            ProductCode(value='{}-{}-{}'.format(self.prefix, kind, index))
+            for index in range(count)
+        ])
+
+    def _create_providers(self):
+        return _bulk_create(Provider, [
+            Provider(name='{} provider {}'.format(self.prefix, index),
+                     company='Benchmark Provider {}'.format(index),
+                     address_1='{} Benchmark Street'.format(index), city='Benchmark',
+                     country='US',
+                     flow=Provider.FLOWS.INVOICE if index % 2 else Provider.FLOWS.PROFORMA,
+                     default_document_state=Provider.DEFAULT_DOC_STATE.ISSUED,
+                     invoice_series='BI{}'.format(index), invoice_starting_number=1,
+                     proforma_series='BP{}'.format(index), proforma_starting_number=1)
+            for index in range(self.providers)
+        ])
+
+    def _create_metered_features(self, providers):
+        product_codes = self._product_codes('feature', len(providers) * self.metered_features)
+
+        features = OrderedDict()
+        for provider_index, provider in enumerate(providers):
+            features[provider.pk] = [
+                MeteredFeature(
+                    name='Feature {}'.format(index), unit='units',
+                    price_per_unit=Decimal(self.random.randint(1, 500)) / 100,
+                    included_units=Decimal(self.random.choice((0, 100, 1000))),
+                    product_code=product_codes[provider_index * self.metered_features + index]
+                )
+                for index in range(self.metered_features)
+            ]
+
+        _bulk_create(MeteredFeature, [feature for provider_features in features.values()
+                                      for feature in provider_features])
+
+        for provider_features in features.values():
+            if len(provider_features) > 1:
+                first, last = provider_features[0], provider_features[-1]
+                MeteredFeature.objects.filter(pk=last.pk).update(linked_feature=first)
+                last.linked_feature = first
+
+        return features
+
+    def _create_plans(self, providers, features):
+        variants = [(interval, trial_period_days) for interval in PLAN_INTERVALS
+                    for trial_period_days in TRIAL_PERIODS_DAYS]
+        product_codes = self._product_codes('plan', len(providers) * len(variants))
+
+        plans = _bulk_create(Plan, [
+            Plan(name='{} {} {}'.format(provider.name, interval, trial_period_days or 'no trial'),
+                 interval=interval, interval_count=1,
+                 amount=Decimal(self.random.randint(500, 50000)) / 100, currency='USD',
+                 trial_period_days=trial_period_days,
+                 generate_documents_on_trial_end=bool(trial_period_days),
+                 provider=provider,
+                 product_code=product_codes[provider_index * len(variants) + variant_index])
+            for provider_index, provider in enumerate(providers)
+            for variant_index, (interval, trial_period_days) in enumerate(variants)
+        ])
+
+        PlanFeatures = Plan.metered_features.through
+        PlanFeatures.objects.bulk_create([
+            PlanFeatures(plan_id=plan.pk, meteredfeature_id=feature.pk)
+            for plan in plans for feature in features[plan.provider_id]
+        ], batch_size=BULK_CREATE_BATCH_SIZE)
+
+        return plans
+
+    def _create_customers(self):
+        return _bulk_create(Customer, [
+            Customer(first_name='Benchmark', last_name='Customer {}'.format(index),
+                     company='Benchmark Customer {}'.format(index),
+                     address_1='{} Benchmark Avenue'.format(index), city='Benchmark',
+                     country='US', currency='USD',
+                     customer_reference='{}-{}'.format(self.prefix, index),
+                     consolidated_billing=index % 2 == 0, payment_due_days=5,
+                     sales_tax_name='VAT', sales_tax_percent=Decimal('20.00'))
+            for index in range(self.customers)
+        ])
+
+    def _subscription(self, customer, plans, linked_subscription=None):
+        plan = self.random.choice(plans)
+        start_date = self.billing_date - timedelta(days=self.random.randint(1, self.max_age_days))
+        trial_end = (start_date + timedelta(days=plan.trial_period_days - 1)
+                     if plan.trial_period_days else None)
+
+        return Subscription(plan=plan, customer=customer, start_date=start_date,
+                            trial_end=trial_end, state=Subscription.STATES.ACTIVE,
+                            linked_subscription=linked_subscription, meta={})
+
+    def _create_subscriptions(self, customers, plans):
+        # The first subscriptions are created first, so the others can be linked to them
+        first_subscriptions = _bulk_create(Subscription, [
+            self._subscription(customer, plans) for customer in customers
+        ])
+
+        return first_subscriptions + _bulk_create(Subscription, [
+            self._subscription(customer, plans, linked_subscription=first_subscription)
+            for customer, first_subscription in zip(customers, first_subscriptions)
+            for _ in range(self.subscriptions - 1)
+        ])
+
+    def _create_usage_events(self, subscriptions, features):
+        # Old enough to be rolled up, past the rollup's lag
+        created_at = timezone.now() - timedelta(hours=1)
+
+        events = []
+        for subscription in subscriptions:
+            age_days = (self.billing_date - subscription.start_date).days
+            for feature in features[subscription.plan.provider_id]:
+                for _ in range(self.usage_events):
+                    date = self.billing_date - timedelta(days=self.random.randint(1, age_days))
+                    events.append(MeteredUsageEvent(
+                        subscription_id=subscription.pk, metered_feature_id=feature.pk,
+                        date=date, count=Decimal(self.random.randint(1, 1000)),
+                        created_at=created_at
+                    ))
+
+        MeteredUsageEvent.objects.bulk_create(events, batch_size=BULK_CREATE_BATCH_SIZE)
+
+        return len(events)
+
+    def _create_payment_methods(self, customers):
+        if not self.payment_processor:
+            return []
+
+        return _bulk_create(PaymentMethod, [
+            PaymentMethod(payment_processor=self.payment_processor, customer=customer,
+                          verified=True,
+                          data={'attempt_retries_after': 1, 'stop_retry_attempts': 10})
+            for customer in customers
+        ])
+
+    def generate(self):
+        """
+        :returns: the number of generated objects, by kind.
+        """
+
+        providers = self._create_providers()
+        features = self._create_metered_features(providers)
+        plans = self._create_plans(providers, features)
+        customers = self._create_customers()
+        subscriptions = self._create_subscriptions(customers, plans)
+        usage_events = self._create_usage_events(subscriptions, features)
+        payment_methods = self._create_payment_methods(customers)
+
+        return OrderedDict([
+            ('providers', len(providers)),
+            ('metered_features', sum(len(value) for value in features.values())),
+            ('plans', len(plans)),
+            ('customers', len(customers)),
+            ('subscriptions', len(subscriptions)),
+            ('linked_subscriptions', len(subscriptions) - len(customers)),
+            ('usage_events', usage_events),
+            ('payment_methods', len(payment_methods)),
+        ])
+
+    def generate_payments(self):
+        """
+        Fails the payments of some of the issued invoices, to be retried, and overpays some
+        others, to be adjusted.
+
+        :returns: the number of failed and of overpaid invoices.
+        """
+
+        payment_methods = dict(
+            PaymentMethod.objects.filter(customer__in=self.get_customers(),
+                                         payment_processor=self.payment_processor)
+                                 .values_list('customer_id', 'id')
+        )
+        invoices = BillingDocumentBase.objects.filter(
+            kind='invoice', customer__in=self.get_customers(),
+            state=BillingDocumentBase.STATES.ISSUED
+        ).order_by('pk').values_list('pk', 'customer_id', 'related_document_id',
+                                     '_total_in_transaction_currency', 'transaction_currency')
+
+        failed, overpaid = [], []
+        for invoice in invoices:
+            if invoice[1] not in payment_methods:
+                continue
+
+            value = self.random.random()
+            if value < self.failed_payments:
+                failed.append(invoice)
+            elif value < self.failed_payments + self.overpayments:
+                overpaid.append(invoice)
+
+        # The transactions automatically created when issuing the invoices failed too
+        Transaction.objects.filter(
+            invoice_id__in=[invoice[0] for invoice in failed],
+            state__in=[Transaction.States.Initial, Transaction.States.Pending]
+        ).update(state=Transaction.States.Failed)
+
+        created_at = timezone.now() - timedelta(days=2)
+
+        def transaction(invoice, state, amount, **kwargs):
+            pk, customer_id, proforma_id, total, currency = invoice
+
+            return Transaction(invoice_id=pk, proforma_id=proforma_id,
+                               payment_method_id=payment_methods[customer_id],
+                               amount=amount, currency=currency, state=state,
+                               created_at=created_at, updated_at=created_at, **kwargs)
+
+        # Scheduled according to the payment methods' data
+        retry_schedule = {'next_retry_at': created_at + timedelta(days=1),
+                          'retry_deadline': created_at + timedelta(days=10)}
+
+        Transaction.objects.bulk_create(
+            [transaction(invoice, Transaction.States.Failed, invoice[3] or Decimal('1.00'),
+                         **retry_schedule)
+             for invoice in failed] +
+            [transaction(invoice, Transaction.States.Settled,
+                         (invoice[3] or Decimal('0.00')) + Decimal('10.00'))
+             for invoice in overpaid],
+            batch_size=BULK_CREATE_BATCH_SIZE
+        )
+
+        return OrderedDict([('failed_invoices', len(failed)),
+                            ('overpaid_invoices', len(overpaid))])
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+
+def environment():
+    try:
+        import pkg_resources
+        silver_version = pkg_resources.get_distribution('django-silver').version
+    except Exception:
+        silver_version = None
+
+    return OrderedDict([
+        ('silver', silver_version),
+        ('django', django.get_version()),
+        ('python', platform.python_version()),
+        ('database', connection.vendor),
+        ('platform', platform.platform()),
+        ('cpus', multiprocessing.cpu_count()),
+    ])
+
+
+class BillingBenchmark(object):
+    """
+    Times the billing stages and the hot list endpoints over the synthetic tenants.
+
+    Every stage is run in its own savepoint, so a failing stage is reported without
+    affecting the next ones.
+    """
+
+    def __init__(self, tenants, pdfs=100, requests=5, page_size=100):
+        self.tenants = tenants
+        self.pdfs = pdfs
+        self.requests = requests
+        self.page_size = page_size
+
+    def _stage(self, name, function):
+        try:
+            with db_transaction.atomic(), instrument(name, enabled=True) as stage:
+                extra = function()
+        except Exception as error:
+            logger.exception('Encountered exception while benchmarking %s.', name)
+            extra = {'error': repr(error)}
+
+        report = stage.report()
+        report.update(extra or {})
+
+        return report
+
+    def _rollup_usage_events(self):
+        return {'buckets': rollup_usage_events()}
+
+    def _generate_documents(self):
+        DocumentsGenerator().generate(billing_date=self.tenants.billing_date,
+                                      customers=self.tenants.get_customers())
+
+        documents = BillingDocumentBase.objects.filter(customer__in=self.tenants.get_customers())
+
+        return {'documents': documents.count()}
+
+    def _generate_pdfs(self):
+        documents = BillingDocumentBase.objects.filter(
+            customer__in=self.tenants.get_customers(), pdf__dirty__gt=0
+        ).select_related('pdf').order_by('pk')[:self.pdfs]
+
+        report = PDFRenderingEngine(processes=1).render(documents).report()
+        report.pop('latency_histogram')
+
+        return report
+
+    def _check_overpayments(self):
+        OverpaymentChecker().check(customers=self.tenants.get_customers(),
+                                   billing_date=self.tenants.billing_date)
+
+    def _retry_failed_transactions(self):
+        TransactionRetryAttempter().check(billing_date=timezone.now())
+
+    def _endpoint(self, name, path, params, user):
+        factory = APIRequestFactory()
+        match = resolve(path)
+
+        stages = []
+        for _ in range(self.requests):
+            request = factory.get(path, dict(params, page_size=self.page_size))
+            force_authenticate(request, user=user)
+
+            with instrument(name, enabled=True) as stage:
+                response = match.func(request, *match.args, **match.kwargs)
+                response.render()
+
+            stages.append(stage)
+
+        return OrderedDict([
+            ('status_code', response.status_code),
+            ('requests', len(stages)),
+            ('queries', stages[-1].queries),
+            ('db_time_median', _median([stage.db_time for stage in stages])),
+            ('wall_time_min', min(stage.wall_time for stage in stages)),
+            ('wall_time_median', _median([stage.wall_time for stage in stages])),
+            ('wall_time_max', max(stage.wall_time for stage in stages)),
+        ])
+
+    def _endpoints(self):
+        user = get_user_model()(username='benchmark', is_staff=True, is_superuser=True)
+        customer = self.tenants.get_customers().order_by('pk').first()
+
+        reports = OrderedDict()
+        for name, url_name, customer_scoped, params in ENDPOINTS:
+            if customer_scoped and not customer:
+                continue
+
+            kwargs = {'customer_pk': customer.pk} if customer_scoped else {}
+            path = reverse(url_name, kwargs=kwargs)
+
+            # A failing endpoint doesn't stop the others from being benchmarked
+            try:
+                with db_transaction.atomic():
+                    reports[name] = self._endpoint(name, path, params, user)
+            except Exception as error:
+                logger.exception('Encountered exception while benchmarking %s.', name)
+                reports[name] = OrderedDict([('error', repr(error))])
+
+        return reports
+
+    def run(self):
+        results = OrderedDict([
+            ('environment', environment()),
+            ('parameters', self.tenants.parameters),
+        ])
+
+        with instrument('synthetic_data', enabled=True) as stage:
+            results['dataset'] = self.tenants.generate()
+        results['setup'] = stage.report()
+
+        stages = results['stages'] = OrderedDict()
+        stages['rollup_usage_events'] = self._stage('rollup_usage_events',
+                                                    self._rollup_usage_events)
+        stages['generate_documents'] = self._stage('generate_documents',
+                                                   self._generate_documents)
+
+        if self.tenants.payment_processor:
+            results['dataset'].update(self.tenants.generate_payments())
+
+        if self.pdfs:
+            stages['generate_pdfs'] = self._stage('generate_pdfs', self._generate_pdfs)
+        stages['check_overpayments'] = self._stage('check_overpayments',
+                                                   self._check_overpayments)
+        stages['retry_failed_transactions'] = self._stage('retry_failed_transactions',
+                                                          self._retry_failed_transactions)
+
+        if self.requests:
+            results['endpoints'] = self._endpoints()
+
+        return results
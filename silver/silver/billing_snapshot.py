@@ -0,0 +1,148 @@
+# Copyright (c) 2015 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+from collections import defaultdict
+
+from django.db.models import OuterRef, Prefetch, Subquery
+from django.utils import timezone
+
+from silver.models import BillingLog, MeteredFeature, MeteredFeatureUnitsLog, Subscription
+from silver.utils.dates import ONE_DAY
+
+
+def prefetch_last_billing_logs(subscriptions):
+    """
+    Loads the latest billing log of each of the given subscriptions with a single query, so
+    `Subscription.last_billing_log` doesn't query the database.
+    """
+
+    latest_billing_log = BillingLog.objects.filter(
+        subscription=OuterRef('subscription')
+    ).order_by('-billing_date', '-pk').values('pk')[:1]
+
+    billing_logs = BillingLog.objects.filter(
+        subscription__in=subscriptions, pk=Subquery(latest_billing_log)
+    )
+    billing_logs = {billing_log.subscription_id: billing_log
+                    for billing_log in billing_logs}
+
+    for subscription in subscriptions:
+        subscription._prefetched_last_billing_log = billing_logs.get(subscription.pk)
+
+
+class BillingSnapshot(object):
+    """
+    An in-memory view of everything needed to bill a batch of customers.
+
+    The subscriptions of the given customers are loaded together with their plans, providers,
+    metered features, latest billing logs and the metered feature units logs that haven't been
+    billed yet, using a fixed number of queries regardless of the batch size.
+
+    The loaded subscriptions carry the prefetched data, so `Subscription.last_billing_log` and
+    the `Subscription._add_*` helpers read it instead of querying the database.
+
+    If a `billing_date` is given, only the subscriptions that might be due for billing on that
+    date are loaded (see `SubscriptionQuerySet.due_for_billing`).
+    """
+
+    billable_states = [Subscription.STATES.ACTIVE, Subscription.STATES.CANCELED]
+
+    def __init__(self, customers, billing_date=None):
+        self.customer_ids = [customer.pk for customer in customers]
+        self.billing_date = billing_date
+        self.loaded_at = None
+        self._subscriptions = defaultdict(list)
+
+    def load(self):
+        self.loaded_at = timezone.now()
+        self._subscriptions = defaultdict(list)
+
+        subscriptions = list(self._get_subscriptions_queryset())
+        if not subscriptions:
+            return self
+
+        self._prefetch_last_billing_logs(subscriptions)
+        self._prefetch_mf_log_entries(subscriptions)
+
+        for subscription in subscriptions:
+            self._subscriptions[subscription.customer_id].append(subscription)
+
+        return self
+
+    def reload_customer(self, customer):
+        """
+        Replaces the snapshot data of a single customer with fresh data from the database.
+        """
+
+        snapshot = BillingSnapshot([customer], self.billing_date).load()
+        self._subscriptions[customer.pk] = snapshot.subscriptions(customer)
+
+    def is_stale(self, customer):
+        """
+        Tells if the customer has been billed since the snapshot was loaded, for example by
+        another billing run.
+        """
+
+        return BillingLog.objects.filter(
+            subscription__customer_id=customer.pk, created_at__gte=self.loaded_at
+        ).exists()
+
+    def subscriptions(self, customer):
+        return self._subscriptions.get(customer.pk, [])
+
+    def _get_subscriptions_queryset(self):
+        metered_features = MeteredFeature.objects.select_related('product_code',
+                                                                 'linked_feature')
+
+        subscriptions = Subscription.objects.filter(
+            customer_id__in=self.customer_ids, state__in=self.billable_states
+        )
+        if self.billing_date:
+            subscriptions = subscriptions.due_for_billing(self.billing_date)
+
+        return subscriptions.select_related(
+            'customer', 'plan__provider', 'plan__product_code', 'linked_subscription'
+        ).prefetch_related(
+            Prefetch('plan__metered_features', queryset=metered_features)
+        ).order_by('pk')
+
+    def _prefetch_last_billing_logs(self, subscriptions):
+        prefetch_last_billing_logs(subscriptions)
+
+    def _prefetch_mf_log_entries(self, subscriptions):
+        # Only the logs ending after the metered features billed up to date can still be billed
+        billed_up_to = {}
+        for subscription in subscriptions:
+            billing_log = subscription._prefetched_last_billing_log
+            if billing_log:
+                billed_up_to[subscription.pk] = billing_log.metered_features_billed_up_to
+            elif subscription.start_date:
+                billed_up_to[subscription.pk] = subscription.start_date - ONE_DAY
+
+        mf_log_entries = MeteredFeatureUnitsLog.objects.filter(subscription__in=subscriptions)
+        if len(billed_up_to) == len(subscriptions):
+            mf_log_entries = mf_log_entries.filter(end_date__gt=min(billed_up_to.values()))
+
+        entries_by_subscription = defaultdict(list)
+        for log_entry in mf_log_entries:
+            subscription_billed_up_to = billed_up_to.get(log_entry.subscription_id)
+            if subscription_billed_up_to and log_entry.end_date <= subscription_billed_up_to:
+                continue
+
+            entries_by_subscription[log_entry.subscription_id].append(log_entry)
+
+        for subscription in subscriptions:
+            subscription._prefetched_mf_log_entries = entries_by_subscription[subscription.pk]
@@ -19,16 +19,102 @@ import logging
 
 from decimal import Decimal
 
+from django.conf import settings
+from django.db.models import QuerySet
 from django.utils import timezone
 
-from silver.models import Customer, Subscription, Proforma, Invoice, Provider, BillingLog
+from silver.billing_snapshot import BillingSnapshot
+from silver.instrumentation import instrumented
+from silver.metered_usage import prepare_metered_usage
+from silver.models import (Customer, Subscription, Proforma, Invoice, Provider, BillingLog,
+                           DocumentEntry)
 from silver.utils.dates import ONE_DAY
+from silver.utils.models import BulkCreateAccumulator
 
 
 logger = logging.getLogger(__name__)
 
+DOCS_GENERATION_BATCH_SIZE = getattr(settings, 'DOCS_GENERATION_BATCH_SIZE',
+                                     100)  # default 100 customers per billing snapshot
+
+
+def batches(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+class BillingAccumulator(object):
+    """
+    Collects the document entries and billing logs created while billing a customer, so that
+    they are inserted with one `bulk_create` statement per model instead of one INSERT each.
+    """
+
+    def __init__(self):
+        self.entries = BulkCreateAccumulator(DocumentEntry, batch_size=DOCS_GENERATION_BATCH_SIZE)
+        self.billing_logs = BulkCreateAccumulator(BillingLog,
+                                                  batch_size=DOCS_GENERATION_BATCH_SIZE)
+
+    def flush(self):
+        entries = self.entries.flush()
+        billing_logs = self.billing_logs.flush()
+
+        # The documents' totals are computed from the entries that were just inserted, instead
+        # of reading them back from the database. bulk_create doesn't send the post_save
+        # signals which would otherwise update them.
+        documents_entries = {}
+        for entry in entries:
+            entry.track_original_values()
+            documents_entries.setdefault(entry.document, []).append(entry)
+
+        for document, document_entries in documents_entries.items():
+            document._document_entries = document_entries
+            document.update_totals(entries=document_entries)
+
+        for billing_log in billing_logs:
+            billing_log.subscription._set_last_billing_log(billing_log)
+
+
+def customer_id_shards(customers, shard_size):
+    """
+    Splits the given customers into contiguous id ranges of at most `shard_size` customers.
+
+    :returns: a list of (first_customer_id, last_customer_id) tuples, both ends included.
+    """
+
+    shard_size = max(int(shard_size), 1)
+
+    shards = []
+    first_id = last_id = None
+    count = 0
+
+    customer_ids = customers.order_by('pk').values_list('pk', flat=True)
+    for customer_id in customer_ids.iterator():
+        if first_id is None:
+            first_id = customer_id
+
+        last_id = customer_id
+        count += 1
+
+        if count == shard_size:
+            shards.append((first_id, last_id))
+            first_id, count = None, 0
+
+    if first_id is not None:
+        shards.append((first_id, last_id))
+
+    return shards
+
 
 class DocumentsGenerator(object):
+    @instrumented('documents_generator.generate')
     def generate(self, subscription=None, billing_date=None, customers=None,
                  force_generate=False):
         """
@@ -53,6 +139,9 @@ class DocumentsGenerator(object):
                 documents for all the customers will be generated.
         """
 
+        # The buffered metered features usage and the usage events must be billed too
+        prepare_metered_usage()
+
         if not subscription:
             customers = customers or Customer.objects.all()
             self._generate_all(billing_date=billing_date,
@@ -72,15 +161,40 @@ class DocumentsGenerator(object):
         billing_date = billing_date or timezone.now().date()
         # billing_date -> the date when the billing documents are issued.
 
-        for customer in customers:
-            if customer.consolidated_billing:
-                self._generate_for_user_with_consolidated_billing(
-                    customer, billing_date, force_generate
-                )
-            else:
-                self._generate_for_user_without_consolidated_billing(
-                    customer, billing_date, force_generate
-                )
+        if not force_generate and isinstance(customers, QuerySet):
+            due_subscriptions = Subscription.objects.due_for_billing(billing_date)
+            customers = customers.filter(pk__in=due_subscriptions.values('customer_id'))
+
+        for customers_batch in batches(customers, DOCS_GENERATION_BATCH_SIZE):
+            snapshot = BillingSnapshot(
+                customers_batch, billing_date=None if force_generate else billing_date
+            ).load()
+
+            for customer in customers_batch:
+                self.generate_for_customer(customer, billing_date, force_generate,
+                                           snapshot=snapshot)
+
+    def generate_for_customer(self, customer, billing_date, force_generate=False,
+                              snapshot=None):
+        """
+        Generates the invoices/proformas for a single customer.
+
+        This is the unit of work of a billing run. It is safe to call it again for a customer
+        that was already (partially) billed, since the subscriptions' billed up to dates are
+        read from their latest `BillingLog`.
+
+        :param snapshot: an optional, loaded `BillingSnapshot` containing the customer. If
+            passed, the customer's subscriptions and billing data are read from it.
+        """
+
+        if customer.consolidated_billing:
+            self._generate_for_user_with_consolidated_billing(
+                customer, billing_date, force_generate, snapshot
+            )
+        else:
+            self._generate_for_user_without_consolidated_billing(
+                customer, billing_date, force_generate, snapshot
+            )
 
     def _log_subscription_billing(self, document, subscription):
         logger.debug('Billing subscription: %s', {
@@ -92,18 +206,27 @@ class DocumentsGenerator(object):
             'customer': document.customer.id
         })
 
-    def get_subscriptions_prepared_for_billing(self, customer, billing_date, force_generate):
+    def get_subscriptions_prepared_for_billing(self, customer, billing_date, force_generate,
+                                               snapshot=None):
         # Select all the active or canceled subscriptions
         subs_to_bill = []
-        criteria = {'state__in': [Subscription.STATES.ACTIVE,
-                                  Subscription.STATES.CANCELED]}
-        for subscription in customer.subscriptions.filter(**criteria):
+        if snapshot:
+            subscriptions = snapshot.subscriptions(customer)
+        else:
+            criteria = {'state__in': [Subscription.STATES.ACTIVE,
+                                      Subscription.STATES.CANCELED]}
+            subscriptions = customer.subscriptions.filter(**criteria)
+            if not force_generate:
+                subscriptions = subscriptions.due_for_billing(billing_date)
+
+        for subscription in subscriptions:
             if subscription.should_be_billed(billing_date) or force_generate:
                 subs_to_bill.append(subscription)
 
         return subs_to_bill
 
-    def _bill_subscription_into_document(self, subscription, billing_date, document=None):
+    def _bill_subscription_into_document(self, subscription, billing_date, accumulator,
+                                         document=None):
         if not document:
             document = self._create_document(subscription, billing_date)
 
@@ -115,6 +238,7 @@ class DocumentsGenerator(object):
             'billing_date': billing_date,
             'subscription': subscription,
             subscription.provider.flow: document,
+            'accumulator': accumulator,
         })
         self.add_subscription_cycles_to_document(**kwargs)
 
@@ -124,7 +248,8 @@ class DocumentsGenerator(object):
 
         return document
 
-    def _generate_for_user_with_consolidated_billing(self, customer, billing_date, force_generate):
+    def _generate_for_user_with_consolidated_billing(self, customer, billing_date, force_generate,
+                                                     snapshot=None):
         """
         Generates the billing documents for all the subscriptions of a customer
         who uses consolidated billing.
@@ -135,35 +260,43 @@ class DocumentsGenerator(object):
         # => all the subscriptions belonging to the same provider will be added to the same document
 
         existing_provider_documents = {}
+        accumulator = BillingAccumulator()
         for subscription in self.get_subscriptions_prepared_for_billing(customer, billing_date,
-                                                                        force_generate):
+                                                                        force_generate, snapshot):
             provider = subscription.plan.provider
 
             existing_document = existing_provider_documents.get(provider)
 
             existing_provider_documents[provider] = self._bill_subscription_into_document(
-                subscription, billing_date, document=existing_document
+                subscription, billing_date, accumulator, document=existing_document
             )
 
+        accumulator.flush()
+
         for provider, document in existing_provider_documents.items():
             if provider.default_document_state == Provider.DEFAULT_DOC_STATE.ISSUED:
                 document.issue(issue_date=billing_date)
 
     def _generate_for_user_without_consolidated_billing(self, customer, billing_date,
-                                                        force_generate):
+                                                        force_generate, snapshot=None):
         """
         Generates the billing documents for all the subscriptions of a customer
         who does not use consolidated billing.
         """
 
         # The user does not use consolidated_billing => add each subscription to a separate document
+        documents = []
+        accumulator = BillingAccumulator()
         for subscription in self.get_subscriptions_prepared_for_billing(customer, billing_date,
-                                                                        force_generate):
-            provider = subscription.plan.provider
+                                                                        force_generate, snapshot):
+            documents.append(
+                self._bill_subscription_into_document(subscription, billing_date, accumulator)
+            )
 
-            document = self._bill_subscription_into_document(subscription, billing_date)
+        accumulator.flush()
 
-            if provider.default_document_state == Provider.DEFAULT_DOC_STATE.ISSUED:
+        for document in documents:
+            if document.provider.default_document_state == Provider.DEFAULT_DOC_STATE.ISSUED:
                 document.issue(issue_date=billing_date)
 
     def _generate_for_single_subscription(self, subscription=None, billing_date=None,
@@ -180,14 +313,30 @@ class DocumentsGenerator(object):
         if not subscription.should_be_billed(billing_date) or force_generate:
             return
 
-        document = self._bill_subscription_into_document(subscription, billing_date)
+        accumulator = BillingAccumulator()
+        document = self._bill_subscription_into_document(subscription, billing_date, accumulator)
+        accumulator.flush()
 
         if provider.default_document_state == Provider.DEFAULT_DOC_STATE.ISSUED:
             document.issue(issue_date=billing_date)
 
     def add_subscription_cycles_to_document(self, billing_date, metered_features_billed_up_to,
                                             plan_billed_up_to, subscription,
-                                            proforma=None, invoice=None):
+                                            proforma=None, invoice=None, accumulator=None):
+        """
+        Adds the entries for the subscription's unbilled cycles to the document and logs the
+        billing.
+
+        :param accumulator: an optional `BillingAccumulator` collecting the entries and the
+            billing log. If passed, it's up to the caller to flush it; otherwise the rows are
+            inserted before returning.
+        """
+
+        flush = accumulator is None
+        if flush:
+            accumulator = BillingAccumulator()
+        entries = accumulator.entries
+
         relative_start_date = metered_features_billed_up_to + ONE_DAY
         plan_now_billed_up_to = plan_billed_up_to
         metered_features_now_billed_up_to = metered_features_billed_up_to
@@ -234,11 +383,13 @@ class DocumentsGenerator(object):
                 if subscription.on_trial(relative_start_date):
                     plan_amount += subscription._add_plan_trial(start_date=relative_start_date,
                                                                 end_date=relative_end_date,
-                                                                invoice=invoice, proforma=proforma)
+                                                                invoice=invoice, proforma=proforma,
+                                                                entries=entries)
                 else:
                     plan_amount += subscription._add_plan_value(start_date=relative_start_date,
                                                                 end_date=relative_end_date,
-                                                                proforma=proforma, invoice=invoice)
+                                                                proforma=proforma, invoice=invoice,
+                                                                entries=entries)
                 plan_now_billed_up_to = relative_end_date
 
             # Only bill metered features if the cycle the metered features belong to has ended
@@ -250,12 +401,12 @@ class DocumentsGenerator(object):
                 if subscription.on_trial(relative_start_date):
                     metered_features_amount += subscription._add_mfs_for_trial(
                         start_date=relative_start_date, end_date=relative_end_date,
-                        invoice=invoice, proforma=proforma
+                        invoice=invoice, proforma=proforma, entries=entries
                     )
                 else:
                     metered_features_amount += subscription._add_mfs(
                         start_date=relative_start_date, end_date=relative_end_date,
-                        proforma=proforma, invoice=invoice
+                        proforma=proforma, invoice=invoice, entries=entries
                     )
 
                 metered_features_now_billed_up_to = relative_end_date
@@ -266,14 +417,19 @@ class DocumentsGenerator(object):
             if relative_end_date == subscription.cancel_date:
                 break
 
-        BillingLog.objects.create(subscription=subscription,
-                                  invoice=invoice, proforma=proforma,
-                                  total=plan_amount + metered_features_amount,
-                                  plan_amount=plan_amount,
-                                  metered_features_amount=metered_features_amount,
-                                  billing_date=billing_date,
-                                  metered_features_billed_up_to=metered_features_now_billed_up_to,
-                                  plan_billed_up_to=plan_now_billed_up_to)
+        accumulator.billing_logs.add(
+            subscription=subscription,
+            invoice=invoice, proforma=proforma,
+            total=plan_amount + metered_features_amount,
+            plan_amount=plan_amount,
+            metered_features_amount=metered_features_amount,
+            billing_date=billing_date,
+            metered_features_billed_up_to=metered_features_now_billed_up_to,
+            plan_billed_up_to=plan_now_billed_up_to
+        )
+
+        if flush:
+            accumulator.flush()
 
     def _create_document(self, subscription, billing_date):
         provider = subscription.provider
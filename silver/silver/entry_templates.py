@@ -0,0 +1,167 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, unicode_literals
+
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.dispatch import receiver
+from django.template import TemplateDoesNotExist
+from django.template.loader import get_template
+from django.test.signals import setting_changed
+from django.utils.encoding import force_text
+from django.utils.formats import localize
+from django.utils.html import conditional_escape
+
+
+ENTRY_TEMPLATES_CACHE_TIMEOUT = getattr(settings, 'ENTRY_TEMPLATES_CACHE_TIMEOUT',
+                                        60)  # default 60 seconds
+
+BUNDLED_TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+
+def provider_template_path(field, provider):
+    return 'billing_documents/{provider}/{field}.html'.format(provider=provider, field=field)
+
+
+def default_template_path(field):
+    return 'billing_documents/{field}.html'.format(field=field)
+
+
+def _value(value):
+    # Mirrors the way the template engine outputs a variable: localized and autoescaped
+    return conditional_escape(force_text(localize(value)))
+
+
+def _describe_entry(context):
+    entry_context = context['context']
+    name, start_date, end_date = (_value(context['name']), _value(context['start_date']),
+                                  _value(context['end_date']))
+
+    if entry_context == 'plan':
+        return '{name} Plan {interval} {prorated}Subscription ({start} - {end})'.format(
+            name=name, interval=_value(context['plan'].interval),
+            prorated='Prorated ' if context['prorated'] else '',
+            start=start_date, end=end_date
+        )
+    elif entry_context == 'plan-trial':
+        return '{} plan trial subscription ({} - {})'.format(name, start_date, end_date)
+    elif entry_context == 'plan-trial-discount':
+        return '{} plan trial discount ({} - {})'.format(name, start_date, end_date)
+    elif entry_context == 'metered-feature':
+        return 'Extra {} ({} - {}). Used {} / {}.'.format(
+            name, start_date, end_date,
+            _value(context['unit']), _value(context.get('included', ''))
+        )
+    elif entry_context == 'metered-feature-trial':
+        return '{} ({} - {}).'.format(name, start_date, end_date)
+    elif entry_context == 'metered-feature-trial-discount':
+        return '{} ({} - {}) trial discount.'.format(name, start_date, end_date)
+    elif entry_context == 'metered-feature-trial-not-discounted':
+        return 'Extra {} During Trial ({} - {})'.format(name, start_date, end_date)
+
+    return '{} ({} - {}).'.format(name, start_date, end_date)
+
+
+def _unit_entry(context):
+    if context['context'] in ('plan', 'plan-trial', 'plan-trial-discount'):
+        return '{}s'.format(_value(context['unit']))
+
+    return _value(context['unit'])
+
+
+# Python equivalents of silver's billing_documents/entry_*.html templates, used when they are
+# not overridden.
+BUNDLED_TEMPLATES_FORMATTERS = {
+    'entry_description': _describe_entry,
+    'entry_unit': _unit_entry,
+}
+
+
+class EntryTemplatesCache(object):
+    """
+    Caches, for each provider, the compiled template used for rendering the document entries'
+    fields.
+
+    Providers without a template of their own (most of them) are cached as well, so the
+    template loaders are only probed once per timeout. When silver's own template is the one
+    in use, the entry is formatted directly in Python instead of being rendered.
+    """
+
+    def __init__(self, timeout=ENTRY_TEMPLATES_CACHE_TIMEOUT):
+        self.timeout = timeout
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._templates = {}
+
+    def get_template(self, field, provider=None):
+        """
+        :returns: a (template, is_bundled) tuple, is_bundled telling if the template is
+            the one shipped with silver.
+        """
+
+        key = (field, provider)
+        now = time.time()
+
+        cached = self._templates.get(key)
+        if cached and (self.timeout is None or now - cached[2] < self.timeout):
+            return cached[0], cached[1]
+
+        template = self._resolve_template(field, provider)
+        is_bundled = self._is_bundled(template, field)
+        with self._lock:
+            self._templates[key] = (template, is_bundled, now)
+
+        return template, is_bundled
+
+    def _resolve_template(self, field, provider):
+        if provider:
+            try:
+                return get_template(provider_template_path(field, provider))
+            except TemplateDoesNotExist:
+                pass
+
+        return get_template(default_template_path(field))
+
+    def _is_bundled(self, template, field):
+        origin = getattr(template, 'origin', None)
+        if not origin or not origin.name:
+            return False
+
+        bundled_path = os.path.join(BUNDLED_TEMPLATES_DIR, default_template_path(field))
+        return os.path.abspath(origin.name) == bundled_path
+
+    def render(self, field, context, provider=None):
+        template, is_bundled = self.get_template(field, provider)
+
+        if is_bundled and field in BUNDLED_TEMPLATES_FORMATTERS:
+            # The templates are wrapped in {% spaceless %}, followed by the file's last newline
+            return BUNDLED_TEMPLATES_FORMATTERS[field](context).strip() + '\n'
+
+        return template.render(context)
+
+
+entry_templates = EntryTemplatesCache()
+
+
+@receiver(setting_changed)
+def clear_entry_templates_cache(sender, setting, **kwargs):
+    if setting == 'TEMPLATES':
+        entry_templates.clear()
@@ -0,0 +1,249 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import csv
+import json
+
+from collections import OrderedDict
+
+import six
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.http import StreamingHttpResponse
+from django.utils.encoding import force_text
+
+from silver.models import BillingDocumentBase, DocumentEntry, Transaction
+
+
+EXPORT_CHUNK_SIZE = getattr(settings, 'EXPORT_CHUNK_SIZE', 1000)  # default 1000 rows
+
+
+class Export(object):
+    """
+    A flat export of billing data.
+
+    The rows are read as tuples of the `columns`' lookups, in chunks of `chunk_size` rows
+    keyed on the primary key (not through `iterator()`, which buffers the whole result set
+    on MySQL), and are rendered as they are read, so the memory used doesn't depend on the
+    size of the export.
+    """
+
+    model = None
+    # (column, lookup) pairs
+    columns = ()
+    date_lookup = None
+    chunk_size = EXPORT_CHUNK_SIZE
+
+    def __init__(self, start_date=None, end_date=None):
+        self.start_date = start_date
+        self.end_date = end_date
+
+    @property
+    def column_names(self):
+        return [column for column, _ in self.columns]
+
+    def get_queryset(self):
+        return self.model.objects.all()
+
+    def filter_dates(self, queryset):
+        if self.start_date:
+            queryset = queryset.filter(**{self.date_lookup + '__gte': self.start_date})
+        if self.end_date:
+            queryset = queryset.filter(**{self.date_lookup + '__lte': self.end_date})
+
+        return queryset
+
+    def rows(self):
+        queryset = self.filter_dates(self.get_queryset()).order_by('pk').values_list(
+            'pk', *[lookup for _, lookup in self.columns]
+        )
+
+        last_pk = None
+        while True:
+            chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+            chunk = list(chunk[:self.chunk_size])
+
+            for row in chunk:
+                yield row[1:]
+
+            if len(chunk) < self.chunk_size:
+                return
+
+            last_pk = chunk[-1][0]
+
+
+class DocumentsExport(Export):
+    model = BillingDocumentBase
+    kind = None
+    columns = (
+        ('id', 'id'),
+        ('series', 'series'),
+        ('number', 'number'),
+        ('state', 'state'),
+        ('provider', 'provider_id'),
+        ('customer', 'customer_id'),
+        ('customer_reference', 'customer__customer_reference'),
+        ('related_document', 'related_document_id'),
+        ('issue_date', 'issue_date'),
+        ('due_date', 'due_date'),
+        ('paid_date', 'paid_date'),
+        ('cancel_date', 'cancel_date'),
+        ('currency', 'currency'),
+        ('sales_tax_name', 'sales_tax_name'),
+        ('sales_tax_percent', 'sales_tax_percent'),
+        ('total_before_tax', '_total_before_tax'),
+        ('tax_value', '_tax_value'),
+        ('total', '_total'),
+        ('transaction_currency', 'transaction_currency'),
+        ('transaction_xe_rate', 'transaction_xe_rate'),
+        ('transaction_xe_date', 'transaction_xe_date'),
+        ('total_in_transaction_currency', '_total_in_transaction_currency'),
+    )
+    date_lookup = 'issue_date'
+
+    def get_queryset(self):
+        return BillingDocumentBase.objects.filter(kind=self.kind)
+
+
+class InvoicesExport(DocumentsExport):
+    kind = 'invoice'
+
+
+class ProformasExport(DocumentsExport):
+    kind = 'proforma'
+
+
+class DocumentEntriesExport(Export):
+    model = DocumentEntry
+    columns = (
+        ('id', 'id'),
+        ('invoice', 'invoice_id'),
+        ('proforma', 'proforma_id'),
+        ('description', 'description'),
+        ('product_code', 'product_code__value'),
+        ('unit', 'unit'),
+        ('quantity', 'quantity'),
+        ('unit_price', 'unit_price'),
+        ('start_date', 'start_date'),
+        ('end_date', 'end_date'),
+        ('prorated', 'prorated'),
+    )
+
+    def filter_dates(self, queryset):
+        if not (self.start_date or self.end_date):
+            return queryset
+
+        # The entries are exported along with the documents they belong to
+        query = Q()
+        for kind in ('invoice', 'proforma'):
+            dates = {}
+            if self.start_date:
+                dates['{}__issue_date__gte'.format(kind)] = self.start_date
+            if self.end_date:
+                dates['{}__issue_date__lte'.format(kind)] = self.end_date
+
+            query |= Q(**dates)
+
+        return queryset.filter(query)
+
+
+class TransactionsExport(Export):
+    model = Transaction
+    columns = (
+        ('id', 'id'),
+        ('uuid', 'uuid'),
+        ('state', 'state'),
+        ('amount', 'amount'),
+        ('currency', 'currency'),
+        ('invoice', 'invoice_id'),
+        ('proforma', 'proforma_id'),
+        ('payment_method', 'payment_method_id'),
+        ('external_reference', 'external_reference'),
+        ('created_at', 'created_at'),
+        ('updated_at', 'updated_at'),
+        ('fail_code', 'fail_code'),
+        ('refund_code', 'refund_code'),
+        ('cancel_code', 'cancel_code'),
+    )
+    date_lookup = 'created_at__date'
+
+
+EXPORTS = OrderedDict([
+    ('invoices', InvoicesExport),
+    ('proformas', ProformasExport),
+    ('document-entries', DocumentEntriesExport),
+    ('transactions', TransactionsExport),
+])
+
+
+def ndjson_lines(export):
+    column_names = export.column_names
+    for row in export.rows():
+        yield json.dumps(OrderedDict(zip(column_names, row)), cls=DjangoJSONEncoder) + '\n'
+
+
+class _Echo(object):
+    # A file-like object for csv.writer, which returns the written lines instead
+    def write(self, value):
+        return value
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+
+    value = force_text(value.isoformat() if hasattr(value, 'isoformat') else value)
+
+    return value.encode('utf-8') if six.PY2 else value
+
+
+def csv_lines(export):
+    writer = csv.writer(_Echo())
+
+    yield writer.writerow([_csv_value(column) for column in export.column_names])
+    for row in export.rows():
+        yield writer.writerow([_csv_value(value) for value in row])
+
+
+EXPORT_FORMATS = OrderedDict([
+    ('ndjson', (ndjson_lines, 'application/x-ndjson')),
+    ('csv', (csv_lines, 'text/csv')),
+])
+
+
+def export_lines(resource, export_format, start_date=None, end_date=None):
+    """
+    :returns: a generator of the export's lines.
+    """
+
+    render_lines, _ = EXPORT_FORMATS[export_format]
+
+    return render_lines(EXPORTS[resource](start_date=start_date, end_date=end_date))
+
+
+def export_response(resource, export_format, start_date=None, end_date=None):
+    _, content_type = EXPORT_FORMATS[export_format]
+
+    response = StreamingHttpResponse(
+        export_lines(resource, export_format, start_date=start_date, end_date=end_date),
+        content_type=content_type
+    )
+    response['Content-Disposition'] = 'attachment; filename="{}.{}"'.format(resource,
+                                                                            export_format)
+
+    return response
@@ -0,0 +1,342 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Query count and latency instrumentation of the billing stages and of the API endpoints.
+
+A stage records the number of queries it ran, the time spent in the database, its wall time
+and the number of rows it inserted. The finished stages are logged and aggregated in
+per-process metrics, which can be exposed in the Prometheus text format (see `metrics_view`).
+"""
+
+from __future__ import absolute_import
+
+import logging
+import threading
+import time
+
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+import six
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse
+from django.utils.deprecation import MiddlewareMixin
+
+
+logger = logging.getLogger(__name__)
+
+
+SILVER_INSTRUMENTATION = getattr(settings, 'SILVER_INSTRUMENTATION',
+                                 False)  # default disabled
+
+# The upper bounds (in seconds) of the stages' wall time histogram buckets
+WALL_TIME_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, float('inf'))
+
+
+_local = threading.local()
+
+
+def _active_stages():
+    if not hasattr(_local, 'stages'):
+        _local.stages = []
+
+    return _local.stages
+
+
+class _InstrumentedCursor(object):
+    """
+    Wraps the cursors Django hands out (debug or not), timing the executed queries into the
+    active stages of the current thread.
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self.cursor.__exit__(exc_type, exc_value, traceback)
+
+    def _observe(self, method, sql, params):
+        rowcount = -1
+        started_at = time.time()
+        try:
+            result = method(sql, params)
+            rowcount = self.cursor.rowcount
+            return result
+        finally:
+            duration = time.time() - started_at
+            for stage in _active_stages():
+                stage.observe_query(sql, duration, rowcount)
+
+    def execute(self, sql, params=None):
+        return self._observe(self.cursor.execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self._observe(self.cursor.executemany, sql, param_list)
+
+
+def _install(connection):
+    if getattr(connection, '_silver_instrumented', False):
+        return
+
+    # The instance attributes shadow the DatabaseWrapper's methods, so the cursors keep being
+    # created (and logged, when DEBUG is set) as usual before being wrapped.
+    make_cursor, make_debug_cursor = connection.make_cursor, connection.make_debug_cursor
+    connection.make_cursor = lambda cursor: _InstrumentedCursor(make_cursor(cursor))
+    connection.make_debug_cursor = lambda cursor: _InstrumentedCursor(make_debug_cursor(cursor))
+    connection._silver_instrumented = True
+
+
+def _uninstall(connection):
+    if not getattr(connection, '_silver_instrumented', False):
+        return
+
+    del connection.make_cursor
+    del connection.make_debug_cursor
+    connection._silver_instrumented = False
+
+
+class Stage(object):
+    """
+    The metrics of a unit of work. The stages can be nested, the queries being accounted in
+    all the active stages of the thread.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.queries = 0
+        self.db_time = 0.0
+        self.wall_time = 0.0
+        self.rows_created = 0
+        self.started_at = None
+
+    def observe_query(self, sql, duration, rowcount):
+        self.queries += 1
+        self.db_time += duration
+
+        if (rowcount > 0 and isinstance(sql, six.string_types) and
+                sql.lstrip()[:6].upper() == 'INSERT'):
+            self.rows_created += rowcount
+
+    def start(self):
+        stages = _active_stages()
+        if not stages:
+            for connection in connections.all():
+                _install(connection)
+
+        stages.append(self)
+        self.started_at = time.time()
+
+        return self
+
+    def stop(self):
+        self.wall_time = time.time() - self.started_at
+
+        stages = _active_stages()
+        if self in stages:
+            stages.remove(self)
+        if not stages:
+            for connection in connections.all():
+                _uninstall(connection)
+
+        registry.observe(self)
+        logger.info('Stage metrics: %s', self.report())
+
+        return self
+
+    def report(self):
+        return OrderedDict([
+            ('stage', self.name),
+            ('queries', self.queries),
+            ('db_time', round(self.db_time, 6)),
+            ('wall_time', round(self.wall_time, 6)),
+            ('rows_created', self.rows_created),
+        ])
+
+
+@contextmanager
+def instrument(name, enabled=None):
+    """
+    Records the metrics of the wrapped block as a stage named `name`.
+
+    :param enabled: overrides the SILVER_INSTRUMENTATION setting.
+    :returns: the stage, or None if the instrumentation is disabled.
+    """
+
+    if not (SILVER_INSTRUMENTATION if enabled is None else enabled):
+        yield None
+        return
+
+    stage = Stage(name).start()
+    try:
+        yield stage
+    finally:
+        stage.stop()
+
+
+def instrumented(name):
+    """
+    Decorates a function, instrumenting its calls as a stage named `name`.
+    """
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with instrument(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class MetricsRegistry(object):
+    """
+    Aggregates the finished stages of the current process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.stages = OrderedDict()
+
+    def observe(self, stage):
+        with self._lock:
+            metrics = self.stages.get(stage.name)
+            if metrics is None:
+                metrics = self.stages[stage.name] = {
+                    'calls': 0,
+                    'queries': 0,
+                    'db_time': 0.0,
+                    'wall_time': 0.0,
+                    'rows_created': 0,
+                    'buckets': [0] * len(WALL_TIME_BUCKETS),
+                }
+
+            metrics['calls'] += 1
+            metrics['queries'] += stage.queries
+            metrics['db_time'] += stage.db_time
+            metrics['wall_time'] += stage.wall_time
+            metrics['rows_created'] += stage.rows_created
+            metrics['buckets'][bisect_left(WALL_TIME_BUCKETS, stage.wall_time)] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return OrderedDict(
+                (name, dict(metrics, buckets=list(metrics['buckets'])))
+                for name, metrics in self.stages.items()
+            )
+
+
+registry = MetricsRegistry()
+
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _bound(value):
+    return '+Inf' if value == float('inf') else repr(float(value))
+
+
+def render_metrics():
+    """
+    :returns: the metrics of the current process, in the Prometheus text exposition format.
+    """
+
+    stages = registry.snapshot()
+    lines = []
+
+    counters = (
+        ('silver_stage_calls_total', 'calls', 'The number of finished stages.'),
+        ('silver_stage_queries_total', 'queries', 'The number of queries run by the stages.'),
+        ('silver_stage_db_seconds_total', 'db_time',
+         'The time the stages spent running queries.'),
+        ('silver_stage_rows_created_total', 'rows_created',
+         'The number of rows inserted by the stages.'),
+    )
+    for metric, key, help_text in counters:
+        lines.append('# HELP {} {}'.format(metric, help_text))
+        lines.append('# TYPE {} counter'.format(metric))
+        for name, metrics in stages.items():
+            lines.append('{}{{stage="{}"}} {}'.format(metric, _label(name), metrics[key]))
+
+    metric = 'silver_stage_wall_seconds'
+    lines.append('# HELP {} The wall time of the stages.'.format(metric))
+    lines.append('# TYPE {} histogram'.format(metric))
+    for name, metrics in stages.items():
+        cumulative = 0
+        for bound, count in zip(WALL_TIME_BUCKETS, metrics['buckets']):
+            cumulative += count
+            lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(
+                metric, _label(name), _bound(bound), cumulative
+            ))
+        lines.append('{}_sum{{stage="{}"}} {}'.format(metric, _label(name),
+                                                      metrics['wall_time']))
+        lines.append('{}_count{{stage="{}"}} {}'.format(metric, _label(name), metrics['calls']))
+
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4')
+
+
+class InstrumentationMiddleware(MiddlewareMixin):
+    """
+    Instruments the requests as stages named after the method and the URL name of their view,
+    adding a Server-Timing header to the responses.
+
+    The queries run while streaming a response's content are not accounted.
+    """
+
+    def process_request(self, request):
+        if SILVER_INSTRUMENTATION:
+            request._silver_stage = Stage('{} unresolved'.format(request.method)).start()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        stage = getattr(request, '_silver_stage', None)
+        if stage and request.resolver_match:
+            stage.name = '{} {}'.format(request.method,
+                                        request.resolver_match.view_name or 'unnamed')
+
+    def process_response(self, request, response):
+        stage = getattr(request, '_silver_stage', None)
+        if not stage:
+            return response
+
+        del request._silver_stage
+        stage.stop()
+
+        response['Server-Timing'] = 'db;desc="{} queries";dur={:.1f}, total;dur={:.1f}'.format(
+            stage.queries, stage.db_time * 1000, stage.wall_time * 1000
+        )
+
+        return response
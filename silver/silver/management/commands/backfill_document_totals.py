@@ -0,0 +1,76 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import logging
+
+from functools import reduce
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from silver.models import BillingDocumentBase
+from silver.models.documents.entries import DOCUMENT_TOTALS
+
+
+logger = logging.getLogger(__name__)
+
+
+def documents_in_batches(documents, batch_size):
+    document_ids = list(documents.order_by('pk').values_list('pk', flat=True))
+
+    for index in range(0, len(document_ids), batch_size):
+        batch = BillingDocumentBase.objects.filter(
+            pk__in=document_ids[index:index + batch_size]
+        ).with_totals_entries().order_by('pk')
+
+        for document in batch:
+            yield document
+
+
+class Command(BaseCommand):
+    help = 'Fills in the denormalized totals of the billing documents that are missing them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all',
+                            action='store_true', dest='all', default=False,
+                            help='Recompute the totals of all the documents, overwriting the '
+                                 'existing ones.')
+        parser.add_argument('--batch-size',
+                            action='store', dest='batch_size', type=int, default=500,
+                            help='The number of documents loaded at once.')
+
+    def handle(self, *args, **options):
+        documents = BillingDocumentBase.objects.all()
+        if not options['all']:
+            documents = documents.filter(
+                reduce(lambda x, y: x | y,
+                       [Q(**{'%s__isnull' % field: True}) for field in DOCUMENT_TOTALS])
+            )
+
+        updated = 0
+        for document in documents_in_batches(documents, options['batch_size']):
+            totals = document.compute_totals(entries=document.entries)
+
+            if not options['all']:
+                # Keep the already existing totals, like the ones computed when issuing
+                totals = {field: value for field, value in totals.items()
+                          if getattr(document, field) is None}
+
+            BillingDocumentBase.objects.filter(pk=document.pk).update(**totals)
+            updated += 1
+
+        logger.info('Backfilled the totals of %s documents.', updated)
+        self.stdout.write('Updated the totals of {} documents.'.format(updated))
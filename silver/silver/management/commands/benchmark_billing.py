@@ -0,0 +1,115 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import io
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+from silver.benchmarks import BillingBenchmark, SyntheticTenants
+from silver.management.commands.check_overpayments import date
+
+
+class Command(BaseCommand):
+    help = ('Generates synthetic tenants in bulk and times the billing documents generation, '
+            'the PDFs generation, the overpayment checks, the transaction retries and the hot '
+            'list endpoints over them, writing the results as JSON. The generated data is rolled '
+            'back at the end, unless --keep is passed.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--providers',
+                            action='store', dest='providers', type=int, default=2,
+                            help='The number of providers.')
+        parser.add_argument('--customers',
+                            action='store', dest='customers', type=int, default=100,
+                            help='The number of customers.')
+        parser.add_argument('--subscriptions',
+                            action='store', dest='subscriptions', type=int, default=2,
+                            help='The number of subscriptions per customer.')
+        parser.add_argument('--metered-features',
+                            action='store', dest='metered_features', type=int, default=3,
+                            help='The number of metered features per provider.')
+        parser.add_argument('--usage-events',
+                            action='store', dest='usage_events', type=int, default=2,
+                            help='The number of usage events per subscription and metered '
+                                 'feature.')
+        parser.add_argument('--billing-date',
+                            action='store', dest='billing_date', type=date,
+                            help='The billing date (format YYYY-MM-DD). Defaults to today.')
+        parser.add_argument('--max-age-days',
+                            action='store', dest='max_age_days', type=int, default=45,
+                            help='The subscriptions start up to this many days before the '
+                                 'billing date.')
+        parser.add_argument('--payment-processor',
+                            action='store', dest='payment_processor',
+                            help='The payment processor of the payment methods. Defaults to '
+                                 'the first one configured.')
+        parser.add_argument('--seed',
+                            action='store', dest='seed', type=int, default=0,
+                            help='The seed of the generated data.')
+        parser.add_argument('--pdfs',
+                            action='store', dest='pdfs', type=int, default=100,
+                            help='The number of PDFs to generate. 0 skips the PDFs generation.')
+        parser.add_argument('--requests',
+                            action='store', dest='requests', type=int, default=5,
+                            help='The number of requests per endpoint. 0 skips the endpoints.')
+        parser.add_argument('--page-size',
+                            action='store', dest='page_size', type=int, default=100,
+                            help='The page size of the endpoints\' requests.')
+        parser.add_argument('--output',
+                            action='store', dest='output',
+                            help='The file to write the results to. Defaults to stdout.')
+        parser.add_argument('--keep',
+                            action='store_true', dest='keep', default=False,
+                            help='Keep the generated data.')
+
+    def handle(self, *args, **options):
+        if options['providers'] < 1 or options['subscriptions'] < 1:
+            raise CommandError('At least one provider and one subscription per customer '
+                               'are needed.')
+
+        payment_processor = options['payment_processor']
+        if not payment_processor and settings.PAYMENT_PROCESSORS:
+            payment_processor = sorted(settings.PAYMENT_PROCESSORS.keys())[0]
+
+        tenants = SyntheticTenants(providers=options['providers'],
+                                   customers=options['customers'],
+                                   subscriptions=options['subscriptions'],
+                                   metered_features=options['metered_features'],
+                                   usage_events=options['usage_events'],
+                                   billing_date=options['billing_date'],
+                                   max_age_days=max(options['max_age_days'], 1),
+                                   payment_processor=payment_processor,
+                                   seed=options['seed'])
+        benchmark = BillingBenchmark(tenants, pdfs=options['pdfs'],
+                                     requests=options['requests'],
+                                     page_size=options['page_size'])
+
+        with transaction.atomic():
+            results = benchmark.run()
+
+            if not options['keep']:
+                transaction.set_rollback(True)
+
+        output = json.dumps(results, indent=2, cls=DjangoJSONEncoder)
+        if options['output']:
+            with io.open(options['output'], 'w', encoding='utf-8') as output_file:
+                output_file.write(output + u'\n')
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,95 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import timeit
+
+from datetime import date
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.template.loader import render_to_string
+from django.utils import translation
+
+from silver.entry_templates import EntryTemplatesCache
+from silver.models import MeteredFeature, Plan, Provider
+from silver.models.subscriptions import field_template_path
+
+
+class Command(BaseCommand):
+    help = ('Measures the per-entry cost of rendering the document entries\' descriptions and '
+            'units, with and without the entry templates cache.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--entries',
+                            action='store', dest='entries', type=int, default=10000,
+                            help='The number of entries to render.')
+        parser.add_argument('--provider',
+                            action='store', dest='provider', default='benchmark',
+                            help='The provider slug used for looking up the templates.')
+
+    def _contexts(self, provider):
+        plan = Plan(name='Hosting', interval=Plan.INTERVALS.MONTH, provider=provider)
+        metered_feature = MeteredFeature(name='Bandwidth', unit='GB',
+                                         price_per_unit=Decimal('0.05'))
+
+        base_context = {
+            'name': plan.name, 'unit': plan.interval, 'plan': plan, 'provider': provider,
+            'start_date': date(2019, 1, 1), 'end_date': date(2019, 1, 31),
+            'prorated': False, 'proration_percentage': Decimal('1.0000'),
+            'product_code': None, 'metered_feature': None, 'customer': None,
+            'subscription': None
+        }
+
+        plan_context = dict(base_context, context='plan')
+        metered_feature_context = dict(base_context, context='metered-feature',
+                                       name=metered_feature.name, unit=metered_feature.unit,
+                                       metered_feature=metered_feature,
+                                       included=Decimal('100.0000'))
+
+        return [plan_context, metered_feature_context]
+
+    def handle(self, *args, **options):
+        translation.activate('en-us')
+
+        entries = max(options['entries'], 1)
+        provider = Provider(name='Benchmark', slug=options['provider'])
+        contexts = self._contexts(provider)
+
+        def render_uncached():
+            for context in contexts:
+                for field in ('entry_description', 'entry_unit'):
+                    render_to_string(field_template_path(field, provider=provider.slug),
+                                     context)
+
+        cache = EntryTemplatesCache()
+
+        def render_cached():
+            for context in contexts:
+                for field in ('entry_description', 'entry_unit'):
+                    cache.render(field, context, provider=provider.slug)
+
+        # Each call renders the description and the unit of `len(contexts)` entries
+        number = max(entries // len(contexts), 1)
+        rendered_entries = number * len(contexts)
+
+        for label, function in (('uncached', render_uncached), ('cached', render_cached)):
+            duration = timeit.timeit(function, number=number)
+
+            self.stdout.write('{label}: {per_entry:.2f} us per entry ({entries} entries in '
+                              '{duration:.3f} s)'.format(
+                                  label=label, entries=rendered_entries, duration=duration,
+                                  per_entry=duration * 10 ** 6 / rendered_entries
+                              ))
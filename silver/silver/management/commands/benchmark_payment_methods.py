@@ -0,0 +1,105 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import timeit
+
+from cryptography.fernet import Fernet
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from silver.benchmarks import _bulk_create
+from silver.models import Customer, PaymentMethod
+from silver.payment_processors import registry
+from silver.utils.payments import get_fernet
+
+
+class Command(BaseCommand):
+    help = ('Measures the per-row cost of loading payment methods in bulk, and compares the '
+            'payment processors registry and the cached Fernet with creating them on every '
+            'call. The generated payment methods are rolled back at the end.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--payment-methods',
+                            action='store', dest='payment_methods', type=int, default=10000,
+                            help='The number of payment methods to load.')
+        parser.add_argument('--payment-processor',
+                            action='store', dest='payment_processor',
+                            help='The payment processor of the payment methods. Defaults to '
+                                 'the first one configured.')
+        parser.add_argument('--repeat',
+                            action='store', dest='repeat', type=int, default=3,
+                            help='The number of measurements, the best one being reported.')
+
+    def _measure(self, label, function, count, repeat):
+        duration = min(timeit.repeat(function, number=1, repeat=repeat))
+
+        self.stdout.write('{label}: {per_row:.2f} us per row ({count} rows in '
+                          '{duration:.3f} s)'.format(
+                              label=label, count=count, duration=duration,
+                              per_row=duration * 10 ** 6 / count
+                          ))
+
+    def handle(self, *args, **options):
+        payment_processor = options['payment_processor']
+        if not payment_processor and settings.PAYMENT_PROCESSORS:
+            payment_processor = sorted(settings.PAYMENT_PROCESSORS.keys())[0]
+
+        if payment_processor not in settings.PAYMENT_PROCESSORS:
+            raise CommandError('No payment processor named {!r} is configured.'.format(
+                payment_processor
+            ))
+
+        count = max(options['payment_methods'], 1)
+        repeat = max(options['repeat'], 1)
+
+        with transaction.atomic():
+            customer = _bulk_create(Customer, [
+                Customer(first_name='Benchmark', last_name='Customer', country='US',
+                         address_1='1 Benchmark Avenue', city='Benchmark', currency='USD')
+            ])[0]
+            payment_methods = _bulk_create(PaymentMethod, [
+                PaymentMethod(payment_processor=payment_processor, customer=customer)
+                for _ in range(count)
+            ])
+            queryset = PaymentMethod.objects.filter(
+                pk__in=[payment_method.pk for payment_method in payment_methods]
+            )
+
+            self._measure('load', lambda: list(queryset), count, repeat)
+
+            transaction.set_rollback(True)
+
+        # What loading every payment method used to cost, besides the query
+        self._measure('processor created per row',
+                      lambda: [registry.create(payment_processor) for _ in range(count)],
+                      count, repeat)
+        self._measure('processor registry lookup per row',
+                      lambda: [registry.get_payment_method_class(payment_processor)
+                               for _ in range(count)],
+                      count, repeat)
+
+        data = b'4111111111111111'
+        token = get_fernet().encrypt(data)
+
+        self._measure('Fernet created per decryption',
+                      lambda: [Fernet(settings.PAYMENT_METHOD_SECRET).decrypt(token)
+                               for _ in range(count)],
+                      count, repeat)
+        self._measure('cached Fernet decryption',
+                      lambda: [get_fernet().decrypt(token) for _ in range(count)],
+                      count, repeat)
@@ -0,0 +1,73 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+
+from silver.management.commands.backfill_document_totals import documents_in_batches
+from silver.models import BillingDocumentBase
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ('Reports the billing documents whose denormalized totals differ from the totals '
+            'computed from their entries.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--state',
+                            action='store', dest='state',
+                            choices=[state for state, _ in BillingDocumentBase.STATE_CHOICES],
+                            help='Only check the documents in the given state.')
+        parser.add_argument('--batch-size',
+                            action='store', dest='batch_size', type=int, default=500,
+                            help='The number of documents loaded at once.')
+
+    def handle(self, *args, **options):
+        documents = BillingDocumentBase.objects.filter(_total__isnull=False)
+        if options['state']:
+            documents = documents.filter(state=options['state'])
+
+        drifted = 0
+        for document in documents_in_batches(documents, options['batch_size']):
+            totals = document.compute_totals(entries=document.entries)
+
+            differences = {
+                field: (getattr(document, field), value)
+                for field, value in totals.items()
+                if getattr(document, field) != value
+            }
+            if not differences:
+                continue
+
+            drifted += 1
+            logger.warning('Drifted totals for %s with id=%s: %s', document.kind, document.pk,
+                           differences)
+            for field in sorted(differences):
+                stored, computed = differences[field]
+                self.stdout.write('{kind} {id}: {field} is {stored}, expected {computed}'.format(
+                    kind=document.kind, id=document.pk, field=field,
+                    stored=stored, computed=computed
+                ))
+
+        if drifted:
+            raise CommandError('The totals of {} documents have drifted. Run '
+                               '`backfill_document_totals --all` to recompute them.'
+                               .format(drifted))
+
+        self.stdout.write('The totals of all the documents are consistent.')
@@ -0,0 +1,59 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import io
+
+from six import text_type
+
+from django.core.management.base import BaseCommand
+
+from silver.exports import EXPORT_FORMATS, EXPORTS, export_lines
+from silver.management.commands.check_overpayments import date
+
+
+class Command(BaseCommand):
+    help = 'Exports the invoices, proformas, document entries or transactions as NDJSON or CSV.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('resource', choices=list(EXPORTS))
+        parser.add_argument('--format',
+                            action='store', dest='export_format', default='ndjson',
+                            choices=list(EXPORT_FORMATS),
+                            help='The format of the exported rows.')
+        parser.add_argument('--start-date',
+                            action='store', dest='start_date', type=date,
+                            help='Export the rows dated on or after this date '
+                                 '(format YYYY-MM-DD).')
+        parser.add_argument('--end-date',
+                            action='store', dest='end_date', type=date,
+                            help='Export the rows dated on or before this date '
+                                 '(format YYYY-MM-DD).')
+        parser.add_argument('--output',
+                            action='store', dest='output',
+                            help='The file to write to. Defaults to the standard output.')
+
+    def handle(self, *args, **options):
+        lines = export_lines(options['resource'], options['export_format'],
+                             start_date=options['start_date'], end_date=options['end_date'])
+
+        if not options['output']:
+            for line in lines:
+                self.stdout.write(line, ending='')
+            return
+
+        with io.open(options['output'], 'w', encoding='utf-8', newline='') as output:
+            for line in lines:
+                output.write(line if isinstance(line, text_type) else line.decode('utf-8'))
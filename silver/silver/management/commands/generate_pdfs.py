@@ -16,24 +16,43 @@ from __future__ import absolute_import
 
 import logging
 
-from itertools import chain
-
 from django.core.management.base import BaseCommand
 
-from silver.models import Invoice, Proforma
+from silver.models import BillingDocumentBase
+from silver.pdf_rendering import PDFRenderingEngine
 
 
 logger = logging.getLogger(__name__)
 
 
 class Command(BaseCommand):
-    help = 'Generates the billing documents (Invoices, Proformas).'
+    help = 'Generates the PDFs of the billing documents (Invoices, Proformas).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes',
+                            action='store', dest='processes', type=int,
+                            help='The number of processes rendering the PDFs '
+                                 '(default: PDF_RENDERING_PROCESSES).')
+        parser.add_argument('--batch-size',
+                            action='store', dest='batch_size', type=int,
+                            help='The number of documents rendered at once '
+                                 '(default: PDF_RENDERING_BATCH_SIZE).')
 
     def handle(self, *args, **options):
-        for document in chain(Invoice.objects.filter(pdf__dirty__gt=0),
-                              Proforma.objects.filter(pdf__dirty__gt=0)):
-            try:
-                document.generate_pdf()
-            except:
-                logger.exception('Encountered exception while generating PDF for document '
-                                 'with id=%s.', document.id)
+        documents = BillingDocumentBase.objects.filter(pdf__dirty__gt=0)\
+                                               .select_related('pdf')\
+                                               .order_by('id')
+
+        engine = PDFRenderingEngine(processes=options['processes'],
+                                    batch_size=options['batch_size'])
+        report = engine.render(documents).report()
+
+        self.stdout.write(
+            'Generated {rendered} PDFs, skipped {skipped} unchanged and failed {failed} '
+            'in {elapsed:.2f}s ({throughput:.2f} documents/s).'.format(**report)
+        )
+        if report['rendered']:
+            self.stdout.write('Rendering latency: p50 {latency_p50:.3f}s, '
+                              'p95 {latency_p95:.3f}s'.format(**report))
+            for upper_bound, count in report['latency_histogram']:
+                self.stdout.write('  <= {}s: {}'.format(upper_bound, count))
@@ -0,0 +1,59 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from silver.models import Customer
+from silver.models.billing_entities.ledger import rebuild_customer_balance_ledger
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds the customers\' balance ledger from their paid invoices and settled '
+            'transactions.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--customer',
+                            action='store', dest='customer_id', type=int,
+                            help='The id of the customer whose ledger is rebuilt.')
+        parser.add_argument('--batch-size',
+                            action='store', dest='batch_size', type=int, default=1000,
+                            help='The number of customers rebuilt at once.')
+
+    def handle(self, *args, **options):
+        customers = Customer.all_objects.all()
+        if options['customer_id']:
+            customers = customers.filter(id=options['customer_id'])
+
+        customer_ids = list(customers.order_by('pk').values_list('pk', flat=True))
+        batch_size = options['batch_size']
+
+        entries = 0
+        for index in range(0, len(customer_ids), batch_size):
+            with transaction.atomic():
+                entries += rebuild_customer_balance_ledger(
+                    customer_ids[index:index + batch_size]
+                )
+
+        logger.info('Rebuilt the balance ledger of %s customers.', len(customer_ids))
+        self.stdout.write('Created {} ledger entries for {} customers.'.format(
+            entries, len(customer_ids)
+        ))
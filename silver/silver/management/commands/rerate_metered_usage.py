@@ -0,0 +1,67 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import logging
+
+from django.core.management.base import BaseCommand
+
+from silver.management.commands.check_overpayments import date
+from silver.metered_usage import UsageEventsRollup
+from silver.models import MeteredUsageEvent, Subscription
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ('Recomputes the metered features units logs of a period from the rolled up usage '
+            'events.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start-date',
+                            action='store', dest='start_date', type=date, required=True,
+                            help='The start of the period (format YYYY-MM-DD).')
+        parser.add_argument('--end-date',
+                            action='store', dest='end_date', type=date, required=True,
+                            help='The end of the period (format YYYY-MM-DD).')
+        parser.add_argument('--subscription',
+                            action='append', dest='subscription_ids', type=int,
+                            help='The id of a subscription to rerate. Defaults to the '
+                                 'subscriptions having usage events in the period.')
+        parser.add_argument('--metered-feature',
+                            action='append', dest='metered_feature_ids', type=int,
+                            help='The id of a metered feature to rerate. Defaults to the '
+                                 'metered features having usage events in the buckets '
+                                 'overlapping the period. The metered features without usage '
+                                 'events in these buckets are never rerated.')
+
+    def handle(self, *args, **options):
+        start_date, end_date = options['start_date'], options['end_date']
+
+        subscription_ids = options['subscription_ids']
+        if not subscription_ids:
+            subscription_ids = MeteredUsageEvent.objects.filter(
+                date__gte=start_date, date__lte=end_date
+            ).order_by().values_list('subscription_id', flat=True).distinct()
+
+        subscriptions = Subscription.objects.filter(pk__in=list(subscription_ids))
+
+        buckets = UsageEventsRollup().rerate(subscriptions, start_date, end_date,
+                                             metered_features=options['metered_feature_ids'])
+
+        logger.info('Rerated %s metered features units logs between %s and %s.', buckets,
+                    start_date, end_date)
+        self.stdout.write('Rerated {} metered features units logs.'.format(buckets))
@@ -0,0 +1,770 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import datetime
+import logging
+
+from collections import OrderedDict
+from decimal import Decimal, InvalidOperation
+
+from redis.exceptions import ResponseError
+from six import StringIO
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Case, DecimalField, F, Max, Sum, Value, When
+from django.utils import timezone
+from django.utils.encoding import force_text
+
+from silver.billing_snapshot import prefetch_last_billing_logs
+from silver.models import (MeteredFeature, MeteredFeatureUnitsLog, MeteredUsageEvent,
+                           MeteredUsageRollupMark, Subscription)
+from silver.vendors.redis_server import redis
+
+
+logger = logging.getLogger(__name__)
+
+
+METERED_USAGE_BATCH_SIZE = getattr(settings, 'METERED_USAGE_BATCH_SIZE',
+                                   500)  # default 500 records
+METERED_USAGE_BUFFERED = getattr(settings, 'METERED_USAGE_BUFFERED',
+                                 False)  # default False
+METERED_USAGE_FLUSH_LOCK_TIMEOUT = getattr(settings, 'METERED_USAGE_FLUSH_LOCK_TIMEOUT',
+                                           60 * 5)  # default 5m
+USAGE_EVENTS_ROLLUP_BATCH_SIZE = getattr(settings, 'USAGE_EVENTS_ROLLUP_BATCH_SIZE',
+                                         10000)  # default 10000 events per transaction
+USAGE_EVENTS_ROLLUP_LAG = getattr(settings, 'USAGE_EVENTS_ROLLUP_LAG',
+                                  60)  # default 60s
+
+METERED_USAGE_BUFFER_KEY = 'silver:metered-usage'
+METERED_USAGE_FLUSHING_KEY = 'silver:metered-usage:flushing'
+METERED_USAGE_FLUSH_LOCK_KEY = 'silver:metered-usage:flush-lock'
+
+UPDATE_TYPES = ('absolute', 'relative')
+
+
+class UsageRecordError(Exception):
+    pass
+
+
+class UsageRecord(object):
+    """
+    A validated `{subscription, product_code, date, count, update_type}` usage record.
+    """
+
+    required_fields = ('subscription', 'product_code', 'date', 'count', 'update_type')
+
+    def __init__(self, subscription_id, product_code, date, count, update_type):
+        self.subscription_id = subscription_id
+        self.product_code = product_code
+        self.date = date
+        self.count = count
+        self.update_type = update_type
+
+    @classmethod
+    def parse(cls, data):
+        if not isinstance(data, dict):
+            raise UsageRecordError('Invalid record.')
+
+        missing_fields = [field for field in cls.required_fields
+                          if data.get(field) in (None, '')]
+        if missing_fields:
+            raise UsageRecordError('Missing fields: %s.' % ', '.join(missing_fields))
+
+        try:
+            subscription_id = int(data['subscription'])
+        except (TypeError, ValueError):
+            raise UsageRecordError('Invalid subscription.')
+
+        try:
+            date = datetime.datetime.strptime(force_text(data['date']), '%Y-%m-%d').date()
+        except (TypeError, ValueError):
+            raise UsageRecordError('Invalid date format. Please use the ISO 8601 date format.')
+
+        try:
+            count = Decimal(force_text(data['count']))
+        except InvalidOperation:
+            raise UsageRecordError('Invalid count.')
+
+        if not count.is_finite():
+            raise UsageRecordError('Invalid count.')
+
+        update_type = data['update_type']
+        if update_type not in UPDATE_TYPES:
+            raise UsageRecordError('Invalid update type. Use one of: %s.' %
+                                   ', '.join(UPDATE_TYPES))
+
+        return cls(subscription_id, force_text(data['product_code']), date, count, update_type)
+
+
+class _BucketUpdate(object):
+    # The records of a batch targeting the same bucket, folded into a single update: an
+    # absolute record discards the previous ones, the relative ones add up.
+    def __init__(self):
+        self.absolute_count = None
+        self.relative_count = Decimal(0)
+
+    def add(self, record):
+        if record.update_type == 'absolute':
+            self.absolute_count = record.count
+            self.relative_count = Decimal(0)
+        else:
+            self.relative_count += record.count
+
+    def updated_count(self, consumed_units):
+        if self.absolute_count is not None:
+            return self.absolute_count + self.relative_count
+
+        return consumed_units + self.relative_count
+
+    def update_expression(self):
+        if self.absolute_count is not None:
+            return Value(self.absolute_count + self.relative_count)
+
+        return F('consumed_units') + self.relative_count
+
+
+class MeteredUsageIngester(object):
+    """
+    Applies metered features usage records in bulk.
+
+    Each batch of records is resolved in memory, using a fixed number of queries: the
+    subscriptions, their plans' metered features and their latest billing logs are loaded
+    together and the bucket of each record is computed (and memoized) from the subscription's
+    cycles. The records of a batch targeting the same bucket are folded together; the missing
+    `MeteredFeatureUnitsLog` rows are bulk created and the existing ones are updated with a
+    single statement, relative updates being applied as `F()` increments.
+
+    The records are validated the same way `MeteredFeatureUnitsLogDetail.patch` does, and a
+    result is returned for each of them, in order: either the `count` of its bucket after the
+    batch was applied, or the `detail` of the error which prevented applying it.
+
+    When buffered, the buckets updated by relative records only are incremented in the
+    `MeteredUsageBuffer` instead of the database, and their `count` includes the buffered
+    increments.
+    """
+
+    def __init__(self, batch_size=None, buffered=None):
+        self.batch_size = batch_size or METERED_USAGE_BATCH_SIZE
+        self.buffered = METERED_USAGE_BUFFERED if buffered is None else buffered
+
+    def ingest(self, records):
+        results = []
+        for index in range(0, len(records), self.batch_size):
+            results.extend(self._ingest_batch(records[index:index + self.batch_size]))
+
+        return results
+
+    def _load_subscriptions(self, subscription_ids):
+        subscriptions = list(
+            Subscription.objects.filter(pk__in=subscription_ids).select_related('plan__provider')
+        )
+        prefetch_last_billing_logs(subscriptions)
+
+        return {subscription.pk: subscription for subscription in subscriptions}
+
+    def _load_metered_features(self, subscriptions):
+        plan_ids = set(subscription.plan_id for subscription in subscriptions)
+
+        metered_features = MeteredFeature.objects.filter(
+            plan__in=plan_ids
+        ).values_list('plan', 'product_code__value', 'pk')
+
+        return {(plan_id, product_code): metered_feature_id
+                for plan_id, product_code, metered_feature_id in metered_features}
+
+    def _resolve(self, record, subscriptions, metered_features, buckets, updateable_buckets):
+        subscription = subscriptions.get(record.subscription_id)
+        if not subscription:
+            raise UsageRecordError('Subscription Not found.')
+
+        metered_feature_id = metered_features.get((subscription.plan_id, record.product_code))
+        if not metered_feature_id:
+            raise UsageRecordError('Metered Feature Not found.')
+
+        if subscription.state not in [Subscription.STATES.ACTIVE,
+                                      Subscription.STATES.CANCELED]:
+            raise UsageRecordError('Subscription is %s.' % subscription.state)
+
+        if subscription.start_date and record.date < subscription.start_date:
+            raise UsageRecordError('Date is out of bounds.')
+
+        bucket_key = (subscription.pk, record.date)
+        if bucket_key not in buckets:
+            buckets[bucket_key] = (subscription.bucket_start_date(record.date),
+                                   subscription.bucket_end_date(record.date))
+
+        if subscription.pk not in updateable_buckets:
+            updateable_buckets[subscription.pk] = set(
+                (bucket['start_date'], bucket['end_date'])
+                for bucket in subscription.updateable_buckets()
+            )
+
+        start_date, end_date = buckets[bucket_key]
+        if (start_date, end_date) not in updateable_buckets[subscription.pk]:
+            raise UsageRecordError('Date is out of bounds.')
+
+        return subscription.pk, metered_feature_id, start_date, end_date
+
+    def _ingest_batch(self, data):
+        results = [None] * len(data)
+        records = {}
+        for index, record_data in enumerate(data):
+            try:
+                records[index] = UsageRecord.parse(record_data)
+            except UsageRecordError as error:
+                results[index] = {'detail': force_text(error)}
+
+        subscriptions = self._load_subscriptions(
+            set(record.subscription_id for record in records.values())
+        )
+        metered_features = self._load_metered_features(subscriptions.values())
+
+        updates = OrderedDict()
+        record_keys = {}
+        buckets, updateable_buckets = {}, {}
+        for index in sorted(records):
+            try:
+                key = self._resolve(records[index], subscriptions, metered_features,
+                                    buckets, updateable_buckets)
+            except UsageRecordError as error:
+                results[index] = {'detail': force_text(error)}
+                continue
+
+            updates.setdefault(key, _BucketUpdate()).add(records[index])
+            record_keys[index] = key
+
+        counts = {}
+        if self.buffered:
+            buffered_updates = OrderedDict(
+                (key, update) for key, update in updates.items() if update.absolute_count is None
+            )
+            if buffered_updates:
+                counts.update(self._buffer(buffered_updates))
+
+            updates = OrderedDict(
+                (key, update) for key, update in updates.items() if key not in buffered_updates
+            )
+            # The absolute updates override the increments buffered before them
+            MeteredUsageBuffer().discard(updates.keys())
+
+        if updates:
+            counts.update(self._apply(updates))
+
+        for index, key in record_keys.items():
+            results[index] = {'count': counts[key]}
+
+        return results
+
+    def _existing_logs(self, keys, lock=False):
+        logs = MeteredFeatureUnitsLog.objects.filter(
+            subscription_id__in=set(key[0] for key in keys),
+            start_date__in=set(key[2] for key in keys)
+        )
+        if lock:
+            logs = logs.select_for_update().order_by('pk')
+
+        logs = logs.values_list('pk', 'subscription_id', 'metered_feature_id',
+                                'start_date', 'end_date', 'consumed_units')
+
+        keys = set(keys)
+        existing_logs = {}
+        for pk, subscription_id, metered_feature_id, start_date, end_date, units in logs:
+            key = (subscription_id, metered_feature_id, start_date, end_date)
+            if key in keys:
+                existing_logs[key] = (pk, units)
+
+        return existing_logs
+
+    def _create_logs(self, updates, keys):
+        logs = []
+        for key in keys:
+            subscription_id, metered_feature_id, start_date, end_date = key
+            logs.append(MeteredFeatureUnitsLog(
+                subscription_id=subscription_id, metered_feature_id=metered_feature_id,
+                start_date=start_date, end_date=end_date,
+                consumed_units=updates[key].updated_count(Decimal(0))
+            ))
+
+        MeteredFeatureUnitsLog.objects.bulk_create(logs)
+
+    def _apply(self, updates):
+        counts = {}
+
+        with transaction.atomic():
+            existing_logs = self._existing_logs(updates.keys(), lock=True)
+
+            missing_keys = [key for key in updates if key not in existing_logs]
+            if missing_keys:
+                try:
+                    with transaction.atomic():
+                        self._create_logs(updates, missing_keys)
+                except IntegrityError:
+                    # Some of the logs have been created concurrently, so they are updated too
+                    existing_logs = self._existing_logs(updates.keys(), lock=True)
+                    missing_keys = [key for key in updates if key not in existing_logs]
+                    self._create_logs(updates, missing_keys)
+
+                for key in missing_keys:
+                    counts[key] = updates[key].updated_count(Decimal(0))
+
+            if existing_logs:
+                MeteredFeatureUnitsLog.objects.filter(
+                    pk__in=[pk for pk, _ in existing_logs.values()]
+                ).update(consumed_units=Case(
+                    *[When(pk=pk, then=updates[key].update_expression())
+                      for key, (pk, _) in existing_logs.items()],
+                    output_field=DecimalField()
+                ))
+
+                # The rows are locked, so their updated values are known without reading them
+                for key, (_, consumed_units) in existing_logs.items():
+                    counts[key] = updates[key].updated_count(consumed_units)
+
+        return counts
+
+    def _buffer(self, updates):
+        pending_counts = MeteredUsageBuffer().increment(
+            (key, update.relative_count) for key, update in updates.items()
+        )
+        existing_logs = self._existing_logs(updates.keys())
+
+        return {
+            key: pending_counts[key] + (existing_logs[key][1] if key in existing_logs else 0)
+            for key in updates
+        }
+
+
+class MeteredUsageBuffer(object):
+    """
+    Write-behind buffer for the relative metered features usage updates.
+
+    The increments are accumulated in a Redis hash, having a field per
+    `MeteredFeatureUnitsLog` bucket, so frequent updates of the same bucket don't contend on its
+    row. `flush` moves them into the database in bulk; it runs periodically (see the
+    `flush_buffered_metered_usage` task) and before billing reads the logs (see
+    `prepare_metered_usage`).
+    """
+
+    # The increments are stored as integers, as the consumed units have 4 decimal places
+    scale = Decimal(10 ** 4)
+
+    def _field(self, key):
+        subscription_id, metered_feature_id, start_date, end_date = key
+
+        return '{}:{}:{}:{}'.format(subscription_id, metered_feature_id,
+                                    start_date.isoformat(), end_date.isoformat())
+
+    def _key(self, field):
+        subscription_id, metered_feature_id, start_date, end_date = force_text(field).split(':')
+
+        return (int(subscription_id), int(metered_feature_id),
+                datetime.datetime.strptime(start_date, '%Y-%m-%d').date(),
+                datetime.datetime.strptime(end_date, '%Y-%m-%d').date())
+
+    def increment(self, increments):
+        """
+        :param increments: (bucket key, count) pairs, the bucket key being a
+            (subscription id, metered feature id, start date, end date) tuple.
+        :returns: the buffered counts of the incremented buckets.
+        """
+
+        keys, amounts = [], []
+        for key, count in increments:
+            keys.append(key)
+            amounts.append(int((count * self.scale).to_integral_value()))
+
+        pipeline = redis.pipeline()
+        for key, amount in zip(keys, amounts):
+            pipeline.hincrby(METERED_USAGE_BUFFER_KEY, self._field(key), amount)
+
+        return {key: Decimal(amount) / self.scale
+                for key, amount in zip(keys, pipeline.execute())}
+
+    def discard(self, keys):
+        """
+        Drops the buffered increments of the given buckets, including those taken by a running
+        flush, which is waited for, so they can't be applied after the bucket is overwritten.
+        """
+
+        fields = [self._field(key) for key in keys]
+        if not fields:
+            return
+
+        with redis.lock(METERED_USAGE_FLUSH_LOCK_KEY, timeout=METERED_USAGE_FLUSH_LOCK_TIMEOUT):
+            redis.hdel(METERED_USAGE_BUFFER_KEY, *fields)
+            redis.hdel(METERED_USAGE_FLUSHING_KEY, *fields)
+
+    def _flush_key(self, buffer_key, batch_size):
+        increments = list(redis.hgetall(buffer_key).items())
+
+        flushed = 0
+        ingester = MeteredUsageIngester()
+        for index in range(0, len(increments), batch_size):
+            batch = increments[index:index + batch_size]
+
+            updates = OrderedDict()
+            for field, amount in batch:
+                update = updates.setdefault(self._key(field), _BucketUpdate())
+                update.relative_count += Decimal(int(amount)) / self.scale
+
+            ingester._apply(updates)
+
+            # Once applied, the increments are dropped, so a failing batch doesn't cause the
+            # previous ones to be applied again
+            redis.hdel(buffer_key, *[field for field, _ in batch])
+            flushed += len(batch)
+
+        redis.delete(buffer_key)
+
+        return flushed
+
+    def flush(self, batch_size=None):
+        """
+        Applies the buffered increments to the `MeteredFeatureUnitsLog` buckets. Flushes don't
+        run concurrently, so a flush returns only after the increments buffered before it
+        started are in the database.
+
+        :returns: the number of flushed buckets.
+        """
+
+        batch_size = batch_size or METERED_USAGE_BATCH_SIZE
+
+        with redis.lock(METERED_USAGE_FLUSH_LOCK_KEY, timeout=METERED_USAGE_FLUSH_LOCK_TIMEOUT):
+            # The increments left behind by an interrupted flush come first
+            flushed = self._flush_key(METERED_USAGE_FLUSHING_KEY, batch_size)
+
+            try:
+                # Atomically takes the buffered increments, while new ones start a new buffer
+                redis.rename(METERED_USAGE_BUFFER_KEY, METERED_USAGE_FLUSHING_KEY)
+            except ResponseError:
+                # Nothing was buffered
+                return flushed
+
+            flushed += self._flush_key(METERED_USAGE_FLUSHING_KEY, batch_size)
+
+        logger.info('Flushed the buffered metered features usage of %s buckets.', flushed)
+
+        return flushed
+
+
+def ingest_usage_records(records, batch_size=None):
+    """
+    :param records: a list of `{subscription, product_code, date, count, update_type}` dicts.
+    :returns: a list with the result of each record (see `MeteredUsageIngester`).
+    """
+
+    return MeteredUsageIngester(batch_size=batch_size).ingest(records)
+
+
+def flush_metered_usage(force=False):
+    """
+    Makes sure the usage buffered so far is in the database. Without buffering, it does
+    nothing, unless forced.
+    """
+
+    if not (METERED_USAGE_BUFFERED or force):
+        return 0
+
+    return MeteredUsageBuffer().flush()
+
+
+class UsageEventsIngester(MeteredUsageIngester):
+    """
+    Appends raw usage events, given as `{subscription, product_code, date, count[, reference]}`
+    records, to the `MeteredUsageEvent` table. On PostgreSQL the events are written with
+    `COPY`, otherwise with `bulk_create`.
+
+    The events are only validated against the subscriptions and their plans; their buckets are
+    resolved by the rollup.
+    """
+
+    copy_columns = ('subscription_id', 'metered_feature_id', 'date', 'count', 'reference',
+                    'created_at')
+
+    def ingest(self, records):
+        """
+        :returns: the number of accepted events and the errors of the rejected ones, as
+            {index, detail} dicts.
+        """
+
+        accepted, errors = 0, []
+        for index in range(0, len(records), self.batch_size):
+            batch_accepted, batch_errors = self._ingest_batch(
+                records[index:index + self.batch_size]
+            )
+
+            accepted += batch_accepted
+            errors.extend({'index': index + error_index, 'detail': detail}
+                          for error_index, detail in batch_errors)
+
+        return accepted, errors
+
+    def _ingest_batch(self, data):
+        errors = []
+        records = {}
+        for index, record_data in enumerate(data):
+            try:
+                if isinstance(record_data, dict):
+                    record_data = dict(record_data, update_type='relative')
+                records[index] = UsageRecord.parse(record_data)
+            except UsageRecordError as error:
+                errors.append((index, force_text(error)))
+                continue
+
+            if records[index].count < 0:
+                del records[index]
+                errors.append((index, 'Invalid count.'))
+
+        subscriptions = self._load_subscriptions(
+            set(record.subscription_id for record in records.values())
+        )
+        metered_features = self._load_metered_features(subscriptions.values())
+
+        created_at = timezone.now()
+        events = []
+        for index in sorted(records):
+            record = records[index]
+            subscription = subscriptions.get(record.subscription_id)
+            metered_feature_id = subscription and metered_features.get(
+                (subscription.plan_id, record.product_code)
+            )
+
+            if not subscription:
+                errors.append((index, 'Subscription Not found.'))
+            elif not metered_feature_id:
+                errors.append((index, 'Metered Feature Not found.'))
+            elif not subscription.start_date or record.date < subscription.start_date:
+                errors.append((index, 'Date is out of bounds.'))
+            else:
+                events.append(MeteredUsageEvent(
+                    subscription_id=subscription.pk, metered_feature_id=metered_feature_id,
+                    date=record.date, count=record.count,
+                    reference=force_text(data[index].get('reference') or '')[:128],
+                    created_at=created_at
+                ))
+
+        if events:
+            self._write_events(events)
+
+        return len(events), sorted(errors)
+
+    def _copy_value(self, value):
+        value = force_text(value.isoformat() if hasattr(value, 'isoformat') else value)
+
+        # The special characters of the COPY text format
+        return (value.replace('\\', '\\\\').replace('\t', '\\t')
+                     .replace('\n', '\\n').replace('\r', '\\r'))
+
+    def _write_events(self, events):
+        if connection.vendor != 'postgresql':
+            MeteredUsageEvent.objects.bulk_create(events)
+            return
+
+        rows = StringIO()
+        for event in events:
+            rows.write('\t'.join(self._copy_value(getattr(event, column))
+                                 for column in self.copy_columns))
+            rows.write('\n')
+        rows.seek(0)
+
+        quote_name = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.copy_expert('COPY {} ({}) FROM STDIN'.format(
+                quote_name(MeteredUsageEvent._meta.db_table),
+                ', '.join(quote_name(column) for column in self.copy_columns)
+            ), rows)
+
+
+class UsageEventsRollup(object):
+    """
+    Folds the usage events into the `MeteredFeatureUnitsLog` buckets, incrementally.
+
+    The events having ids above the high-water mark (`MeteredUsageRollupMark`) are aggregated
+    per subscription, metered feature and date in the database and added to their buckets,
+    in id ranges of bounded size. Each range is rolled up in a transaction which also moves the
+    mark, so every event is accounted exactly once. The events created in the last `lag`
+    seconds are left for the next rollup, as the transactions inserting them (and the ones
+    with lower ids) might not be committed yet.
+    """
+
+    def __init__(self, batch_size=None, lag=None):
+        self.batch_size = batch_size or USAGE_EVENTS_ROLLUP_BATCH_SIZE
+        self.lag = USAGE_EVENTS_ROLLUP_LAG if lag is None else lag
+        self.ingester = MeteredUsageIngester(buffered=False)
+
+    def _locked_mark(self):
+        MeteredUsageRollupMark.objects.get_or_create(name='default')
+
+        return MeteredUsageRollupMark.objects.select_for_update().get(name='default')
+
+    def _bucket_usage(self, events, subscriptions):
+        usage = events.order_by().values(
+            'subscription_id', 'metered_feature_id', 'date'
+        ).annotate(total_count=Sum('count'))
+
+        bucket_usage = OrderedDict()
+        for row in usage:
+            subscription = subscriptions[row['subscription_id']]
+            start_date = subscription.bucket_start_date(row['date'])
+            end_date = subscription.bucket_end_date(row['date'])
+            if not start_date or not end_date:
+                logger.warning('Usage events outside the cycles of subscription with id=%s: %s',
+                               subscription.pk, row)
+                continue
+
+            key = (subscription.pk, row['metered_feature_id'], start_date, end_date)
+            bucket_usage[key] = bucket_usage.get(key, Decimal(0)) + row['total_count']
+
+        return bucket_usage
+
+    def _rollup(self, after_event_id, last_event_id):
+        events = MeteredUsageEvent.objects.filter(id__gt=after_event_id, id__lte=last_event_id)
+        subscriptions = self.ingester._load_subscriptions(
+            events.order_by().values('subscription_id').distinct()
+        )
+
+        updates = OrderedDict()
+        for key, count in self._bucket_usage(events, subscriptions).items():
+            updates[key] = _BucketUpdate()
+            updates[key].relative_count = count
+
+        if updates:
+            self.ingester._apply(updates)
+
+        return len(updates)
+
+    def run(self):
+        """
+        :returns: the number of updated buckets.
+        """
+
+        cutoff = timezone.now() - datetime.timedelta(seconds=self.lag)
+        last_event_id = MeteredUsageEvent.objects.filter(
+            created_at__lte=cutoff
+        ).aggregate(Max('id'))['id__max']
+        if not last_event_id:
+            return 0
+
+        buckets = 0
+        while True:
+            with transaction.atomic():
+                mark = self._locked_mark()
+                if mark.last_event_id >= last_event_id:
+                    break
+
+                batch_last_event_id = min(mark.last_event_id + self.batch_size, last_event_id)
+                buckets += self._rollup(mark.last_event_id, batch_last_event_id)
+
+                mark.last_event_id = batch_last_event_id
+                mark.save()
+
+        if buckets:
+            logger.info('Rolled up the usage events up to id=%s into %s buckets.',
+                        last_event_id, buckets)
+
+        return buckets
+
+    def rerate(self, subscriptions, start_date, end_date, metered_features=None):
+        """
+        Recomputes, from the rolled up events, the consumed units of the given subscriptions'
+        buckets overlapping the given period, without ingesting the events again. Only the
+        metered features having rolled up events in these buckets are rerated, as their buckets
+        without events are reset: the usage reported otherwise is left alone.
+
+        :returns: the number of updated buckets.
+        """
+
+        with transaction.atomic():
+            # The rollup doesn't run meanwhile
+            mark = self._locked_mark()
+
+            subscriptions = self.ingester._load_subscriptions(
+                [getattr(subscription, 'pk', subscription) for subscription in subscriptions]
+            )
+            if not subscriptions:
+                return 0
+
+            logs = MeteredFeatureUnitsLog.objects.filter(
+                subscription__in=subscriptions.keys(),
+                start_date__lte=end_date, end_date__gte=start_date
+            )
+            events = MeteredUsageEvent.objects.filter(
+                subscription__in=subscriptions.keys(), id__lte=mark.last_event_id
+            )
+            if metered_features is not None:
+                logs = logs.filter(metered_feature__in=metered_features)
+                events = events.filter(metered_feature__in=metered_features)
+
+            # The whole buckets are recomputed, including their days outside of the period
+            logs = list(logs.values_list('subscription_id', 'metered_feature_id',
+                                         'start_date', 'end_date'))
+            period_start_dates = [log[2] for log in logs] + [start_date] + [
+                subscription.bucket_start_date(start_date) or start_date
+                for subscription in subscriptions.values()
+            ]
+            period_end_dates = [log[3] for log in logs] + [end_date] + [
+                subscription.bucket_end_date(end_date) or end_date
+                for subscription in subscriptions.values()
+            ]
+            events = events.filter(date__gte=min(period_start_dates),
+                                   date__lte=max(period_end_dates))
+
+            bucket_usage = OrderedDict(
+                (key, count) for key, count in self._bucket_usage(events, subscriptions).items()
+                if key[2] <= end_date and key[3] >= start_date
+            )
+            event_features = set(key[:2] for key in bucket_usage)
+
+            updates = OrderedDict()
+            for key in logs:
+                if key[:2] in event_features:
+                    updates[key] = _BucketUpdate()
+                    updates[key].absolute_count = Decimal(0)
+
+            for key, count in bucket_usage.items():
+                updates.setdefault(key, _BucketUpdate()).absolute_count = count
+
+            keys = list(updates)
+            for index in range(0, len(keys), self.batch_size):
+                self.ingester._apply(OrderedDict(
+                    (key, updates[key]) for key in keys[index:index + self.batch_size]
+                ))
+
+        return len(updates)
+
+
+def ingest_usage_events(records, batch_size=None):
+    """
+    :param records: a list of `{subscription, product_code, date, count[, reference]}` dicts.
+    :returns: the number of accepted events and the errors of the rejected ones.
+    """
+
+    return UsageEventsIngester(batch_size=batch_size).ingest(records)
+
+
+def rollup_usage_events():
+    return UsageEventsRollup().run()
+
+
+def prepare_metered_usage():
+    """
+    The barrier to pass before reading the `MeteredFeatureUnitsLog` entries for billing: the
+    buffered usage is flushed and the usage events are rolled up.
+    """
+
+    flush_metered_usage()
+    rollup_usage_events()
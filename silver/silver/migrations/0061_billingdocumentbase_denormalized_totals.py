@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('silver', '0060_auto_20190329_0108'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='billingdocumentbase',
+            name='_tax_value',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=19, null=True),
+        ),
+        migrations.AddField(
+            model_name='billingdocumentbase',
+            name='_tax_value_in_transaction_currency',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=19, null=True),
+        ),
+        migrations.AddField(
+            model_name='billingdocumentbase',
+            name='_total_before_tax',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=19, null=True),
+        ),
+        migrations.AddField(
+            model_name='billingdocumentbase',
+            name='_total_before_tax_in_transaction_currency',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=19, null=True),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('silver', '0061_billingdocumentbase_denormalized_totals'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CustomerBalanceLedger',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reason', models.CharField(choices=[('opening', 'Opening balance'), ('invoice_paid', 'Invoice paid'), ('transaction_settled', 'Transaction settled'), ('transaction_refunded', 'Transaction refunded')], max_length=24)),
+                ('date', models.DateField()),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=19)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance_ledger_entries', to='silver.Customer')),
+                ('invoice', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='balance_ledger_entries', to='silver.BillingDocumentBase')),
+                ('transaction', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='balance_ledger_entries', to='silver.Transaction')),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='customerbalanceledger',
+            index_together=set([('customer', 'date')]),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('silver', '0063_pdf_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocumentNumberCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=8)),
+                ('series', models.CharField(blank=True, default='', max_length=20)),
+                ('next_number', models.PositiveIntegerField(default=1)),
+                ('provider', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='document_number_counters', to='silver.Provider')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='documentnumbercounter',
+            unique_together=set([('provider', 'kind', 'series')]),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('silver', '0064_documentnumbercounter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MeteredUsageEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('count', models.DecimalField(decimal_places=4, max_digits=19, validators=[django.core.validators.MinValueValidator(0.0)])),
+                ('reference', models.CharField(blank=True, default='', help_text='Identifies the event in the reporting system.', max_length=128)),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('metered_feature', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='usage_events', to='silver.MeteredFeature')),
+                ('subscription', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='usage_events', to='silver.Subscription')),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='meteredusageevent',
+            index_together=set([('subscription', 'metered_feature', 'date')]),
+        ),
+        migrations.CreateModel(
+            name='MeteredUsageRollupMark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(default='default', max_length=32, unique=True)),
+                ('last_event_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import timedelta
+
+from django.db import migrations, models
+
+
+def schedule_retries(apps, schema_editor):
+    Transaction = apps.get_model('silver', 'Transaction')
+
+    # Only the last failed transaction of the documents which aren't being charged already can
+    # still be retried
+    failed_transactions = Transaction.objects.filter(
+        state='failed', invoice__state='issued'
+    ).exclude(
+        invoice__invoice_transactions__state__in=['initial', 'pending']
+    ).select_related('payment_method').order_by('invoice_id', '-created_at')
+
+    last_invoice_id = None
+    for transaction in failed_transactions.iterator():
+        if transaction.invoice_id == last_invoice_id:
+            continue
+        last_invoice_id = transaction.invoice_id
+
+        data = transaction.payment_method.data or {}
+        attempt_retries_after = data.get('attempt_retries_after')
+        stop_retry_attempts = data.get('stop_retry_attempts')
+        if not (attempt_retries_after or stop_retry_attempts):
+            continue
+
+        Transaction.objects.filter(pk=transaction.pk).update(
+            next_retry_at=transaction.created_at + timedelta(days=attempt_retries_after or 0),
+            retry_deadline=(transaction.created_at + timedelta(days=stop_retry_attempts)
+                            if stop_retry_attempts else None)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('silver', '0065_meteredusageevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='next_retry_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='retry_deadline',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(schedule_retries, migrations.RunPython.noop),
+    ]
@@ -12,10 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from silver.models.billing_entities import Customer, Provider
-from silver.models.documents import Proforma, Invoice, BillingDocumentBase, DocumentEntry, PDF
+from silver.models.billing_entities import Customer, CustomerBalanceLedger, Provider
+from silver.models.documents import (Proforma, Invoice, BillingDocumentBase, DocumentEntry, PDF,
+                                     DocumentNumberCounter)
 from silver.models.plans import Plan, MeteredFeature
 from silver.models.product_codes import ProductCode
 from silver.models.subscriptions import Subscription, MeteredFeatureUnitsLog, BillingLog
+from silver.models.usage_events import MeteredUsageEvent, MeteredUsageRollupMark
 from silver.models.payment_methods import PaymentMethod
 from silver.models.transactions import Transaction
@@ -14,3 +14,4 @@
 
 from silver.models.billing_entities.customer import Customer
 from silver.models.billing_entities.provider import Provider
+from silver.models.billing_entities.ledger import CustomerBalanceLedger
@@ -14,6 +14,8 @@
 
 from __future__ import absolute_import
 
+from livefield.managers import LiveManagerBase
+from livefield.querysets import LiveQuerySet
 from pyvat import is_vat_number_format_valid
 
 from decimal import Decimal
@@ -23,6 +25,9 @@ from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator
 from django.db import models
+from django.db.models import (ExpressionWrapper, OuterRef, Q, Subquery, Sum,
+                              Value)
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 
 from silver.utils.international import currencies
@@ -34,6 +39,78 @@ PAYMENT_DUE_DAYS = getattr(settings, 'SILVER_DEFAULT_DUE_DAYS', 5)
 import logging
 import uuid
 
+
+CUSTOMER_BALANCE_LEDGER = getattr(settings, 'SILVER_CUSTOMER_BALANCE_LEDGER',
+                                  False)  # default False
+
+
+class CustomerQuerySet(LiveQuerySet):
+    def with_balances(self, date, use_ledger=None):
+        """ Annotate the customers with their balances as of the given
+        date, computed in the database.
+
+        Overpaid balances are the difference between the amount paid by
+        the customer for an invoice, and the invoice total. The balance
+        corrections (invoices with negative totals) count with the
+        amount paid for them.
+        """
+        if use_ledger is None:
+            use_ledger = CUSTOMER_BALANCE_LEDGER
+
+        Invoice = apps.get_model('silver.Invoice')
+        Transaction = apps.get_model('silver.Transaction')
+        CustomerBalanceLedger = apps.get_model('silver.CustomerBalanceLedger')
+
+        output_field = models.DecimalField(max_digits=19, decimal_places=2)
+
+        def sum_subquery(queryset, customer_field, amount_field):
+            return Coalesce(
+                Subquery(queryset.filter(**{customer_field: OuterRef('pk')})
+                                 .order_by()
+                                 .values(customer_field)
+                                 .annotate(amount=Sum(amount_field))
+                                 .values('amount'),
+                         output_field=output_field),
+                Value(Decimal('0.00')),
+                output_field=output_field
+            )
+
+        if use_ledger:
+            balance = sum_subquery(
+                CustomerBalanceLedger.objects.filter(date__lte=date),
+                'customer', 'amount'
+            )
+        else:
+            # Balance corrections are invoices with negative values.
+            counted_invoices = (
+                Q(invoice___total_in_transaction_currency__gt=0) |
+                Q(invoice___total_in_transaction_currency__lt=0)
+            )
+            paid = sum_subquery(
+                Transaction.objects.filter(
+                    counted_invoices,
+                    state=Transaction.States.Settled,
+                    invoice__kind='invoice',
+                    invoice__state=Invoice.STATES.PAID,
+                    invoice__paid_date__lte=date
+                ),
+                'invoice__customer', 'amount'
+            )
+            totals = sum_subquery(
+                Invoice.objects.filter(
+                    state=Invoice.STATES.PAID,
+                    paid_date__lte=date,
+                    _total_in_transaction_currency__gt=0
+                ),
+                'customer', '_total_in_transaction_currency'
+            )
+            balance = ExpressionWrapper(paid - totals,
+                                        output_field=output_field)
+
+        return self.annotate(_balance=balance,
+                             _balance_date=Value(date, models.DateField()))
+
+
 class Customer(BaseBillingEntity):
     # TODO: Overpayments
     # 
@@ -47,6 +124,11 @@ class Customer(BaseBillingEntity):
         index_together = (('first_name', 'last_name', 'company'),)
         ordering = ['first_name', 'last_name', 'company']
 
+    objects = LiveManagerBase.from_queryset(CustomerQuerySet)()
+    all_objects = LiveManagerBase.from_queryset(CustomerQuerySet)(
+        include_soft_deleted=True
+    )
+
     account_id = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
 
     first_name = models.CharField(
@@ -136,53 +218,20 @@ class Customer(BaseBillingEntity):
 
         return self.balance_on_date(date=timezone.now().date())
 
-    def balance_on_date(self, date):
+    def balance_on_date(self, date, use_ledger=None):
         """ Get the customer balance as of a given billing date.
 
-        :param billing_date: The date to check balance, default=now.
+        :param date: The date to check balance.
+        :param use_ledger: Whether to sum up the `CustomerBalanceLedger`
+            entries instead of the invoices and their transactions.
+            Defaults to the SILVER_CUSTOMER_BALANCE_LEDGER setting.
 
         """
-        from django.db.models import Sum, Q
-
-        Invoice = apps.get_model('silver.Invoice')
-
-        this_customer  = Q(customer=self)
-        issued_or_paid = Q(state__in=[Invoice.STATES.PAID])
-
-        # Balance corrections are invoices with negative values.
-        not_balance_correction = Q(_total_in_transaction_currency__gt = 0)
-        is_balance_correction  = Q(_total_in_transaction_currency__lt = 0)
-        date_filter            = Q(paid_date__lte                     = date)
-
-        docs = Invoice.objects\
-            .filter( this_customer
-                   & issued_or_paid
-                   & not_balance_correction
-                   & date_filter
-                   )
-
-        credit_docs = Invoice.objects\
-            .filter( this_customer
-                   & issued_or_paid
-                   & is_balance_correction
-                   & date_filter
-                   )
-
-        # Overpaid balances are the difference between the amount paid
-        # by the customer for an invoice, and the invoice total.
-        # 
-        # NB: the .amount_paid_in_transaction_currency is a @property,
-        # and not a database field, so can't be aggregated.
-        # 
-
-        diffs = Decimal(0.0)
-        for d in  docs:
-            bal = d.amount_paid_in_transaction_currency - d._total_in_transaction_currency
-            diffs += bal
-
-        # Sum up all the payments made to correct a balance.
-        sum_abs = Decimal(0.0)
-        sum_abs += sum([d.amount_paid_in_transaction_currency for d in credit_docs])
-
-        # Customer's balance.
-        return diffs + sum_abs
+        # Use the balance annotated by `with_balances`, if any
+        if self.__dict__.get('_balance_date') == date:
+            return self.__dict__['_balance']
+
+        return Customer.objects.filter(pk=self.pk)\
+            .with_balances(date, use_ledger=use_ledger)\
+            .values_list('_balance', flat=True)\
+            .get()
@@ -0,0 +1,162 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, unicode_literals
+
+import logging
+
+from decimal import Decimal
+
+from model_utils import Choices
+
+from django.apps import apps
+from django.db import models
+from django.utils import timezone
+from django.utils.encoding import python_2_unicode_compatible
+
+
+logger = logging.getLogger(__name__)
+
+
+@python_2_unicode_compatible
+class CustomerBalanceLedger(models.Model):
+    """
+    An append-only record of the changes of the customers' balances.
+
+    The balance of a customer on a given date is the sum of the amounts of the entries dated on
+    or before that date. Like `Customer.balance_on_date`, the amounts are accounted on the paid
+    date of the invoices they relate to.
+    """
+
+    REASONS = Choices(
+        ('opening', 'Opening balance'),
+        ('invoice_paid', 'Invoice paid'),
+        ('transaction_settled', 'Transaction settled'),
+        ('transaction_refunded', 'Transaction refunded'),
+    )
+
+    customer = models.ForeignKey('Customer', related_name='balance_ledger_entries')
+    invoice = models.ForeignKey('BillingDocumentBase', null=True, blank=True,
+                                related_name='balance_ledger_entries')
+    transaction = models.ForeignKey('Transaction', null=True, blank=True,
+                                    related_name='balance_ledger_entries')
+    reason = models.CharField(choices=REASONS, max_length=24)
+    date = models.DateField()
+    amount = models.DecimalField(max_digits=19, decimal_places=2)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        index_together = (('customer', 'date'),)
+        ordering = ['id']
+
+    def save(self, *args, **kwargs):
+        if self.pk:
+            raise ValueError('The balance ledger entries cannot be changed.')
+
+        super(CustomerBalanceLedger, self).save(*args, **kwargs)
+
+    def __str__(self):
+        return '{} {} {} ({})'.format(self.customer_id, self.date, self.amount, self.reason)
+
+
+def invoice_balance_contribution(invoice):
+    """
+    :returns: what a paid invoice adds to its customer's balance: the overpaid amount for the
+        regular invoices and the paid amount for the balance corrections (the invoices with
+        negative totals). None for the invoices that don't count towards the balance.
+    """
+
+    total = invoice._total_in_transaction_currency
+    if not total or not invoice.paid_date:
+        return None
+
+    amount_paid = invoice.amount_paid_in_transaction_currency
+
+    return amount_paid - total if total > 0 else amount_paid
+
+
+def record_invoice_payment(invoice):
+    # Any annotated amounts might predate the latest transactions
+    invoice.clear_payment_amounts()
+
+    contribution = invoice_balance_contribution(invoice)
+    if contribution is None:
+        return
+
+    CustomerBalanceLedger.objects.create(
+        customer_id=invoice.customer_id, invoice=invoice,
+        reason=CustomerBalanceLedger.REASONS.invoice_paid,
+        date=invoice.paid_date, amount=contribution
+    )
+
+
+def record_transaction(transaction):
+    """
+    Records the settled or refunded transactions of already paid invoices. The transactions
+    settled before the invoice was paid are included in the invoice's payment entry.
+    """
+
+    Invoice = apps.get_model('silver.Invoice')
+    Transaction = apps.get_model('silver.Transaction')
+
+    reasons = {
+        Transaction.States.Settled: (CustomerBalanceLedger.REASONS.transaction_settled, 1),
+        Transaction.States.Refunded: (CustomerBalanceLedger.REASONS.transaction_refunded, -1),
+    }
+    if transaction.state not in reasons:
+        return
+
+    invoice = Invoice.objects.filter(pk=transaction.invoice_id).first()
+    if (not invoice or invoice.state != Invoice.STATES.PAID or
+            not invoice._total_in_transaction_currency or not invoice.paid_date):
+        return
+
+    reason, sign = reasons[transaction.state]
+    CustomerBalanceLedger.objects.create(
+        customer_id=invoice.customer_id, invoice=invoice, transaction=transaction,
+        reason=reason, date=invoice.paid_date, amount=sign * transaction.amount
+    )
+
+
+def rebuild_customer_balance_ledger(customers):
+    """
+    Replaces the ledger entries of the given customers with an opening entry for each of their
+    paid invoices.
+    """
+
+    Invoice = apps.get_model('silver.Invoice')
+
+    CustomerBalanceLedger.objects.filter(customer__in=customers).delete()
+
+    invoices = Invoice.objects.filter(
+        customer__in=customers, state=Invoice.STATES.PAID, paid_date__isnull=False
+    ).exclude(
+        _total_in_transaction_currency=Decimal('0.00')
+    ).prefetch_related(None).with_payment_amounts()
+
+    entries = []
+    for invoice in invoices:
+        contribution = invoice_balance_contribution(invoice)
+        if contribution is None:
+            continue
+
+        entries.append(CustomerBalanceLedger(
+            customer_id=invoice.customer_id, invoice=invoice,
+            reason=CustomerBalanceLedger.REASONS.opening,
+            date=invoice.paid_date, amount=contribution
+        ))
+
+    CustomerBalanceLedger.objects.bulk_create(entries)
+
+    return len(entries)
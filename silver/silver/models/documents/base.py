@@ -23,7 +23,7 @@ from django_fsm import FSMField, transition, TransitionNotAllowed, post_transiti
 from model_utils import Choices
 
 from django.apps import apps
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.conf import settings
 from django.core.exceptions import ValidationError, NON_FIELD_ERRORS
@@ -31,7 +31,9 @@ from django.core.urlresolvers import reverse
 from django.core.validators import MinValueValidator
 from django.db import models
 from django.db import transaction as db_transaction
-from django.db.models import Max, ForeignKey, F
+from django.db.models import (Case, DecimalField, F, ForeignKey, OuterRef, Subquery,
+                              Sum, Value, When)
+from django.db.models.functions import Coalesce
 from django.template.loader import select_template
 from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible, force_text
@@ -41,7 +43,10 @@ from django.utils.module_loading import import_string
 
 from silver.currencies import CurrencyConverter, RateNotFound
 from silver.models.billing_entities import Customer, Provider
-from silver.models.documents.entries import DocumentEntry
+from silver.models.billing_entities.ledger import record_invoice_payment
+from silver.models.documents.entries import DOCUMENT_TOTALS, DocumentEntry
+from silver.models.documents.numbering import (active_number_block, allocate_document_numbers,
+                                               release_document_numbers, skip_document_number)
 from silver.models.documents.pdf import PDF
 from silver.utils.international import currencies
 
@@ -67,7 +72,61 @@ def documents_pdf_path(document, filename):
     return path
 
 
+def payment_amounts_states():
+    """
+    :returns: the transaction states summed up by each of the documents' payment amounts.
+    """
+
+    Transaction = apps.get_model('silver.Transaction')
+
+    return {
+        '_amount_paid_in_transaction_currency': [Transaction.States.Settled],
+        '_amount_pending_in_transaction_currency': [Transaction.States.Pending],
+        '_amount_charged_in_transaction_currency': [Transaction.States.Initial,
+                                                    Transaction.States.Pending,
+                                                    Transaction.States.Settled],
+    }
+
+
 class BillingDocumentQuerySet(models.QuerySet):
+    def with_payment_amounts(self):
+        """
+        Annotates the documents with the amounts of their transactions (paid, pending and
+        charged), so that the `amount_*_in_transaction_currency` properties don't query the
+        transactions of each document.
+        """
+
+        Transaction = apps.get_model('silver.Transaction')
+        output_field = DecimalField(max_digits=12, decimal_places=2)
+
+        def transactions_amount(kind, states):
+            transactions = Transaction.objects.filter(
+                **{kind: OuterRef('pk')}
+            ).order_by().values(kind).annotate(
+                amount=Sum(Case(When(state__in=states, then=F('amount')),
+                                default=Value(0), output_field=output_field))
+            ).values('amount')
+
+            return Subquery(transactions, output_field=output_field)
+
+        return self.annotate(**{
+            field: Coalesce(
+                Case(When(kind='invoice', then=transactions_amount('invoice', states)),
+                     default=transactions_amount('proforma', states),
+                     output_field=output_field),
+                Value(Decimal('0.00')),
+                output_field=output_field
+            )
+            for field, states in payment_amounts_states().items()
+        })
+
+    def with_totals_entries(self):
+        """
+        Prefetches the entries (and their documents) needed for computing the documents' totals.
+        """
+
+        return self.prefetch_related('invoice_entries', 'proforma_entries__invoice')
+
     def due_this_month(self):
         return self.filter(
             state=BillingDocumentBase.STATES.ISSUED,
@@ -169,9 +228,22 @@ class BillingDocumentBase(models.Model):
     _total_in_transaction_currency = models.DecimalField(max_digits=19,
                                                          decimal_places=2,
                                                          null=True, blank=True)
+    _total_before_tax = models.DecimalField(max_digits=19, decimal_places=2,
+                                            null=True, blank=True)
+    _tax_value = models.DecimalField(max_digits=19, decimal_places=2,
+                                     null=True, blank=True)
+    _total_before_tax_in_transaction_currency = models.DecimalField(max_digits=19,
+                                                                    decimal_places=2,
+                                                                    null=True, blank=True)
+    _tax_value_in_transaction_currency = models.DecimalField(max_digits=19,
+                                                             decimal_places=2,
+                                                             null=True, blank=True)
 
     _last_state = None
     _document_entries = None
+    _original_rates = None
+    _original_number = None
+    _allocated_number = None
 
     class Meta:
         unique_together = ('kind', 'provider', 'series', 'number')
@@ -188,6 +260,13 @@ class BillingDocumentBase(models.Model):
                     self.__class__ = subclass
 
         self._last_state = self.state
+        self._original_rates = self._rates
+        self._original_number = self.number
+
+    @property
+    def _rates(self):
+        # The entries' contribution to the totals depends on these
+        return self.sales_tax_percent, self.transaction_xe_rate
 
     def _get_entries(self):
         if not self._document_entries:
@@ -203,6 +282,41 @@ class BillingDocumentBase(models.Model):
         return sum([Decimal(entry.total)
                     for entry in self._get_entries()])
 
+    def compute_totals(self, entries=None):
+        """
+        :returns: the denormalized totals, computed from the given entries or from the
+            document's entries.
+        """
+
+        if entries is None:
+            entries = (self._document_entries or
+                       getattr(self, self.kind + '_entries').select_related('invoice',
+                                                                            'proforma'))
+
+        totals = {field: Decimal('0.00') for field in DOCUMENT_TOTALS}
+
+        for entry in entries:
+            for field, value in entry.get_totals().items():
+                if value is None or totals[field] is None:
+                    totals[field] = None
+                else:
+                    totals[field] += value
+
+        return totals
+
+    def update_totals(self, entries=None):
+        """
+        Recomputes the denormalized totals and stores them.
+        """
+
+        totals = self.compute_totals(entries)
+
+        for field, value in totals.items():
+            setattr(self, field, value)
+
+        if self.pk and not self._state.adding:
+            BillingDocumentBase.objects.filter(pk=self.pk).update(**totals)
+
     def mark_for_generation(self):
         self.pdf.mark_as_dirty()
 
@@ -244,8 +358,7 @@ class BillingDocumentBase(models.Model):
             self.number = self._generate_number()
 
         self.archived_customer = self.customer.get_archivable_field_values()
-        self._total = self.compute_total()
-        self._total_in_transaction_currency = self.compute_total_in_transaction_currency()
+        self.update_totals()
 
     @transition(field=state, source=STATES.DRAFT, target=STATES.ISSUED)
     def issue(self, issue_date=None, due_date=None):
@@ -304,6 +417,12 @@ class BillingDocumentBase(models.Model):
 
         clone.save()
 
+        # The clone's totals were updated in the database as the entries were saved. They are
+        # read as values, since deferred documents can't be instantiated.
+        totals = BillingDocumentBase.objects.filter(pk=clone.pk).values(*DOCUMENT_TOTALS).get()
+        for field, value in totals.items():
+            setattr(clone, field, value)
+
         return clone
 
     def clean(self):
@@ -355,38 +474,81 @@ class BillingDocumentBase(models.Model):
 
         self._last_state = self.state
 
-        with db_transaction.atomic():
-            # Create pdf object
-            if not self.pdf and self.state != self.STATES.DRAFT:
-                self.pdf = PDF.objects.create(upload_path=self.get_pdf_upload_path(), dirty=1)
+        if self._state.adding:
+            for field in DOCUMENT_TOTALS:
+                if getattr(self, field) is None:
+                    setattr(self, field, Decimal('0.00'))
+        elif not kwargs.get('update_fields'):
+            # The totals are maintained through queryset updates, as the entries change, so a
+            # stale in-memory copy must not overwrite them.
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in DOCUMENT_TOTALS
+            ]
+
+        rates_changed = not self._state.adding and self._rates != self._original_rates
+
+        try:
+            with db_transaction.atomic():
+                # Create pdf object
+                if not self.pdf and self.state != self.STATES.DRAFT:
+                    self.pdf = PDF.objects.create(upload_path=self.get_pdf_upload_path(),
+                                                  dirty=1)
+
+                super(BillingDocumentBase, self).save(*args, **kwargs)
 
-            super(BillingDocumentBase, self).save(*args, **kwargs)
+                if rates_changed:
+                    self.update_totals(entries=list(self._entries))
+
+                if self.number and self.number != self._original_number and \
+                        not self._allocated_number:
+                    # The number was set by hand
+                    skip_document_number(self.provider_id, self.kind, self.series, self.number)
+        except Exception:
+            self._release_allocated_number()
+            raise
+
+        self._allocated_number = None
+        self._original_number = self.number
+        self._original_rates = self._rates
 
     def _generate_number(self, default_starting_number=1):
         """Generates the number for a proforma/invoice."""
         default_starting_number = max(default_starting_number, 1)
 
-        documents = self.__class__._default_manager.filter(
-            provider=self.provider, series=self.series
-        )
-        if not documents.exists():
-            # An invoice/proforma with this provider and series does not exist
-            if self.series == self.default_series:
-                return self._starting_number
-            else:
-                return default_starting_number
+        if self._starting_number and self.series == self.default_series:
+            starting_number = self._starting_number
         else:
-            # An invoice with this provider and series already exists
-            max_existing_number = documents.aggregate(
-                Max('number')
-            )['number__max']
-            if max_existing_number:
-                if self._starting_number and self.series == self.default_series:
-                    return max(max_existing_number + 1, self._starting_number)
-                else:
-                    return max_existing_number + 1
-            else:
-                return default_starting_number
+            starting_number = default_starting_number
+
+        block = active_number_block(self.provider_id, self.kind, self.series)
+        number = block.take() if block else None
+        if number is None:
+            block = None
+            number = allocate_document_numbers(self.provider_id, self.kind, self.series,
+                                               starting_number=starting_number)
+
+        self._allocated_number = (number, block)
+
+        return number
+
+    def _release_allocated_number(self):
+        """Gives back the generated number of a document which couldn't be saved."""
+        if not self._allocated_number:
+            return
+
+        number, block = self._allocated_number
+        self._allocated_number = None
+
+        if self.number != number:
+            return
+
+        if block:
+            block.give_back(number)
+        else:
+            release_document_numbers(self.provider_id, self.kind, self.series, number)
+
+        self.number = None
 
     def series_number(self):
         if self.series:
@@ -544,10 +706,16 @@ class BillingDocumentBase(models.Model):
 
     @property
     def total_before_tax(self):
+        if self._total_before_tax is not None:
+            return self._total_before_tax
+
         return sum([entry.total_before_tax for entry in self.entries])
 
     @property
     def tax_value(self):
+        if self._tax_value is not None:
+            return self._tax_value
+
         return sum([entry.tax_value for entry in self.entries])
 
     @property
@@ -560,20 +728,43 @@ class BillingDocumentBase(models.Model):
 
     @property
     def total_before_tax_in_transaction_currency(self):
+        if self._total_before_tax_in_transaction_currency is not None:
+            return self._total_before_tax_in_transaction_currency
+
         return sum([entry.total_before_tax_in_transaction_currency
                     for entry in self.entries])
 
     @property
     def tax_value_in_transaction_currency(self):
+        if self._tax_value_in_transaction_currency is not None:
+            return self._tax_value_in_transaction_currency
+
         return sum([entry.tax_value_in_transaction_currency
                     for entry in self.entries])
 
+    def _payment_amount(self, field):
+        # Use the amount annotated by `with_payment_amounts`, if any
+        if field in self.__dict__:
+            return self.__dict__[field]
+
+        amount = self.transactions.filter(
+            state__in=payment_amounts_states()[field]
+        ).aggregate(amount=Sum('amount'))['amount']
+
+        return amount or Decimal('0.00')
+
+    def clear_payment_amounts(self):
+        """
+        Drops the annotated payment amounts, which are stale once the document's transactions
+        change.
+        """
+
+        for field in payment_amounts_states():
+            self.__dict__.pop(field, None)
+
     @property
     def amount_paid_in_transaction_currency(self):
-        Transaction = apps.get_model('silver.Transaction')
-
-        return sum([transaction.amount
-                    for transaction in self.transactions.filter(state=Transaction.States.Settled)])
+        return self._payment_amount('_amount_paid_in_transaction_currency')
 
     @property
     def amount_overpaid_in_transaction_currency(self):
@@ -581,23 +772,12 @@ class BillingDocumentBase(models.Model):
 
     @property
     def amount_pending_in_transaction_currency(self):
-        Transaction = apps.get_model('silver.Transaction')
-
-        return sum([transaction.amount
-                    for transaction in self.transactions.filter(state=Transaction.States.Pending)])
+        return self._payment_amount('_amount_pending_in_transaction_currency')
 
     @property
     def amount_to_be_charged_in_transaction_currency(self):
-        Transaction = apps.get_model('silver.Transaction')
-
-        return self.total_in_transaction_currency - sum([
-            transaction.amount
-            for transaction in self.transactions.filter(state__in=[
-                Transaction.States.Initial,
-                Transaction.States.Pending,
-                Transaction.States.Settled
-            ])
-        ])
+        return (self.total_in_transaction_currency -
+                self._payment_amount('_amount_charged_in_transaction_currency'))
 
 
 def create_transaction_for_document(document):
@@ -645,6 +825,9 @@ def post_document_save(sender, instance, created=False, **kwargs):
     # Transition related document too, if needed
     document.sync_related_document_state()
 
+    if document.kind == 'invoice' and document.state == BillingDocumentBase.STATES.PAID:
+        record_invoice_payment(document)
+
     # Create a transaction if the document was recently issued
     if (document.state == BillingDocumentBase.STATES.ISSUED and
             settings.SILVER_AUTOMATICALLY_CREATE_TRANSACTIONS):
@@ -661,3 +844,94 @@ def post_document_save(sender, instance, created=False, **kwargs):
 
     # Generate a PDF
     document.mark_for_generation()
+
+
+def recompute_document_totals(document_id):
+    document = BillingDocumentBase.objects.filter(pk=document_id).first()
+    if document:
+        document.update_totals(
+            entries=DocumentEntry.objects.filter(**{document.kind: document})
+                                         .select_related('invoice', 'proforma')
+        )
+
+
+def add_to_document_totals(document_id, totals, sign=1):
+    """
+    Adds (or subtracts) an entry's contribution to the document's denormalized totals. The
+    totals of documents which haven't got them computed yet are computed from scratch.
+    """
+
+    updates = {
+        field: F(field) + sign * value if value is not None else None
+        for field, value in totals.items()
+    }
+    if BillingDocumentBase.objects.filter(pk=document_id, _total__isnull=False).update(**updates):
+        return
+
+    recompute_document_totals(document_id)
+
+
+@receiver(post_save, sender=DocumentEntry)
+def post_entry_save(sender, instance, created=False, raw=False, **kwargs):
+    if raw:
+        return
+
+    entry = instance
+    original = entry._original_values
+    entry.track_original_values()
+
+    document_ids = [document_id for document_id in (entry.invoice_id, entry.proforma_id)
+                    if document_id]
+
+    if not created:
+        if original is None:
+            # What the entry contributed with before is unknown
+            for document_id in document_ids:
+                recompute_document_totals(document_id)
+            return
+
+        original_document_ids = [original['invoice_id'], original['proforma_id']]
+        if original_document_ids != [entry.invoice_id, entry.proforma_id]:
+            # The entry was moved to other documents
+            for document_id in set(original_document_ids + document_ids) - {None}:
+                recompute_document_totals(document_id)
+            return
+
+        if document_ids:
+            original_entry = DocumentEntry(invoice=entry.invoice, proforma=entry.proforma,
+                                           quantity=original['quantity'],
+                                           unit_price=original['unit_price'])
+            for document_id in document_ids:
+                add_to_document_totals(document_id, original_entry.get_totals(), sign=-1)
+
+    if document_ids:
+        totals = entry.get_totals()
+        for document_id in document_ids:
+            add_to_document_totals(document_id, totals)
+
+
+@receiver(post_delete, sender=DocumentEntry)
+def post_entry_delete(sender, instance, **kwargs):
+    entry = instance
+    original = entry._original_values
+
+    if original and original['invoice_id'] == entry.invoice_id and \
+            original['proforma_id'] == entry.proforma_id:
+        try:
+            original_entry = DocumentEntry(invoice=entry.invoice, proforma=entry.proforma,
+                                           quantity=original['quantity'],
+                                           unit_price=original['unit_price'])
+        except BillingDocumentBase.DoesNotExist:
+            # The entry is deleted together with its documents
+            return
+
+        if original_entry.document:
+            totals = original_entry.get_totals()
+            for document_id in (entry.invoice_id, entry.proforma_id):
+                if document_id:
+                    add_to_document_totals(document_id, totals, sign=-1)
+            return
+
+    for document_id in (entry.invoice_id, entry.proforma_id):
+        if document_id:
+            recompute_document_totals(document_id)
@@ -21,6 +21,17 @@ from django.db import models
 from django.utils.encoding import python_2_unicode_compatible
 
 
+# The denormalized document totals, mapped to the entry properties they sum up
+DOCUMENT_TOTALS = {
+    '_total_before_tax': 'total_before_tax',
+    '_tax_value': 'tax_value',
+    '_total': 'total',
+    '_total_before_tax_in_transaction_currency': 'total_before_tax_in_transaction_currency',
+    '_tax_value_in_transaction_currency': 'tax_value_in_transaction_currency',
+    '_total_in_transaction_currency': 'total_in_transaction_currency',
+}
+
+
 @python_2_unicode_compatible
 class DocumentEntry(models.Model):
     description = models.CharField(max_length=1024)
@@ -38,10 +49,25 @@ class DocumentEntry(models.Model):
     proforma = models.ForeignKey('BillingDocumentBase', related_name='proforma_entries',
                                  blank=True, null=True)
 
+    # The values the entry's contribution to the documents' totals depends on, as last saved
+    _original_values = None
+    _TRACKED_FIELDS = ('invoice_id', 'proforma_id', 'quantity', 'unit_price')
+
     class Meta:
         verbose_name = 'Entry'
         verbose_name_plural = 'Entries'
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(DocumentEntry, cls).from_db(db, field_names, values)
+        instance.track_original_values()
+
+        return instance
+
+    def track_original_values(self):
+        self._original_values = {field: self.__dict__.get(field)
+                                 for field in self._TRACKED_FIELDS}
+
     @property
     def document(self):
         return self.invoice or self.proforma
@@ -91,6 +117,20 @@ class DocumentEntry(models.Model):
         result = self.tax_value * self.document.transaction_xe_rate
         return result.quantize(Decimal('0.00'))
 
+    def get_totals(self):
+        """
+        :returns: the entry's contribution to each of its document's denormalized totals. The
+            transaction currency totals are None while the document's exchange rate is unknown.
+        """
+
+        has_xe_rate = self.document.transaction_xe_rate is not None
+
+        return {
+            field: (getattr(self, prop)
+                    if has_xe_rate or not prop.endswith('_in_transaction_currency') else None)
+            for field, prop in DOCUMENT_TOTALS.items()
+        }
+
     def clone(self):
         return DocumentEntry(
             description=self.description,
@@ -0,0 +1,247 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import threading
+
+from contextlib import contextmanager
+
+from django.apps import apps
+from django.db import IntegrityError, models, transaction
+from django.db.models import Max
+from django.utils.encoding import python_2_unicode_compatible
+
+
+logger = logging.getLogger(__name__)
+
+
+@python_2_unicode_compatible
+class DocumentNumberCounter(models.Model):
+    """
+    The next number to be given to the documents of a provider's series.
+
+    The numbers are allocated while holding a lock on the counter's row, so concurrent issues
+    can't get the same number. When the allocation is part of a larger transaction which is
+    rolled back, the counter is rolled back too, so no numbers are skipped.
+    """
+
+    provider = models.ForeignKey('Provider', related_name='document_number_counters')
+    kind = models.CharField(max_length=8)
+    series = models.CharField(max_length=20, blank=True, default='')
+    next_number = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        unique_together = ('provider', 'kind', 'series')
+
+    def __str__(self):
+        return '{} {} {}: {}'.format(self.provider_id, self.kind, self.series, self.next_number)
+
+
+def _counter_key(provider, kind, series):
+    # The unique constraint doesn't apply to NULLs
+    return {'provider_id': getattr(provider, 'pk', provider), 'kind': kind,
+            'series': series or ''}
+
+
+def _existing_next_number(key):
+    BillingDocumentBase = apps.get_model('silver.BillingDocumentBase')
+
+    series = key['series']
+    documents = BillingDocumentBase.objects.filter(
+        provider_id=key['provider_id'], kind=key['kind']
+    )
+    if series:
+        documents = documents.filter(series=series)
+    else:
+        documents = documents.filter(models.Q(series='') | models.Q(series__isnull=True))
+
+    max_existing_number = documents.aggregate(Max('number'))['number__max']
+
+    return (max_existing_number or 0) + 1
+
+
+def _locked_counter(key):
+    counter = DocumentNumberCounter.objects.select_for_update().filter(**key).first()
+    if counter:
+        return counter
+
+    # The counter is created on the first allocation, continuing the existing documents' numbers
+    try:
+        with transaction.atomic():
+            DocumentNumberCounter.objects.create(next_number=_existing_next_number(key), **key)
+    except IntegrityError:
+        # It has been created concurrently
+        pass
+
+    return DocumentNumberCounter.objects.select_for_update().get(**key)
+
+
+def allocate_document_numbers(provider, kind, series, count=1, starting_number=None):
+    """
+    Allocates `count` consecutive numbers in a single round trip.
+
+    :param starting_number: the lowest number that may be allocated.
+    :returns: the first allocated number.
+    """
+
+    key = _counter_key(provider, kind, series)
+
+    with transaction.atomic():
+        counter = _locked_counter(key)
+
+        first_number = max(counter.next_number, starting_number or 1)
+        counter.next_number = first_number + count
+        counter.save(update_fields=['next_number'])
+
+    return first_number
+
+
+def release_document_numbers(provider, kind, series, first_number, count=1):
+    """
+    Gives back allocated numbers which ended up unused (e.g. the document couldn't be saved).
+    That's only possible while no other numbers were allocated after them. Otherwise they
+    remain a gap in the series, which is logged.
+
+    :returns: whether the numbers were given back.
+    """
+
+    key = _counter_key(provider, kind, series)
+
+    released = DocumentNumberCounter.objects.filter(
+        next_number=first_number + count, **key
+    ).update(next_number=first_number)
+
+    if not released:
+        logger.warning('Numbers %s to %s of the %s series %s (provider id=%s) remain unused.',
+                       first_number, first_number + count - 1, kind, series,
+                       key['provider_id'])
+
+    return bool(released)
+
+
+def skip_document_number(provider, kind, series, number):
+    """
+    Makes sure a number set by hand is not allocated again.
+    """
+
+    DocumentNumberCounter.objects.filter(
+        next_number__lte=number, **_counter_key(provider, kind, series)
+    ).update(next_number=number + 1)
+
+
+class DocumentNumberBlock(object):
+    """
+    A block of consecutive numbers reserved upfront, with a single allocation.
+    """
+
+    def __init__(self, provider, kind, series, count, starting_number=None):
+        self.provider = provider
+        self.kind = kind
+        self.series = series
+        self.first_number = allocate_document_numbers(provider, kind, series, count=count,
+                                                      starting_number=starting_number)
+        self.end_number = self.first_number + count
+        self.next_number = self.first_number
+
+    @property
+    def key(self):
+        key = _counter_key(self.provider, self.kind, self.series)
+
+        return key['provider_id'], key['kind'], key['series']
+
+    def take(self):
+        """
+        :returns: the next number of the block, or None if the block is exhausted.
+        """
+
+        if self.next_number >= self.end_number:
+            return None
+
+        number = self.next_number
+        self.next_number += 1
+
+        return number
+
+    def give_back(self, number):
+        # Only the last taken number can be given back without leaving a gap
+        if number == self.next_number - 1:
+            self.next_number = number
+            return True
+
+        return False
+
+    def release(self):
+        """
+        Gives back the numbers that weren't taken.
+        """
+
+        unused = self.end_number - self.next_number
+        if unused:
+            release_document_numbers(self.provider, self.kind, self.series,
+                                     self.next_number, unused)
+
+        self.end_number = self.next_number
+
+
+_blocks = threading.local()
+
+
+def _active_blocks():
+    if not hasattr(_blocks, 'blocks'):
+        _blocks.blocks = {}
+
+    return _blocks.blocks
+
+
+def active_number_block(provider, kind, series):
+    return _active_blocks().get(tuple(_counter_key(provider, kind, series)[field]
+                                      for field in ('provider_id', 'kind', 'series')))
+
+
+@contextmanager
+def reserved_document_numbers(document_class, provider, count, series=None):
+    """
+    Reserves `count` numbers of a provider's series (its default series unless specified). The
+    documents of that series issued by the current thread within the block take their numbers
+    from the reservation, without touching the counter. The unused numbers are given back at
+    the end, when possible.
+
+        with reserved_document_numbers(Invoice, provider, len(invoices)):
+            for invoice in invoices:
+                invoice.issue()
+                invoice.save()
+    """
+
+    document = document_class(provider=provider)
+    if series is None:
+        series = document.default_series
+    starting_number = document._starting_number if series == document.default_series else None
+
+    block = DocumentNumberBlock(provider, document.kind, series, count,
+                                starting_number=starting_number)
+
+    blocks = _active_blocks()
+    previous_block = blocks.get(block.key)
+    blocks[block.key] = block
+    try:
+        yield block
+    finally:
+        if previous_block:
+            blocks[block.key] = previous_block
+        else:
+            blocks.pop(block.key, None)
+
+        block.release()
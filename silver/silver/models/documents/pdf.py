@@ -14,6 +14,7 @@
 
 from __future__ import absolute_import
 
+import hashlib
 import uuid
 from io import BytesIO
 
@@ -23,7 +24,7 @@ from django.conf import settings
 from django.core.files.base import ContentFile
 from django.db import transaction
 from django.db.models import (
-    Model, FileField, TextField, UUIDField, PositiveIntegerField, F
+    Model, CharField, FileField, TextField, UUIDField, PositiveIntegerField, F
 )
 from django.db.models.functions import Greatest
 from django.http import HttpResponse
@@ -53,6 +54,40 @@ def force_bytes(s, encoding='utf-8', strings_only=False, errors='strict'):
     else:
         return force_bytes_dj(s, encoding, strings_only, errors)
 
+PDF_TEMPLATES_VERSION = getattr(settings, 'PDF_TEMPLATES_VERSION',
+                                '1')  # default '1'
+
+
+def render_pdf(html):
+    """
+    Renders the given HTML into a PDF.
+
+    :returns: a BytesIO holding the PDF.
+    """
+
+    pdf_file_object = BytesIO()
+    pisa.pisaDocument(
+        src=html.encode("UTF-8"),
+        dest=pdf_file_object,
+        encoding='UTF-8',
+        link_callback=fetch_resources
+    )
+
+    return pdf_file_object
+
+
+def get_content_hash(html):
+    """
+    :returns: the hash identifying the PDF rendered from the given HTML. Bump the
+        PDF_TEMPLATES_VERSION setting to regenerate the PDFs when something outside the HTML (like
+        the referenced images or stylesheets) changes.
+    """
+
+    content = force_bytes_dj(PDF_TEMPLATES_VERSION) + b'\n' + force_bytes_dj(html)
+
+    return hashlib.sha256(content).hexdigest()
+
+
 def get_storage():
     storage_settings = getattr(settings, 'SILVER_DOCUMENT_STORAGE', None)
     if not storage_settings:
@@ -72,20 +107,29 @@ class PDF(Model):
                          storage=get_storage(), upload_to=get_upload_path)
     dirty = PositiveIntegerField(default=0)
     upload_path = TextField(null=True, blank=True)
+    content_hash = CharField(max_length=64, null=True, blank=True, editable=False)
 
     @property
     def url(self):
         return self.pdf_file.url if self.pdf_file else None
 
+    def is_up_to_date(self, content_hash):
+        """
+        :returns: whether the uploaded PDF was rendered from the same content.
+        """
+
+        return bool(self.pdf_file and self.content_hash == content_hash)
+
     def generate(self, template, context, upload=True):
         html = template.render(context)
-        pdf_file_object = BytesIO()
-        pisa.pisaDocument(
-            src=html.encode("UTF-8"),
-            dest=pdf_file_object,
-            encoding='UTF-8',
-            link_callback=fetch_resources
-        )
+
+        content_hash = get_content_hash(html)
+        if upload and self.is_up_to_date(content_hash):
+            # Nothing changed since the last upload
+            self.mark_as_clean()
+            return
+
+        pdf_file_object = render_pdf(html)
 
         if not pdf_file_object:
             return
@@ -93,16 +137,18 @@ class PDF(Model):
         if upload:
             self.upload(
                 pdf_file_object=force_bytes(pdf_file_object),
-                filename=context['filename']
+                filename=context['filename'],
+                content_hash=content_hash
             )
         return pdf_file_object
 
-    def upload(self, pdf_file_object, filename):
+    def upload(self, pdf_file_object, filename, content_hash=None):
         # the PDF's upload_path attribute needs to be set before calling this method
 
         pdf_content = ContentFile(pdf_file_object)
 
         with transaction.atomic():
+            self.content_hash = content_hash
             self.pdf_file.save(filename, pdf_content, True)
             self.mark_as_clean()
 
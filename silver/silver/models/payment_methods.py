@@ -17,8 +17,7 @@ from __future__ import absolute_import, unicode_literals
 from itertools import chain
 
 from annoying.fields import JSONField
-from annoying.functions import get_object_or_None
-from cryptography.fernet import InvalidToken, Fernet
+from cryptography.fernet import InvalidToken
 from django_fsm import TransitionNotAllowed
 from model_utils.managers import InheritanceManager
 
@@ -34,6 +33,8 @@ from silver import payment_processors
 from silver.models import Invoice, Proforma
 from silver.models.billing_entities import Customer
 from silver.models.transactions import Transaction
+from silver.utils.models import OriginalValuesMixin
+from silver.utils.payments import get_fernet
 
 
 class PaymentMethodInvalid(Exception):
@@ -41,7 +42,7 @@ class PaymentMethodInvalid(Exception):
 
 
 @python_2_unicode_compatible
-class PaymentMethod(models.Model):
+class PaymentMethod(OriginalValuesMixin, models.Model):
     class PaymentProcessors:
         @classmethod
         def as_choices(cls):
@@ -66,6 +67,8 @@ class PaymentMethod(models.Model):
 
     objects = InheritanceManager()
 
+    _TRACKED_FIELDS = ('payment_processor', 'customer_id', 'added_at', 'verified', 'canceled')
+
     class Meta:
         ordering = ['-id']
 
@@ -81,13 +84,12 @@ class PaymentMethod(models.Model):
         super(PaymentMethod, self).__init__(*args, **kwargs)
 
         if self.id:
-            try:
-                payment_method_class = self.get_payment_processor().payment_method_class
+            payment_method_class = payment_processors.registry.get_payment_method_class(
+                self.payment_processor
+            )
 
-                if payment_method_class:
-                    self.__class__ = payment_method_class
-            except AttributeError:
-                pass
+            if payment_method_class:
+                self.__class__ = payment_method_class
 
     @property
     def transactions(self):
@@ -103,14 +105,11 @@ class PaymentMethod(models.Model):
         super(PaymentMethod, self).delete(using=using)
 
     def encrypt_data(self, data):
-        key = settings.PAYMENT_METHOD_SECRET
-        return Fernet(key).encrypt(bytes(data))
+        return get_fernet().encrypt(bytes(data))
 
     def decrypt_data(self, crypted_data):
-        key = settings.PAYMENT_METHOD_SECRET
-
         try:
-            return str(Fernet(key).decrypt(bytes(crypted_data)))
+            return str(get_fernet().decrypt(bytes(crypted_data)))
         except InvalidToken:
             return None
 
@@ -171,13 +170,15 @@ class PaymentMethod(models.Model):
 
         return None
 
-    def clean_with_previous_instance(self, previous_instance):
-        if not previous_instance:
+    def clean_final_fields(self):
+        original_values = self.original_values
+        if not original_values:
             return
 
         for field in self.final_fields:
-            old_value = getattr(previous_instance, field, None)
-            current_value = getattr(self, field, None)
+            attname = self._meta.get_field(field).attname
+            old_value = original_values.get(attname)
+            current_value = getattr(self, attname, None)
 
             if old_value != current_value:
                 raise ValidationError(
@@ -185,7 +186,7 @@ class PaymentMethod(models.Model):
                 )
 
         for field in self.irreversible_fields:
-            old_value = getattr(previous_instance, field, None)
+            old_value = original_values.get(field)
             current_value = getattr(self, field, None)
 
             if old_value and old_value != current_value:
@@ -194,10 +195,8 @@ class PaymentMethod(models.Model):
                 )
 
     def full_clean(self, *args, **kwargs):
-        previous_instance = kwargs.pop('previous_instance', None)
-
         super(PaymentMethod, self).full_clean(*args, **kwargs)
-        self.clean_with_previous_instance(previous_instance)
+        self.clean_final_fields()
 
         # this assumes that nobody calls clean and then modifies this object
         # without calling clean again
@@ -247,11 +246,11 @@ def pre_payment_method_save(sender, instance=None, **kwargs):
 
     payment_method = instance
 
-    previous_instance = get_object_or_None(PaymentMethod, pk=payment_method.pk)
-    setattr(payment_method, '.previous_instance', previous_instance)
+    # The values as they were before saving, for the post_save handler
+    setattr(payment_method, '.original_values', payment_method.original_values)
 
     if not getattr(payment_method, '.cleaned', False):
-        payment_method.full_clean(previous_instance=previous_instance)
+        payment_method.full_clean()
 
 
 @receiver(post_save)
@@ -264,7 +263,7 @@ def post_payment_method_save(sender, instance, **kwargs):
     if hasattr(payment_method, '.cleaned'):
         delattr(payment_method, '.cleaned')
 
-    previous_instance = getattr(payment_method, '.previous_instance', None)
+    original_values = getattr(payment_method, '.original_values', None)
 
     if not (settings.SILVER_AUTOMATICALLY_CREATE_TRANSACTIONS or
             not payment_method.verified or
@@ -272,5 +271,5 @@ def post_payment_method_save(sender, instance, **kwargs):
                 payment_processors.Types.Triggered)):
         return
 
-    if not previous_instance or not previous_instance.verified:
+    if not original_values or not original_values['verified']:
         create_transactions_for_issued_documents(payment_method)
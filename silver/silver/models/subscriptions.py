@@ -31,17 +31,21 @@ from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator
 from django.db import models
+from django.db.models import F, OuterRef, Q, Subquery
 from django.db.models.signals import pre_delete
 from django.dispatch import receiver
 from django.template import TemplateDoesNotExist
-from django.template.loader import get_template, render_to_string
+from django.template.loader import get_template
 from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.timezone import utc
 from django.utils.translation import ugettext_lazy as _
 
+from silver.entry_templates import entry_templates
 from silver.models.billing_entities import Customer
 from silver.models.documents import DocumentEntry
+from silver.models.plans import Plan
+from silver.utils.cycles import cycle_schedule, first_aligned_date
 from silver.utils.dates import ONE_DAY, relativedelta, first_day_of_month
 from silver.utils.models import UnsavedForeignKey
 from silver.validators import validate_reference
@@ -120,8 +124,86 @@ class MeteredFeatureUnitsLog(models.Model):
         return self.metered_feature.name
 
 
+class SubscriptionQuerySet(models.QuerySet):
+    # The minimum number of days of a regular (aligned, not truncated) cycle, per interval
+    _MIN_INTERVAL_DAYS = {
+        'year': 365,
+        'month': 28,
+        'week': 7,
+        'day': 1
+    }
+
+    def due_for_billing(self, billing_date):
+        """
+        Narrows down the subscriptions to the ones that might have to be billed on the given
+        date, based on their latest billing log.
+
+        The filtering is conservative: only the subscriptions for which `should_be_billed` would
+        certainly return False are excluded, so the remaining ones must still be checked with
+        it.
+        """
+
+        latest_billing_logs = BillingLog.objects.filter(
+            subscription=OuterRef('pk')
+        ).order_by('-billing_date', '-pk')
+
+        subscriptions = self.filter(
+            state__in=[Subscription.STATES.ACTIVE, Subscription.STATES.CANCELED],
+            start_date__lte=billing_date
+        ).annotate(
+            _plan_billed_up_to=Subquery(
+                latest_billing_logs.values('plan_billed_up_to')[:1]
+            ),
+            _metered_features_billed_up_to=Subquery(
+                latest_billing_logs.values('metered_features_billed_up_to')[:1]
+            )
+        )
+
+        never_billed = Q(_plan_billed_up_to__isnull=True)
+
+        # A canceled subscription's last cycle starts the day after its cancel date
+        canceled = Q(state=Subscription.STATES.CANCELED, cancel_date__lt=billing_date) & (
+            never_billed |
+            Q(_plan_billed_up_to__lte=F('cancel_date')) |
+            Q(_metered_features_billed_up_to__lte=F('cancel_date'))
+        )
+
+        # The plan is billed in advance once the cycle following the billed one has started
+        prebilled = (Q(plan__prebill_plan=True) |
+                     Q(plan__prebill_plan__isnull=True, plan__provider__prebill_plan=True))
+        not_prebilled = (Q(plan__prebill_plan=False) |
+                         Q(plan__prebill_plan__isnull=True, plan__provider__prebill_plan=False))
+
+        # Otherwise, the cycle following the billed one must have ended. Unless it's irregular
+        # (monthish, trial or ended) it lasts at least its interval's minimum number of days.
+        irregular_cycle = (Q(plan__interval=Plan.INTERVALS.MONTHISH) |
+                           Q(trial_end__gte=F('_plan_billed_up_to')) |
+                           Q(ended_at__isnull=False))
+        cycle_ended = irregular_cycle & Q(_plan_billed_up_to__lt=billing_date)
+
+        intervals = Plan.objects.exclude(
+            interval=Plan.INTERVALS.MONTHISH
+        ).order_by().values_list('interval', 'interval_count').distinct()
+        for interval, interval_count in intervals:
+            min_cycle_days = self._MIN_INTERVAL_DAYS[interval] * interval_count
+            cycle_ended |= Q(
+                plan__interval=interval, plan__interval_count=interval_count,
+                _plan_billed_up_to__lt=billing_date - timedelta(days=min_cycle_days)
+            )
+
+        active = Q(state=Subscription.STATES.ACTIVE) & (
+            never_billed |
+            (prebilled & Q(_plan_billed_up_to__lt=billing_date)) |
+            (not_prebilled & cycle_ended)
+        )
+
+        return subscriptions.filter(active | canceled)
+
+
 @python_2_unicode_compatible
 class Subscription(models.Model):
+    objects = SubscriptionQuerySet.as_manager()
+
     class STATES(object):
         ACTIVE = 'active'
         INACTIVE = 'inactive'
@@ -266,14 +348,8 @@ class Subscription(models.Model):
     def _get_aligned_start_date_after_date(self, reference_date, interval_type,
                                            bymonth=None, byweekday=None, bymonthday=None):
         # SetBillingDates
-        return list(
-            rrule.rrule(interval_type,
-                        count=1,  # align the cycle to the given rules as quickly as possible
-                        bymonth=bymonth,
-                        bymonthday=bymonthday,
-                        byweekday=byweekday,
-                        dtstart=reference_date)
-        )[-1].date()
+        return first_aligned_date(reference_date, interval_type, bymonth=bymonth,
+                                  byweekday=byweekday, bymonthday=bymonthday)
 
     def _get_last_start_date_within_range(self, range_start, range_end,
                                           interval_type, interval_count,
@@ -293,16 +369,44 @@ class Subscription(models.Model):
             raise Exception("Plan.interval_count cannot be 0.")
 
         # SetBillingDates
-        dates = list(
-            rrule.rrule(interval_type,
-                        dtstart=relative_start_date,
-                        interval=interval_count,
-                        until=range_end)
-        )
+        start_date = cycle_schedule(interval_type, interval_count,
+                                    relative_start_date).last_start_date(range_end)
+
+        return aligned_start_date if not start_date else start_date
+
+    def _cycle_dates_cache_key(self, reference_date, ignore_trial, granulate):
+        # The cycle dates depend on these fields only, except for monthish plans, which also
+        # depend on the billing logs and the cycle end override
+        return (reference_date, bool(ignore_trial), bool(granulate),
+                self.start_date, self.trial_end, self.ended_at,
+                self.plan_id, self.plan.interval, self.plan.interval_count,
+                self.separate_cycles_during_trial)
 
-        return aligned_start_date if not dates else dates[-1].date()
+    def _memoized_cycle_date(self, compute, reference_date, ignore_trial, granulate):
+        if reference_date is None:
+            reference_date = timezone.now().date()
+
+        if self.plan.interval == self.plan.INTERVALS.MONTHISH:
+            return compute(reference_date, ignore_trial, granulate)
+
+        cache = self.__dict__.setdefault('_cycle_dates_cache', {})
+        key = (compute.__name__, ) + self._cycle_dates_cache_key(reference_date, ignore_trial,
+                                                                 granulate)
+        try:
+            return cache[key]
+        except KeyError:
+            cache[key] = compute(reference_date, ignore_trial, granulate)
+            return cache[key]
 
     def _cycle_start_date(self, reference_date=None, ignore_trial=None, granulate=None):
+        return self._memoized_cycle_date(self._compute_cycle_start_date,
+                                         reference_date, ignore_trial, granulate)
+
+    def _cycle_end_date(self, reference_date=None, ignore_trial=None, granulate=None):
+        return self._memoized_cycle_date(self._compute_cycle_end_date,
+                                         reference_date, ignore_trial, granulate)
+
+    def _compute_cycle_start_date(self, reference_date=None, ignore_trial=None, granulate=None):
         # SetBillingDates
         # For monthly plans, bill on the same date of the start of the
         # plan, unless it's a short month 
@@ -389,7 +493,7 @@ class Subscription(models.Model):
                     # Otherwise, the start date of the trial period is the subscription start date
                     return self.start_date
 
-    def _cycle_end_date(self, reference_date=None, ignore_trial=None, granulate=None):
+    def _compute_cycle_end_date(self, reference_date=None, ignore_trial=None, granulate=None):
         # SetBillingDates
         ignore_trial_default = False
         granulate_default = False
@@ -690,12 +794,44 @@ class Subscription(models.Model):
 
     @property
     def is_billed_first_time(self):
+        if hasattr(self, '_prefetched_last_billing_log'):
+            return self._prefetched_last_billing_log is None
+
         return self.billing_logs.all().count() == 0
 
     @property
     def last_billing_log(self):
+        # Set by silver.billing_snapshot.BillingSnapshot
+        if hasattr(self, '_prefetched_last_billing_log'):
+            return self._prefetched_last_billing_log
+
         return self.billing_logs.order_by('billing_date').last()
 
+    def _set_last_billing_log(self, billing_log):
+        if hasattr(self, '_prefetched_last_billing_log'):
+            self._prefetched_last_billing_log = billing_log
+
+    def _get_consumed_units_in_range(self, metered_feature, start_date, end_date):
+        """
+        :returns: the total of the units consumed for the given metered feature, logged in
+            buckets contained within the given dates.
+        """
+
+        # Set by silver.billing_snapshot.BillingSnapshot
+        log_entries = getattr(self, '_prefetched_mf_log_entries', None)
+        if log_entries is None:
+            log_entries = self.mf_log_entries.filter(metered_feature=metered_feature,
+                                                     start_date__gte=start_date,
+                                                     end_date__lte=end_date)
+        else:
+            log_entries = [log_entry for log_entry in log_entries
+                           if (log_entry.metered_feature_id == metered_feature.pk and
+                               log_entry.start_date >= start_date and
+                               log_entry.end_date <= end_date)]
+
+        return reduce(lambda x, y: x + y,
+                      [log_entry.consumed_units for log_entry in log_entries], 0)
+
     @property
     def last_billing_date(self):
         # ToDo: Improve this when dropping Django 1.8 support
@@ -807,8 +943,19 @@ class Subscription(models.Model):
             'value_state': value_state
         })
 
+    def _create_entry(self, entries, **kwargs):
+        """
+        Adds the entry to the `entries` accumulator if one is given, otherwise saves it right
+        away.
+        """
+
+        if entries is None:
+            return DocumentEntry.objects.create(**kwargs)
+
+        return entries.add(**kwargs)
+
     def _add_plan_trial(self, start_date, end_date, invoice=None,
-                        proforma=None):
+                        proforma=None, entries=None):
         """
         Adds the plan trial to the document, by adding an entry with positive
         prorated value and one with prorated, negative value which represents
@@ -835,8 +982,8 @@ class Subscription(models.Model):
         description = self._entry_description(context)
 
         # Add plan with positive value
-        DocumentEntry.objects.create(
-            invoice=invoice, proforma=proforma, description=description,
+        self._create_entry(
+            entries, invoice=invoice, proforma=proforma, description=description,
             unit=unit, unit_price=plan_price, quantity=Decimal('1.00'),
             product_code=self.plan.product_code, prorated=prorated,
             start_date=start_date, end_date=end_date
@@ -849,8 +996,8 @@ class Subscription(models.Model):
         description = self._entry_description(context)
 
         # Add plan with negative value
-        DocumentEntry.objects.create(
-            invoice=invoice, proforma=proforma, description=description,
+        self._create_entry(
+            entries, invoice=invoice, proforma=proforma, description=description,
             unit=unit, unit_price=-plan_price, quantity=Decimal('1.00'),
             product_code=self.plan.product_code, prorated=prorated,
             start_date=start_date, end_date=end_date
@@ -895,7 +1042,7 @@ class Subscription(models.Model):
             # spans over 2 months and the subscription has been already billed
             # once => this month it is still on trial but it only
             # has remaining = consumed_last_cycle - included_during_trial
-            last_log_entry = self.billing_logs.all()[0]
+            last_log_entry = self.last_billing_log
             if last_log_entry.proforma:
                 qs = last_log_entry.proforma.proforma_entries.filter(
                     product_code=metered_feature.product_code)
@@ -924,7 +1071,7 @@ class Subscription(models.Model):
             return 0, consumed_units
 
     def _add_mfs_for_trial(self, start_date, end_date, invoice=None,
-                           proforma=None):
+                           proforma=None, entries=None):
         prorated, percent = self._get_proration_status_and_percent(start_date,
                                                                    end_date)
         context = self._build_entry_context({
@@ -947,11 +1094,8 @@ class Subscription(models.Model):
 
             unit = self._entry_unit(context)
 
-            qs = self.mf_log_entries.filter(metered_feature=metered_feature,
-                                            start_date__gte=start_date,
-                                            end_date__lte=end_date)
-            log = [qs_item.consumed_units for qs_item in qs]
-            total_consumed_units = sum(log)
+            total_consumed_units = self._get_consumed_units_in_range(metered_feature,
+                                                                     start_date, end_date)
 
             extra_consumed, free = self._get_extra_consumed_units_during_trial(
                 metered_feature, total_consumed_units)
@@ -967,8 +1111,8 @@ class Subscription(models.Model):
                 description = self._entry_description(context)
 
                 # Positive value for the consumed items.
-                DocumentEntry.objects.create(
-                    invoice=invoice, proforma=proforma, description=description,
+                self._create_entry(
+                    entries, invoice=invoice, proforma=proforma, description=description,
                     unit=unit, quantity=free_units,
                     unit_price=metered_feature.price_per_unit,
                     product_code=metered_feature.product_code,
@@ -983,8 +1127,8 @@ class Subscription(models.Model):
                 description = self._entry_description(context)
 
                 # Negative value for the consumed items.
-                DocumentEntry.objects.create(
-                    invoice=invoice, proforma=proforma, description=description,
+                self._create_entry(
+                    entries, invoice=invoice, proforma=proforma, description=description,
                     unit=unit, quantity=free_units,
                     unit_price=-metered_feature.price_per_unit,
                     product_code=metered_feature.product_code,
@@ -998,15 +1142,10 @@ class Subscription(models.Model):
                     'context': 'metered-feature-trial-not-discounted'
                 })
 
-                description_template_path = field_template_path(
-                    field='entry_description',
-                    provider=self.plan.provider.slug)
-                description = render_to_string(
-                    description_template_path, context
-                )
+                description = self._entry_description(context)
 
-                total += DocumentEntry.objects.create(
-                    invoice=invoice, proforma=proforma,
+                total += self._create_entry(
+                    entries, invoice=invoice, proforma=proforma,
                     description=description, unit=unit,
                     quantity=charged_units, prorated=prorated,
                     unit_price=metered_feature.price_per_unit,
@@ -1017,7 +1156,7 @@ class Subscription(models.Model):
         return total
 
     def _add_plan_value(self, start_date, end_date, invoice=None,
-                        proforma=None):
+                        proforma=None, entries=None):
         """
         Adds to the document the value of the plan.
         """
@@ -1042,8 +1181,8 @@ class Subscription(models.Model):
 
         unit = self._entry_unit(context)
 
-        return DocumentEntry.objects.create(
-            invoice=invoice, proforma=proforma, description=description,
+        return self._create_entry(
+            entries, invoice=invoice, proforma=proforma, description=description,
             unit=unit, unit_price=plan_price, quantity=Decimal('1.00'),
             product_code=self.plan.product_code, prorated=prorated,
             start_date=start_date, end_date=end_date
@@ -1066,11 +1205,8 @@ class Subscription(models.Model):
 
         included_units = (proration_percent * incl)
 
-        qs = self.mf_log_entries.filter(metered_feature=metered_feature,
-                                        start_date__gte=start_date,
-                                        end_date__lte=end_date)
-        log = [qs_item.consumed_units for qs_item in qs]
-        total_consumed_units = reduce(lambda x, y: x + y, log, 0)
+        total_consumed_units = self._get_consumed_units_in_range(metered_feature,
+                                                                 start_date, end_date)
 
         # LinkedFeaturesFeature
         # PrebilledMeteredFeature
@@ -1084,7 +1220,8 @@ class Subscription(models.Model):
                 return total_consumed_units - included_units
         return 0
 
-    def _add_mfs(self, start_date, end_date, invoice=None, proforma=None):
+    def _add_mfs(self, start_date, end_date, invoice=None, proforma=None,
+                 entries=None):
         prorated, percent = self._get_proration_status_and_percent(start_date,
                                                                    end_date)
 
@@ -1118,8 +1255,8 @@ class Subscription(models.Model):
             description = self._entry_description(context)
             unit = self._entry_unit(context)
 
-            mf = DocumentEntry.objects.create(
-                invoice=invoice, proforma=proforma,
+            mf = self._create_entry(
+                entries, invoice=invoice, proforma=proforma,
                 description=description, unit=unit,
                 quantity=consumed_units, prorated=prorated,
                 unit_price=metered_feature.price_per_unit,
@@ -1343,15 +1480,11 @@ class Subscription(models.Model):
 
 
     def _entry_unit(self, context):
-        unit_template_path = field_template_path(
-            field='entry_unit', provider=self.plan.provider.slug)
-        return render_to_string(unit_template_path, context)
+        return entry_templates.render('entry_unit', context, provider=self.plan.provider.slug)
 
     def _entry_description(self, context):
-        description_template_path = field_template_path(
-            field='entry_description', provider=self.plan.provider.slug
-        )
-        return render_to_string(description_template_path, context)
+        return entry_templates.render('entry_description', context,
+                                      provider=self.plan.provider.slug)
 
     @property
     def _base_entry_context(self):
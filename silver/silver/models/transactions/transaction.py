@@ -17,10 +17,10 @@ from __future__ import absolute_import, unicode_literals
 import uuid
 import logging
 
+from datetime import timedelta
 from decimal import Decimal
 
 from annoying.fields import JSONField
-from annoying.functions import get_object_or_None
 from django_fsm import FSMField, post_transition, transition
 
 from django.core.exceptions import ValidationError
@@ -28,7 +28,6 @@ from django.core.validators import MinValueValidator
 from django.core.mail import mail_managers
 
 from django.db import models, transaction
-from django.db.models import Q
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.utils import timezone
@@ -36,19 +35,27 @@ from django.utils.encoding import python_2_unicode_compatible, force_text
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
 
-from silver.models import Invoice, Proforma
+from silver.models import BillingDocumentBase, Invoice, Proforma
+from silver.models.billing_entities.ledger import record_transaction
 from silver.models.transactions.codes import FAIL_CODES, REFUND_CODES, CANCEL_CODES
 from silver.utils.international import currencies
-from silver.utils.models import AutoDateTimeField
+from silver.utils.models import AutoDateTimeField, OriginalValuesMixin
 
 
 logger = logging.getLogger(__name__)
 
 
 @python_2_unicode_compatible
-class Transaction(models.Model):
+class Transaction(OriginalValuesMixin, models.Model):
     _provider = None
 
+    _TRACKED_FIELDS = ('proforma_id', 'invoice_id', 'uuid', 'payment_method_id', 'amount',
+                       'currency', 'created_at', 'state')
+
+    # The fields a state transition may change, saved by `save_state`
+    STATE_FIELDS = ('state', 'fail_code', 'refund_code', 'cancel_code', 'next_retry_at',
+                    'retry_deadline', 'data', 'external_reference', 'updated_at')
+
     amount = models.DecimalField(
         decimal_places=2, max_digits=12,
         # validators=[MinValueValidator(Decimal('0.00'))]
@@ -108,6 +115,10 @@ class Transaction(models.Model):
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = AutoDateTimeField(default=timezone.now)
 
+    # When the document of a failed transaction can be charged again, and until when
+    next_retry_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    retry_deadline = models.DateTimeField(null=True, blank=True)
+
     fail_code = models.CharField(
         choices=[(code, code) for code in FAIL_CODES.keys()], max_length=32,
         null=True, blank=True
@@ -170,25 +181,45 @@ class Transaction(models.Model):
 
     @transaction.atomic()
     def save(self, *args, **kwargs):
-        previous_instance = get_object_or_None(Transaction, pk=self.pk) if self.pk else None
-        setattr(self, 'previous_instance', previous_instance)
+        original_values = self.original_values
 
-        if not previous_instance:
-            # Creating a new Transaction so we lock the DB rows for related billing documents and
-            # transactions
-            if self.proforma:
-                Proforma.objects.select_for_update().filter(pk=self.proforma.pk)
-            elif self.invoice:
-                Invoice.objects.select_for_update().filter(pk=self.invoice.pk)
+        if not original_values:
+            # The amount left to be charged is validated against the documents' other
+            # transactions, so the transactions of a document are created one at a time
+            self.lock_documents()
 
-            Transaction.objects.select_for_update().filter(Q(proforma=self.proforma) |
-                                                           Q(invoice=self.invoice))
+        if self.state == Transaction.States.Failed and (
+            not original_values or original_values['state'] != Transaction.States.Failed
+        ):
+            self.schedule_retry()
 
         if not getattr(self, '.cleaned', False):
-            self.full_clean(previous_instance=previous_instance)
+            self.full_clean()
 
         super(Transaction, self).save(*args, **kwargs)
 
+    def save_state(self, *fields):
+        """
+        Saves a state transition of an existing transaction, along with the given fields, in a
+        single UPDATE. The transaction isn't validated again, since only the `STATE_FIELDS`
+        are saved.
+        """
+
+        setattr(self, '.cleaned', True)
+        self.save(update_fields=set(self.STATE_FIELDS + fields))
+
+    def lock_documents(self):
+        """
+        Locks the rows of the transaction's billing documents until the end of the database
+        transaction.
+        """
+
+        document_ids = [pk for pk in (self.proforma_id, self.invoice_id) if pk]
+
+        if document_ids:
+            list(BillingDocumentBase.objects.select_for_update()
+                 .filter(pk__in=document_ids).order_by('pk').values_list('pk', flat=True))
+
     def clean(self):
         # Validate documents
         document = self.document
@@ -250,13 +281,15 @@ class Transaction(models.Model):
             else:
                 self.amount = self.document.amount_to_be_charged_in_transaction_currency
 
-    def clean_with_previous_instance(self, previous_instance):
-        if not previous_instance:
+    def clean_final_fields(self):
+        original_values = self.original_values
+        if not original_values:
             return
 
         for field in self.final_fields:
-            old_value = getattr(previous_instance, field, None)
-            current_value = getattr(self, field, None)
+            attname = self._meta.get_field(field).attname
+            old_value = original_values.get(attname)
+            current_value = getattr(self, attname, None)
 
             if old_value is not None and old_value != current_value:
                 raise ValidationError("Field '%s' may not be changed." % field)
@@ -265,16 +298,34 @@ class Transaction(models.Model):
         # 'amount' and 'currency' are handled in our clean method
         kwargs['exclude'] = kwargs.get('exclude', []) + ['currency', 'amount']
 
-        previous_instance = kwargs.pop('previous_instance', None)
-
         super(Transaction, self).full_clean(*args, **kwargs)
 
-        self.clean_with_previous_instance(previous_instance)
+        self.clean_final_fields()
 
         # this assumes that nobody calls clean and then modifies this object
         # without calling clean again
         setattr(self, '.cleaned', True)
 
+    def schedule_retry(self):
+        """
+        Sets when the document can be charged again, according to the payment method's
+        `attempt_retries_after` and `stop_retry_attempts` data (in days since the transaction was
+        created). Without them, the document won't be charged again.
+        """
+
+        data = self.payment_method.data or {}
+        attempt_retries_after = data.get('attempt_retries_after')
+        stop_retry_attempts = data.get('stop_retry_attempts')
+
+        if not (attempt_retries_after or stop_retry_attempts):
+            self.next_retry_at = self.retry_deadline = None
+            return
+
+        created_at = self.created_at or timezone.now()
+        self.next_retry_at = created_at + timedelta(days=attempt_retries_after or 0)
+        self.retry_deadline = (created_at + timedelta(days=stop_retry_attempts)
+                               if stop_retry_attempts else None)
+
     @property
     def can_be_consumed(self):
         # TODO: Overpayments?
@@ -317,6 +368,14 @@ class Transaction(models.Model):
     def payment_processor(self):
         return self.payment_method.payment_processor
 
+    def clear_documents_payment_amounts(self):
+        # Only the documents already loaded on the transaction can hold stale amounts
+        for field_name in ('invoice', 'proforma'):
+            cache_name = self._meta.get_field(field_name).get_cache_name()
+            document = getattr(self, cache_name, None)
+            if document:
+                document.clear_payment_amounts()
+
     def update_document_state(self):
         if (
             self.state == Transaction.States.Settled and
@@ -342,11 +401,15 @@ msg = """ Transaction %(transaction_id)s has failed:
  """
 
 @receiver(post_save, sender=Transaction)
-def post_transaction_save(sender, instance, **kwargs):
+def post_transaction_save(sender, instance, created=False, **kwargs):
     transaction = instance
 
+    transaction.clear_documents_payment_amounts()
+
     if hasattr(transaction, '.recently_transitioned'):
         delattr(transaction, '.recently_transitioned')
+        # Before the document is paid, which accounts for its settled transactions
+        record_transaction(transaction)
         transaction.update_document_state()
 
     if hasattr(transaction, '.cleaned'):
@@ -377,8 +440,7 @@ def post_transaction_save(sender, instance, **kwargs):
                 logger.info('Unable to send mail - [Models][Transaction]: %s',
                             msg_kwargs)
 
-    if not getattr(transaction, 'previous_instance', None):
-        # we know this instance is freshly made as it doesn't have an old_value
+    if created:
         logger.info('[Models][Transaction]: %s', {
             'detail': 'A transaction was created.',
             'transaction_id': transaction.id,
@@ -0,0 +1,68 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, unicode_literals
+
+from django.core.validators import MinValueValidator
+from django.db import models
+from django.utils import timezone
+from django.utils.encoding import python_2_unicode_compatible
+
+
+@python_2_unicode_compatible
+class MeteredUsageEvent(models.Model):
+    """
+    An append-only record of raw metered features usage (e.g. a call detail record).
+
+    The events are folded into the `MeteredFeatureUnitsLog` buckets by the incremental rollup
+    (see `silver.metered_usage.rollup_usage_events`), and are kept for auditing and re-rating.
+    """
+
+    subscription = models.ForeignKey('Subscription', related_name='usage_events')
+    metered_feature = models.ForeignKey('MeteredFeature', related_name='usage_events')
+    date = models.DateField()
+    count = models.DecimalField(max_digits=19, decimal_places=4,
+                                validators=[MinValueValidator(0.0)])
+    reference = models.CharField(max_length=128, blank=True, default='',
+                                 help_text='Identifies the event in the reporting system.')
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        index_together = (('subscription', 'metered_feature', 'date'),)
+        ordering = ['id']
+
+    def save(self, *args, **kwargs):
+        if self.pk:
+            raise ValueError('The usage events cannot be changed.')
+
+        super(MeteredUsageEvent, self).save(*args, **kwargs)
+
+    def __str__(self):
+        return '{} {} {}: {}'.format(self.subscription_id, self.metered_feature_id, self.date,
+                                     self.count)
+
+
+@python_2_unicode_compatible
+class MeteredUsageRollupMark(models.Model):
+    """
+    The high-water mark of the usage events rollup: the events having ids up to
+    `last_event_id` are accounted in the `MeteredFeatureUnitsLog` buckets.
+    """
+
+    name = models.CharField(max_length=32, unique=True, default='default')
+    last_event_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return '{}: {}'.format(self.name, self.last_event_id)
@@ -7,8 +7,10 @@ import logging
 
 from decimal import Decimal
 
+from django.db.models import QuerySet
 from django.utils import timezone
 
+from silver.instrumentation import instrumented
 from silver.models import (Customer, DocumentEntry, Subscription,
                            Proforma, Invoice, Provider, BillingLog)
 from silver.utils.dates import ONE_DAY
@@ -58,6 +60,7 @@ class OverpaymentChecker(object):
 
         return provider
 
+    @instrumented('overpayment_checker.check')
     def check(self, customer=None, billing_date=None, customers=None,
               provider=None):
         """
@@ -105,6 +108,10 @@ class OverpaymentChecker(object):
 
         billing_date = billing_date or timezone.now().date()
 
+        # Compute all the balances in a single query
+        if isinstance(customers, QuerySet):
+            customers = customers.with_balances(billing_date)
+
         for customer in customers:
             self._check_for_single_customer(
                 customer, billing_date, provider
@@ -15,6 +15,8 @@
 from __future__ import absolute_import
 
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from django.template.loader import select_template
 from django.utils.deconstruct import deconstructible
 from django.utils.encoding import force_text
@@ -22,18 +24,58 @@ from django.utils.module_loading import import_string
 from django.utils.text import slugify
 
 
+class PaymentProcessorRegistry(object):
+    """
+    The payment processors configured in `PAYMENT_PROCESSORS`, each instantiated once per process,
+    when first used, and shared.
+
+    The registry is cleared after the settings change.
+    """
+
+    def __init__(self):
+        # The processors, by name
+        self._processors = {}
+
+    @staticmethod
+    def create(name):
+        data = settings.PAYMENT_PROCESSORS[name]
+        klass = import_string(data['class'])
+        kwargs = data.get('setup_data', {})
+        return klass(name, **kwargs)
+
+    def clear(self):
+        self._processors = {}
+
+    def get(self, name):
+        processors = self._processors
+        if name not in processors:
+            # Concurrent lookups create equivalent processors, so there is no need to lock
+            processors[name] = self.create(name)
+
+        return processors[name]
+
+    def all(self):
+        return [self.get(name) for name in getattr(settings, 'PAYMENT_PROCESSORS', {}).keys()]
+
+    def get_payment_method_class(self, name):
+        return getattr(self.get(name), 'payment_method_class', None)
+
+
+registry = PaymentProcessorRegistry()
+
+
+@receiver(setting_changed)
+def clear_payment_processors_registry(**kwargs):
+    # The processors may depend on any setting, not only on PAYMENT_PROCESSORS
+    registry.clear()
+
+
 def get_instance(name):
-    data = settings.PAYMENT_PROCESSORS[name]
-    klass = import_string(data['class'])
-    kwargs = data.get('setup_data', {})
-    return klass(name, **kwargs)
+    return registry.get(name)
 
 
 def get_all_instances():
-    choices = []
-    for processor_import_path in settings.PAYMENT_PROCESSORS.keys():
-        choices.append(get_instance(processor_import_path))
-    return choices
+    return registry.all()
 
 
 @deconstructible
@@ -15,6 +15,9 @@
 from __future__ import absolute_import
 
 import logging
+import threading
+
+import requests
 
 from django_fsm import TransitionNotAllowed
 
@@ -32,11 +35,59 @@ class ManualProcessorMixin(object):
     type = PaymentProcessorTypes.Manual
 
 
+_http_sessions_lock = threading.Lock()
+
+
 class BaseActionableProcessor(object):
     """
         Not a Manual type Processor
     """
 
+    @property
+    def http_session(self):
+        """
+            A `requests.Session` owned by the current thread, which keeps the connections to the
+            payment gateway open across the calls made through this processor instance.
+
+            The sessions are closed by `close_http_session` (the current thread's one) and
+            `close_http_sessions`.
+        """
+
+        with _http_sessions_lock:
+            if '_http_sessions' not in self.__dict__:
+                self._http_sessions = []
+                self._local_http_session = threading.local()
+
+        session = getattr(self._local_http_session, 'session', None)
+        if session is None:
+            session = self._local_http_session.session = requests.Session()
+            with _http_sessions_lock:
+                self._http_sessions.append(session)
+
+        return session
+
+    def close_http_session(self):
+        local_http_session = self.__dict__.get('_local_http_session')
+        session = getattr(local_http_session, 'session', None)
+        if session is None:
+            return
+
+        del local_http_session.session
+        with _http_sessions_lock:
+            sessions = self.__dict__.get('_http_sessions', [])
+            if session in sessions:
+                sessions.remove(session)
+
+        session.close()
+
+    def close_http_sessions(self):
+        with _http_sessions_lock:
+            sessions = self.__dict__.pop('_http_sessions', [])
+            self.__dict__.pop('_local_http_session', None)
+
+        for session in sessions:
+            session.close()
+
     def refund_transaction(self, transaction, payment_method=None):
         """
             Refunds / returns the money to the given payment_method or to the
@@ -66,7 +117,7 @@ class BaseActionableProcessor(object):
         """
         try:
             transaction.process()
-            transaction.save()
+            transaction.save_state()
         except TransitionNotAllowed:
             logger.exception("Couldn't process transaction with pk %d." % transaction.pk)
 
@@ -110,6 +161,26 @@ class BaseActionableProcessor(object):
 
         return True
 
+    # Whether `fetch_transactions_status` fetches the statuses in bulk, instead of calling
+    # `fetch_transaction_status` for each transaction
+    bulk_fetch_transactions_status = False
+
+    def fetch_transactions_status(self, transactions):
+        """
+            Fetches the statuses of many pending transactions of this payment processor at once.
+
+            Processors able to query their gateway in bulk should override it and set
+            `bulk_fetch_transactions_status`, so the `fetch_transactions_status` task calls it
+            once for all their pending transactions.
+
+            :return: The number of updated transactions.
+        """
+
+        return len([
+            transaction for transaction in transactions
+            if self.fetch_transaction_status(transaction)
+        ])
+
 
 class AutomaticProcessorMixin(BaseActionableProcessor):
     type = PaymentProcessorTypes.Automatic
@@ -0,0 +1,225 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, division
+
+import logging
+import multiprocessing
+import time
+import traceback
+
+from bisect import bisect_left
+
+from django.conf import settings
+from django.db import connections
+
+from silver.models.documents.pdf import force_bytes, get_content_hash, render_pdf
+
+
+logger = logging.getLogger(__name__)
+
+
+PDF_RENDERING_PROCESSES = getattr(settings, 'PDF_RENDERING_PROCESSES',
+                                  None)  # default one process per CPU
+PDF_RENDERING_BATCH_SIZE = getattr(settings, 'PDF_RENDERING_BATCH_SIZE',
+                                   50)  # default 50 documents
+
+# The upper bounds (in seconds) of the rendering latency histogram buckets
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+
+def _render(html):
+    # Runs in the pool's processes, so it only deals with picklable values
+    started_at = time.time()
+    try:
+        pdf_content = force_bytes(render_pdf(html))
+    except Exception:
+        return None, time.time() - started_at, traceback.format_exc()
+
+    return pdf_content, time.time() - started_at, None
+
+
+class PDFRenderingStats(object):
+    def __init__(self):
+        self.rendered = 0
+        self.skipped = 0
+        self.failed = 0
+        self.latencies = []
+        self.started_at = time.time()
+        self.finished_at = None
+
+    def observe(self, latency):
+        self.rendered += 1
+        self.latencies.append(latency)
+
+    def finish(self):
+        self.finished_at = time.time()
+
+    @property
+    def documents(self):
+        return self.rendered + self.skipped + self.failed
+
+    @property
+    def elapsed(self):
+        return (self.finished_at or time.time()) - self.started_at
+
+    @property
+    def throughput(self):
+        """
+        :returns: the number of documents handled per second.
+        """
+
+        return self.documents / self.elapsed if self.elapsed else 0
+
+    def histogram(self):
+        """
+        :returns: the number of rendered documents in each latency bucket, as
+            (upper bound, count) pairs.
+        """
+
+        counts = [0] * len(LATENCY_BUCKETS)
+        for latency in self.latencies:
+            counts[bisect_left(LATENCY_BUCKETS, latency)] += 1
+
+        return list(zip(LATENCY_BUCKETS, counts))
+
+    def percentile(self, percent):
+        if not self.latencies:
+            return None
+
+        latencies = sorted(self.latencies)
+        index = min(int(len(latencies) * percent / 100), len(latencies) - 1)
+
+        return latencies[index]
+
+    def report(self):
+        return {
+            'documents': self.documents,
+            'rendered': self.rendered,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'elapsed': self.elapsed,
+            'throughput': self.throughput,
+            'latency_p50': self.percentile(50),
+            'latency_p95': self.percentile(95),
+            'latency_histogram': self.histogram(),
+        }
+
+
+class PDFRenderingEngine(object):
+    """
+    Generates the PDFs of billing documents, rendering them in a local pool of processes.
+
+    The documents are handled in batches of bounded size: their HTML is rendered in the current
+    process, the CPU bound HTML to PDF conversion is done by the pool and the results are uploaded
+    by the current process, which is the only one using the database. The documents whose HTML
+    didn't change since their PDF was uploaded are not converted nor uploaded again.
+    """
+
+    def __init__(self, processes=None, batch_size=None):
+        self.processes = processes or PDF_RENDERING_PROCESSES or multiprocessing.cpu_count()
+        self.batch_size = batch_size or PDF_RENDERING_BATCH_SIZE
+        self.stats = PDFRenderingStats()
+
+    def _prepare(self, document):
+        # The same template and context as `BillingDocumentBase.generate_pdf` uses
+        context = document.get_template_context()
+        context['filename'] = document.get_pdf_filename()
+
+        html = document.get_template().render(context)
+
+        return context['filename'], html
+
+    def _batches(self, documents):
+        batch = []
+        for document in documents:
+            batch.append(document)
+
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+
+        if batch:
+            yield batch
+
+    def _render_batch(self, batch, pool):
+        jobs = []
+        for document in batch:
+            try:
+                filename, html = self._prepare(document)
+            except Exception:
+                self.stats.failed += 1
+                logger.exception('Encountered exception while rendering the HTML for document '
+                                 'with id=%s.', document.id)
+                continue
+
+            content_hash = get_content_hash(html)
+            if document.pdf.is_up_to_date(content_hash):
+                document.pdf.mark_as_clean()
+                self.stats.skipped += 1
+                continue
+
+            jobs.append((document, filename, html, content_hash))
+
+        htmls = [html for _, _, html, _ in jobs]
+        results = pool.imap(_render, htmls) if pool else (_render(html) for html in htmls)
+
+        for (document, filename, _, content_hash), result in zip(jobs, results):
+            pdf_content, latency, error = result
+            if error:
+                self.stats.failed += 1
+                logger.error('Encountered exception while generating PDF for document '
+                             'with id=%s: %s', document.id, error)
+                continue
+
+            try:
+                document.pdf.upload(pdf_file_object=pdf_content, filename=filename,
+                                    content_hash=content_hash)
+            except Exception:
+                self.stats.failed += 1
+                logger.exception('Encountered exception while generating PDF for document '
+                                 'with id=%s.', document.id)
+                continue
+
+            self.stats.observe(latency)
+
+    def render(self, documents):
+        """
+        Generates and uploads the PDFs of the given documents, clearing their dirty flags.
+
+        :returns: the rendering stats.
+        """
+
+        pool = None
+        if self.processes > 1:
+            # The forked processes must not share the database connections
+            connections.close_all()
+            pool = multiprocessing.Pool(self.processes)
+
+        try:
+            for batch in self._batches(documents):
+                self._render_batch(batch, pool)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+        self.stats.finish()
+
+        report = self.stats.report()
+        logger.info('Generated PDFs: %s', {
+            key: value for key, value in report.items() if key != 'latency_histogram'
+        })
+
+        return self.stats
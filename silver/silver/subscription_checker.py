@@ -1,218 +1,143 @@
 from __future__ import absolute_import
 
-import datetime as dt
 from datetime import timedelta
 
 import logging
 
-from decimal import Decimal
-
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 
-from silver.models import Customer, Subscription, Proforma, Invoice, Provider, BillingLog
-from silver.utils.dates import ONE_DAY
+from silver.documents_generator import batches
+from silver.instrumentation import instrumented
+from silver.models import (BillingDocumentBase, BillingLog, MeteredFeatureUnitsLog,
+                           Subscription)
 
 
 logger = logging.getLogger(__name__)
 
 
+SUBSCRIPTIONS_CANCEL_BATCH_SIZE = getattr(settings, 'SUBSCRIPTIONS_CANCEL_BATCH_SIZE',
+                                          500)  # default 500 subscriptions
+
+
 class SubscriptionChecker(object):
+    @instrumented('subscription_checker.check')
     def check(self, subscription=None, billing_date=None,
               customers=None, force_generate=False, ignore_date=None):
         """
-        The `public` method called when one wants to check subscriptions are up to date.
+        The `public` method called when one wants to cancel the subscriptions whose last
+        billing document is still unpaid after its grace period.
 
-        :param subscription: the subscription for which one wants to generate the
-            proformas/invoices.
+        :param subscription: the subscription which one wants to check.
         :param billing_date: the date used as billing date. most likely
             this is timezone.now().date()
-        :param customers: the customers for which one wants to generate the
-            proformas/invoices.
-        :param force_generate: if True, invoices are generated at the date
-            indicated by `billing_date` instead of the normal end of
-            billing cycle.
+        :param customers: the customers whose subscriptions one wants to check.
+        :param force_generate: unused, kept for compatibility with the other checkers.
         :param ignore_date: if True, ignore date checks and force things
             to happen
 
         :note
-                If `subscription` is passed, only the documents for that
-                subscription are
-            generated.
-                If the `customers` parameter is passed, only the
-                docments for those customers are
-            generated.
-                Only one of the `customers` and `subscription`
-                parameters may be passed at a time.  If neither the
-                `subscription` nor the `customers` parameters are
-                passed, the documents for all the customers will be
-                generated.
+                If `subscription` is passed, only that subscription is checked.
+                If the `customers` parameter is passed, only the subscriptions of those
+            customers are checked.
+                If neither the `subscription` nor the `customers` parameters are passed, all
+            the subscriptions are checked.
+
+        :returns: the number of canceled subscriptions.
         """
 
-        if not subscription:
-            customers = customers or Customer.objects.all()
-            self._check_all(billing_date=billing_date,
-                            customers=customers,
-                            force_generate=force_generate,
-                            ignore_date=ignore_date)
+        billing_date = billing_date or timezone.now().date()
+
+        if subscription:
+            subscriptions = Subscription.objects.filter(pk=subscription.pk)
+        elif customers is not None:
+            subscriptions = Subscription.objects.filter(customer__in=customers)
         else:
-            self._check_for_single_subscription(subscription=subscription,
-                                                billing_date=billing_date,
-                                                force_generate=force_generate,
-                                                ignore_date=ignore_date)
+            subscriptions = Subscription.objects.all()
 
-    def _check_all(self, billing_date=None, customers=None,
-                   force_generate=False, ignore_date=None):
-        """
-        Generates the invoices/proformas for all the subscriptions that should
-        be billed.
-        """
+        unpaid_subscription_ids = self.get_unpaid_subscription_ids(subscriptions, billing_date,
+                                                                   ignore_date)
 
-        billing_date = billing_date or timezone.now().date()
-        # billing_date -> the date when the billing documents are issued.
-
-        for customer in customers:
-            if customer.consolidated_billing:
-                self._check_for_user_with_consolidated_billing(
-                    customer, billing_date, force_generate, ignore_date
-                )
-            else:
-                self._check_for_user_without_consolidated_billing(
-                    customer, billing_date, force_generate, ignore_date
-                )
-
-    def _log_subscription_billing(self, document, subscription):
-        # TODO: fix
-        logger.debug('Cancelling unpaid subscription: %s', {
-            'subscription': subscription.id,
-            'state': subscription.state,
-            'doc_type': document.provider.flow,
-            'number': document.number,
-            'provider': document.provider.id,
-            'customer': document.customer.id
-        })
-
-    def _is_subscription_unpaid_after_grace(self, customer,
-                                            billing_date,
-                                            subscription,
-                                            ignore_date):
-
-        due_grace_period = timedelta(days=customer.payment_due_days)
-
-        lbl = subscription.last_billing_log
-
-        if lbl.invoice:
-            doc = lbl.invoice
-
-        if lbl.proforma:
-            doc = lbl.proforma
-
-        # Doc is issued
-        if doc.state == doc.__class__.STATES.ISSUED:
-            # current billing date is greater than the issued date +
-            # grace period
-            if ignore_date:
-                return True
-            if billing_date >= (doc.due_date + due_grace_period):
-                return True
-
-        return False
-
-    def get_subscriptions_with_doc_issued_and_past_grace(self,
-                                                         customer,
-                                                         billing_date,
-                                                         force_generate,
-                                                         ignore_date):
-
-        due_grace_period = timedelta(days=customer.payment_due_days)
-
-        # Select all the active or canceled subscriptions
-        criteria = {'state__in': [Subscription.STATES.ACTIVE,
-                                  Subscription.STATES.CANCELED]}
-
-        for subscription in customer.subscriptions.filter(**criteria):
-            # Find a subscription with billing log items where invoices
-            # have failed transactions
-            if self._is_subscription_unpaid_after_grace(customer,
-                                                        billing_date,
-                                                        subscription,
-                                                        ignore_date):
-                yield subscription
-
-
-    def _check_for_user_with_consolidated_billing(self,
-                                                  customer,
-                                                  billing_date,
-                                                  force_generate,
-                                                  ignore_date):
-        """
-        Checks the billing documents for all the subscriptions of a customer
-        who uses consolidated billing.
-        """
+        canceled = 0
+        for batch in batches(unpaid_subscription_ids, SUBSCRIPTIONS_CANCEL_BATCH_SIZE):
+            canceled += self._cancel(batch)
+
+        logger.info('Canceled %s unpaid subscriptions; billing_date=%s.', canceled,
+                    billing_date)
+
+        return canceled
 
-        # For each provider there will be one invoice or proforma. The
-        # cache is necessary as a certain customer might have more than
-        # one subscription => all the subscriptions belonging to the
-        # same provider will be added to the same document
-
-        existing_provider_documents = {}
-        subs = self.get_subscriptions_with_doc_issued_and_past_grace(customer,
-                                                                     billing_date,
-                                                                     force_generate,
-                                                                     ignore_date)
-        for subscription in subs:
-            subscription.cancel(when="now")
-            subscription.save()
-            self._debug_log("Cancelling ", customer, billing_date, subscription)
-            # self._log_subscription_billing(document, subscription)
-
-
-    def _check_for_user_without_consolidated_billing(self, customer,
-                                                     billing_date,
-                                                     force_generate,
-                                                     ignore_date):
+    def get_unpaid_subscription_ids(self, subscriptions, billing_date, ignore_date=False):
         """
-        Generates the billing documents for all the subscriptions of a customer
-        who does not use consolidated billing.
+        :returns: the ids of the active `subscriptions` whose last billed document (the
+            proforma, if there is one, or the invoice) is still issued after its due date plus
+            the customer's payment due days.
         """
 
-        # The user does not use consolidated_billing => add each
-        # subscription to a separate document
-        subs = self.get_subscriptions_with_doc_issued_and_past_grace(customer,
-                                                                     billing_date,
-                                                                     force_generate,
-                                                                     ignore_date)
-        for subscription in subs:
-            provider = subscription.plan.provider
-
-            subscription.cancel(when="now")
-            subscription.save()
-            logger.info("Cancelling " % {'subscription': subscription})
-            self._debug_log("Cancelling ", customer, billing_date, subscription)
-            # self._log_subscription_billing(document, subscription)
-
-    def _check_for_single_subscription(self,
-                                       subscription=None,
-                                       billing_date=None,
-                                       force_generate=False,
-                                       ignore_date=None):
+        last_billing_logs = BillingLog.objects.filter(
+            subscription=OuterRef('pk')
+        ).order_by('-billing_date', '-id')
+
+        def last_document(field_name, output_field):
+            return Subquery(
+                last_billing_logs.annotate(
+                    value=Coalesce('proforma__' + field_name, 'invoice__' + field_name)
+                ).values('value')[:1],
+                output_field=output_field
+            )
+
+        candidates = subscriptions.filter(state=Subscription.STATES.ACTIVE).annotate(
+            last_document_state=last_document('state', models.CharField()),
+            last_document_due_date=last_document('due_date', models.DateField())
+        ).filter(last_document_state=BillingDocumentBase.STATES.ISSUED)
+
+        if ignore_date:
+            return list(candidates.values_list('pk', flat=True))
+
+        # The grace periods differ between customers, so only the documents past their due
+        # dates are compared in Python
+        candidates = candidates.filter(last_document_due_date__lte=billing_date)
+
+        return [
+            subscription_id for subscription_id, due_date, payment_due_days in
+            candidates.values_list('pk', 'last_document_due_date', 'customer__payment_due_days')
+            if billing_date >= due_date + timedelta(days=payment_due_days)
+        ]
+
+    def _cancel(self, subscription_ids):
         """
-        Generates the billing documents corresponding to a single subscription.
-        Usually used when a subscription is ended with `when`=`now`.
+        Cancels the given subscriptions now, in bulk (see `Subscription.cancel`).
+
+        :returns: the number of canceled subscriptions.
         """
 
-        billing_date = billing_date or timezone.now().date()
+        today = timezone.now().date()
+
+        with transaction.atomic():
+            subscription_ids = list(
+                Subscription.objects.select_for_update()
+                                    .filter(pk__in=subscription_ids,
+                                            state=Subscription.STATES.ACTIVE)
+                                    .values_list('pk', flat=True)
+            )
+
+            # The current billing cycles' metered features usage ends now
+            MeteredFeatureUnitsLog.objects.filter(
+                subscription_id__in=subscription_ids, start_date__lte=today, end_date__gte=today
+            ).update(end_date=today)
 
-        provider = subscription.provider
+            Subscription.objects.filter(
+                pk__in=subscription_ids, trial_end__gte=today
+            ).update(trial_end=today)
 
-        if self._is_subscription_unpaid_after_grace(customer,
-                                                    billing_date,
-                                                    subscription,
-                                                    ignore_date):
+            Subscription.objects.filter(pk__in=subscription_ids).update(
+                state=Subscription.STATES.CANCELED, cancel_date=today
+            )
 
-            subscription.cancel(when="now")
-            subscription.save()
-            self._debug_log("Cancelling ", customer, billing_date, subscription)
-            assert subscription.state == Subscription.States.CANCELED
+        for subscription_id in subscription_ids:
+            logger.debug('Cancelled unpaid subscription with id=%s.', subscription_id)
 
-    def _debug_log(self, msg, *args, **kwargs):
-        logging.debug("Debugging - " + msg + " %s %s" % (args, kwargs))
+        return len(subscription_ids)
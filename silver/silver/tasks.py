@@ -14,45 +14,81 @@
 
 from __future__ import absolute_import
 
+import logging
+
+from datetime import datetime
 from itertools import chain
 
-from celery import group, shared_task
+from celery import chord, group, shared_task
 from celery_once import QueueOnce
 from redis.exceptions import LockError
+from six import string_types
 
 from django.conf import settings
+from django.db import transaction as db_transaction
 from django.utils import timezone
 
-from silver.documents_generator import DocumentsGenerator
+from silver.billing_snapshot import BillingSnapshot
+from silver.documents_generator import DocumentsGenerator, batches, customer_id_shards
+from silver.instrumentation import instrumented
+from silver.metered_usage import (flush_metered_usage, prepare_metered_usage,
+                                  rollup_usage_events)
 from silver.subscription_checker import SubscriptionChecker
 from silver.overpayment_checker import OverpaymentChecker
+from silver.pdf_rendering import PDFRenderingEngine
+from silver.transaction_execution import (TRANSACTION_EXECUTION_BATCH_SIZE,
+                                          TransactionExecutionEngine)
 from silver.transaction_retries import TransactionRetryAttempter
 
-from silver.models import Invoice, Proforma, Transaction, BillingDocumentBase
+from silver.models import (Customer, Transaction, BillingDocumentBase,
+                           Subscription)
+from silver import payment_processors
 from silver.payment_processors.mixins import PaymentProcessorTypes
 from silver.vendors.redis_server import redis
 
 
+logger = logging.getLogger(__name__)
+
+
 PDF_GENERATION_TIME_LIMIT = getattr(settings, 'PDF_GENERATION_TIME_LIMIT',
                                     60)  # default 60s
 
 
 @shared_task(base=QueueOnce, once={'graceful': True},
              time_limit=PDF_GENERATION_TIME_LIMIT)
+@instrumented('tasks.generate_pdf')
 def generate_pdf(document_id, document_type):
     document = BillingDocumentBase.objects.get(id=document_id, kind=document_type)
 
     document.generate_pdf()
 
 
+PDF_GENERATION_BATCH_SIZE = getattr(settings, 'PDF_GENERATION_BATCH_SIZE',
+                                    10)  # default 10 documents per task
+
+
+@shared_task(base=QueueOnce, once={'graceful': True},
+             time_limit=PDF_GENERATION_TIME_LIMIT * PDF_GENERATION_BATCH_SIZE)
+@instrumented('tasks.generate_pdfs_batch')
+def generate_pdfs_batch(document_ids):
+    documents = BillingDocumentBase.objects.filter(id__in=document_ids, pdf__dirty__gt=0)\
+                                           .select_related('pdf')
+
+    # The Celery workers are the pool here
+    PDFRenderingEngine(processes=1).render(documents)
+
+
 @shared_task(ignore_result=True)
 def generate_pdfs():
-    dirty_documents = chain(Invoice.objects.filter(pdf__dirty__gt=0),
-                            Proforma.objects.filter(pdf__dirty__gt=0))
+    dirty_document_ids = list(
+        BillingDocumentBase.objects.filter(pdf__dirty__gt=0)
+                                   .order_by('id')
+                                   .values_list('id', flat=True)
+    )
 
-    # Generate PDFs in parallel
-    group(generate_pdf.s(document.id, document.kind)
-          for document in dirty_documents)()
+    # Generate PDFs in parallel, in batches
+    group(generate_pdfs_batch.s(dirty_document_ids[index:index + PDF_GENERATION_BATCH_SIZE])
+          for index in range(0, len(dirty_document_ids), PDF_GENERATION_BATCH_SIZE))()
 
 
 DOCS_GENERATION_TIME_LIMIT = getattr(settings, 'DOCS_GENERATION_TIME_LIMIT',
@@ -65,13 +101,164 @@ def retry_failed_transactions():
     TransactionRetryAttempter().check(billing_date=billing_date)
 
 
+DOCS_GENERATION_SHARD_SIZE = getattr(settings, 'DOCS_GENERATION_SHARD_SIZE',
+                                     500)  # default 500 customers per shard
+DOCS_GENERATION_SHARD_TIME_LIMIT = getattr(settings, 'DOCS_GENERATION_SHARD_TIME_LIMIT',
+                                           60 * 15)  # default 15m
+CUSTOMER_BILLING_LOCK_TIMEOUT = getattr(settings, 'CUSTOMER_BILLING_LOCK_TIMEOUT',
+                                        60 * 5)  # default 5m
+BILLING_RUN_PROGRESS_TIMEOUT = getattr(settings, 'BILLING_RUN_PROGRESS_TIMEOUT',
+                                       60 * 60 * 24 * 3)  # default 3 days
+
+BILLING_RUN_PROGRESS_KEY = 'silver:billing-run:{billing_date}'
+CUSTOMER_BILLING_LOCK_KEY = 'silver:billing-customer:{customer_id}'
+
+
+def _parse_billing_date(billing_date):
+    if isinstance(billing_date, string_types):
+        return datetime.strptime(billing_date, '%Y-%m-%d').date()
+
+    return billing_date
+
+
 @shared_task(base=QueueOnce, once={'graceful': True},
              time_limit=DOCS_GENERATION_TIME_LIMIT, ignore_result=True)
 def generate_billing_documents(billing_date=None):
+    """
+    Starts a sharded billing run: the customers are split into id ranges and each range is
+    billed by a separate `generate_billing_documents_shard` task. A chord callback reports the
+    outcome of the whole run once every shard has finished.
+    """
+
     if not billing_date:
         billing_date = timezone.now().date()
 
-    DocumentsGenerator().generate(billing_date=billing_date)
+    # Dates are passed as strings so that they survive any task serializer
+    billing_date = _parse_billing_date(billing_date).strftime('%Y-%m-%d')
+
+    # The buffered metered features usage and the usage events must be billed too
+    prepare_metered_usage()
+
+    due_subscriptions = Subscription.objects.due_for_billing(_parse_billing_date(billing_date))
+    customers = Customer.objects.filter(pk__in=due_subscriptions.values('customer_id'))
+
+    shards = customer_id_shards(customers, DOCS_GENERATION_SHARD_SIZE)
+    if not shards:
+        return
+
+    progress_key = BILLING_RUN_PROGRESS_KEY.format(billing_date=billing_date)
+    pipeline = redis.pipeline()
+    pipeline.delete(progress_key)
+    pipeline.hset(progress_key, 'shards', len(shards))
+    pipeline.expire(progress_key, BILLING_RUN_PROGRESS_TIMEOUT)
+    pipeline.execute()
+
+    chord(
+        generate_billing_documents_shard.s(first_customer_id, last_customer_id, billing_date)
+        for first_customer_id, last_customer_id in shards
+    )(report_billing_documents_generation.s(billing_date=billing_date))
+
+
+@shared_task(time_limit=DOCS_GENERATION_SHARD_TIME_LIMIT)
+@instrumented('tasks.generate_billing_documents_shard')
+def generate_billing_documents_shard(first_customer_id, last_customer_id, billing_date):
+    """
+    Bills the customers having ids between `first_customer_id` and `last_customer_id`.
+
+    Every customer is billed in its own database transaction while holding a lock on that
+    customer, so a customer failing doesn't affect the rest of the shard and two runs can't bill
+    the same customer at the same time. Re-running a shard is safe, as already billed
+    subscriptions are skipped based on their latest `BillingLog`.
+    """
+
+    generator = DocumentsGenerator()
+    billing_date = _parse_billing_date(billing_date)
+    result = {
+        'first_customer_id': first_customer_id,
+        'last_customer_id': last_customer_id,
+        'billed': 0,
+        'locked': [],
+        'failed': []
+    }
+
+    customers = list(Customer.objects.filter(
+        pk__gte=first_customer_id, pk__lte=last_customer_id
+    ).order_by('pk'))
+
+    # The shard might run (or be retried) a while after the billing run started
+    prepare_metered_usage()
+    snapshot = BillingSnapshot(customers, billing_date).load()
+
+    for customer in customers:
+        lock = redis.lock(CUSTOMER_BILLING_LOCK_KEY.format(customer_id=customer.pk),
+                          timeout=CUSTOMER_BILLING_LOCK_TIMEOUT)
+        if not lock.acquire(blocking=False):
+            result['locked'].append(customer.pk)
+            continue
+
+        try:
+            # The customer might have been billed by someone else since the snapshot was taken
+            if snapshot.is_stale(customer):
+                snapshot.reload_customer(customer)
+
+            with db_transaction.atomic():
+                generator.generate_for_customer(customer, billing_date, snapshot=snapshot)
+
+            result['billed'] += 1
+        except Exception:
+            logger.exception('Encountered exception while billing customer with id=%s.',
+                             customer.pk)
+            result['failed'].append(customer.pk)
+        finally:
+            try:
+                lock.release()
+            except LockError:
+                pass
+
+    progress_key = BILLING_RUN_PROGRESS_KEY.format(billing_date=billing_date.strftime('%Y-%m-%d'))
+    pipeline = redis.pipeline()
+    pipeline.hincrby(progress_key, 'shards_done', 1)
+    pipeline.hincrby(progress_key, 'customers_billed', result['billed'])
+    pipeline.hincrby(progress_key, 'customers_locked', len(result['locked']))
+    pipeline.hincrby(progress_key, 'customers_failed', len(result['failed']))
+    pipeline.execute()
+
+    return result
+
+
+@shared_task()
+def report_billing_documents_generation(shard_results, billing_date):
+    summary = {
+        'billing_date': billing_date,
+        'shards': len(shard_results),
+        'billed': sum(result['billed'] for result in shard_results),
+        'locked': list(chain.from_iterable(result['locked'] for result in shard_results)),
+        'failed': list(chain.from_iterable(result['failed'] for result in shard_results))
+    }
+
+    if summary['failed'] or summary['locked']:
+        logger.error('Billing run finished with unbilled customers: %s', summary)
+    else:
+        logger.info('Billing run finished: %s', summary)
+
+    return summary
+
+
+METERED_USAGE_FLUSH_TIME_LIMIT = getattr(settings, 'METERED_USAGE_FLUSH_TIME_LIMIT',
+                                         60 * 5)  # default 5m
+
+
+@shared_task(base=QueueOnce, once={'graceful': True},
+             time_limit=METERED_USAGE_FLUSH_TIME_LIMIT, ignore_result=True)
+def flush_buffered_metered_usage():
+    flush_metered_usage(force=True)
+
+
+@shared_task(base=QueueOnce, once={'graceful': True},
+             time_limit=METERED_USAGE_FLUSH_TIME_LIMIT, ignore_result=True)
+def rollup_metered_usage_events():
+    rollup_usage_events()
+
 
 @shared_task(base=QueueOnce, once={'graceful': True},
              time_limit=DOCS_GENERATION_TIME_LIMIT, ignore_result=True)
@@ -108,14 +295,60 @@ def fetch_transaction_status(transaction_id):
     payment_processor.fetch_transaction_status(transaction)
 
 
+FETCH_PROCESSOR_TRANSACTIONS_STATUS_TIME_LIMIT = getattr(
+    settings, 'FETCH_PROCESSOR_TRANSACTIONS_STATUS_TIME_LIMIT', 60 * 15
+)  # default 15m
+
+
+@shared_task(base=QueueOnce, once={'graceful': True},
+             time_limit=FETCH_PROCESSOR_TRANSACTIONS_STATUS_TIME_LIMIT)
+@instrumented('tasks.fetch_payment_processor_transactions_status')
+def fetch_payment_processor_transactions_status(payment_processor_name, transaction_ids=None):
+    transactions = Transaction.objects.filter(
+        state=Transaction.States.Pending,
+        payment_method__payment_processor=payment_processor_name
+    ).select_related('payment_method')
+
+    if transaction_ids:
+        transactions = transactions.filter(pk__in=transaction_ids)
+
+    payment_processor = payment_processors.get_instance(payment_processor_name)
+
+    return payment_processor.fetch_transactions_status(transactions)
+
+
 @shared_task(ignore_result=True)
 def fetch_transactions_status(transaction_ids=None):
+    """
+    Fetches the statuses of the pending transactions, either in bulk, one task per payment
+    processor which supports it, or one task per transaction.
+    """
+
     eligible_transactions = Transaction.objects.filter(state=Transaction.States.Pending)
 
     if transaction_ids:
         eligible_transactions = eligible_transactions.filter(pk__in=transaction_ids)
 
-    group(fetch_transaction_status.s(transaction.id) for transaction in eligible_transactions)()
+    bulk_processor_names = [
+        processor_name for processor_name in settings.PAYMENT_PROCESSORS
+        if getattr(payment_processors.get_instance(processor_name),
+                   'bulk_fetch_transactions_status', False)
+    ]
+
+    tasks = [
+        fetch_payment_processor_transactions_status.s(processor_name, transaction_ids)
+        for processor_name in eligible_transactions.filter(
+            payment_method__payment_processor__in=bulk_processor_names
+        ).values_list('payment_method__payment_processor', flat=True).order_by().distinct()
+    ]
+    tasks.extend(
+        fetch_transaction_status.s(transaction_id)
+        for transaction_id in eligible_transactions.exclude(
+            payment_method__payment_processor__in=bulk_processor_names
+        ).values_list('pk', flat=True)
+    )
+
+    group(tasks)()
 
 
 EXECUTE_TRANSACTION_TIME_LIMIT = getattr(settings, 'EXECUTE_TRANSACTION_TIME_LIMIT',
@@ -139,11 +372,29 @@ def execute_transaction(transaction_id):
     payment_processor.process_transaction(transaction)
 
 
+EXECUTE_TRANSACTIONS_BATCH_TIME_LIMIT = getattr(settings, 'EXECUTE_TRANSACTIONS_BATCH_TIME_LIMIT',
+                                                60 * 10)  # default 10m
+
+
+@shared_task(base=QueueOnce, once={'graceful': True},
+             time_limit=EXECUTE_TRANSACTIONS_BATCH_TIME_LIMIT)
+@instrumented('tasks.execute_transactions_batch')
+def execute_transactions_batch(transaction_ids):
+    stats = TransactionExecutionEngine().execute_batch(transaction_ids)
+
+    return [processor_stats.report() for processor_stats in stats]
+
+
 @shared_task(ignore_result=True)
 def execute_transactions(transaction_ids=None):
-    executable_transactions = Transaction.objects.filter(state=Transaction.States.Initial)
+    """
+    Executes the initial transactions of the triggered payment processors, one task per batch
+    of transactions (see `TRANSACTION_EXECUTION_BATCH_SIZE`).
+    """
 
-    if transaction_ids:
-        executable_transactions = executable_transactions.filter(pk__in=transaction_ids)
+    transaction_ids = TransactionExecutionEngine().iter_executable_transaction_ids(
+        transaction_ids
+    )
 
-    group(execute_transaction.s(transaction.id) for transaction in executable_transactions)()
+    group(execute_transactions_batch.s(batch)
+          for batch in batches(transaction_ids, TRANSACTION_EXECUTION_BATCH_SIZE))()
@@ -0,0 +1,64 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import re
+
+from rest_framework import status
+from rest_framework.reverse import reverse
+from rest_framework.test import APITestCase
+
+from silver.tests.factories import AdminUserFactory, InvoiceFactory
+
+
+class TestCursorPagination(APITestCase):
+    def setUp(self):
+        admin_user = AdminUserFactory.create()
+        self.client.force_authenticate(user=admin_user)
+
+    def links(self, response):
+        return dict((rel, url) for url, rel in
+                    re.findall(r'<([^>]*)>; rel="(\w+)"', response['Link']))
+
+    def test_invoices_cursor_pagination(self):
+        invoices = InvoiceFactory.create_batch(5)
+        invoice_ids = sorted([invoice.id for invoice in invoices], reverse=True)
+
+        response = self.client.get(reverse('invoice-list') + '?cursor=&page_size=2')
+
+        assert response.status_code == status.HTTP_200_OK
+        assert [invoice['id'] for invoice in response.data] == invoice_ids[:2]
+
+        links = self.links(response)
+        assert set(links) == {'next', 'first'}
+
+        ids = [invoice['id'] for invoice in response.data]
+        while 'next' in links:
+            response = self.client.get(links['next'])
+            assert response.status_code == status.HTTP_200_OK
+
+            ids += [invoice['id'] for invoice in response.data]
+            links = self.links(response)
+
+        assert ids == invoice_ids
+        assert 'prev' in links
+
+    def test_page_number_pagination_is_still_the_default(self):
+        InvoiceFactory.create_batch(3)
+
+        response = self.client.get(reverse('invoice-list') + '?page_size=2')
+
+        assert response.status_code == status.HTTP_200_OK
+        assert 'rel="last"' in response['Link']
@@ -0,0 +1,113 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import csv
+import datetime
+import json
+
+from decimal import Decimal
+
+from six import StringIO
+
+from django.core.management import call_command
+from django.test import override_settings
+from django.utils.encoding import force_text
+
+from rest_framework import status
+from rest_framework.reverse import reverse
+from rest_framework.test import APITestCase
+
+from silver.exports import InvoicesExport
+from silver.models import Invoice
+from silver.tests.factories import (AdminUserFactory, DocumentEntryFactory, InvoiceFactory,
+                                    TransactionFactory)
+from silver.tests.fixtures import PAYMENT_PROCESSORS
+
+
+@override_settings(PAYMENT_PROCESSORS=PAYMENT_PROCESSORS)
+class TestExports(APITestCase):
+    def setUp(self):
+        admin_user = AdminUserFactory.create()
+        self.client.force_authenticate(user=admin_user)
+
+    def export(self, resource, export_format, **params):
+        url = reverse('export-detail', kwargs={'resource': resource,
+                                               'export_format': export_format})
+        response = self.client.get(url, params)
+
+        assert response.status_code == status.HTTP_200_OK
+        return response, ''.join(force_text(line) for line in response.streaming_content)
+
+    def test_invoices_ndjson_export(self):
+        entry = DocumentEntryFactory.create(quantity=Decimal('2.00'),
+                                            unit_price=Decimal('10.00'))
+        invoice = InvoiceFactory.create(state=Invoice.STATES.ISSUED,
+                                        issue_date=datetime.date(2019, 1, 10),
+                                        invoice_entries=[entry])
+        InvoiceFactory.create(state=Invoice.STATES.ISSUED,
+                              issue_date=datetime.date(2019, 2, 10))
+
+        response, content = self.export('invoices', 'ndjson',
+                                        start_date='2019-01-01', end_date='2019-01-31')
+
+        assert response['Content-Type'] == 'application/x-ndjson'
+        rows = [json.loads(line) for line in content.splitlines()]
+        assert len(rows) == 1
+        assert rows[0]['id'] == invoice.id
+        assert rows[0]['issue_date'] == '2019-01-10'
+        assert Decimal(rows[0]['total']) == invoice.total
+
+        _, content = self.export('document-entries', 'ndjson', start_date='2019-01-01',
+                                 end_date='2019-01-31')
+        rows = [json.loads(line) for line in content.splitlines()]
+        assert [(row['id'], row['invoice']) for row in rows] == [(entry.id, invoice.id)]
+
+    def test_transactions_csv_export(self):
+        transactions = TransactionFactory.create_batch(2)
+
+        response, content = self.export('transactions', 'csv')
+
+        assert response['Content-Type'] == 'text/csv'
+        rows = list(csv.DictReader(StringIO(content)))
+        assert [int(row['id']) for row in rows] == [transaction.id
+                                                    for transaction in transactions]
+        assert rows[0]['uuid'] == str(transactions[0].uuid)
+
+    def test_exports_are_read_in_chunks(self):
+        invoices = InvoiceFactory.create_batch(5)
+
+        export = InvoicesExport()
+        export.chunk_size = 2
+
+        # Two full chunks, then a last one which ends the export
+        with self.assertNumQueries(3):
+            rows = list(export.rows())
+
+        assert [row[0] for row in rows] == [invoice.id for invoice in invoices]
+
+    def test_unknown_export(self):
+        url = reverse('export-detail', kwargs={'resource': 'customers',
+                                               'export_format': 'csv'})
+
+        assert self.client.get(url).status_code == status.HTTP_404_NOT_FOUND
+
+    def test_export_command(self):
+        transaction = TransactionFactory.create()
+        stdout = StringIO()
+
+        call_command('export_billing_data', 'transactions', stdout=stdout)
+
+        assert json.loads(stdout.getvalue())['id'] == transaction.id
@@ -0,0 +1,138 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import datetime
+import json
+
+from decimal import Decimal
+
+from freezegun import freeze_time
+
+from rest_framework import status
+from rest_framework.reverse import reverse
+from rest_framework.test import APITestCase
+
+from silver.metered_usage import ingest_usage_records
+from silver.models import MeteredFeatureUnitsLog, Subscription
+from silver.tests.factories import (AdminUserFactory, MeteredFeatureFactory,
+                                    MeteredFeatureUnitsLogFactory, SubscriptionFactory)
+
+
+@freeze_time('2017-01-15')
+class TestMeteredFeatureUsageBatchEndpoint(APITestCase):
+    def setUp(self):
+        admin_user = AdminUserFactory.create()
+        self.client.force_authenticate(user=admin_user)
+
+        self.url = reverse('mf-usage-batch')
+        self.date = '2017-01-15'
+
+    def create_subscription(self, **kwargs):
+        kwargs.setdefault('state', Subscription.STATES.ACTIVE)
+        kwargs.setdefault('start_date', datetime.date(2016, 1, 1))
+
+        subscription = SubscriptionFactory.create(**kwargs)
+        metered_feature = MeteredFeatureFactory.create()
+        subscription.plan.metered_features.add(metered_feature)
+
+        return subscription, metered_feature
+
+    def record(self, subscription, metered_feature, count, update_type='relative', date=None):
+        return {
+            'subscription': subscription.pk,
+            'product_code': str(metered_feature.product_code),
+            'date': date or self.date,
+            'count': count,
+            'update_type': update_type
+        }
+
+    def test_batch_usage(self):
+        subscription, metered_feature = self.create_subscription()
+        other_subscription, other_metered_feature = self.create_subscription()
+
+        MeteredFeatureUnitsLogFactory.create(
+            subscription=other_subscription, metered_feature=other_metered_feature,
+            start_date=datetime.date(2017, 1, 1), end_date=datetime.date(2017, 1, 31),
+            consumed_units=Decimal('10')
+        )
+
+        response = self.client.post(self.url, json.dumps([
+            self.record(subscription, metered_feature, 150, update_type='absolute'),
+            self.record(subscription, metered_feature, 29),
+            self.record(other_subscription, other_metered_feature, 5),
+        ]), content_type='application/json')
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data == [{'count': 179}, {'count': 179}, {'count': 15}]
+
+        assert MeteredFeatureUnitsLog.objects.get(
+            subscription=subscription
+        ).consumed_units == Decimal('179')
+        assert MeteredFeatureUnitsLog.objects.get(
+            subscription=other_subscription
+        ).consumed_units == Decimal('15')
+
+    def test_batch_usage_per_record_errors(self):
+        subscription, metered_feature = self.create_subscription()
+        ended_subscription, ended_metered_feature = self.create_subscription(
+            state=Subscription.STATES.ENDED
+        )
+
+        response = self.client.post(self.url, json.dumps([
+            self.record(subscription, metered_feature, 1),
+            {'subscription': subscription.pk},
+            self.record(subscription, metered_feature, 1, date='2015-12-31'),
+            dict(self.record(subscription, metered_feature, 1), product_code='missing'),
+            dict(self.record(subscription, metered_feature, 1), subscription=0),
+            self.record(ended_subscription, ended_metered_feature, 1),
+            self.record(subscription, metered_feature, 1, date='15-01-2017'),
+        ]), content_type='application/json')
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data == [
+            {'count': 1},
+            {'detail': 'Missing fields: product_code, date, count, update_type.'},
+            {'detail': 'Date is out of bounds.'},
+            {'detail': 'Metered Feature Not found.'},
+            {'detail': 'Subscription Not found.'},
+            {'detail': 'Subscription is ended.'},
+            {'detail': 'Invalid date format. Please use the ISO 8601 date format.'},
+        ]
+
+    def test_batch_usage_expects_a_list(self):
+        response = self.client.post(self.url, json.dumps({}), content_type='application/json')
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    def test_batch_usage_uses_a_fixed_number_of_queries(self):
+        records = []
+        for _ in range(5):
+            subscription, metered_feature = self.create_subscription()
+            MeteredFeatureUnitsLogFactory.create(
+                subscription=subscription, metered_feature=metered_feature,
+                start_date=datetime.date(2017, 1, 1), end_date=datetime.date(2017, 1, 31)
+            )
+            records.append(self.record(subscription, metered_feature, 1))
+
+            subscription, metered_feature = self.create_subscription()
+            records.append(self.record(subscription, metered_feature, 1))
+
+        # subscriptions, billing logs, metered features, locked logs, bulk create and update,
+        # plus the savepoints of the two (nested) atomic blocks
+        with self.assertNumQueries(10):
+            results = ingest_usage_records(records)
+
+        assert len([result for result in results if 'count' in result]) == 10
@@ -0,0 +1,48 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from rest_framework import status
+from rest_framework.reverse import reverse
+from rest_framework.test import APITestCase
+
+from silver.tests.factories import AdminUserFactory, InvoiceFactory, ProformaFactory
+from silver.tests.utils import query_budget
+
+
+class TestListQueryBudgets(APITestCase):
+    def setUp(self):
+        admin_user = AdminUserFactory.create()
+        self.client.force_authenticate(user=admin_user)
+
+    def assert_constant_queries(self, url, factory):
+        factory.create()
+        with CaptureQueriesContext(connection) as baseline:
+            response = self.client.get(url)
+        assert response.status_code == status.HTTP_200_OK
+
+        factory.create_batch(4)
+        with query_budget(len(baseline)):
+            response = self.client.get(url)
+        assert len(response.data) == 5
+
+    def test_invoice_list(self):
+        self.assert_constant_queries(reverse('invoice-list'), InvoiceFactory)
+
+    def test_proforma_list(self):
+        self.assert_constant_queries(reverse('proforma-list'), ProformaFactory)
@@ -0,0 +1,87 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import json
+
+from mock import patch
+from six import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+
+from silver.benchmarks import BillingBenchmark
+from silver.models import Customer, Subscription
+from silver.tests.fixtures import PAYMENT_PROCESSORS, triggered_processor
+
+
+@override_settings(PAYMENT_PROCESSORS=PAYMENT_PROCESSORS)
+class TestBenchmarkBillingCommand(TestCase):
+    def run_benchmark(self, *args):
+        output = StringIO()
+        call_command('benchmark_billing', '--providers=2', '--customers=4',
+                     '--subscriptions=3', '--metered-features=2', '--pdfs=0',
+                     '--requests=1', '--payment-processor={}'.format(triggered_processor),
+                     *args, stdout=output)
+
+        return json.loads(output.getvalue())
+
+    def test_benchmark_results(self):
+        results = self.run_benchmark('--billing-date=2019-02-01')
+
+        assert results['parameters']['billing_date'] == '2019-02-01'
+        assert results['dataset']['providers'] == 2
+        assert results['dataset']['plans'] == 20
+        assert results['dataset']['customers'] == 4
+        assert results['dataset']['subscriptions'] == 12
+        assert results['dataset']['linked_subscriptions'] == 8
+        assert results['dataset']['usage_events'] == 12 * 2 * 2
+
+        assert list(results['stages']) == ['rollup_usage_events', 'generate_documents',
+                                           'check_overpayments', 'retry_failed_transactions']
+        for stage in results['stages'].values():
+            assert 'error' not in stage
+            assert stage['wall_time'] >= stage['db_time']
+
+        for endpoint in results['endpoints'].values():
+            assert 'error' not in endpoint
+            assert endpoint['status_code'] == 200
+        assert results['endpoints']['subscription-list']['requests'] == 1
+
+    def test_failing_endpoints_are_reported(self):
+        endpoint = BillingBenchmark._endpoint
+
+        def failing_endpoint(benchmark, name, *args):
+            if name == 'invoice-list':
+                raise ValueError('Failed')
+
+            return endpoint(benchmark, name, *args)
+
+        with patch.object(BillingBenchmark, '_endpoint', failing_endpoint):
+            results = self.run_benchmark()
+
+        assert list(results['endpoints']['invoice-list']) == ['error']
+        assert 'Failed' in results['endpoints']['invoice-list']['error']
+        assert results['endpoints']['proforma-list']['status_code'] == 200
+
+    def test_the_generated_data_is_rolled_back(self):
+        self.run_benchmark()
+
+        assert not Customer.objects.exists()
+        assert not Subscription.objects.exists()
+
+        self.run_benchmark('--keep')
+
+        assert Customer.objects.count() == 4
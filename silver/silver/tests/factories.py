@@ -192,10 +192,8 @@ class InvoiceFactory(factory.django.DjangoModelFactory):
             for invoice_entry in extracted:
                 self.invoice_entries.add(invoice_entry)
 
-        if self.state != 'draft':
-            self._total = self.compute_total()
-            self._total_in_transaction_currency = self.compute_total_in_transaction_currency()
-            self.save()
+        # The entries are added with a queryset update, which doesn't maintain the totals
+        self.update_totals()
 
 
 class ProformaFactory(factory.django.DjangoModelFactory):
@@ -239,10 +237,8 @@ class ProformaFactory(factory.django.DjangoModelFactory):
             for proforma_entry in extracted:
                 self.proforma_entries.add(proforma_entry)
 
-        if self.state != Proforma.STATES.DRAFT:
-            self._total = self.compute_total()
-            self._total_in_transaction_currency = self.compute_total_in_transaction_currency()
-            self.save()
+        # The entries are added with a queryset update, which doesn't maintain the totals
+        self.update_totals()
 
 
 class DocumentEntryFactory(factory.django.DjangoModelFactory):
@@ -97,35 +97,44 @@ class TestTransactionDeclineRetries(TestCase):
         self.assertNotEqual(invoice.state, invoice.STATES.PAID)
 
     @pytest.mark.django_db
-    def test_failed_docs_query(self):
+    def test_due_retries_query(self):
         from silver.transaction_retries import TransactionRetryAttempter
         attempts = TransactionRetryAttempter()
 
-        c = list(attempts._query_payment_failures())
+        initial_try = dt.datetime(2019, 1, 1, 0, 0, 0, 0, tzinfo=pytz.UTC)
+        retry_begins = dt.datetime(2019, 1, 3, 0, 0, 0, 0, tzinfo=pytz.UTC)
+
+        c = list(attempts._query_due_retries(retry_begins))
         assert len(c) == 0
 
-        b = TransactionFactory(state=Transaction.States.Failed)
-        b.save()
+        customer, payment_method = self._create_default_payment_method()
+        b = TransactionFactory(state=Transaction.States.Failed,
+                               created_at=initial_try,
+                               proforma=None,
+                               payment_method=payment_method)
+
+        c = list(attempts._query_due_retries(initial_try))
+        assert len(c) == 0
+
+        c = list(attempts._query_due_retries(initial_try, force=True))
+        assert c == [b]
 
-        c = list(attempts._query_payment_failures())
-        assert len(c) == 1
+        c = list(attempts._query_due_retries(retry_begins))
+        assert c == [b]
 
     @pytest.mark.django_db
     def test_no_new_attempts_for_existing_functionality(self):
         from silver.transaction_retries import TransactionRetryAttempter
         attempts = TransactionRetryAttempter()
 
-        c = list(attempts._query_payment_failures())
-        assert len(c) == 0
-
         b = TransactionFactory(state=Transaction.States.Failed)
         b.save()
 
         invoice = b.invoice
         proforma = b.proforma
 
-        c = list(attempts._query_payment_failures())
-        assert len(c) == 1
+        c = list(attempts._query_due_retries(timezone.now(), force=True))
+        assert len(c) == 0
 
         # payment method is not configured to allow retry attempts.
         attempts.check(billing_date=timezone.now())
@@ -267,6 +276,51 @@ class TestTransactionDeclineRetries(TestCase):
         attempts.check(billing_date=retry_begins)
         assert trx.invoice.transactions.count() == 2
 
+    @pytest.mark.django_db
+    def test_failing_schedules_the_retry(self):
+        customer, payment_method = self._create_default_payment_method()
+
+        initial_try = dt.datetime(2019, 1, 1, 0, 0, 0, 0, tzinfo=pytz.UTC)
+
+        trx = TransactionFactory(state=Transaction.States.Pending,
+                                 created_at=initial_try,
+                                 proforma=None,
+                                 payment_method=payment_method)
+        assert trx.next_retry_at is None
+
+        trx.fail()
+        trx.save()
+        trx.refresh_from_db()
+
+        assert trx.next_retry_at == dt.datetime(2019, 1, 3, tzinfo=pytz.UTC)
+        assert trx.retry_deadline == dt.datetime(2019, 1, 6, tzinfo=pytz.UTC)
+
+    @pytest.mark.django_db
+    def test_no_retries_past_the_deadline(self):
+        from silver.transaction_retries import TransactionRetryAttempter
+        attempts = TransactionRetryAttempter()
+
+        initial_try = dt.datetime(2019, 1, 1, 0, 0, 0, 0, tzinfo=pytz.UTC)
+        past_deadline = dt.datetime(2019, 1, 7, 0, 0, 0, 0, tzinfo=pytz.UTC)
+
+        customer, payment_method = self._create_default_payment_method()
+
+        trx = TransactionFactory(state=Transaction.States.Failed,
+                                 created_at=initial_try,
+                                 updated_at=initial_try,
+                                 proforma=None,
+                                 payment_method=payment_method)
+
+        attempts.check(billing_date=past_deadline)
+        assert trx.invoice.transactions.count() == 1
+
+        # The retried transactions are not retried again
+        attempts.check(billing_date=past_deadline, force=True)
+        assert trx.invoice.transactions.count() == 2
+
+        trx.refresh_from_db()
+        assert trx.next_retry_at is None
+
     @override_settings(EMAIL_ON_TRANSACTION_FAIL=True,
                        MANAGERS=(('Admin', 'admin@example.com')))
     def test_transaction_failure_sends_emails(self):
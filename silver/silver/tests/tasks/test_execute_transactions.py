@@ -0,0 +1,235 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import threading
+
+import pytest
+
+from mock import MagicMock, call, patch
+
+from silver.models import Transaction
+from silver.payment_processors import get_instance
+from silver.tasks import execute_transactions, execute_transactions_batch
+from silver.tests.factories import PaymentMethodFactory, TransactionFactory
+from silver.tests.fixtures import (PAYMENT_PROCESSORS, TriggeredProcessor, manual_processor,
+                                   triggered_processor)
+from silver.transaction_execution import RateLimiter, TransactionExecutionEngine
+
+
+class LocksRedis(object):
+    # Keeps the locks in memory, implementing the commands used by the engine
+    def __init__(self):
+        self.held = set()
+        self._lock = threading.Lock()
+
+    def lock(self, key, timeout=None):
+        redis = self
+
+        class Lock(object):
+            def acquire(self, blocking=True):
+                with redis._lock:
+                    if key in redis.held:
+                        return False
+
+                    redis.held.add(key)
+                    return True
+
+            def release(self):
+                with redis._lock:
+                    redis.held.discard(key)
+
+        return Lock()
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    redis = LocksRedis()
+    monkeypatch.setattr('silver.transaction_execution.redis', redis)
+
+    return redis
+
+
+@pytest.fixture
+def execution_settings(settings, monkeypatch, redis):
+    settings.PAYMENT_PROCESSORS = PAYMENT_PROCESSORS
+    # The worker threads wouldn't see the test's data
+    monkeypatch.setattr('silver.transaction_execution.TRANSACTION_EXECUTION_CONCURRENCY', 1)
+
+    return settings
+
+
+@pytest.mark.django_db
+def test_execute_transactions_queues_a_task_per_batch(execution_settings):
+    payment_method = PaymentMethodFactory.create(payment_processor=triggered_processor,
+                                                 verified=True)
+    transactions = TransactionFactory.create_batch(5, payment_method=payment_method)
+
+    unverified_payment_method = PaymentMethodFactory.create(
+        payment_processor=triggered_processor, verified=False
+    )
+    TransactionFactory.create(payment_method=unverified_payment_method)
+
+    manual_payment_method = PaymentMethodFactory.create(payment_processor=manual_processor,
+                                                        verified=True)
+    TransactionFactory.create(payment_method=manual_payment_method)
+
+    with patch('silver.tasks.group') as group_mock, \
+            patch('silver.tasks.TRANSACTION_EXECUTION_BATCH_SIZE', 3):
+        execute_transactions()
+
+        batches = [signature.args[0] for signature in group_mock.call_args[0][0]]
+        transaction_ids = sorted(transaction.id for transaction in transactions)
+        assert batches == [transaction_ids[:3], transaction_ids[3:]]
+
+
+@pytest.mark.django_db
+def test_execute_transactions_batch_task(execution_settings):
+    payment_method = PaymentMethodFactory.create(payment_processor=triggered_processor,
+                                                 verified=True)
+    transactions = TransactionFactory.create_batch(3, payment_method=payment_method)
+
+    mock_execute = MagicMock(side_effect=[True, False, Exception('This happened.')])
+    with patch.multiple(TriggeredProcessor, execute_transaction=mock_execute):
+        reports = execute_transactions_batch([transaction.id for transaction in transactions])
+
+    assert mock_execute.call_args_list == [call(transaction) for transaction in transactions]
+
+    assert len(reports) == 1
+    assert reports[0]['payment_processor'] == triggered_processor
+    assert reports[0]['transactions'] == 3
+    assert reports[0]['succeeded'] == 1
+    assert reports[0]['failed'] == 1
+    assert reports[0]['errors'] == 1
+
+    for transaction in transactions:
+        transaction.refresh_from_db()
+        assert transaction.state == Transaction.States.Pending
+
+
+@pytest.mark.django_db
+def test_execute_transactions_batch_skips_already_executed_transactions(execution_settings):
+    payment_method = PaymentMethodFactory.create(payment_processor=triggered_processor,
+                                                 verified=True)
+    transaction = TransactionFactory.create(payment_method=payment_method,
+                                            state=Transaction.States.Pending)
+
+    mock_execute = MagicMock()
+    with patch.multiple(TriggeredProcessor, execute_transaction=mock_execute):
+        assert execute_transactions_batch([transaction.id]) == []
+
+    assert not mock_execute.called
+
+
+@pytest.mark.django_db
+def test_overlapping_batches_execute_a_transaction_only_once(execution_settings, redis):
+    payment_method = PaymentMethodFactory.create(payment_processor=triggered_processor,
+                                                 verified=True)
+    transactions = TransactionFactory.create_batch(3, payment_method=payment_method)
+    transaction_ids = [transaction.id for transaction in transactions]
+
+    # Both batches are loaded before either of them is executed
+    first_engine, second_engine = TransactionExecutionEngine(), TransactionExecutionEngine()
+    first_batch = list(first_engine.get_executable_transactions(transaction_ids[:2]))
+    second_batch = list(second_engine.get_executable_transactions(transaction_ids[1:]))
+    processor = first_engine.get_payment_processor(triggered_processor)
+
+    # The last transaction is being executed by yet another task
+    redis.held.add('silver:execute-transaction:{}'.format(transaction_ids[2]))
+
+    mock_execute = MagicMock(return_value=True)
+    with patch.multiple(TriggeredProcessor, execute_transaction=mock_execute):
+        first_stats = first_engine._execute_for_processor(processor, first_batch)
+        second_stats = second_engine._execute_for_processor(processor, second_batch)
+
+    assert sorted(call_args[0][0].id for call_args in mock_execute.call_args_list) == \
+        transaction_ids[:2]
+
+    assert (first_stats.succeeded, first_stats.skipped) == (2, 0)
+    assert (second_stats.succeeded, second_stats.skipped) == (0, 2)
+    assert redis.held == {'silver:execute-transaction:{}'.format(transaction_ids[2])}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_engine_executes_the_transactions_concurrently(settings, redis):
+    # The data is committed, so the worker threads can see it
+    settings.PAYMENT_PROCESSORS = PAYMENT_PROCESSORS
+
+    payment_method = PaymentMethodFactory.create(payment_processor=triggered_processor,
+                                                 verified=True)
+    transactions = TransactionFactory.create_batch(6, payment_method=payment_method)
+
+    executed_ids = []
+    executed_ids_lock = threading.Lock()
+
+    # The processor is shared with the rest of the process
+    processor = get_instance(triggered_processor)
+    http_session = processor.http_session
+
+    def execute_transaction(transaction):
+        with executed_ids_lock:
+            executed_ids.append(transaction.id)
+
+        assert processor.http_session is not http_session
+
+        return transaction.id % 2 == 0
+
+    with patch.multiple(TriggeredProcessor,
+                        execute_transaction=MagicMock(side_effect=execute_transaction)):
+        stats = TransactionExecutionEngine(batch_size=4, concurrency=3).execute()
+
+    assert sorted(executed_ids) == sorted(transaction.id for transaction in transactions)
+
+    # A batch of 4 transactions and one of 2, both of the triggered processor
+    assert [processor_stats.payment_processor for processor_stats in stats] == \
+        [triggered_processor] * 2
+    assert [processor_stats.transactions for processor_stats in stats] == [4, 2]
+    assert sum(processor_stats.succeeded for processor_stats in stats) == len(
+        [transaction for transaction in transactions if transaction.id % 2 == 0]
+    )
+    assert sum(processor_stats.failed for processor_stats in stats) == len(
+        [transaction for transaction in transactions if transaction.id % 2]
+    )
+    assert not any(processor_stats.errors or processor_stats.skipped
+                   for processor_stats in stats)
+    assert not redis.held
+
+    # Only the worker threads' HTTP sessions are closed
+    assert processor._http_sessions == [http_session]
+    assert processor.http_session is http_session
+
+    assert set(Transaction.objects.values_list('state', flat=True)) == {
+        Transaction.States.Pending
+    }
+
+
+def test_rate_limiter_spaces_out_the_calls():
+    with patch('silver.transaction_execution.time') as time_mock:
+        time_mock.time.return_value = 100
+
+        rate_limiter = RateLimiter(rate=4)
+        for _ in range(3):
+            rate_limiter.wait()
+
+    assert time_mock.sleep.call_args_list == [call(0.25), call(0.5)]
+
+
+def test_rate_limiter_without_rate_does_not_wait():
+    with patch('silver.transaction_execution.time') as time_mock:
+        rate_limiter = RateLimiter()
+        for _ in range(3):
+            rate_limiter.wait()
+
+    assert not time_mock.sleep.called
@@ -0,0 +1,79 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import pytest
+
+from mock import MagicMock, patch
+
+from silver.models import Transaction
+from silver.tasks import fetch_payment_processor_transactions_status, fetch_transactions_status
+from silver.tests.factories import PaymentMethodFactory, TransactionFactory
+from silver.tests.fixtures import PAYMENT_PROCESSORS, TriggeredProcessor, triggered_processor
+
+
+@pytest.mark.django_db
+def test_fetch_transactions_status_queues_a_task_per_transaction(settings):
+    settings.PAYMENT_PROCESSORS = PAYMENT_PROCESSORS
+
+    payment_method = PaymentMethodFactory.create(payment_processor=triggered_processor)
+    transactions = TransactionFactory.create_batch(2, payment_method=payment_method,
+                                                   state=Transaction.States.Pending)
+
+    with patch('silver.tasks.group') as group_mock:
+        fetch_transactions_status()
+
+    signatures = list(group_mock.call_args[0][0])
+    assert all(signature.task == 'silver.tasks.fetch_transaction_status'
+               for signature in signatures)
+    assert sorted(signature.args[0] for signature in signatures) == sorted(
+        transaction.id for transaction in transactions
+    )
+
+
+@pytest.mark.django_db
+def test_fetch_transactions_status_queues_a_task_per_bulk_processor(settings):
+    settings.PAYMENT_PROCESSORS = PAYMENT_PROCESSORS
+
+    payment_method = PaymentMethodFactory.create(payment_processor=triggered_processor)
+    TransactionFactory.create_batch(3, payment_method=payment_method,
+                                    state=Transaction.States.Pending)
+
+    with patch('silver.tasks.group') as group_mock, \
+            patch.object(TriggeredProcessor, 'bulk_fetch_transactions_status', True):
+        fetch_transactions_status()
+
+    signatures = list(group_mock.call_args[0][0])
+    assert len(signatures) == 1
+    assert signatures[0].task == 'silver.tasks.fetch_payment_processor_transactions_status'
+    assert signatures[0].args == (triggered_processor, None)
+
+
+@pytest.mark.django_db
+def test_fetch_payment_processor_transactions_status_task(settings):
+    settings.PAYMENT_PROCESSORS = PAYMENT_PROCESSORS
+
+    payment_method = PaymentMethodFactory.create(payment_processor=triggered_processor)
+    transactions = TransactionFactory.create_batch(3, payment_method=payment_method,
+                                                   state=Transaction.States.Pending)
+    TransactionFactory.create(payment_method=payment_method)
+
+    mock_fetch = MagicMock(return_value=True)
+    with patch.multiple(TriggeredProcessor, fetch_transaction_status=mock_fetch):
+        assert fetch_payment_processor_transactions_status(triggered_processor) == 3
+
+    assert sorted(call_args[0][0].id for call_args in mock_fetch.call_args_list) == sorted(
+        transaction.id for transaction in transactions
+    )
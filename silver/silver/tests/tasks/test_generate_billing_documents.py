@@ -0,0 +1,123 @@
+# Copyright (c) 2015 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import datetime
+
+import pytest
+
+from mock import patch, MagicMock
+
+from silver.documents_generator import customer_id_shards
+from silver.models import Customer, Subscription
+from silver.tasks import (BILLING_RUN_PROGRESS_TIMEOUT, generate_billing_documents,
+                          generate_billing_documents_shard, report_billing_documents_generation)
+from silver.tests.factories import CustomerFactory, SubscriptionFactory
+
+
+@pytest.mark.django_db
+def test_customer_id_shards():
+    customers = CustomerFactory.create_batch(size=5)
+    ids = sorted(customer.pk for customer in customers)
+
+    shards = customer_id_shards(Customer.objects.all(), shard_size=2)
+
+    assert shards == [(ids[0], ids[1]), (ids[2], ids[3]), (ids[4], ids[4])]
+
+
+@pytest.mark.django_db
+def test_customer_id_shards_without_customers():
+    assert customer_id_shards(Customer.objects.all(), shard_size=2) == []
+
+
+@pytest.mark.django_db
+def test_generate_billing_documents_fans_out_one_task_per_shard(monkeypatch):
+    for customer in CustomerFactory.create_batch(size=3):
+        SubscriptionFactory.create(customer=customer, start_date=datetime.date(2017, 12, 1),
+                                   state=Subscription.STATES.ACTIVE)
+
+    # Customers without subscriptions due for billing are skipped
+    CustomerFactory.create()
+
+    redis_mock = MagicMock()
+    monkeypatch.setattr('silver.tasks.redis', redis_mock)
+    monkeypatch.setattr('silver.tasks.DOCS_GENERATION_SHARD_SIZE', 2)
+
+    with patch('silver.tasks.chord') as chord_mock:
+        generate_billing_documents(billing_date='2018-01-01')
+
+        header = list(chord_mock.call_args[0][0])
+        assert len(header) == 2
+        assert all(signature.args[2] == '2018-01-01' for signature in header)
+
+    # the run's progress is not kept forever
+    pipeline = redis_mock.pipeline.return_value
+    pipeline.hset.assert_called_once_with('silver:billing-run:2018-01-01', 'shards', 2)
+    pipeline.expire.assert_called_once_with('silver:billing-run:2018-01-01',
+                                            BILLING_RUN_PROGRESS_TIMEOUT)
+
+
+@pytest.mark.django_db
+def test_generate_billing_documents_shard(monkeypatch):
+    customers = CustomerFactory.create_batch(size=3)
+    failing_customer = customers[1]
+
+    redis_mock = MagicMock()
+    monkeypatch.setattr('silver.tasks.redis', redis_mock)
+
+    def generate_for_customer(customer, billing_date, force_generate=False, snapshot=None):
+        if customer == failing_customer:
+            raise Exception('Payment provider is down.')
+
+    with patch('silver.tasks.DocumentsGenerator.generate_for_customer',
+               side_effect=generate_for_customer) as generate_mock:
+        result = generate_billing_documents_shard(customers[0].pk, customers[2].pk,
+                                                  '2018-01-01')
+
+    assert generate_mock.call_count == 3
+    assert result['billed'] == 2
+    assert result['failed'] == [failing_customer.pk]
+    assert result['locked'] == []
+
+    # every customer lock is released, even when billing fails
+    assert redis_mock.lock.return_value.release.call_count == 3
+
+
+@pytest.mark.django_db
+def test_generate_billing_documents_shard_skips_locked_customers(monkeypatch):
+    customer = CustomerFactory.create()
+
+    redis_mock = MagicMock()
+    redis_mock.lock.return_value.acquire.return_value = False
+    monkeypatch.setattr('silver.tasks.redis', redis_mock)
+
+    with patch('silver.tasks.DocumentsGenerator.generate_for_customer') as generate_mock:
+        result = generate_billing_documents_shard(customer.pk, customer.pk, '2018-01-01')
+
+    assert not generate_mock.called
+    assert result['locked'] == [customer.pk]
+
+
+def test_report_billing_documents_generation():
+    summary = report_billing_documents_generation(
+        [{'billed': 2, 'locked': [], 'failed': [3]},
+         {'billed': 1, 'locked': [5], 'failed': []}],
+        billing_date='2018-01-01'
+    )
+
+    assert summary['shards'] == 2
+    assert summary['billed'] == 3
+    assert summary['failed'] == [3]
+    assert summary['locked'] == [5]
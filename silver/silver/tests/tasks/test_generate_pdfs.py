@@ -18,7 +18,7 @@ import pytest
 
 from mock import patch, call, MagicMock
 
-from silver.tasks import generate_pdfs, generate_pdf
+from silver.tasks import generate_pdfs, generate_pdf, generate_pdfs_batch
 from silver.tests.factories import InvoiceFactory, ProformaFactory
 from silver.utils.pdf import fetch_resources
 
@@ -58,11 +58,38 @@ def test_generate_pdfs_task(monkeypatch):
     lock_mock = MagicMock()
     monkeypatch.setattr('silver.tasks.redis.lock', lock_mock)
 
-    with patch('silver.tasks.group') as group_mock:
+    with patch('silver.tasks.group') as group_mock, \
+            patch('silver.tasks.PDF_GENERATION_BATCH_SIZE', 3):
         generate_pdfs()
 
         assert group_mock.call_count
 
+        batches = [signature.args[0] for signature in group_mock.call_args[0][0]]
+        assert batches == [
+            sorted(document.id for document in documents_to_generate)[:3],
+            sorted(document.id for document in documents_to_generate)[3:],
+        ]
+
+
+@pytest.mark.django_db
+def test_generate_pdfs_batch_task(settings, tmpdir, monkeypatch):
+    settings.MEDIA_ROOT = tmpdir.strpath
+
+    pisa_document_mock = MagicMock()
+    monkeypatch.setattr('silver.models.documents.pdf.pisa.pisaDocument',
+                        pisa_document_mock)
+
+    invoices = InvoiceFactory.create_batch(2)
+    for invoice in invoices:
+        invoice.issue()
+
+    generate_pdfs_batch([invoice.id for invoice in invoices])
+
+    assert pisa_document_mock.call_count == 2
+    for invoice in invoices:
+        invoice.pdf.refresh_from_db()
+        assert not invoice.pdf.dirty
+
 
 @pytest.mark.django_db
 @patch('silver.models.documents.base.BillingDocumentBase.get_template')
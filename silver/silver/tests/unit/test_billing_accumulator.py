@@ -0,0 +1,94 @@
+# Copyright (c) 2015 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import datetime as dt
+
+from decimal import Decimal
+
+from django.test import TestCase
+
+from silver.documents_generator import BillingAccumulator
+from silver.models import BillingLog, DocumentEntry
+from silver.tests.factories import ProformaFactory, SubscriptionFactory
+from silver.utils.models import BulkCreateAccumulator
+
+
+class TestBulkCreateAccumulator(TestCase):
+    def test_flush_inserts_all_instances_in_one_query(self):
+        proforma = ProformaFactory.create()
+        accumulator = BulkCreateAccumulator(DocumentEntry)
+
+        with self.assertNumQueries(0):
+            for _ in range(10):
+                accumulator.add(proforma=proforma, description='Entry',
+                                quantity=Decimal('1.00'), unit_price=Decimal('10.00'))
+
+        assert len(accumulator) == 10
+
+        with self.assertNumQueries(1):
+            entries = accumulator.flush()
+
+        assert len(entries) == 10
+        assert len(accumulator) == 0
+        assert DocumentEntry.objects.filter(proforma=proforma).count() == 10
+
+    def test_flush_without_instances(self):
+        with self.assertNumQueries(0):
+            assert BulkCreateAccumulator(DocumentEntry).flush() == []
+
+    def test_decimals_are_quantized_as_stored(self):
+        proforma = ProformaFactory.create()
+        accumulator = BulkCreateAccumulator(DocumentEntry)
+
+        entry = accumulator.add(proforma=proforma, description='Entry',
+                                quantity=Decimal('1.00'), unit_price=Decimal('6.66266667'))
+        accumulator.flush()
+
+        assert entry.unit_price == Decimal('6.6627')
+        assert DocumentEntry.objects.get().unit_price == entry.unit_price
+
+
+class TestBillingAccumulator(TestCase):
+    def test_flush_seeds_the_document_entries(self):
+        proforma = ProformaFactory.create()
+        subscription = SubscriptionFactory.create()
+
+        accumulator = BillingAccumulator()
+        accumulator.entries.add(proforma=proforma, description='Plan',
+                                quantity=Decimal('1.00'), unit_price=Decimal('10.00'))
+        accumulator.entries.add(proforma=proforma, description='Feature',
+                                quantity=Decimal('2.00'), unit_price=Decimal('2.50'))
+        accumulator.billing_logs.add(subscription=subscription, proforma=proforma,
+                                     billing_date=dt.date(2018, 1, 1),
+                                     plan_billed_up_to=dt.date(2018, 1, 31),
+                                     metered_features_billed_up_to=dt.date(2017, 12, 31),
+                                     total=Decimal('15.00'), plan_amount=Decimal('10.00'),
+                                     metered_features_amount=Decimal('5.00'))
+
+        # The entries, the billing logs and the proforma's totals
+        with self.assertNumQueries(3):
+            accumulator.flush()
+
+        assert DocumentEntry.objects.filter(proforma=proforma).count() == 2
+        assert BillingLog.objects.filter(subscription=subscription).count() == 1
+
+        # The customer's 1% sales tax is applied
+        with self.assertNumQueries(0):
+            assert proforma.compute_total() == Decimal('15.15')
+
+        proforma.refresh_from_db()
+        assert proforma.total_before_tax == Decimal('15.00')
+        assert proforma.total == Decimal('15.15')
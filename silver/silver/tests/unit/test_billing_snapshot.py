@@ -0,0 +1,127 @@
+# Copyright (c) 2015 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import datetime as dt
+
+from decimal import Decimal
+
+from django.test import TestCase
+
+from silver.billing_snapshot import BillingSnapshot
+from silver.models import BillingLog, Plan, Subscription
+from silver.tests.factories import (CustomerFactory, MeteredFeatureFactory,
+                                    MeteredFeatureUnitsLogFactory, PlanFactory,
+                                    SubscriptionFactory)
+
+
+class TestBillingSnapshot(TestCase):
+    def setUp(self):
+        self.metered_feature = MeteredFeatureFactory.create()
+        self.plan = PlanFactory.create(interval=Plan.INTERVALS.MONTH, interval_count=1,
+                                       metered_features=[self.metered_feature])
+
+        self.customers = CustomerFactory.create_batch(size=3)
+        self.subscriptions = [
+            SubscriptionFactory.create(plan=self.plan, customer=customer,
+                                       start_date=dt.date(2018, 1, 1),
+                                       state=Subscription.STATES.ACTIVE)
+            for customer in self.customers
+        ]
+
+        for subscription in self.subscriptions:
+            BillingLog.objects.create(subscription=subscription,
+                                      billing_date=dt.date(2018, 2, 1),
+                                      plan_billed_up_to=dt.date(2018, 2, 28),
+                                      metered_features_billed_up_to=dt.date(2018, 1, 31))
+            self.last_billing_log = BillingLog.objects.create(
+                subscription=subscription,
+                billing_date=dt.date(2018, 3, 1),
+                plan_billed_up_to=dt.date(2018, 3, 31),
+                metered_features_billed_up_to=dt.date(2018, 2, 28)
+            )
+
+            # Already billed
+            MeteredFeatureUnitsLogFactory.create(
+                subscription=subscription, metered_feature=self.metered_feature,
+                start_date=dt.date(2018, 2, 1), end_date=dt.date(2018, 2, 28),
+                consumed_units=Decimal('10.00')
+            )
+            MeteredFeatureUnitsLogFactory.create(
+                subscription=subscription, metered_feature=self.metered_feature,
+                start_date=dt.date(2018, 3, 1), end_date=dt.date(2018, 3, 31),
+                consumed_units=Decimal('5.00')
+            )
+
+    def test_snapshot_is_loaded_in_a_fixed_number_of_queries(self):
+        with self.assertNumQueries(4):
+            snapshot = BillingSnapshot(self.customers).load()
+
+        with self.assertNumQueries(0):
+            for customer in self.customers:
+                subscription, = snapshot.subscriptions(customer)
+
+                assert subscription.last_billing_log.billing_date == dt.date(2018, 3, 1)
+                assert not subscription.is_billed_first_time
+                assert subscription.billed_up_to_dates == {
+                    'metered_features_billed_up_to': dt.date(2018, 2, 28),
+                    'plan_billed_up_to': dt.date(2018, 3, 31)
+                }
+                assert list(subscription.plan.metered_features.all()) == [self.metered_feature]
+                assert subscription.plan.provider == self.plan.provider
+
+                assert subscription._get_consumed_units_in_range(
+                    self.metered_feature, dt.date(2018, 3, 1), dt.date(2018, 3, 31)
+                ) == Decimal('5.00')
+
+    def test_snapshot_skips_billed_mf_log_entries(self):
+        snapshot = BillingSnapshot(self.customers).load()
+
+        for customer in self.customers:
+            subscription, = snapshot.subscriptions(customer)
+
+            assert [log.start_date for log in subscription._prefetched_mf_log_entries] == [
+                dt.date(2018, 3, 1)
+            ]
+
+    def test_snapshot_for_subscription_without_billing_logs(self):
+        customer = CustomerFactory.create()
+        SubscriptionFactory.create(plan=self.plan, customer=customer,
+                                   start_date=dt.date(2018, 1, 1),
+                                   state=Subscription.STATES.ACTIVE)
+
+        snapshot = BillingSnapshot([customer]).load()
+        subscription, = snapshot.subscriptions(customer)
+
+        with self.assertNumQueries(0):
+            assert subscription.last_billing_log is None
+            assert subscription.is_billed_first_time
+
+    def test_snapshot_staleness(self):
+        snapshot = BillingSnapshot(self.customers).load()
+        customer = self.customers[0]
+
+        assert not snapshot.is_stale(customer)
+
+        BillingLog.objects.create(subscription=self.subscriptions[0],
+                                  billing_date=dt.date(2018, 4, 1),
+                                  plan_billed_up_to=dt.date(2018, 4, 30),
+                                  metered_features_billed_up_to=dt.date(2018, 3, 31))
+
+        assert snapshot.is_stale(customer)
+
+        snapshot.reload_customer(customer)
+        subscription, = snapshot.subscriptions(customer)
+        assert subscription.last_billing_log.billing_date == dt.date(2018, 4, 1)
@@ -0,0 +1,103 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+from datetime import timedelta
+from decimal import Decimal
+
+from six import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from silver.models import Customer, CustomerBalanceLedger, Invoice, Transaction
+from silver.tests.factories import (CustomerFactory, DocumentEntryFactory, InvoiceFactory,
+                                    PaymentMethodFactory, TransactionFactory)
+from silver.tests.fixtures import PAYMENT_PROCESSORS
+
+
+@override_settings(PAYMENT_PROCESSORS=PAYMENT_PROCESSORS)
+class TestCustomerBalance(TestCase):
+    def setUp(self):
+        self.today = timezone.now().date()
+
+        entry = DocumentEntryFactory.create(quantity=Decimal('1.00'),
+                                            unit_price=Decimal('100.00'))
+        self.invoice = InvoiceFactory.create(state=Invoice.STATES.ISSUED,
+                                             invoice_entries=[entry])
+        self.customer = self.invoice.customer
+        self.payment_method = PaymentMethodFactory.create(customer=self.customer)
+
+    def settle_transaction(self, amount):
+        transaction = TransactionFactory.create(invoice=self.invoice, proforma=None,
+                                                payment_method=self.payment_method,
+                                                amount=amount,
+                                                state=Transaction.States.Pending)
+        transaction.settle()
+        transaction.save()
+
+        return transaction
+
+    def assert_balance(self, balance, date=None):
+        date = date or self.today
+
+        assert self.customer.balance_on_date(date, use_ledger=False) == balance
+        assert self.customer.balance_on_date(date, use_ledger=True) == balance
+
+    def test_ledger_follows_the_payments_and_refunds(self):
+        total = self.invoice.total_in_transaction_currency
+
+        first_transaction = self.settle_transaction(Decimal('60.00'))
+        assert not CustomerBalanceLedger.objects.exists()
+
+        self.settle_transaction(total - Decimal('60.00'))
+        self.invoice.refresh_from_db()
+        assert self.invoice.state == Invoice.STATES.PAID
+        self.assert_balance(Decimal('0.00'))
+
+        first_transaction.refund()
+        first_transaction.save()
+
+        self.assert_balance(Decimal('-60.00'))
+        self.assert_balance(Decimal('0.00'), date=self.today - timedelta(days=1))
+
+        assert list(CustomerBalanceLedger.objects.values_list('reason', flat=True)) == [
+            CustomerBalanceLedger.REASONS.invoice_paid,
+            CustomerBalanceLedger.REASONS.transaction_refunded
+        ]
+
+    def test_balances_are_annotated_in_a_single_query(self):
+        self.settle_transaction(self.invoice.total_in_transaction_currency)
+        CustomerFactory.create_batch(3)
+
+        with self.assertNumQueries(1):
+            customers = list(Customer.objects.with_balances(self.today))
+
+            for customer in customers:
+                assert customer.balance_on_date(self.today) == Decimal('0.00')
+
+        assert len(customers) == 4
+
+    def test_rebuild_customer_balance_ledger(self):
+        self.settle_transaction(self.invoice.total_in_transaction_currency)
+        CustomerBalanceLedger.objects.all().delete()
+
+        call_command('rebuild_customer_balance_ledger', stdout=StringIO())
+
+        entry = CustomerBalanceLedger.objects.get()
+        assert entry.reason == CustomerBalanceLedger.REASONS.opening
+        assert entry.invoice_id == self.invoice.pk
+        self.assert_balance(Decimal('0.00'))
@@ -0,0 +1,81 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+from datetime import date
+
+import pytest
+
+from dateutil import rrule
+from mock import patch
+
+from silver.models import Plan
+from silver.tests.factories import PlanFactory, SubscriptionFactory
+from silver.utils.cycles import CycleSchedule, cycle_schedule, first_aligned_date
+
+
+@pytest.mark.parametrize('interval_type, interval_count, dtstart', [
+    (rrule.MONTHLY, 1, date(2015, 1, 31)),
+    (rrule.MONTHLY, 3, date(2016, 2, 29)),
+    (rrule.WEEKLY, 2, date(2018, 1, 3)),
+    (rrule.YEARLY, 1, date(2016, 2, 29)),
+    (rrule.DAILY, 10, date(2018, 1, 1)),
+])
+def test_cycle_schedule_matches_rrule_expansion(interval_type, interval_count, dtstart):
+    schedule = CycleSchedule(interval_type, interval_count, dtstart)
+
+    for until in [date(2014, 12, 31), dtstart, date(2018, 3, 1), date(2018, 2, 28),
+                  date(2020, 2, 29), date(2019, 12, 31)]:
+        dates = list(rrule.rrule(interval_type, dtstart=dtstart, interval=interval_count,
+                                 until=until))
+        expected = dates[-1].date() if dates else None
+
+        assert schedule.last_start_date(until) == expected
+
+
+def test_cycle_schedules_are_shared():
+    schedule = cycle_schedule(rrule.MONTHLY, 1, date(2018, 1, 1))
+
+    assert cycle_schedule(rrule.MONTHLY, 1, date(2018, 1, 1)) is schedule
+    assert cycle_schedule(rrule.MONTHLY, 2, date(2018, 1, 1)) is not schedule
+
+
+def test_first_aligned_date():
+    assert first_aligned_date(date(2018, 1, 15), rrule.MONTHLY, bymonthday=1) == date(2018, 2, 1)
+    assert first_aligned_date(date(2018, 1, 15), rrule.WEEKLY, byweekday=0) == date(2018, 1, 15)
+    assert first_aligned_date(date(2018, 1, 15), rrule.YEARLY,
+                              bymonth=1, bymonthday=1) == date(2019, 1, 1)
+
+
+@pytest.mark.django_db
+def test_subscription_cycle_dates_are_memoized():
+    plan = PlanFactory.create(interval=Plan.INTERVALS.MONTH, interval_count=1)
+    subscription = SubscriptionFactory.create(plan=plan, start_date=date(2010, 1, 15))
+
+    with patch('silver.models.subscriptions.cycle_schedule',
+               wraps=cycle_schedule) as schedule_mock:
+        assert subscription.cycle_start_date(date(2019, 3, 10)) == date(2019, 3, 1)
+        assert subscription.cycle_end_date(date(2019, 3, 10)) == date(2019, 3, 31)
+
+        calls = schedule_mock.call_count
+
+        assert subscription.cycle_start_date(date(2019, 3, 10)) == date(2019, 3, 1)
+        assert subscription.cycle_end_date(date(2019, 3, 10)) == date(2019, 3, 31)
+
+        assert schedule_mock.call_count == calls
+
+    # Changing the fields the cycles depend on invalidates the memoized dates
+    subscription.start_date = date(2019, 3, 5)
+    assert subscription.cycle_start_date(date(2019, 3, 10)) == date(2019, 3, 5)
@@ -0,0 +1,134 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+from mock import patch
+
+from django.db import IntegrityError, models
+from django.test import TestCase
+
+from silver.models import DocumentNumberCounter, Invoice
+from silver.models.documents.numbering import (allocate_document_numbers,
+                                               release_document_numbers,
+                                               reserved_document_numbers)
+from silver.tests.factories import InvoiceFactory, ProformaFactory, ProviderFactory
+
+
+class TestDocumentNumbering(TestCase):
+    def setUp(self):
+        self.provider = ProviderFactory.create(invoice_starting_number=1)
+
+    def issue_invoice(self, **kwargs):
+        invoice = InvoiceFactory.create(provider=self.provider, **kwargs)
+        invoice.issue()
+        invoice.save()
+
+        return invoice
+
+    def test_numbers_are_consecutive_per_series_and_kind(self):
+        assert [self.issue_invoice().number for _ in range(3)] == [1, 2, 3]
+
+        proforma = ProformaFactory.create(provider=self.provider)
+        proforma.issue()
+        assert proforma.number == 1
+
+        assert self.issue_invoice(series='OTHER').number == 1
+
+    def test_counter_continues_the_existing_numbers(self):
+        InvoiceFactory.create(provider=self.provider, state=Invoice.STATES.ISSUED, number=41)
+        DocumentNumberCounter.objects.all().delete()
+
+        assert self.issue_invoice().number == 42
+
+    def test_provider_starting_number(self):
+        self.provider.invoice_starting_number = 100
+        self.provider.save()
+
+        assert self.issue_invoice().number == 100
+        assert self.issue_invoice().number == 101
+
+    def test_numbers_set_by_hand_are_skipped(self):
+        self.issue_invoice()
+
+        invoice = InvoiceFactory.create(provider=self.provider)
+        invoice.number = 10
+        invoice.issue()
+        invoice.save()
+
+        assert self.issue_invoice().number == 11
+
+    def test_numbers_of_unsaved_documents_are_released(self):
+        self.issue_invoice()
+
+        invoice = InvoiceFactory.create(provider=self.provider)
+        model_save = models.Model.save
+
+        def save(instance, *args, **kwargs):
+            if isinstance(instance, Invoice):
+                raise IntegrityError
+
+            return model_save(instance, *args, **kwargs)
+
+        # Issuing saves the document, after its number was allocated
+        with patch.object(models.Model, 'save', save):
+            with self.assertRaises(IntegrityError):
+                invoice.issue()
+
+        assert invoice.number is None
+        assert DocumentNumberCounter.objects.get(
+            provider=self.provider, kind='invoice'
+        ).next_number == 2
+        assert self.issue_invoice().number == 2
+
+    def test_released_numbers_followed_by_allocations_remain_gaps(self):
+        first_number = allocate_document_numbers(self.provider, 'invoice', 'SER')
+        allocate_document_numbers(self.provider, 'invoice', 'SER')
+
+        assert not release_document_numbers(self.provider, 'invoice', 'SER', first_number)
+        assert allocate_document_numbers(self.provider, 'invoice', 'SER') == first_number + 2
+
+    def test_reserved_numbers_block(self):
+        invoices = InvoiceFactory.create_batch(3, provider=self.provider)
+
+        with reserved_document_numbers(Invoice, self.provider, 5) as block:
+            assert block.first_number == 1
+
+            with self.assertNumQueries(0):
+                for invoice in invoices:
+                    invoice._generate_number()
+
+        assert [invoice.number for invoice in invoices] == [None, None, None]
+
+        # The unused numbers were given back
+        assert self.issue_invoice().number == 4
+
+    def test_reserved_numbers_are_used_when_issuing(self):
+        with reserved_document_numbers(Invoice, self.provider, 2):
+            numbers = [self.issue_invoice().number for _ in range(3)]
+
+        assert numbers == [1, 2, 3]
+        assert DocumentNumberCounter.objects.get(
+            provider=self.provider, kind='invoice'
+        ).next_number == 4
+
+    def test_other_kinds_dont_use_the_reserved_numbers(self):
+        with reserved_document_numbers(Invoice, self.provider, 2):
+            proforma = ProformaFactory.create(provider=self.provider)
+            proforma.issue()
+
+        assert proforma.number == 1
+        assert DocumentNumberCounter.objects.get(
+            provider=self.provider, kind='invoice'
+        ).next_number == 1
@@ -0,0 +1,84 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+from decimal import Decimal
+
+from django.test import TestCase, override_settings
+
+from silver.models import BillingDocumentBase, Invoice, Transaction
+from silver.tests.factories import (DocumentEntryFactory, InvoiceFactory, PaymentMethodFactory,
+                                    TransactionFactory)
+from silver.tests.fixtures import PAYMENT_PROCESSORS
+
+
+PAYMENT_AMOUNTS = ['amount_paid_in_transaction_currency',
+                   'amount_pending_in_transaction_currency',
+                   'amount_to_be_charged_in_transaction_currency']
+
+
+@override_settings(PAYMENT_PROCESSORS=PAYMENT_PROCESSORS)
+class TestDocumentPaymentAmounts(TestCase):
+    def setUp(self):
+        entry = DocumentEntryFactory.create(quantity=Decimal('1.00'),
+                                            unit_price=Decimal('100.00'))
+        self.invoice = InvoiceFactory.create(state=Invoice.STATES.ISSUED,
+                                             invoice_entries=[entry])
+        self.payment_method = PaymentMethodFactory.create(customer=self.invoice.customer)
+
+    def create_transaction(self, amount, state, invoice=None):
+        return TransactionFactory.create(invoice=invoice or self.invoice, proforma=None,
+                                         payment_method=self.payment_method,
+                                         amount=amount, state=state)
+
+    def test_annotated_amounts_match_the_transactions(self):
+        self.create_transaction(Decimal('30.00'), Transaction.States.Settled)
+        self.create_transaction(Decimal('20.00'), Transaction.States.Pending)
+        self.create_transaction(Decimal('10.00'), Transaction.States.Failed)
+
+        total = self.invoice.total_in_transaction_currency
+
+        with self.assertNumQueries(1):
+            invoice = BillingDocumentBase.objects.with_payment_amounts().get(pk=self.invoice.pk)
+
+            assert invoice.amount_paid_in_transaction_currency == Decimal('30.00')
+            assert invoice.amount_pending_in_transaction_currency == Decimal('20.00')
+            assert invoice.amount_to_be_charged_in_transaction_currency == total - 50
+            assert invoice.amount_overpaid_in_transaction_currency == abs(total - 50)
+
+        invoice = Invoice.objects.get(pk=self.invoice.pk)
+        for amount in PAYMENT_AMOUNTS:
+            with self.assertNumQueries(1):
+                assert getattr(invoice, amount) is not None
+
+    def test_listing_documents_without_transactions(self):
+        InvoiceFactory.create_batch(3, state=Invoice.STATES.ISSUED)
+
+        with self.assertNumQueries(1):
+            documents = list(BillingDocumentBase.objects.with_payment_amounts())
+
+            for document in documents:
+                assert document.amount_paid_in_transaction_currency == Decimal('0.00')
+                assert document.amount_pending_in_transaction_currency == Decimal('0.00')
+
+        assert len(documents) == 4
+
+    def test_new_transactions_clear_the_annotated_amounts(self):
+        invoice = Invoice.objects.with_payment_amounts().get(pk=self.invoice.pk)
+        assert invoice.amount_paid_in_transaction_currency == Decimal('0.00')
+
+        self.create_transaction(Decimal('30.00'), Transaction.States.Settled, invoice=invoice)
+
+        assert invoice.amount_paid_in_transaction_currency == Decimal('30.00')
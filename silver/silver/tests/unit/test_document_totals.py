@@ -0,0 +1,145 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+from decimal import Decimal
+
+from six import StringIO
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+
+from silver.models import BillingDocumentBase, DocumentEntry, Invoice
+from silver.tests.factories import (CustomerFactory, DocumentEntryFactory, InvoiceFactory,
+                                    ProformaFactory)
+
+
+class TestDocumentTotals(TestCase):
+    def setUp(self):
+        customer = CustomerFactory.create(sales_tax_percent=Decimal('10.00'))
+        self.invoice = InvoiceFactory.create(customer=customer,
+                                             sales_tax_percent=Decimal('10.00'),
+                                             transaction_xe_rate=Decimal('2.0000'))
+
+    def create_entry(self, **kwargs):
+        kwargs.setdefault('quantity', Decimal('2.00'))
+        kwargs.setdefault('unit_price', Decimal('5.00'))
+
+        return DocumentEntryFactory.create(invoice=self.invoice, **kwargs)
+
+    def assert_totals(self, total_before_tax, tax_value):
+        self.invoice.refresh_from_db()
+
+        assert self.invoice._total_before_tax == total_before_tax
+        assert self.invoice._tax_value == tax_value
+        assert self.invoice._total == total_before_tax + tax_value
+        assert self.invoice._total_in_transaction_currency == 2 * (total_before_tax + tax_value)
+
+        assert self.invoice.compute_totals() == {
+            field: getattr(self.invoice, field) for field in self.invoice.compute_totals()
+        }
+
+    def test_entries_changes_maintain_the_totals(self):
+        entry = self.create_entry()
+        self.assert_totals(Decimal('10.00'), Decimal('1.00'))
+
+        self.create_entry(unit_price=Decimal('1.00'))
+        self.assert_totals(Decimal('12.00'), Decimal('1.20'))
+
+        entry.quantity = Decimal('4.00')
+        entry.save()
+        self.assert_totals(Decimal('22.00'), Decimal('2.20'))
+
+        entry.delete()
+        self.assert_totals(Decimal('2.00'), Decimal('0.20'))
+
+    def test_moving_an_entry_updates_both_documents(self):
+        entry = self.create_entry()
+        other_invoice = InvoiceFactory.create(customer=self.invoice.customer,
+                                              sales_tax_percent=Decimal('10.00'),
+                                              transaction_xe_rate=Decimal('2.0000'))
+
+        entry.invoice = other_invoice
+        entry.save()
+
+        self.assert_totals(Decimal('0.00'), Decimal('0.00'))
+        other_invoice.refresh_from_db()
+        assert other_invoice.total == Decimal('11.00')
+
+    def test_changing_the_tax_updates_the_totals(self):
+        self.create_entry()
+
+        self.invoice.refresh_from_db()
+        self.invoice.sales_tax_percent = Decimal('20.00')
+        self.invoice.save()
+
+        self.assert_totals(Decimal('10.00'), Decimal('2.00'))
+
+    def test_stale_documents_dont_overwrite_the_totals(self):
+        stale_invoice = Invoice.objects.get(pk=self.invoice.pk)
+        self.create_entry()
+
+        stale_invoice.sales_tax_name = 'GST'
+        stale_invoice.save()
+
+        self.assert_totals(Decimal('10.00'), Decimal('1.00'))
+
+        self.invoice.refresh_from_db()
+        assert self.invoice.sales_tax_name == 'GST'
+
+    def test_listing_documents_doesnt_query_the_entries(self):
+        for _ in range(3):
+            self.create_entry()
+        ProformaFactory.create_batch(2)
+
+        with self.assertNumQueries(1):
+            documents = list(BillingDocumentBase.objects.all())
+            totals = [(document.total, document.total_before_tax, document.tax_value,
+                       document.total_in_transaction_currency)
+                      for document in documents]
+
+        assert (Decimal('33.00'), Decimal('30.00'), Decimal('3.00'),
+                Decimal('66.00')) in totals
+
+
+class TestDocumentTotalsCommands(TestCase):
+    def test_backfill_and_check_document_totals(self):
+        invoice = InvoiceFactory.create()
+        DocumentEntryFactory.create(invoice=invoice, quantity=Decimal('1.00'),
+                                    unit_price=Decimal('10.00'))
+
+        # Simulate documents created before the totals were denormalized
+        Invoice.objects.filter(pk=invoice.pk).update(_total_before_tax=None, _tax_value=None)
+        # and some drift
+        Invoice.objects.filter(pk=invoice.pk).update(_total=Decimal('1.00'))
+
+        with self.assertRaises(CommandError):
+            call_command('check_document_totals', stdout=StringIO())
+
+        call_command('backfill_document_totals', stdout=StringIO())
+        invoice.refresh_from_db()
+        assert invoice._total_before_tax == Decimal('10.00')
+        assert invoice._total == Decimal('1.00')
+
+        call_command('backfill_document_totals', '--all', stdout=StringIO())
+        invoice.refresh_from_db()
+        assert invoice._total == invoice.compute_total()
+
+        output = StringIO()
+        call_command('check_document_totals', stdout=output)
+        assert 'consistent' in output.getvalue()
+
+        assert DocumentEntry.objects.count() == 1
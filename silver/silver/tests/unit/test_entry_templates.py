@@ -0,0 +1,103 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+from datetime import date
+from decimal import Decimal
+
+import pytest
+
+from mock import patch
+
+from django.template.loader import get_template, render_to_string
+
+from silver.entry_templates import EntryTemplatesCache
+from silver.models import Plan
+from silver.tests.factories import MeteredFeatureFactory, PlanFactory, ProviderFactory
+
+
+ENTRY_CONTEXTS = ['plan', 'plan-trial', 'plan-trial-discount', 'metered-feature',
+                  'metered-feature-trial', 'metered-feature-trial-discount',
+                  'metered-feature-trial-not-discounted', None]
+
+
+def entry_context(context, **kwargs):
+    plan = PlanFactory.build(name='Hosting & Co', interval=Plan.INTERVALS.MONTH)
+    metered_feature = MeteredFeatureFactory.build(name='<Bandwidth>', unit='GB')
+
+    entry_context = {
+        'name': plan.name, 'unit': plan.interval, 'plan': plan, 'provider': plan.provider,
+        'start_date': date(2019, 1, 1), 'end_date': date(2019, 1, 31), 'prorated': False,
+        'proration_percentage': Decimal('1.0000'), 'product_code': None,
+        'metered_feature': None, 'customer': None, 'subscription': None, 'context': context
+    }
+    if context and context.startswith('metered-feature'):
+        entry_context.update({'name': metered_feature.name, 'unit': metered_feature.unit,
+                              'metered_feature': metered_feature,
+                              'included': Decimal('10.5000')})
+    entry_context.update(kwargs)
+
+    return entry_context
+
+
+@pytest.mark.parametrize('field', ['entry_description', 'entry_unit'])
+@pytest.mark.parametrize('context', ENTRY_CONTEXTS)
+@pytest.mark.parametrize('prorated', [True, False])
+def test_bundled_templates_formatters_match_the_templates(field, context, prorated):
+    context = entry_context(context, prorated=prorated)
+
+    expected = render_to_string('billing_documents/{}.html'.format(field), context)
+
+    assert EntryTemplatesCache().render(field, context) == expected
+
+
+@pytest.mark.django_db
+def test_provider_templates_lookups_are_cached():
+    provider = ProviderFactory.create()
+    cache = EntryTemplatesCache()
+
+    with patch('silver.entry_templates.get_template',
+               wraps=get_template) as get_mock:
+        for _ in range(3):
+            cache.render('entry_description', entry_context('plan'), provider=provider.slug)
+
+    # One failed lookup for the provider's template and one for the bundled template
+    assert get_mock.call_count == 2
+
+    template, is_bundled = cache.get_template('entry_description', provider=provider.slug)
+    assert is_bundled
+
+
+@pytest.mark.django_db
+def test_provider_templates_cache_expires():
+    provider = ProviderFactory.create()
+    cache = EntryTemplatesCache(timeout=0)
+
+    with patch('silver.entry_templates.get_template',
+               wraps=get_template) as get_mock:
+        cache.render('entry_unit', entry_context('plan'), provider=provider.slug)
+        cache.render('entry_unit', entry_context('plan'), provider=provider.slug)
+
+    assert get_mock.call_count == 4
+
+
+def test_overridden_templates_are_rendered():
+    cache = EntryTemplatesCache()
+
+    with patch.object(cache, '_is_bundled', return_value=False):
+        assert cache.render('entry_unit', entry_context('plan')) == 'months\n'
+
+        template, is_bundled = cache.get_template('entry_unit')
+        assert not is_bundled
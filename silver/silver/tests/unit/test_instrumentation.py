@@ -0,0 +1,63 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+from django.db import connection
+from django.test import TestCase
+
+from silver.instrumentation import instrument, registry, render_metrics
+from silver.models import ProductCode
+
+
+class TestInstrumentation(TestCase):
+    def setUp(self):
+        registry.reset()
+
+    def test_stage_metrics(self):
+        with instrument('outer', enabled=True) as outer:
+            ProductCode.objects.bulk_create([ProductCode(value='first'),
+                                             ProductCode(value='second')])
+
+            with instrument('inner', enabled=True) as inner:
+                assert ProductCode.objects.count() == 2
+
+        assert inner.queries == 1
+        assert inner.rows_created == 0
+        assert outer.queries == 2
+        assert outer.rows_created == 2
+        assert outer.wall_time >= outer.db_time > 0
+
+        # The connection is left as it was
+        assert 'make_cursor' not in vars(connection)
+
+    def test_disabled_instrumentation(self):
+        with instrument('disabled', enabled=False) as stage:
+            ProductCode.objects.count()
+
+        assert stage is None
+        assert not registry.snapshot()
+
+    def test_render_metrics(self):
+        for _ in range(2):
+            with instrument('billing', enabled=True):
+                ProductCode.objects.create(value='code-{}'.format(ProductCode.objects.count()))
+
+        metrics = render_metrics()
+
+        assert 'silver_stage_calls_total{stage="billing"} 2' in metrics
+        assert 'silver_stage_queries_total{stage="billing"} 4' in metrics
+        assert 'silver_stage_rows_created_total{stage="billing"} 2' in metrics
+        assert 'silver_stage_wall_seconds_bucket{stage="billing",le="+Inf"} 2' in metrics
+        assert 'silver_stage_wall_seconds_count{stage="billing"} 2' in metrics
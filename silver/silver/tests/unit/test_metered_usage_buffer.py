@@ -0,0 +1,178 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import datetime
+
+from decimal import Decimal
+
+import pytest
+
+from freezegun import freeze_time
+from mock import MagicMock, patch
+from redis.exceptions import ResponseError
+
+from silver.metered_usage import (METERED_USAGE_BUFFER_KEY, METERED_USAGE_FLUSH_LOCK_KEY,
+                                  METERED_USAGE_FLUSHING_KEY, MeteredUsageIngester,
+                                  flush_metered_usage)
+from silver.models import MeteredFeatureUnitsLog, Subscription
+from silver.tasks import generate_billing_documents_shard
+from silver.tests.factories import (CustomerFactory, MeteredFeatureFactory,
+                                    MeteredFeatureUnitsLogFactory, SubscriptionFactory)
+
+
+class HashesRedis(object):
+    # Keeps the hashes in memory, implementing the commands used by the buffer
+    def __init__(self):
+        self.hashes = {}
+        self.locks = []
+
+    def hincrby(self, key, field, amount):
+        fields = self.hashes.setdefault(key, {})
+        fields[field] = fields.get(field, 0) + amount
+
+        return fields[field]
+
+    def hdel(self, key, *fields):
+        for field in fields:
+            self.hashes.get(key, {}).pop(field, None)
+
+    def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    def delete(self, key):
+        self.hashes.pop(key, None)
+
+    def rename(self, key, new_key):
+        if not self.hashes.get(key):
+            raise ResponseError('no such key')
+
+        self.hashes[new_key] = self.hashes.pop(key)
+
+    def lock(self, key, *args, **kwargs):
+        self.locks.append(key)
+
+        return MagicMock()
+
+    def pipeline(self):
+        redis = self
+        calls = []
+
+        class Pipeline(object):
+            def hincrby(self, *args):
+                calls.append(args)
+
+            def execute(self):
+                return [redis.hincrby(*args) for args in calls]
+
+        return Pipeline()
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    redis = HashesRedis()
+    monkeypatch.setattr('silver.metered_usage.redis', redis)
+
+    return redis
+
+
+@pytest.fixture
+def subscription():
+    subscription = SubscriptionFactory.create(state=Subscription.STATES.ACTIVE,
+                                              start_date=datetime.date(2016, 1, 1))
+    subscription.plan.metered_features.add(MeteredFeatureFactory.create())
+
+    return subscription
+
+
+def usage_record(subscription, count, update_type='relative'):
+    return {
+        'subscription': subscription.pk,
+        'product_code': str(subscription.plan.metered_features.get().product_code),
+        'date': '2017-01-15',
+        'count': count,
+        'update_type': update_type
+    }
+
+
+@freeze_time('2017-01-15')
+@pytest.mark.django_db
+def test_relative_usage_is_buffered_until_flushed(redis, subscription):
+    ingester = MeteredUsageIngester(buffered=True)
+
+    assert ingester.ingest([usage_record(subscription, 10)]) == [{'count': Decimal('10')}]
+    assert ingester.ingest([usage_record(subscription, '2.5')]) == [{'count': Decimal('12.5')}]
+    assert not MeteredFeatureUnitsLog.objects.exists()
+
+    assert flush_metered_usage(force=True) == 1
+    assert MeteredFeatureUnitsLog.objects.get().consumed_units == Decimal('12.5')
+    assert redis.hashes == {}
+
+    # The flushed increments are added to the existing logs
+    assert ingester.ingest([usage_record(subscription, 1)]) == [{'count': Decimal('13.5')}]
+    flush_metered_usage(force=True)
+
+    assert MeteredFeatureUnitsLog.objects.get().consumed_units == Decimal('13.5')
+
+
+@freeze_time('2017-01-15')
+@pytest.mark.django_db
+def test_absolute_usage_discards_the_buffered_increments(redis, subscription):
+    MeteredFeatureUnitsLogFactory.create(
+        subscription=subscription, metered_feature=subscription.plan.metered_features.get(),
+        start_date=datetime.date(2017, 1, 1), end_date=datetime.date(2017, 1, 31),
+        consumed_units=Decimal('1')
+    )
+    ingester = MeteredUsageIngester(buffered=True)
+
+    ingester.ingest([usage_record(subscription, 10)])
+    assert ingester.ingest([usage_record(subscription, 3, update_type='absolute')]) == [
+        {'count': Decimal('3')}
+    ]
+
+    assert flush_metered_usage(force=True) == 0
+    assert MeteredFeatureUnitsLog.objects.get().consumed_units == Decimal('3')
+
+
+@freeze_time('2017-01-15')
+@pytest.mark.django_db
+def test_absolute_usage_discards_the_increments_taken_by_a_running_flush(redis, subscription):
+    ingester = MeteredUsageIngester(buffered=True)
+    ingester.ingest([usage_record(subscription, 10)])
+
+    # A flush took the increments, but didn't apply them yet
+    redis.rename(METERED_USAGE_BUFFER_KEY, METERED_USAGE_FLUSHING_KEY)
+    redis.locks = []
+
+    assert ingester.ingest([usage_record(subscription, 3, update_type='absolute')]) == [
+        {'count': Decimal('3')}
+    ]
+    # The running flush is waited for
+    assert redis.locks == [METERED_USAGE_FLUSH_LOCK_KEY]
+
+    assert flush_metered_usage(force=True) == 0
+    assert MeteredFeatureUnitsLog.objects.get().consumed_units == Decimal('3')
+
+
+@pytest.mark.django_db
+def test_billing_shards_flush_the_buffered_usage(monkeypatch):
+    customer = CustomerFactory.create()
+    monkeypatch.setattr('silver.tasks.redis', MagicMock())
+
+    with patch('silver.tasks.prepare_metered_usage') as flush_mock, \
+            patch('silver.tasks.DocumentsGenerator.generate_for_customer'):
+        generate_billing_documents_shard(customer.pk, customer.pk, '2018-01-01')
+
+    flush_mock.assert_called_once_with()
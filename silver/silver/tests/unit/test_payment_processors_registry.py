@@ -0,0 +1,88 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import pytest
+
+from cryptography.fernet import Fernet
+from mock import patch
+
+from silver.models import PaymentMethod
+from silver.payment_processors import get_all_instances, get_instance, registry
+from silver.tests.factories import PaymentMethodFactory
+from silver.tests.fixtures import (PAYMENT_PROCESSORS, ManualProcessor, TriggeredProcessor,
+                                   manual_processor, triggered_processor)
+from silver.utils.payments import get_fernet
+
+
+def test_get_instance_returns_the_same_processor(settings):
+    settings.PAYMENT_PROCESSORS = PAYMENT_PROCESSORS
+
+    payment_processor = get_instance(triggered_processor)
+
+    assert isinstance(payment_processor, TriggeredProcessor)
+    assert payment_processor.name == triggered_processor
+    assert get_instance(triggered_processor) is payment_processor
+    assert payment_processor in get_all_instances()
+
+
+def test_the_registry_is_rebuilt_when_the_settings_change(settings):
+    settings.PAYMENT_PROCESSORS = PAYMENT_PROCESSORS
+    payment_processor = get_instance(triggered_processor)
+
+    settings.PAYMENT_PROCESSORS = {
+        manual_processor: PAYMENT_PROCESSORS[manual_processor]
+    }
+
+    assert isinstance(get_instance(manual_processor), ManualProcessor)
+    assert [processor.name for processor in get_all_instances()] == [manual_processor]
+    with pytest.raises(KeyError):
+        get_instance(triggered_processor)
+
+    settings.PAYMENT_PROCESSORS = PAYMENT_PROCESSORS
+    assert get_instance(triggered_processor) is not payment_processor
+
+
+def test_processors_failing_to_import_dont_affect_the_others(settings):
+    settings.PAYMENT_PROCESSORS = dict(PAYMENT_PROCESSORS, broken={
+        'class': 'silver.tests.fixtures.MissingProcessor'
+    })
+
+    assert isinstance(get_instance(triggered_processor), TriggeredProcessor)
+    with pytest.raises(ImportError):
+        get_instance('broken')
+
+
+@pytest.mark.django_db
+def test_loading_payment_methods_does_not_create_processors(settings):
+    settings.PAYMENT_PROCESSORS = PAYMENT_PROCESSORS
+    PaymentMethodFactory.create_batch(5, payment_processor=triggered_processor)
+    registry.get(triggered_processor)
+
+    with patch.object(registry, 'create', side_effect=AssertionError) as create_mock:
+        payment_methods = list(PaymentMethod.objects.all())
+
+    assert len(payment_methods) == 5
+    assert not create_mock.called
+
+
+def test_get_fernet_is_created_once_per_key():
+    key = Fernet.generate_key()
+
+    fernet = get_fernet(key)
+
+    assert get_fernet(key) is fernet
+    assert fernet.decrypt(Fernet(key).encrypt(b'data')) == b'data'
+    assert get_fernet(Fernet.generate_key()) is not fernet
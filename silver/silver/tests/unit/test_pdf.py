@@ -115,3 +115,24 @@ def test_pdf_mark_as_dirty_min_value():
     pdf.refresh_from_db()
 
     assert pdf.dirty == 1
+
+
+@pytest.mark.django_db
+def test_generate_pdf_skips_unchanged_content(settings, tmpdir):
+    settings.MEDIA_ROOT = tmpdir.strpath
+
+    pdf = PDF.objects.create(dirty=1, upload_path='document.pdf')
+    template = get_template('billing_documents/invoice_pdf.html')
+
+    pdf.generate(template=template, context={'filename': 'filename'})
+    assert pdf.content_hash
+
+    pdf.mark_as_dirty()
+
+    with patch('silver.models.documents.pdf.render_pdf') as render_mock:
+        assert pdf.generate(template=template, context={'filename': 'filename'}) is None
+
+    assert not render_mock.called
+
+    pdf.refresh_from_db()
+    assert pdf.dirty == 0
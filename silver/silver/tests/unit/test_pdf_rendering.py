@@ -0,0 +1,98 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import pytest
+
+from mock import MagicMock
+
+from silver.models import BillingDocumentBase
+from silver.pdf_rendering import LATENCY_BUCKETS, PDFRenderingEngine, PDFRenderingStats
+from silver.tests.factories import InvoiceFactory, ProformaFactory
+
+
+def dirty_documents():
+    return BillingDocumentBase.objects.filter(pdf__dirty__gt=0).select_related('pdf')
+
+
+@pytest.mark.django_db
+def test_rendering_engine_generates_the_dirty_documents(settings, tmpdir, monkeypatch):
+    settings.MEDIA_ROOT = tmpdir.strpath
+
+    pisa_document_mock = MagicMock()
+    monkeypatch.setattr('silver.models.documents.pdf.pisa.pisaDocument', pisa_document_mock)
+
+    invoices = InvoiceFactory.create_batch(3)
+    proforma = ProformaFactory.create()
+    for document in invoices + [proforma]:
+        document.issue()
+
+    stats = PDFRenderingEngine(processes=1, batch_size=2).render(dirty_documents())
+
+    assert stats.rendered == 4
+    assert stats.failed == stats.skipped == 0
+    assert pisa_document_mock.call_count == 4
+    assert not dirty_documents().exists()
+
+    for document in invoices + [proforma]:
+        document.pdf.refresh_from_db()
+        assert document.pdf.content_hash
+        assert document.pdf.url
+
+    # Marking the documents as dirty without changing them doesn't render them again
+    for document in invoices + [proforma]:
+        document.mark_for_generation()
+
+    stats = PDFRenderingEngine(processes=1).render(dirty_documents())
+
+    assert stats.skipped == 4
+    assert pisa_document_mock.call_count == 4
+    assert not dirty_documents().exists()
+
+
+@pytest.mark.django_db
+def test_rendering_engine_reports_failures(settings, tmpdir, monkeypatch):
+    settings.MEDIA_ROOT = tmpdir.strpath
+
+    monkeypatch.setattr('silver.models.documents.pdf.pisa.pisaDocument',
+                        MagicMock(side_effect=[ValueError, None]))
+
+    for invoice in InvoiceFactory.create_batch(2):
+        invoice.issue()
+
+    stats = PDFRenderingEngine(processes=1).render(dirty_documents())
+
+    assert stats.failed == 1
+    assert stats.rendered == 1
+    # The failed document stays dirty
+    assert dirty_documents().count() == 1
+
+
+def test_rendering_stats_report():
+    stats = PDFRenderingStats()
+    for latency in [0.05, 0.3, 0.3, 1.5, 20]:
+        stats.observe(latency)
+    stats.skipped = 1
+    stats.finish()
+
+    report = stats.report()
+
+    assert report['documents'] == 6
+    assert report['rendered'] == 5
+    assert report['latency_p50'] == 0.3
+    assert report['latency_p95'] == 20
+    assert dict(report['latency_histogram']) == {
+        0.1: 1, 0.25: 0, 0.5: 2, 1: 0, 2.5: 1, 5: 0, 10: 0, LATENCY_BUCKETS[-1]: 1
+    }
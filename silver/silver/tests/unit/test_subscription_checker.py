@@ -0,0 +1,93 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import datetime as dt
+
+import pytest
+
+from silver.models import BillingLog, Proforma, Subscription
+from silver.subscription_checker import SubscriptionChecker
+from silver.tests.factories import CustomerFactory, ProformaFactory, SubscriptionFactory
+from silver.tests.utils import query_budget
+
+
+def create_billed_subscription(document_state, due_date, payment_due_days=5, **kwargs):
+    customer = CustomerFactory.create(payment_due_days=payment_due_days)
+    subscription = SubscriptionFactory.create(customer=customer, **kwargs)
+    proforma = ProformaFactory.create(customer=customer, state=document_state,
+                                      due_date=due_date)
+    BillingLog.objects.create(subscription=subscription, proforma=proforma,
+                              billing_date=due_date - dt.timedelta(days=10),
+                              plan_billed_up_to=due_date, metered_features_billed_up_to=due_date)
+
+    return subscription
+
+
+@pytest.mark.django_db
+def test_check_cancels_only_the_subscriptions_unpaid_after_their_grace_period():
+    billing_date = dt.date(2018, 3, 1)
+    active = Subscription.STATES.ACTIVE
+
+    unpaid = create_billed_subscription(Proforma.STATES.ISSUED, dt.date(2018, 2, 1),
+                                        state=active)
+    in_grace = create_billed_subscription(Proforma.STATES.ISSUED, dt.date(2018, 2, 26),
+                                          state=active)
+    paid = create_billed_subscription(Proforma.STATES.PAID, dt.date(2018, 2, 1), state=active)
+    inactive = create_billed_subscription(Proforma.STATES.ISSUED, dt.date(2018, 2, 1),
+                                          state=Subscription.STATES.INACTIVE)
+
+    # A later billing log, whose document is paid, supersedes the unpaid one
+    superseded = create_billed_subscription(Proforma.STATES.ISSUED, dt.date(2018, 1, 1),
+                                            state=active)
+    BillingLog.objects.create(
+        subscription=superseded, billing_date=dt.date(2018, 2, 1),
+        proforma=ProformaFactory.create(customer=superseded.customer,
+                                        state=Proforma.STATES.PAID),
+        plan_billed_up_to=dt.date(2018, 2, 28),
+        metered_features_billed_up_to=dt.date(2018, 2, 28)
+    )
+
+    assert SubscriptionChecker().check(billing_date=billing_date) == 1
+
+    states = dict(Subscription.objects.values_list('pk', 'state'))
+    assert states[unpaid.pk] == Subscription.STATES.CANCELED
+    assert states[in_grace.pk] == active
+    assert states[paid.pk] == active
+    assert states[inactive.pk] == Subscription.STATES.INACTIVE
+    assert states[superseded.pk] == active
+
+    assert Subscription.objects.get(pk=unpaid.pk).cancel_date is not None
+
+
+@pytest.mark.django_db
+def test_check_ignore_date_cancels_the_subscriptions_within_their_grace_period():
+    subscription = create_billed_subscription(Proforma.STATES.ISSUED, dt.date(2018, 2, 26),
+                                              state=Subscription.STATES.ACTIVE)
+
+    assert SubscriptionChecker().check(subscription=subscription,
+                                       billing_date=dt.date(2018, 3, 1),
+                                       ignore_date=True) == 1
+    assert Subscription.objects.get(pk=subscription.pk).state == Subscription.STATES.CANCELED
+
+
+@pytest.mark.django_db
+def test_check_query_count_does_not_depend_on_the_number_of_subscriptions():
+    for _ in range(10):
+        create_billed_subscription(Proforma.STATES.ISSUED, dt.date(2018, 2, 1),
+                                   state=Subscription.STATES.ACTIVE)
+
+    with query_budget(10):
+        assert SubscriptionChecker().check(billing_date=dt.date(2018, 3, 1)) == 10
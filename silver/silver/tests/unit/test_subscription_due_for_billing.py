@@ -0,0 +1,111 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import datetime as dt
+
+import pytest
+
+from silver.models import BillingLog, Plan, Subscription
+from silver.tests.factories import PlanFactory, SubscriptionFactory
+from silver.utils.dates import ONE_DAY
+
+
+def create_billed_subscription(billing_date, plan_billed_up_to, metered_features_billed_up_to,
+                               **kwargs):
+    subscription = SubscriptionFactory.create(state=Subscription.STATES.ACTIVE, **kwargs)
+    BillingLog.objects.create(subscription=subscription, billing_date=billing_date,
+                              plan_billed_up_to=plan_billed_up_to,
+                              metered_features_billed_up_to=metered_features_billed_up_to)
+
+    return subscription
+
+
+@pytest.mark.django_db
+def test_due_for_billing_includes_every_subscription_that_should_be_billed():
+    monthly_prebilled = PlanFactory.create(interval=Plan.INTERVALS.MONTH, interval_count=1,
+                                           prebill_plan=True)
+    monthly = PlanFactory.create(interval=Plan.INTERVALS.MONTH, interval_count=1,
+                                 prebill_plan=False)
+    weekly = PlanFactory.create(interval=Plan.INTERVALS.WEEK, interval_count=2,
+                                prebill_plan=False)
+    yearly = PlanFactory.create(interval=Plan.INTERVALS.YEAR, interval_count=1)
+    monthish = PlanFactory.create(interval=Plan.INTERVALS.MONTHISH, interval_count=1,
+                                  prebill_plan=False)
+
+    start_date = dt.date(2018, 1, 15)
+    SubscriptionFactory.create(plan=monthly_prebilled, start_date=start_date,
+                               state=Subscription.STATES.ACTIVE)
+    SubscriptionFactory.create(plan=monthly, start_date=start_date,
+                               trial_end=dt.date(2018, 2, 10), state=Subscription.STATES.ACTIVE)
+
+    create_billed_subscription(dt.date(2018, 2, 1), dt.date(2018, 2, 28), dt.date(2018, 1, 31),
+                               plan=monthly_prebilled, start_date=start_date)
+    create_billed_subscription(dt.date(2018, 2, 1), dt.date(2018, 1, 31), dt.date(2018, 1, 31),
+                               plan=monthly, start_date=start_date)
+    create_billed_subscription(dt.date(2018, 1, 29), dt.date(2018, 1, 28), dt.date(2018, 1, 28),
+                               plan=weekly, start_date=start_date)
+    create_billed_subscription(dt.date(2018, 1, 15), dt.date(2018, 12, 31), dt.date(2018, 1, 14),
+                               plan=yearly, start_date=start_date)
+    create_billed_subscription(dt.date(2018, 2, 15), dt.date(2018, 2, 14), dt.date(2018, 2, 14),
+                               plan=monthish, start_date=start_date)
+
+    canceled = create_billed_subscription(dt.date(2018, 2, 1), dt.date(2018, 2, 28),
+                                          dt.date(2018, 1, 31), plan=monthly_prebilled,
+                                          start_date=start_date)
+    canceled.cancel(when=Subscription.CANCEL_OPTIONS.NOW)
+    canceled.cancel_date = dt.date(2018, 2, 20)
+    canceled.save()
+
+    billing_date = start_date
+    while billing_date <= dt.date(2018, 5, 1):
+        due = set(Subscription.objects.due_for_billing(billing_date))
+
+        for subscription in Subscription.objects.all():
+            if subscription.should_be_billed(billing_date):
+                assert subscription in due, (subscription.plan.interval, billing_date)
+
+        billing_date += ONE_DAY
+
+
+@pytest.mark.django_db
+def test_due_for_billing_excludes_subscriptions_billed_in_advance():
+    plan = PlanFactory.create(interval=Plan.INTERVALS.MONTH, interval_count=1, prebill_plan=True)
+    subscription = create_billed_subscription(dt.date(2018, 2, 1), dt.date(2018, 2, 28),
+                                              dt.date(2018, 1, 31), plan=plan,
+                                              start_date=dt.date(2018, 1, 1))
+
+    assert not Subscription.objects.due_for_billing(dt.date(2018, 2, 15)).exists()
+    assert list(Subscription.objects.due_for_billing(dt.date(2018, 3, 1))) == [subscription]
+
+
+@pytest.mark.django_db
+def test_due_for_billing_excludes_subscriptions_in_an_unfinished_cycle():
+    plan = PlanFactory.create(interval=Plan.INTERVALS.MONTH, interval_count=1,
+                              prebill_plan=False)
+    subscription = create_billed_subscription(dt.date(2018, 2, 1), dt.date(2018, 1, 31),
+                                              dt.date(2018, 1, 31), plan=plan,
+                                              start_date=dt.date(2018, 1, 1))
+
+    assert not Subscription.objects.due_for_billing(dt.date(2018, 2, 20)).exists()
+    assert list(Subscription.objects.due_for_billing(dt.date(2018, 3, 1))) == [subscription]
+
+
+@pytest.mark.django_db
+def test_due_for_billing_ignores_inactive_and_not_started_subscriptions():
+    SubscriptionFactory.create(start_date=dt.date(2018, 1, 1))
+    SubscriptionFactory.create(start_date=dt.date(2018, 3, 1), state=Subscription.STATES.ACTIVE)
+
+    assert not Subscription.objects.due_for_billing(dt.date(2018, 2, 1)).exists()
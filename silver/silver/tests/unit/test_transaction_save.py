@@ -0,0 +1,109 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+from decimal import Decimal
+
+import pytest
+
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from silver.models import PaymentMethod, Transaction
+from silver.tests.factories import PaymentMethodFactory, TransactionFactory
+
+
+def data_queries(context):
+    return [query['sql'] for query in context.captured_queries
+            if not query['sql'].startswith(('SAVEPOINT', 'RELEASE SAVEPOINT'))]
+
+
+@pytest.mark.django_db
+def test_save_state_saves_a_transition_in_a_single_update():
+    transaction = Transaction.objects.get(pk=TransactionFactory.create().pk)
+
+    transaction.process()
+    with CaptureQueriesContext(connection) as context:
+        transaction.save_state()
+
+    queries = data_queries(context)
+    assert len(queries) == 1
+    assert queries[0].startswith('UPDATE')
+
+    assert Transaction.objects.get(pk=transaction.pk).state == Transaction.States.Pending
+
+
+@pytest.mark.django_db
+def test_save_state_saves_only_the_state_fields():
+    payment_method = PaymentMethodFactory.create(data={'attempt_retries_after': 2})
+    transaction = TransactionFactory.create(payment_method=payment_method,
+                                            state=Transaction.States.Pending)
+    amount = transaction.amount
+
+    transaction.amount += Decimal('1.00')
+    transaction.fail(fail_code='insufficient_funds')
+    transaction.save_state()
+
+    transaction = Transaction.objects.get(pk=transaction.pk)
+    assert transaction.state == Transaction.States.Failed
+    assert transaction.fail_code == 'insufficient_funds'
+    assert transaction.next_retry_at is not None
+    assert transaction.amount == amount
+
+
+@pytest.mark.django_db
+def test_final_fields_are_checked_against_the_loaded_values():
+    transaction = Transaction.objects.get(pk=TransactionFactory.create().pk)
+
+    transaction.amount += Decimal('1.00')
+    with CaptureQueriesContext(connection) as context, pytest.raises(ValidationError) as error:
+        transaction.save()
+
+    assert "Field 'amount' may not be changed." in str(error.value)
+    assert not [query for query in data_queries(context)
+                if 'FROM "silver_transaction"' in query]
+
+
+@pytest.mark.django_db
+def test_final_fields_of_instances_not_loaded_from_the_database_are_checked():
+    transaction = TransactionFactory.create()
+
+    unloaded = Transaction(pk=transaction.pk, amount=transaction.amount + Decimal('1.00'),
+                           currency=transaction.currency,
+                           payment_method=transaction.payment_method,
+                           invoice=transaction.invoice, proforma=transaction.proforma,
+                           uuid=transaction.uuid, created_at=transaction.created_at)
+
+    with pytest.raises(ValidationError):
+        unloaded.save()
+
+
+@pytest.mark.django_db
+def test_payment_method_irreversible_fields_are_checked_against_the_loaded_values():
+    payment_method = PaymentMethodFactory.create(canceled=True)
+    payment_method = PaymentMethod.objects.get(pk=payment_method.pk)
+
+    payment_method.canceled = False
+    with pytest.raises(ValidationError) as error:
+        payment_method.save()
+
+    assert "Field 'canceled' may not be changed anymore." in str(error.value)
+
+    payment_method.refresh_from_db()
+    payment_method.display_info = 'Visa'
+    payment_method.save()
+
+    assert PaymentMethod.objects.get(pk=payment_method.pk).display_info == 'Visa'
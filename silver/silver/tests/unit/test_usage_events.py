@@ -0,0 +1,147 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import datetime
+
+from decimal import Decimal
+
+from freezegun import freeze_time
+
+from django.test import TestCase
+
+from silver.metered_usage import UsageEventsRollup, ingest_usage_events
+from silver.models import (MeteredFeatureUnitsLog, MeteredUsageEvent, MeteredUsageRollupMark,
+                           Subscription)
+from silver.tests.factories import MeteredFeatureFactory, SubscriptionFactory
+
+
+@freeze_time('2017-02-15')
+class TestUsageEvents(TestCase):
+    def setUp(self):
+        self.subscription = SubscriptionFactory.create(state=Subscription.STATES.ACTIVE,
+                                                       start_date=datetime.date(2016, 1, 1))
+        self.metered_feature = MeteredFeatureFactory.create()
+        self.subscription.plan.metered_features.add(self.metered_feature)
+
+        self.rollup = UsageEventsRollup(lag=0)
+
+    def event(self, count, date='2017-02-10', **kwargs):
+        event = {
+            'subscription': self.subscription.pk,
+            'product_code': str(self.metered_feature.product_code),
+            'date': date,
+            'count': count
+        }
+        event.update(kwargs)
+
+        return event
+
+    def consumed_units(self):
+        return {
+            (log.start_date, log.end_date): log.consumed_units
+            for log in MeteredFeatureUnitsLog.objects.all()
+        }
+
+    def test_ingest_usage_events(self):
+        accepted, errors = ingest_usage_events([
+            self.event(1, reference='call-1'),
+            self.event(-1),
+            self.event(1, date='2015-12-31'),
+            self.event(1, product_code='missing'),
+        ])
+
+        assert accepted == 1
+        assert errors == [
+            {'index': 1, 'detail': 'Invalid count.'},
+            {'index': 2, 'detail': 'Date is out of bounds.'},
+            {'index': 3, 'detail': 'Metered Feature Not found.'},
+        ]
+        assert MeteredUsageEvent.objects.get().reference == 'call-1'
+
+    def test_incremental_rollup(self):
+        ingest_usage_events([self.event(1), self.event('2.5'),
+                             self.event(4, date='2017-01-31')])
+
+        assert self.rollup.run() == 2
+        assert self.consumed_units() == {
+            (datetime.date(2017, 1, 1), datetime.date(2017, 1, 31)): Decimal('4'),
+            (datetime.date(2017, 2, 1), datetime.date(2017, 2, 28)): Decimal('3.5'),
+        }
+
+        # Only the events newer than the high-water mark are rolled up
+        ingest_usage_events([self.event(1)])
+
+        assert self.rollup.run() == 1
+        assert self.rollup.run() == 0
+        assert self.consumed_units()[
+            (datetime.date(2017, 2, 1), datetime.date(2017, 2, 28))
+        ] == Decimal('4.5')
+        assert MeteredUsageRollupMark.objects.get().last_event_id == \
+            MeteredUsageEvent.objects.latest('id').id
+
+    def test_recent_events_are_left_for_the_next_rollup(self):
+        ingest_usage_events([self.event(1)])
+
+        assert UsageEventsRollup(lag=60).run() == 0
+        assert not MeteredFeatureUnitsLog.objects.exists()
+
+    def test_rerate(self):
+        ingest_usage_events([self.event(1), self.event(2, date='2017-02-01'),
+                             self.event(4, date='2017-01-31')])
+        self.rollup.run()
+
+        MeteredFeatureUnitsLog.objects.update(consumed_units=Decimal('100'))
+
+        # Not rolled up yet, so not rerated either
+        ingest_usage_events([self.event(8)])
+
+        assert self.rollup.rerate([self.subscription], datetime.date(2017, 2, 5),
+                                  datetime.date(2017, 2, 5)) == 1
+        assert self.consumed_units() == {
+            (datetime.date(2017, 1, 1), datetime.date(2017, 1, 31)): Decimal('100'),
+            (datetime.date(2017, 2, 1), datetime.date(2017, 2, 28)): Decimal('3'),
+        }
+
+    def test_rerate_leaves_the_metered_features_without_events_alone(self):
+        reported_feature = MeteredFeatureFactory.create()
+        self.subscription.plan.metered_features.add(reported_feature)
+
+        # Usage reported through the API, not through events
+        MeteredFeatureUnitsLog.objects.create(
+            subscription=self.subscription, metered_feature=reported_feature,
+            start_date=datetime.date(2017, 2, 1), end_date=datetime.date(2017, 2, 28),
+            consumed_units=Decimal('7')
+        )
+        ingest_usage_events([self.event(1)])
+        self.rollup.run()
+
+        MeteredFeatureUnitsLog.objects.filter(
+            metered_feature=self.metered_feature
+        ).update(consumed_units=Decimal('100'))
+
+        assert self.rollup.rerate([self.subscription], datetime.date(2017, 2, 1),
+                                  datetime.date(2017, 2, 28)) == 1
+        assert dict(MeteredFeatureUnitsLog.objects.values_list(
+            'metered_feature_id', 'consumed_units'
+        )) == {self.metered_feature.pk: Decimal('1'), reported_feature.pk: Decimal('7')}
+
+        # Not even when asked for explicitly
+        assert self.rollup.rerate([self.subscription], datetime.date(2017, 2, 1),
+                                  datetime.date(2017, 2, 28),
+                                  metered_features=[reported_feature.pk]) == 0
+        assert MeteredFeatureUnitsLog.objects.get(
+            metered_feature=reported_feature
+        ).consumed_units == Decimal('7')
@@ -12,6 +12,33 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from __future__ import absolute_import
+
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test.utils import CaptureQueriesContext
+
 
 def build_absolute_test_url(relative_path):
     return 'http://testserver' + relative_path
+
+
+@contextmanager
+def query_budget(max_queries, using=DEFAULT_DB_ALIAS):
+    """
+    Fails if the wrapped block runs more than `max_queries` queries, listing them.
+
+    Measuring a list endpoint's queries for a single object and using that as the budget for
+    more objects catches the N+1 queries.
+    """
+
+    context = CaptureQueriesContext(connections[using])
+    with context:
+        yield context
+
+    queries = context.captured_queries
+    assert len(queries) <= max_queries, '{} queries executed, the budget is {}:\n{}'.format(
+        len(queries), max_queries,
+        '\n'.join('{}. {}'.format(index, query['sql']) for index, query in enumerate(queries, 1))
+    )
@@ -0,0 +1,339 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, division
+
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+
+from redis.exceptions import LockError
+from six.moves import queue
+
+from django.conf import settings
+from django.db import connections
+
+from silver import payment_processors
+from silver.documents_generator import batches
+from silver.models import Transaction
+from silver.vendors.redis_server import redis
+
+
+logger = logging.getLogger(__name__)
+
+
+TRANSACTION_EXECUTION_BATCH_SIZE = getattr(settings, 'TRANSACTION_EXECUTION_BATCH_SIZE',
+                                           100)  # default 100 transactions per batch
+TRANSACTION_EXECUTION_CONCURRENCY = getattr(settings, 'TRANSACTION_EXECUTION_CONCURRENCY',
+                                            4)  # default 4 gateway calls at once per processor
+TRANSACTION_EXECUTION_RATE_LIMIT = getattr(settings, 'TRANSACTION_EXECUTION_RATE_LIMIT',
+                                           None)  # default unlimited gateway calls per second
+TRANSACTION_EXECUTION_LOCK_TIMEOUT = getattr(settings, 'TRANSACTION_EXECUTION_LOCK_TIMEOUT',
+                                             60 * 5)  # default 5m
+
+TRANSACTION_EXECUTION_LOCK_KEY = 'silver:execute-transaction:{transaction_id}'
+
+
+class RateLimiter(object):
+    """
+    Spaces out the calls to `wait`, shared by any number of threads, so that at most `rate`
+    calls start every second. A falsy `rate` means no limit.
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 1 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next_at = 0
+
+    def wait(self):
+        if not self.interval:
+            return
+
+        with self._lock:
+            now = time.time()
+            starts_at = max(self._next_at, now)
+            self._next_at = starts_at + self.interval
+
+        if starts_at > now:
+            time.sleep(starts_at - now)
+
+
+class TransactionExecutionStats(object):
+    def __init__(self, payment_processor):
+        self.payment_processor = payment_processor
+        self.succeeded = 0
+        self.failed = 0
+        self.errors = 0
+        # The transactions executed by someone else in the meantime
+        self.skipped = 0
+        self.latencies = []
+        self.started_at = time.time()
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def observe(self, latency, succeeded=False, error=False):
+        with self._lock:
+            if error:
+                self.errors += 1
+            elif succeeded:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+
+            self.latencies.append(latency)
+
+    def skip(self):
+        with self._lock:
+            self.skipped += 1
+
+    def finish(self):
+        self.finished_at = time.time()
+
+    @property
+    def transactions(self):
+        return self.succeeded + self.failed + self.errors
+
+    @property
+    def elapsed(self):
+        return (self.finished_at or time.time()) - self.started_at
+
+    @property
+    def throughput(self):
+        """
+        :returns: the number of transactions executed per second.
+        """
+
+        return self.transactions / self.elapsed if self.elapsed else 0
+
+    def percentile(self, percent):
+        if not self.latencies:
+            return None
+
+        latencies = sorted(self.latencies)
+        index = min(int(len(latencies) * percent / 100), len(latencies) - 1)
+
+        return latencies[index]
+
+    def report(self):
+        return OrderedDict([
+            ('payment_processor', self.payment_processor),
+            ('transactions', self.transactions),
+            ('succeeded', self.succeeded),
+            ('failed', self.failed),
+            ('errors', self.errors),
+            ('skipped', self.skipped),
+            ('elapsed', self.elapsed),
+            ('throughput', self.throughput),
+            ('latency_p50', self.percentile(50)),
+            ('latency_p95', self.percentile(95)),
+        ])
+
+
+class TransactionExecutionEngine(object):
+    """
+    Executes the initial transactions of the triggered payment processors.
+
+    The transactions are handled in batches, each batch being loaded in a single query and split
+    per payment processor. The gateway calls of a processor are made by up to `concurrency`
+    threads, at most `rate_limit` calls being started every second. Both can be set per payment
+    processor, through the `execution` dict of its `PAYMENT_PROCESSORS` entry:
+
+        'braintree_triggered': {
+            'class': 'silver_braintree.payment_processors.BraintreeTriggered',
+            'setup_data': {...},
+            'execution': {'concurrency': 8, 'rate_limit': 20}
+        }
+
+    The processors are the process-wide instances, which reuse their HTTP connections across
+    the transactions (see `http_session`).
+
+    The worker threads use their own database connections and HTTP sessions, closed once they
+    are done, so every executed transaction is committed separately, as before.
+
+    The batches of different tasks might overlap, so every transaction is executed while holding
+    a lock on it, and only if it is still initial once the lock is acquired.
+    """
+
+    def __init__(self, batch_size=None, concurrency=None, rate_limit=None):
+        self.batch_size = batch_size or TRANSACTION_EXECUTION_BATCH_SIZE
+        self.concurrency = concurrency
+        self.rate_limit = rate_limit
+        self._rate_limiters = {}
+
+    def _execution_setting(self, processor_name, setting, default):
+        execution = settings.PAYMENT_PROCESSORS.get(processor_name, {}).get('execution', {})
+
+        return execution.get(setting, default)
+
+    def get_concurrency(self, processor_name):
+        if self.concurrency:
+            return self.concurrency
+
+        return self._execution_setting(processor_name, 'concurrency',
+                                       TRANSACTION_EXECUTION_CONCURRENCY)
+
+    def get_rate_limiter(self, processor_name):
+        if processor_name not in self._rate_limiters:
+            rate_limit = self.rate_limit or self._execution_setting(
+                processor_name, 'rate_limit', TRANSACTION_EXECUTION_RATE_LIMIT
+            )
+            self._rate_limiters[processor_name] = RateLimiter(rate_limit)
+
+        return self._rate_limiters[processor_name]
+
+    def get_payment_processor(self, processor_name):
+        return payment_processors.get_instance(processor_name)
+
+    def get_triggered_processor_names(self):
+        return [
+            processor_name for processor_name in settings.PAYMENT_PROCESSORS
+            if (self.get_payment_processor(processor_name).type ==
+                payment_processors.Types.Triggered)
+        ]
+
+    def get_executable_transactions(self, transaction_ids=None):
+        transactions = Transaction.objects.filter(
+            state=Transaction.States.Initial,
+            payment_method__verified=True,
+            payment_method__canceled=False,
+            payment_method__payment_processor__in=self.get_triggered_processor_names()
+        )
+
+        if transaction_ids:
+            transactions = transactions.filter(pk__in=transaction_ids)
+
+        return transactions
+
+    def iter_executable_transaction_ids(self, transaction_ids=None):
+        """
+        :returns: an iterator of the executable transactions' ids, read in chunks.
+        """
+
+        return self.get_executable_transactions(transaction_ids).order_by('pk').values_list(
+            'pk', flat=True
+        ).iterator()
+
+    def _execute_transaction(self, processor, transaction, stats):
+        lock = redis.lock(TRANSACTION_EXECUTION_LOCK_KEY.format(transaction_id=transaction.pk),
+                          timeout=TRANSACTION_EXECUTION_LOCK_TIMEOUT)
+        if not lock.acquire(blocking=False):
+            stats.skip()
+            return
+
+        try:
+            # The transaction might have been executed since the batch was loaded
+            transaction.refresh_from_db(fields=['state'])
+            if transaction.state != Transaction.States.Initial:
+                stats.skip()
+                return
+
+            self.get_rate_limiter(processor.name).wait()
+
+            started_at = time.time()
+            try:
+                succeeded = processor.process_transaction(transaction)
+            except Exception:
+                stats.observe(time.time() - started_at, error=True)
+                logger.exception('Encountered exception while executing transaction with '
+                                 'id=%s.', transaction.pk)
+                return
+
+            stats.observe(time.time() - started_at, succeeded=bool(succeeded))
+        finally:
+            try:
+                lock.release()
+            except LockError:
+                pass
+
+    def _work(self, processor, transactions, stats):
+        try:
+            while True:
+                try:
+                    transaction = transactions.get_nowait()
+                except queue.Empty:
+                    return
+
+                self._execute_transaction(processor, transaction, stats)
+        finally:
+            # The connections opened by this thread
+            connections.close_all()
+            if hasattr(processor, 'close_http_session'):
+                processor.close_http_session()
+
+    def _execute_for_processor(self, processor, transactions):
+        stats = TransactionExecutionStats(processor.name)
+
+        concurrency = min(self.get_concurrency(processor.name), len(transactions))
+        if concurrency <= 1:
+            for transaction in transactions:
+                self._execute_transaction(processor, transaction, stats)
+        else:
+            pending_transactions = queue.Queue()
+            for transaction in transactions:
+                pending_transactions.put(transaction)
+
+            workers = [
+                threading.Thread(target=self._work,
+                                 args=(processor, pending_transactions, stats))
+                for _ in range(concurrency)
+            ]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+        stats.finish()
+        logger.info('Executed transactions batch: %s', stats.report())
+
+        return stats
+
+    def execute_batch(self, transaction_ids):
+        """
+        Executes the given transactions, if they are still executable.
+
+        :returns: the execution stats, per payment processor.
+        """
+
+        transactions = self.get_executable_transactions(transaction_ids).select_related(
+            'payment_method'
+        ).order_by('pk')
+
+        transactions_per_processor = OrderedDict()
+        for transaction in transactions:
+            transactions_per_processor.setdefault(
+                transaction.payment_method.payment_processor, []
+            ).append(transaction)
+
+        return [
+            self._execute_for_processor(self.get_payment_processor(processor_name),
+                                        processor_transactions)
+            for processor_name, processor_transactions in transactions_per_processor.items()
+        ]
+
+    def execute(self, transaction_ids=None):
+        """
+        Executes the executable transactions (or only those of them with the given ids), batch
+        by batch.
+
+        :returns: the execution stats, per batch and payment processor.
+        """
+
+        stats = []
+        for batch in batches(self.iter_executable_transaction_ids(transaction_ids),
+                             self.batch_size):
+            stats.extend(self.execute_batch(batch))
+
+        return stats
@@ -1,17 +1,19 @@
 from __future__ import absolute_import
 
 import datetime as dt
-from datetime import timedelta
 
 import logging
 
 from decimal import Decimal
 from itertools import chain
 
-from django.utils import timezone
-from django.db.models import Q
 from django.apps import apps
+from django.core.exceptions import ValidationError
+from django.db import transaction as db_transaction
+from django.db.models import Q
+from django.utils import timezone
 
+from silver.instrumentation import instrumented
 from silver.models import (Customer, DocumentEntry, Subscription,
                            Proforma, Invoice, Provider, BillingLog)
 from silver.utils.dates import ONE_DAY
@@ -22,48 +24,42 @@ logger = logging.getLogger(__name__)
 
 class TransactionRetryAttempter(object):
 
-    def _query_payment_failures(self):
-        Doc         = apps.get_model('silver.BillingDocumentBase')
-        Invoice     = apps.get_model('silver.Invoice')
-        Proforma    = apps.get_model('silver.Proforma')
-        Transaction = apps.get_model('silver.Transaction')
-
-        # The query will be the result of an exclusion, to make most use
-        # of Field lookups. So, we want to exclude successful
-        # transaction states.
-        # 
-        trx_successful_states = [
-            # - Transaction.States.Failed,
-            Transaction.States.Initial,
-            Transaction.States.Pending,
-            Transaction.States.Settled,
-            Transaction.States.Canceled,
-            Transaction.States.Refunded,
-        ]
-
-        doc_successful_states = [
-            # - Doc.STATES.ISSUED,
-            Doc.STATES.DRAFT,
-            Doc.STATES.PAID,
-            Doc.STATES.CANCELED,
-        ]
+    def _query_due_retries(self, billing_date, force=False):
+        """ Return the failed transactions whose issued invoices are due
+        for a new payment attempt at `billing_date`, the most recent
+        first for each invoice.
 
-        payment_failures = Q(state__in=doc_successful_states)
-
-        inv_transactions = \
-            Q(invoice_transactions__state__in=trx_successful_states)
+        The retry window of a transaction is set when it fails (see
+        `Transaction.schedule_retry`), so this is a range query over
+        the indexed `next_retry_at`.
+        """
 
-        pro_transactions = \
-            Q(proforma_transactions__state__in=trx_successful_states)
+        Doc         = apps.get_model('silver.BillingDocumentBase')
+        Transaction = apps.get_model('silver.Transaction')
 
-        inv = Invoice.objects.exclude(payment_failures & inv_transactions)
+        transactions = Transaction.objects.filter(
+            state=Transaction.States.Failed,
+            next_retry_at__isnull=False,
+            invoice__state=Doc.STATES.ISSUED,
+        )
+
+        if not force:
+            transactions = transactions.filter(
+                Q(retry_deadline__isnull=True) |
+                Q(retry_deadline__gte=billing_date),
+                next_retry_at__lte=billing_date,
+            )
 
-        # NB: excluding proformas from this flow for now.
-        # pro = Proforma.objects.exclude(payment_failures & pro_transactions)
-        # chain(inv, pro)
+        # Don't issue a new transaction while another one is in progress
+        in_progress_states = [Transaction.States.Initial,
+                              Transaction.States.Pending]
 
-        return inv
+        return transactions.exclude(
+            invoice__invoice_transactions__state__in=in_progress_states
+        ).select_related('payment_method', 'invoice')\
+         .order_by('invoice_id', '-created_at')
 
+    @instrumented('transaction_retries.check')
     def check(self, document=None, documents=None, billing_date=None, force=None):
         """ The `public` method called when one wants to check unpaid
         billing docs for failed attempts, and then retry them based on
@@ -78,165 +74,59 @@ class TransactionRetryAttempter(object):
         :note
             If `document` is passed, only that document will be checked,
             use `documents` to specify a batch. Default behavior is to
-            query and check all existing documents.
+            check all existing documents.
         """
 
         billing_date = billing_date or timezone.now()
 
-        if not document:
-            if not documents:
-                documents = self._query_payment_failures()
-
-            self._check_all(documents=documents,
-                            billing_date=billing_date, force=force)
-        else:
-            self._check_for_single_document(document=document,
-                                            billing_date=billing_date,
-                                            force=force)
+        transactions = self._query_due_retries(billing_date, force=force)
+        if document:
+            transactions = transactions.filter(invoice=document)
+        elif documents is not None:
+            transactions = transactions.filter(invoice__in=documents)
 
-    def _check_all(self, documents, billing_date, force):
-        """ Issue new transactions for all documents.
-        """
-        if billing_date:
-            assert type(billing_date) == type(timezone.now())
+        retried_invoice_ids = set()
+        for transaction in transactions:
+            if transaction.invoice_id in retried_invoice_ids:
+                continue
+            retried_invoice_ids.add(transaction.invoice_id)
 
-        for document in documents:
-            self._check_for_single_document(
-                document, billing_date, force
-            )
+            self._retry(transaction)
 
     def _log_document(self, document, transaction):
         msg = 'Retrying document with failed transaction, and retry attempts: %s'
         logger.debug(msg, {
-            'document': transaction,
+            'document': document,
             'transaction': transaction,
         })
 
-    def _get_last_failed_for_doc(self, document):
-        """ Return the last failed transaction for a document.
+    def _retry(self, failed_transaction):
+        """ Issue a new transaction for the document of a failed one,
+        with the same payment method. The failed transactions of the
+        document are not retried again afterwards.
         """
 
         Transaction = apps.get_model('silver.Transaction')
 
-        # The query will be the result of an exclusion, to make most use
-        # of Field lookups. So, we want to exclude successful
-        # transaction states.
-        # 
-        trx_successful_states = [
-            # - Transaction.States.Failed,
-            Transaction.States.Initial,
-            Transaction.States.Pending,
-            Transaction.States.Settled,
-            Transaction.States.Canceled,
-            Transaction.States.Refunded,
-        ]
-
-        transaction = document.transactions\
-                .exclude(state__in=trx_successful_states)\
-                .order_by('updated_at')\
-                .first()
-
-        return transaction
-
-    def _can_make_payment_attempts(self, document, billing_date,
-                                   force=None, transaction=None):
-        """ Check that we can make new payment attempts for the
-        document.
-
-        :returns Boolean:
-        """
-
-        Transaction = apps.get_model('silver.Transaction')
-
-        # Option to skip the query again if we just ran it.
-        if transaction is None:
-            transaction  = self._get_last_failed_for_doc(document)
-
-        # If it's still none, then that means there's no last failed
-        # transaction.
-        # 
-        if transaction is None:
-            return False
-
-        # Check to see if there's already another initial or pending
-        # transaction for the document. If there is, then don't issue a
-        # new one.
-        # 
-        has_initial = \
-            document.transactions \
-                .filter(state__in=[Transaction.States.Initial,
-                                   Transaction.States.Pending])\
-                .count()
-
-        if has_initial:
-            return False
-
-        # Check to see if the payment method allows for issuing
-        # re-attempts. If nothing is defined, no reattempts will be
-        # made.
-        # 
-        payment_method = transaction.payment_method
-        if not payment_method.data.get('attempt_retries_after') and \
-           not payment_method.data.get('stop_retry_attempts'):
-            return False
-
-        if force:
-            return True
-
-        # Prepare the time comparisons.
-        # 
-        _attempt_retries_after = payment_method.data.get('attempt_retries_after')
-        _stop_retry_attempts   = payment_method.data.get('stop_retry_attempts')
-
-        attempt_retries_after = timedelta(days=_attempt_retries_after)
-        stop_retry_attempts   = timedelta(days=_stop_retry_attempts)
-
-        trx_allow_retries   = transaction.created_at + attempt_retries_after
-        trx_no_more_retries = transaction.created_at + stop_retry_attempts
-
-        can_make_attempts = trx_allow_retries <= billing_date and \
-                            billing_date      <= trx_no_more_retries
-
-        return can_make_attempts
-
-    def _check_for_single_document(self, document, billing_date, force):
-        """ For a single document that has no successful payments, issue
-        a new transaction.
-        """
-        from datetime import timedelta
-
-        def create_transaction_for_document(doc, method):
-            """ Create transactions for documents, for the payment
-            methods that allow it.
-            """
-            # get a usable, recurring payment_method for the customer
-            PaymentMethod = apps.get_model('silver.PaymentMethod')
-            Transaction = apps.get_model('silver.Transaction')
-
-            if method.verified and not method.canceled:
-                try:
-                    return Transaction.objects.create(document=doc,
-                                                      payment_method=method)
-                except ValidationError:
-                    pass
-
-            return None
-
-        transaction = self._get_last_failed_for_doc(document)
-        if transaction is None:
+        payment_method = failed_transaction.payment_method
+        if not payment_method.verified or payment_method.canceled:
             return None
 
-        if not self._can_make_payment_attempts(document,
-                                               billing_date,
-                                               force=force,
-                                               transaction=transaction):
+        document = failed_transaction.invoice
+        try:
+            with db_transaction.atomic():
+                transaction = Transaction.objects.create(
+                    invoice=document, payment_method=payment_method
+                )
+
+                Transaction.objects.filter(
+                    invoice=document, state=Transaction.States.Failed
+                ).update(next_retry_at=None)
+        except ValidationError:
+            logger.exception('Could not retry the failed transaction with '
+                             'id=%s.', failed_transaction.pk)
             return None
 
-        payment_method = transaction.payment_method
-        updated        = create_transaction_for_document(document,
-                                                         payment_method)
-        updated.save()
-
-        self._log_document(document, updated)
-
+        self._log_document(document, transaction)
 
+        return transaction
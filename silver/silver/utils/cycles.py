@@ -0,0 +1,118 @@
+# Copyright (c) 2019 Presslabs SRL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import threading
+
+from bisect import bisect_right
+
+from dateutil import rrule
+
+from django.conf import settings
+
+
+CYCLE_SCHEDULES_CACHE_SIZE = getattr(settings, 'CYCLE_SCHEDULES_CACHE_SIZE',
+                                     10000)  # default 10000 schedules
+
+
+class CycleSchedule(object):
+    """
+    The start dates of the cycles recurring every `interval_count` intervals of the given
+    `rrule` type, starting from `dtstart`.
+
+    The dates are generated lazily and kept sorted, so they are only expanded once and the cycle
+    containing a given date is found with a binary search.
+    """
+
+    def __init__(self, interval_type, interval_count, dtstart):
+        self._occurrences = iter(
+            rrule.rrule(interval_type, dtstart=dtstart, interval=interval_count)
+        )
+        self._dates = []
+        self._exhausted = False
+        self._lock = threading.Lock()
+
+    def _expand_past(self, date):
+        with self._lock:
+            while not self._exhausted and (not self._dates or self._dates[-1] <= date):
+                try:
+                    self._dates.append(next(self._occurrences).date())
+                except StopIteration:
+                    self._exhausted = True
+
+    def last_start_date(self, date):
+        """
+        :returns: the start date of the cycle containing `date` (the last start date before or
+            on `date`), or None if `date` is before the first cycle.
+        """
+
+        if not self._dates or self._dates[-1] <= date:
+            self._expand_past(date)
+
+        index = bisect_right(self._dates, date)
+
+        return self._dates[index - 1] if index else None
+
+
+_schedules = {}
+_aligned_dates = {}
+
+
+def _cached(cache, key, compute):
+    try:
+        return cache[key]
+    except KeyError:
+        pass
+
+    if len(cache) >= CYCLE_SCHEDULES_CACHE_SIZE:
+        cache.clear()
+
+    value = cache[key] = compute()
+    return value
+
+
+def cycle_schedule(interval_type, interval_count, dtstart):
+    """
+    :returns: the shared `CycleSchedule` for the given rules.
+    """
+
+    return _cached(_schedules, (interval_type, interval_count, dtstart),
+                   lambda: CycleSchedule(interval_type, interval_count, dtstart))
+
+
+def first_aligned_date(reference_date, interval_type, bymonth=None, byweekday=None,
+                       bymonthday=None):
+    """
+    :returns: the first date, on or after `reference_date`, matching the given rules.
+    """
+
+    def compute():
+        return next(iter(
+            rrule.rrule(interval_type,
+                        count=1,  # align the cycle to the given rules as quickly as possible
+                        bymonth=bymonth,
+                        bymonthday=bymonthday,
+                        byweekday=byweekday,
+                        dtstart=reference_date)
+        )).date()
+
+    return _cached(_aligned_dates,
+                   (reference_date, interval_type, bymonth, byweekday, bymonthday),
+                   compute)
+
+
+def clear_cycle_caches():
+    _schedules.clear()
+    _aligned_dates.clear()
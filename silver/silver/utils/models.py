@@ -14,6 +14,8 @@
 
 from __future__ import absolute_import
 
+from decimal import Decimal
+
 from django.db import models
 from django.utils import timezone
 
@@ -25,3 +27,117 @@ class UnsavedForeignKey(models.ForeignKey):
 class AutoDateTimeField(models.DateTimeField):
     def pre_save(self, model_instance, add):
         return timezone.now()
+
+
+class OriginalValuesMixin(object):
+    """
+    Keeps the values of the `_TRACKED_FIELDS` (attribute names) as they were loaded from or last
+    saved to the database, so the changes made to them can be checked without fetching the
+    instance again.
+    """
+
+    _TRACKED_FIELDS = ()
+    _original_values = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(OriginalValuesMixin, cls).from_db(db, field_names, values)
+        instance.track_original_values()
+
+        return instance
+
+    def _tracked_attnames(self, field_names):
+        attnames = set(self._meta.get_field(field_name).attname for field_name in field_names)
+
+        return [field for field in self._TRACKED_FIELDS if field in attnames]
+
+    def track_original_values(self, fields=None):
+        # Deferred fields are missing from __dict__, they are fetched when needed
+        fields = self._TRACKED_FIELDS if fields is None else fields
+        values = {field: self.__dict__[field] for field in fields if field in self.__dict__}
+
+        if fields is self._TRACKED_FIELDS or self._original_values is None:
+            self._original_values = values
+        else:
+            self._original_values.update(values)
+
+    @property
+    def original_values(self):
+        """
+        The tracked values as stored in the database, or None if the instance wasn't saved yet.
+        Only the instances which weren't loaded from the database are fetched again.
+        """
+
+        if self.pk is None:
+            return None
+
+        original_values = self._original_values or {}
+        missing = [field for field in self._TRACKED_FIELDS if field not in original_values]
+
+        if missing:
+            values = self.__class__._base_manager.filter(pk=self.pk).values(*missing).first()
+            if values is None:
+                return None
+
+            self._original_values = dict(original_values, **values)
+
+        return self._original_values
+
+    def refresh_from_db(self, using=None, fields=None):
+        super(OriginalValuesMixin, self).refresh_from_db(using=using, fields=fields)
+
+        self.track_original_values(self._tracked_attnames(fields) if fields else None)
+
+    def save(self, *args, **kwargs):
+        super(OriginalValuesMixin, self).save(*args, **kwargs)
+
+        update_fields = kwargs.get('update_fields')
+        self.track_original_values(self._tracked_attnames(update_fields)
+                                   if update_fields else None)
+
+
+class BulkCreateAccumulator(object):
+    """
+    Collects unsaved instances of a model and inserts them with `bulk_create`.
+
+    The decimal values are quantized the same way the database would store them, so the
+    in-memory instances can be used for computing totals without reading the rows back.
+    """
+
+    def __init__(self, model, batch_size=None):
+        self.model = model
+        self.batch_size = batch_size
+        self.instances = []
+
+        self._decimal_fields = [field for field in model._meta.concrete_fields
+                                if isinstance(field, models.DecimalField)]
+
+    def add(self, **kwargs):
+        instance = self.model(**kwargs)
+
+        for field in self._decimal_fields:
+            value = getattr(instance, field.attname)
+            if isinstance(value, Decimal):
+                setattr(instance, field.attname,
+                        value.quantize(Decimal(1).scaleb(-field.decimal_places)))
+
+        self.instances.append(instance)
+
+        return instance
+
+    def flush(self):
+        """
+        Inserts the collected instances.
+
+        :returns: the list of inserted instances.
+        """
+
+        instances, self.instances = self.instances, []
+
+        if instances:
+            self.model.objects.bulk_create(instances, batch_size=self.batch_size)
+
+        return instances
+
+    def __len__(self):
+        return len(self.instances)
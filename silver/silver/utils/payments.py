@@ -20,6 +20,7 @@ import six.moves.urllib.parse
 import six.moves.urllib.error
 
 from datetime import datetime
+from cryptography.fernet import Fernet
 from furl import furl
 
 from django.conf import settings
@@ -28,6 +29,23 @@ from django.utils.encoding import force_text
 from rest_framework.reverse import reverse
 
 
+_fernets = {}
+
+
+def get_fernet(key=None):
+    """
+    Returns the `Fernet` of the key (`PAYMENT_METHOD_SECRET` by default), created once per key.
+    """
+
+    key = key or settings.PAYMENT_METHOD_SECRET
+
+    fernet = _fernets.get(key)
+    if fernet is None:
+        fernet = _fernets[key] = Fernet(key)
+
+    return fernet
+
+
 def _get_jwt_token(transaction):
     valid_until = datetime.utcnow() + settings.SILVER_PAYMENT_TOKEN_EXPIRATION
     data = {'transaction': force_text(transaction.uuid), 'exp': valid_until}